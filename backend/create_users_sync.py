@@ -2,13 +2,13 @@
 """
 Create test users for all roles using synchronous pymongo
 """
-from pymongo import MongoClient
 import bcrypt
 import uuid
 import sys
 
-# MongoDB connection
-MONGO_URL = "mongodb://localhost:27017"
+from utils.database import get_sync_client
+
+# MongoDB connection (MONGO_URL and pool settings come from utils.database)
 DATABASE_NAME = "glass_admin_database"
 
 def hash_password(password: str) -> str:
@@ -41,7 +41,7 @@ def create_user(collection, email: str, password: str, name: str, role: str):
 def main():
     try:
         # Connect to MongoDB
-        client = MongoClient(MONGO_URL)
+        client = get_sync_client()
         db = client[DATABASE_NAME]
         users_collection = db.users
         
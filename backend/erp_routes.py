@@ -46,6 +46,7 @@ from routers.vendor import vendor_router
 from routers.alerts import alerts_router
 from routers.ledger import ledger_router
 from routers.customer_master import customer_master_router
+from routers.furnace import furnace_router
 from routers.glass_configurator import router as glass_config_router
 
 def init_erp_routes(database, auth_dependency):
@@ -89,4 +90,5 @@ def init_erp_routes(database, auth_dependency):
     erp_router.include_router(alerts_router)
     erp_router.include_router(ledger_router)
     erp_router.include_router(customer_master_router)
+    erp_router.include_router(furnace_router)
     erp_router.include_router(glass_config_router)
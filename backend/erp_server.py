@@ -3,7 +3,6 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
@@ -28,9 +27,10 @@ import pandas as pd
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+from utils.database import get_database
+
+# Shares the process-wide client with server.py (this router is mounted into the same app)
+db = get_database()
 
 app = FastAPI(title="Lucumaa Glass Factory ERP")
 erp_router = APIRouter(prefix="/api/erp")
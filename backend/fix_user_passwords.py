@@ -9,10 +9,11 @@ This script will:
 import asyncio
 import bcrypt
 import uuid
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from dotenv import load_dotenv
 
+from utils.database import get_client
+
 load_dotenv()
 
 async def fix_users():
@@ -20,7 +21,7 @@ async def fix_users():
     db_name = os.environ.get('DB_NAME', 'lucumaa')
     
     print(f"🔗 Connecting to MongoDB at {mongo_url}...")
-    client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=5000)
+    client = get_client()
     db = client[db_name]
     
     try:
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Script to backfill / repair the precomputed daily cash balances (cash_daily_balances)
+Usage: python rebuild_cash_balances.py [FROM_DATE]   (YYYY-MM-DD, default: all history)
+"""
+import asyncio
+import sys
+import os
+from dotenv import load_dotenv
+
+from utils.database import get_client
+from utils.cash_balances import ensure_cash_balance_indexes, rebuild_cash_daily_balances
+
+load_dotenv()
+
+async def rebuild(from_date=None):
+    mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+    db_name = os.environ.get('DB_NAME', 'lucumaa')
+
+    print(f"Connecting to MongoDB at {mongo_url}...")
+    client = get_client()
+    db = client[db_name]
+
+    try:
+        await client.admin.command('ping')
+        print("✓ Connected to MongoDB")
+    except Exception as e:
+        print(f"✗ Failed to connect to MongoDB: {e}")
+        return False
+
+    await ensure_cash_balance_indexes(db)
+    result = await rebuild_cash_daily_balances(db, from_date)
+    print(f"✓ Rebuilt {result['rows']} daily balance rows across {result['scopes']} scopes"
+          f" from {from_date or 'the first transaction'}")
+
+    return True
+
+if __name__ == "__main__":
+    success = asyncio.run(rebuild(sys.argv[1] if len(sys.argv) > 1 else None))
+    exit(0 if success else 1)
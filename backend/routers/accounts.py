@@ -5,12 +5,16 @@ With Auto-posting to Party Ledger & GL
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
 from fastapi.responses import StreamingResponse
 from typing import Optional, Dict, Any
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import uuid
 import io
 from .base import get_erp_user, get_db
 from .notifications import notify_new_invoice, notify_payment_received
 from .ledger import auto_post_to_ledger
+from utils.inventory_valuation import get_stock_valuation
+from utils.pnl_engine import get_pnl_figures, profit_loss_statement, month_range
+from utils.period_close import gst_totals
+from utils.gst_returns import record_invoice, record_invoice_payment, return_summary
 
 accounts_router = APIRouter(prefix="/accounts", tags=["Accounts"])
 
@@ -49,6 +53,7 @@ async def create_invoice(
         "customer_name": invoice_data.get("customer_name"),
         "customer_gst": invoice_data.get("customer_gst", ""),
         "customer_address": invoice_data.get("customer_address", ""),
+        "place_of_supply": invoice_data.get("place_of_supply", ""),
         "order_id": invoice_data.get("order_id", ""),
         "items": items,
         "subtotal": round(subtotal, 2),
@@ -67,6 +72,12 @@ async def create_invoice(
     
     await db.invoices.insert_one(invoice)
     
+    # GSTR-1 / GSTR-3B aggregates (a missed invoice is picked up when its return is built)
+    try:
+        await record_invoice(db, invoice)
+    except Exception as e:
+        print(f"[ACCOUNTS] GST return update failed: {e}")
+    
     # AUTO-POST TO PARTY LEDGER & GL
     # Sales Invoice → Debit Accounts Receivable, Credit Sales + GST
     try:
@@ -193,6 +204,11 @@ async def record_payment(
         }}
     )
     
+    try:
+        await record_invoice_payment(db, invoice, amount)
+    except Exception as e:
+        print(f"[ACCOUNTS] GST return payment update failed: {e}")
+    
     # AUTO-POST TO PARTY LEDGER & GL
     # Payment Received → Debit Cash/Bank, Credit Accounts Receivable
     try:
@@ -315,24 +331,16 @@ async def get_gst_report(
 ):
     """Get GST report for a month"""
     db = get_db()
-    # Sales invoices for the month
-    invoices = await db.invoices.find(
-        {"created_at": {"$regex": f"^{month}"}},
-        {"_id": 0}
-    ).to_list(1000)
+    # Frozen months come from the period close, open months are aggregated live
+    start_date, end_date = month_range(month)
+    totals = await gst_totals(db, start_date, end_date)
     
-    total_taxable = sum(inv["subtotal"] for inv in invoices)
-    total_cgst = sum(inv.get("cgst", 0) for inv in invoices)
-    total_sgst = sum(inv.get("sgst", 0) for inv in invoices)
-    total_igst = sum(inv.get("igst", 0) for inv in invoices)
-    
-    # Purchase orders for input credit
-    pos = await db.purchase_orders.find(
-        {"created_at": {"$regex": f"^{month}"}, "status": "received"},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    input_gst = sum(po.get("gst", 0) for po in pos)
+    total_taxable = totals["taxable"]
+    total_cgst = totals["cgst"]
+    total_sgst = totals["sgst"]
+    total_igst = totals["igst"]
+    input_gst = totals["input_gst"]
+    split = await return_summary(db, month)
     
     return {
         "month": month,
@@ -343,10 +351,11 @@ async def get_gst_report(
             "igst": round(total_igst, 2),
             "total": round(total_cgst + total_sgst + total_igst, 2)
         },
+        "supply_split": {"b2b": split["b2b_taxable"], "b2c": split["b2c_taxable"]},
         "input_gst": round(input_gst, 2),
         "net_gst_liability": round((total_cgst + total_sgst + total_igst) - input_gst, 2),
-        "invoice_count": len(invoices),
-        "purchase_count": len(pos)
+        "invoice_count": totals["invoice_count"],
+        "purchase_count": totals["purchase_count"]
     }
 
 
@@ -356,93 +365,16 @@ async def get_gst_report(
 async def get_profit_loss(
     start_date: str,
     end_date: str,
-    current_user: dict = Depends(get_erp_user)
+    current_user: dict = Depends(get_erp_user),
+    refresh: bool = False
 ):
     """Get Profit & Loss statement for date range"""
     db = get_db()
+    figures = await get_pnl_figures(db, start_date[:10], end_date[:10], refresh=refresh)
     
-    # Revenue (Sales Invoices)
-    invoices = await db.invoices.find({
-        "created_at": {"$gte": start_date, "$lte": end_date + "T23:59:59"}
-    }, {"_id": 0}).to_list(5000)
-    
-    total_revenue = sum(inv.get("subtotal", 0) for inv in invoices)
-    total_gst_collected = sum(inv.get("total_tax", 0) for inv in invoices)
-    
-    # Job Work Revenue (NEW)
-    job_work_orders = await db.job_work_orders.find({
-        "payment_status": "completed",
-        "paid_at": {"$gte": start_date, "$lte": end_date + "T23:59:59"}
-    }, {"_id": 0}).to_list(5000)
+    # Inventory valuation (latest snapshots on/before each date - FIFO / weighted average)
+    opening_date = (datetime.strptime(start_date[:10], "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+    opening_stock = (await get_stock_valuation(db, opening_date))["total_value"]
+    closing_stock = (await get_stock_valuation(db, end_date[:10]))["total_value"]
     
-    job_work_revenue = sum(jw.get("summary", {}).get("labour_charges", 0) for jw in job_work_orders)
-    job_work_gst = sum(jw.get("summary", {}).get("gst_amount", 0) for jw in job_work_orders)
-    job_work_total = sum(jw.get("paid_amount", 0) for jw in job_work_orders)
-    
-    # Cost of Goods (Purchase Orders received)
-    pos = await db.purchase_orders.find({
-        "status": "received",
-        "received_at": {"$gte": start_date, "$lte": end_date + "T23:59:59"}
-    }, {"_id": 0}).to_list(5000)
-    
-    total_purchases = sum(po.get("subtotal", 0) for po in pos)
-    total_gst_paid = sum(po.get("gst", 0) for po in pos)
-    
-    # Breakage/Wastage Costs
-    breakages = await db.breakage_entries.find({
-        "created_at": {"$gte": start_date, "$lte": end_date + "T23:59:59"}
-    }, {"_id": 0}).to_list(5000)
-    
-    total_breakage_loss = sum(b.get("total_cost", 0) for b in breakages)
-    
-    # Salary Expenses
-    salaries = await db.salary_payments.find({
-        "created_at": {"$gte": start_date, "$lte": end_date + "T23:59:59"},
-        "status": {"$in": ["approved", "paid"]}
-    }, {"_id": 0}).to_list(5000)
-    
-    total_salaries = sum(s.get("net_salary", s.get("amount", 0)) for s in salaries)
-    
-    # Calculations (including Job Work)
-    combined_revenue = total_revenue + job_work_revenue
-    combined_gst_collected = total_gst_collected + job_work_gst
-    gross_profit = combined_revenue - total_purchases
-    operating_expenses = total_breakage_loss + total_salaries
-    net_profit = gross_profit - operating_expenses
-    gst_liability = combined_gst_collected - total_gst_paid
-    
-    return {
-        "period": {"start_date": start_date, "end_date": end_date},
-        "revenue": {
-            "sales": round(total_revenue, 2),
-            "job_work": round(job_work_revenue, 2),
-            "total_sales": round(combined_revenue, 2),
-            "invoice_count": len(invoices),
-            "job_work_count": len(job_work_orders),
-            "gst_collected": round(combined_gst_collected, 2)
-        },
-        "job_work_details": {
-            "orders": len(job_work_orders),
-            "labour_revenue": round(job_work_revenue, 2),
-            "gst_collected": round(job_work_gst, 2),
-            "total_collected": round(job_work_total, 2)
-        },
-        "cost_of_goods": {
-            "total_purchases": round(total_purchases, 2),
-            "po_count": len(pos),
-            "gst_paid": round(total_gst_paid, 2)
-        },
-        "gross_profit": round(gross_profit, 2),
-        "operating_expenses": {
-            "breakage_loss": round(total_breakage_loss, 2),
-            "salaries": round(total_salaries, 2),
-            "total": round(operating_expenses, 2)
-        },
-        "net_profit": round(net_profit, 2),
-        "profit_margin": round((net_profit / combined_revenue * 100) if combined_revenue > 0 else 0, 2),
-        "gst_summary": {
-            "collected": round(combined_gst_collected, 2),
-            "paid": round(total_gst_paid, 2),
-            "net_liability": round(gst_liability, 2)
-        }
-    }
+    return profit_loss_statement(figures, opening_stock, closing_stock)
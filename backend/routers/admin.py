@@ -4,6 +4,7 @@ Admin Dashboard Router - Real-time metrics and overview
 from fastapi import APIRouter, Depends
 from datetime import datetime, timezone, timedelta
 from .base import get_erp_user, get_db
+from utils.dashboard_metrics import get_admin_dashboard_metrics, get_production_stage_counts
 
 admin_router = APIRouter(prefix="/admin", tags=["Admin"])
 
@@ -11,70 +12,7 @@ admin_router = APIRouter(prefix="/admin", tags=["Admin"])
 @admin_router.get("/dashboard")
 async def get_admin_dashboard(current_user: dict = Depends(get_erp_user)):
     """Get real-time admin dashboard metrics"""
-    db = get_db()
-    today = datetime.now(timezone.utc).date()
-    today_start = datetime.combine(today, datetime.min.time()).replace(tzinfo=timezone.utc)
-    
-    # Today's orders
-    orders_today = await db.production_orders.count_documents({
-        "created_at": {"$gte": today_start.isoformat()}
-    })
-    
-    # Production status counts
-    production_stats = {}
-    stages = ['pending', 'cutting', 'polishing', 'grinding', 'toughening', 'quality_check', 'packing', 'dispatched']
-    for stage in stages:
-        count = await db.production_orders.count_documents({"current_stage": stage})
-        production_stats[stage] = count
-    
-    # Breakage today
-    breakage_pipeline = [
-        {"$match": {"created_at": {"$gte": today_start.isoformat()}}},
-        {"$group": {"_id": None, "total_loss": {"$sum": "$total_loss"}}}
-    ]
-    breakage_result = await db.breakage_entries.aggregate(breakage_pipeline).to_list(1)
-    breakage_today = breakage_result[0]['total_loss'] if breakage_result else 0
-    
-    # Low stock
-    low_stock = await db.raw_materials.count_documents({"$expr": {"$lte": ["$current_stock", "$minimum_stock"]}})
-    
-    # Pending POs
-    pending_pos = await db.purchase_orders.count_documents({"status": "pending"})
-    
-    # Present employees
-    present_today = await db.attendance.count_documents({
-        "date": today.isoformat(),
-        "status": "present"
-    })
-    
-    # Job Work Stats
-    job_work_today = await db.job_work_orders.count_documents({
-        "created_at": {"$gte": today_start.isoformat()}
-    })
-    job_work_pending = await db.job_work_orders.count_documents({
-        "status": {"$in": ["pending", "accepted", "material_received", "in_process"]}
-    })
-    job_work_revenue_pipeline = [
-        {"$match": {"payment_status": "completed"}},
-        {"$group": {"_id": None, "total": {"$sum": "$paid_amount"}}}
-    ]
-    job_work_revenue_result = await db.job_work_orders.aggregate(job_work_revenue_pipeline).to_list(1)
-    job_work_revenue = job_work_revenue_result[0]["total"] if job_work_revenue_result else 0
-    
-    return {
-        "orders_today": orders_today,
-        "production_stats": production_stats,
-        "breakage_today": round(breakage_today, 2),
-        "low_stock_items": low_stock,
-        "pending_pos": pending_pos,
-        "present_employees": present_today,
-        # Job Work Stats
-        "job_work": {
-            "today": job_work_today,
-            "pending": job_work_pending,
-            "total_revenue": round(job_work_revenue, 2)
-        }
-    }
+    return await get_admin_dashboard_metrics(get_db())
 
 
 @admin_router.get("/charts/revenue")
@@ -138,9 +76,11 @@ async def get_production_chart_data(current_user: dict = Depends(get_erp_user)):
         {'id': 'dispatched', 'name': 'Dispatched', 'color': '#22c55e'}
     ]
     
+    stage_counts = await get_production_stage_counts(db)
+    
     chart_data = []
     for stage in stages:
-        count = await db.production_orders.count_documents({"current_stage": stage['id']})
+        count = stage_counts.get(stage['id'], 0)
         if count > 0:
             chart_data.append({
                 "name": stage['name'],
@@ -1,46 +1,21 @@
 """
 AI Demand Forecasting Router
-Analyzes order history and predicts future demand using AI
+Analyzes order history and predicts future demand with local statistical models
 """
 from fastapi import APIRouter, Depends, HTTPException
 from typing import Optional, List
 from datetime import datetime, timezone, timedelta
 from pydantic import BaseModel
 from routers.base import get_erp_user, get_db
-# from emergentintegrations.llm.chat import LlmChat, UserMessage  # Temporarily disabled
-import os
-import json
+from utils.demand_forecast import (
+    DIMENSIONS, FREQUENCIES, HISTORY_DAYS, ForecastNotReady, get_cached_forecasts, refresh_demand_forecasts
+)
 
 forecast_router = APIRouter(prefix="/forecast", tags=["AI Demand Forecasting"])
 
-FORECAST_SYSTEM_PROMPT = """You are a business analytics AI for Lucumaa Glass, a glass manufacturing company. 
-Your job is to analyze order data and provide actionable demand forecasts and insights.
-
-When given order data, analyze it and provide:
-1. Overall demand trends (growing/declining/stable)
-2. Peak periods and seasonal patterns
-3. Top-performing products
-4. Regional demand patterns if available
-5. Recommendations for inventory and production planning
-6. Predicted demand for next month
-
-Format your response as JSON with the following structure:
-{
-  "summary": "Brief executive summary",
-  "trend": "growing/declining/stable",
-  "trend_percentage": number,
-  "peak_periods": ["list of peak periods"],
-  "top_products": [{"name": "product", "demand": number}],
-  "recommendations": ["list of recommendations"],
-  "next_month_prediction": {
-    "estimated_orders": number,
-    "estimated_revenue": number,
-    "high_demand_products": ["list"]
-  },
-  "insights": ["additional insights"]
-}
-
-Be specific with numbers and percentages. Base predictions on the actual data provided."""
+TREND_THRESHOLD_PCT = 5
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+REFRESH_STARTED = "Demand models are being fitted for the first time - retry in a minute"
 
 
 class ForecastResponse(BaseModel):
@@ -56,33 +31,65 @@ class ForecastResponse(BaseModel):
     generated_at: str
 
 
+def _sum_last(points: List[dict], count: int) -> float:
+    return sum(p["value"] for p in points[-count:]) if count > 0 else 0
+
+
+def _change_pct(doc: dict, window: int) -> float:
+    """Forecast for the next `window` periods against the last `window` actuals"""
+    recent = _sum_last(doc["history"], window)
+    upcoming = _sum_last(doc["forecast"][:window], window)
+    return round((upcoming - recent) / recent * 100, 1) if recent else 0.0
+
+
 @forecast_router.get("/demand")
 async def get_demand_forecast(
     days: int = 90,
     current_user: dict = Depends(get_erp_user)
 ):
-    """Get AI-powered demand forecast based on order history"""
+    """Demand forecast from the locally fitted statistical models (refreshed nightly)"""
     if current_user.get("role") not in ["super_admin", "admin", "owner", "finance", "manager"]:
         raise HTTPException(status_code=403, detail="Access denied")
     
     db = get_db()
-    api_key = os.environ.get("EMERGENT_LLM_KEY")
-    
-    if not api_key:
-        raise HTTPException(status_code=500, detail="AI service not configured")
-    
-    # Get order data for the specified period
-    start_date = (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d")
+    days = max(7, min(days, HISTORY_DAYS))
+    try:
+        docs = await get_cached_forecasts(db, "daily")
+    except ForecastNotReady:
+        return {
+            "status": "refresh_started",
+            "summary": REFRESH_STARTED,
+            "trend": "unknown",
+            "trend_percentage": 0,
+            "peak_periods": [],
+            "top_products": [],
+            "recommendations": [],
+            "next_month_prediction": {
+                "estimated_orders": 0,
+                "estimated_revenue": 0,
+                "high_demand_products": []
+            },
+            "insights": [],
+            "data_period": {"start": None, "end": None, "order_count": 0},
+            "generated_at": datetime.now(timezone.utc).isoformat()
+        }
+    totals = {d["metric"]: d for d in docs if d["dimension"] == "total"}
+    products = [d for d in docs if d["dimension"] == "product"]
+    thicknesses = [d for d in docs if d["dimension"] == "thickness"]
     
-    orders = await db.orders.find(
-        {"created_at": {"$gte": start_date}},
-        {"_id": 0}
-    ).to_list(1000)
+    history = totals["orders"]["history"] if totals else []
+    window = history[-days:]
+    order_count = int(sum(p["value"] for p in window))
+    data_period = {
+        "start": window[0]["period"] if window else None,
+        "end": window[-1]["period"] if window else None,
+        "order_count": order_count
+    }
+    generated_at = totals["orders"]["fitted_at"] if totals else datetime.now(timezone.utc).isoformat()
     
-    if len(orders) < 5:
-        # Not enough data - return basic response
+    if order_count < 5:
         return {
-            "summary": "Insufficient data for AI forecasting. Need at least 5 orders.",
+            "summary": "Insufficient data for forecasting. Need at least 5 orders.",
             "trend": "unknown",
             "trend_percentage": 0,
             "peak_periods": [],
@@ -93,115 +100,106 @@ async def get_demand_forecast(
                 "estimated_revenue": 0,
                 "high_demand_products": []
             },
-            "insights": ["Start tracking orders to enable AI forecasting"],
-            "data_period": {"start": start_date, "end": datetime.now().strftime("%Y-%m-%d"), "order_count": len(orders)},
-            "generated_at": datetime.now(timezone.utc).isoformat()
+            "insights": ["Start tracking orders to enable forecasting"],
+            "data_period": data_period,
+            "generated_at": generated_at
         }
     
-    # Prepare order summary for AI
-    order_summary = {
-        "total_orders": len(orders),
-        "period": f"{days} days",
-        "orders_by_date": {},
-        "orders_by_product": {},
-        "total_revenue": 0,
-        "avg_order_value": 0
-    }
+    trend_pct = _change_pct(totals["sqft"], 30)
+    trend = "growing" if trend_pct > TREND_THRESHOLD_PCT else "declining" if trend_pct < -TREND_THRESHOLD_PCT else "stable"
     
-    for order in orders:
-        # By date
-        date = order.get("created_at", "")[:10]
-        if date:
-            order_summary["orders_by_date"][date] = order_summary["orders_by_date"].get(date, 0) + 1
-        
-        # By product
-        product = order.get("glass_type", order.get("product_name", "Unknown"))
-        order_summary["orders_by_product"][product] = order_summary["orders_by_product"].get(product, 0) + 1
-        
-        # Revenue
-        order_summary["total_revenue"] += order.get("total_price", 0)
+    # Peak weekdays over the requested window, peak month over the full history
+    by_weekday = [0.0] * 7
+    for point in totals["sqft"]["history"][-days:]:
+        by_weekday[datetime.strptime(point["period"], "%Y-%m-%d").weekday()] += point["value"]
+    by_month = {}
+    for point in totals["sqft"]["history"]:
+        by_month[point["period"][:7]] = by_month.get(point["period"][:7], 0) + point["value"]
+    peak_periods = [WEEKDAYS[i] for i in sorted(range(7), key=lambda i: -by_weekday[i])[:2] if by_weekday[i] > 0]
+    if by_month:
+        peak_month = max(by_month, key=by_month.get)
+        peak_periods.append(datetime.strptime(peak_month, "%Y-%m").strftime("%B %Y"))
     
-    order_summary["avg_order_value"] = order_summary["total_revenue"] / len(orders) if orders else 0
+    ranked = sorted(products, key=lambda d: -_sum_last(d["history"], days))
+    top_products = [{
+        "name": d["key"],
+        "demand": round(_sum_last(d["history"], days), 2),
+        "forecast_30d_sqft": round(_sum_last(d["forecast"], 30), 2),
+        "change_pct": _change_pct(d, 30),
+        "model": d["model"]
+    } for d in ranked[:5]]
+    high_demand = [d["key"] for d in sorted(products, key=lambda d: -_sum_last(d["forecast"], 30))[:3]]
     
-    # Call AI for analysis
-    try:
-        chat = LlmChat(
-            api_key=api_key,
-            system_message=FORECAST_SYSTEM_PROMPT
-        ).with_model("openai", "gpt-4o-mini")
-        
-        prompt = f"""Analyze this order data and provide demand forecast:
-
-Order Summary:
-- Total Orders: {order_summary['total_orders']}
-- Period: {order_summary['period']}
-- Total Revenue: ₹{order_summary['total_revenue']:,.0f}
-- Average Order Value: ₹{order_summary['avg_order_value']:,.0f}
+    recommendations = []
+    for item in top_products:
+        if item["change_pct"] > TREND_THRESHOLD_PCT:
+            recommendations.append(f"Stock up on {item['name']}: next 30 days forecast {item['forecast_30d_sqft']:,.0f} sqft ({item['change_pct']:+.0f}%)")
+        elif item["change_pct"] < -TREND_THRESHOLD_PCT:
+            recommendations.append(f"Reduce {item['name']} purchases: demand expected {item['change_pct']:+.0f}%")
+    if thicknesses:
+        leading = max(thicknesses, key=lambda d: _sum_last(d["forecast"], 30))
+        recommendations.append(f"Plan cutting and toughening capacity around {leading['key']} - highest forecast thickness")
+    if not recommendations:
+        recommendations.append("Demand is steady - keep current stock levels")
+    
+    accuracy = [1 - d["backtest_wape"][d["model"]] for d in docs if d["model"] in d["backtest_wape"]]
+    insights = [
+        f"Average {order_count / (days / 30):.1f} orders per month over the last {days} days",
+        f"{len(docs)} demand series modelled; best fit chosen by holdout backtest per series"
+    ]
+    if accuracy:
+        insights.append(f"Median backtest accuracy {sorted(accuracy)[len(accuracy) // 2] * 100:.0f}%")
+    
+    return {
+        "summary": f"Based on {order_count} orders in the last {days} days, demand is {trend} ({trend_pct:+.1f}% expected over the next 30 days)",
+        "trend": trend,
+        "trend_percentage": trend_pct,
+        "peak_periods": peak_periods,
+        "top_products": top_products,
+        "recommendations": recommendations,
+        "next_month_prediction": {
+            "estimated_orders": int(round(_sum_last(totals["orders"]["forecast"], 30))),
+            "estimated_revenue": int(round(_sum_last(totals["revenue"]["forecast"], 30))),
+            "estimated_sqft": round(_sum_last(totals["sqft"]["forecast"], 30), 2),
+            "high_demand_products": high_demand
+        },
+        "insights": insights,
+        "data_period": data_period,
+        "generated_at": generated_at
+    }
 
-Orders by Date (last 30 entries):
-{json.dumps(dict(list(order_summary['orders_by_date'].items())[-30:]), indent=2)}
 
-Orders by Product:
-{json.dumps(order_summary['orders_by_product'], indent=2)}
+@forecast_router.get("/series")
+async def get_forecast_series(
+    frequency: str = "daily",
+    dimension: Optional[str] = None,
+    key: Optional[str] = None,
+    current_user: dict = Depends(get_erp_user)
+):
+    """Cached history + forecast per series (dimension: total, product, thickness, customer_category)"""
+    if current_user.get("role") not in ["super_admin", "admin", "owner", "finance", "manager"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if frequency not in FREQUENCIES:
+        raise HTTPException(status_code=400, detail=f"frequency must be one of {list(FREQUENCIES)}")
+    if dimension and dimension not in ["total"] + DIMENSIONS:
+        raise HTTPException(status_code=400, detail="Invalid dimension")
+    
+    db = get_db()
+    try:
+        series = await get_cached_forecasts(db, frequency, dimension, key)
+    except ForecastNotReady:
+        return {"frequency": frequency, "count": 0, "series": [], "status": "refresh_started", "message": REFRESH_STARTED}
+    return {"frequency": frequency, "count": len(series), "series": series}
 
-Provide your analysis in the JSON format specified."""
 
-        response = await chat.send_message(UserMessage(text=prompt))
-        
-        # Parse JSON response
-        try:
-            # Extract JSON from response
-            json_start = response.find('{')
-            json_end = response.rfind('}') + 1
-            if json_start != -1 and json_end > json_start:
-                forecast_data = json.loads(response[json_start:json_end])
-            else:
-                raise ValueError("No JSON found")
-        except:
-            # Fallback structured response
-            forecast_data = {
-                "summary": response[:500],
-                "trend": "stable",
-                "trend_percentage": 0,
-                "peak_periods": [],
-                "top_products": [{"name": k, "demand": v} for k, v in list(order_summary["orders_by_product"].items())[:5]],
-                "recommendations": ["Review the detailed analysis above"],
-                "next_month_prediction": {
-                    "estimated_orders": int(len(orders) / (days/30)),
-                    "estimated_revenue": order_summary["total_revenue"] / (days/30),
-                    "high_demand_products": list(order_summary["orders_by_product"].keys())[:3]
-                },
-                "insights": [response[:200]]
-            }
-        
-        forecast_data["data_period"] = {
-            "start": start_date,
-            "end": datetime.now().strftime("%Y-%m-%d"),
-            "order_count": len(orders)
-        }
-        forecast_data["generated_at"] = datetime.now(timezone.utc).isoformat()
-        
-        return forecast_data
-        
-    except Exception as e:
-        print(f"AI Forecast error: {e}")
-        # Return basic statistical analysis
-        return {
-            "summary": f"Based on {len(orders)} orders in the last {days} days, total revenue is ₹{order_summary['total_revenue']:,.0f}",
-            "trend": "stable",
-            "trend_percentage": 0,
-            "peak_periods": [],
-            "top_products": [{"name": k, "demand": v} for k, v in sorted(order_summary["orders_by_product"].items(), key=lambda x: -x[1])[:5]],
-            "recommendations": ["AI analysis temporarily unavailable. Using basic statistics."],
-            "next_month_prediction": {
-                "estimated_orders": int(len(orders) / (days/30)),
-                "estimated_revenue": int(order_summary["total_revenue"] / (days/30)),
-                "high_demand_products": list(order_summary["orders_by_product"].keys())[:3]
-            },
-            "insights": [f"Average {len(orders)/(days/30):.1f} orders per month"],
-            "data_period": {"start": start_date, "end": datetime.now().strftime("%Y-%m-%d"), "order_count": len(orders)},
-            "generated_at": datetime.now(timezone.utc).isoformat()
-        }
+@forecast_router.post("/refresh")
+async def refresh_forecasts(current_user: dict = Depends(get_erp_user)):
+    """Refit all demand models now instead of waiting for the nightly run"""
+    if current_user.get("role") not in ["super_admin", "admin", "owner"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    db = get_db()
+    return await refresh_demand_forecasts(db)
 
 
 @forecast_router.get("/stats")
@@ -179,6 +179,7 @@ async def get_alert_settings(current_user: dict = Depends(get_erp_user)):
         settings = {
             "type": "payment_alerts",
             "enabled": True,
+            "cooldown_hours": 20,
             "customer_alerts": {
                 "enabled": True,
                 "days_before_due": [3, 1, 0],
@@ -6,7 +6,10 @@ Generates Daily/Monthly/Yearly reports for compliance and MIS
 from fastapi import APIRouter, Depends, HTTPException, Request
 from typing import Optional, List
 from datetime import datetime, timezone, timedelta
+from pymongo import UpdateOne
 from .base import get_erp_user, get_db
+from utils.audit_sink import audit_sink, diff_documents, write_audit
+from utils.pagination import paginate
 import uuid
 
 audit_router = APIRouter(prefix="/audit", tags=["Audit Trail & MIS"])
@@ -48,9 +51,16 @@ async def log_action(
     old_data: dict = None,
     new_data: dict = None
 ):
-    """Log an action to the audit trail"""
+    """Log an action to the audit trail (buffered through the audit sink)"""
     db = get_db()
     
+    # Updates store only the changed fields; creates/deletes keep the one snapshot they have.
+    # new_data is often just the $set payload, so only its fields are compared.
+    changes = None
+    if old_data is not None and new_data is not None:
+        changes = diff_documents({key: old_data.get(key) for key in new_data}, new_data)
+        old_data = new_data = None
+    
     log_entry = {
         "id": str(uuid.uuid4()),
         "user_id": user_id,
@@ -62,6 +72,7 @@ async def log_action(
         "details": details,
         "old_data": old_data,
         "new_data": new_data,
+        "changes": changes,
         "ip_address": ip_address,
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "date": datetime.now(timezone.utc).strftime("%Y-%m-%d"),
@@ -69,10 +80,134 @@ async def log_action(
         "year": datetime.now(timezone.utc).strftime("%Y")
     }
     
-    await db.audit_logs.insert_one(log_entry)
+    await write_audit(db, "audit_logs", log_entry)
     return log_entry
 
 
+# ============ DAILY ROLLUPS ============
+# audit_daily_stats holds one row per (date, user, module, action) with a count,
+# so MIS/yearly/performance reports never scan raw audit_logs.
+
+ROLLUP_KEY_FIELDS = ["date", "user_id", "module", "action"]
+
+
+async def ensure_audit_indexes(db):
+    """Indexes for audit logs and their daily rollups"""
+    await db.audit_daily_stats.create_index(
+        [("date", 1), ("user_id", 1), ("module", 1), ("action", 1)], unique=True
+    )
+    await db.audit_daily_stats.create_index([("month", 1), ("user_id", 1)])
+    await db.audit_daily_stats.create_index([("year", 1), ("month", 1)])
+    await db.audit_logs.create_index([("date", 1), ("timestamp", -1)])
+    await db.audit_logs.create_index([("year", 1), ("action", 1), ("timestamp", -1)])
+    # Audit sink replays dedupe on id; legacy rows without one are left out of the index
+    for collection in ["audit_logs", "glass_config_audit"]:
+        await db[collection].create_index(
+            "id", unique=True, partialFilterExpression={"id": {"$type": "string"}}
+        )
+
+
+async def apply_daily_stats_increments(db, log_entries: list):
+    """
+    Fold a batch of written audit entries into audit_daily_stats.
+    Registered as the audit sink's flush hook for audit_logs, so a batch of
+    N entries costs one bulk_write instead of N upserts.
+    """
+    increments = {}
+    for entry in log_entries:
+        if not all(entry.get(field) for field in ROLLUP_KEY_FIELDS + ["month", "year"]):
+            continue  # Entries written by other modules without the MIS fields
+        key = tuple(entry[field] for field in ROLLUP_KEY_FIELDS)
+        row = increments.setdefault(key, {
+            "count": 0,
+            "month": entry["month"],
+            "year": entry["year"],
+            "user_name": entry.get("user_name"),
+            "user_role": entry.get("user_role"),
+            "first_at": entry["timestamp"],
+            "last_at": entry["timestamp"]
+        })
+        row["count"] += 1
+        row["first_at"] = min(row["first_at"], entry["timestamp"])
+        row["last_at"] = max(row["last_at"], entry["timestamp"])
+    
+    if not increments:
+        return
+    
+    ops = [
+        UpdateOne(
+            dict(zip(ROLLUP_KEY_FIELDS, key)),
+            {
+                "$inc": {"count": row["count"]},
+                "$set": {
+                    "month": row["month"],
+                    "year": row["year"],
+                    "user_name": row["user_name"],
+                    "user_role": row["user_role"]
+                },
+                "$min": {"first_at": row["first_at"]},
+                "$max": {"last_at": row["last_at"]}
+            },
+            upsert=True
+        )
+        for key, row in increments.items()
+    ]
+    # A failure here self-heals: the nightly compaction rebuilds rollups from raw logs
+    await db.audit_daily_stats.bulk_write(ops, ordered=False)
+
+
+audit_sink.register_flush_hook("audit_logs", apply_daily_stats_increments)
+
+
+async def rebuild_audit_daily_stats(db, start_date: str, end_date: str) -> dict:
+    """
+    Recompute audit_daily_stats for a date range (YYYY-MM-DD, inclusive) from raw audit_logs.
+    Used by the nightly compaction job and for backfilling existing data.
+    Rows are replaced in place by $merge, so readers never see the range empty.
+    """
+    date_filter = {"$gte": start_date, "$lte": end_date}
+    
+    await db.audit_logs.aggregate([
+        {"$match": {"date": date_filter, "user_id": {"$ne": None}, "action": {"$ne": None}}},
+        {"$group": {
+            "_id": {"date": "$date", "user_id": "$user_id", "module": "$module", "action": "$action"},
+            "count": {"$sum": 1},
+            "user_name": {"$last": "$user_name"},
+            "user_role": {"$last": "$user_role"},
+            "first_at": {"$min": "$timestamp"},
+            "last_at": {"$max": "$timestamp"}
+        }},
+        {"$project": {
+            "_id": 0,
+            "date": "$_id.date",
+            "user_id": "$_id.user_id",
+            "module": "$_id.module",
+            "action": "$_id.action",
+            "month": {"$substrBytes": ["$_id.date", 0, 7]},
+            "year": {"$substrBytes": ["$_id.date", 0, 4]},
+            "count": 1,
+            "user_name": 1,
+            "user_role": 1,
+            "first_at": 1,
+            "last_at": 1
+        }},
+        {"$merge": {
+            "into": "audit_daily_stats",
+            "on": ROLLUP_KEY_FIELDS,
+            "whenMatched": "replace",
+            "whenNotMatched": "insert"
+        }}
+    ]).to_list(None)
+    
+    rows = await db.audit_daily_stats.count_documents({"date": date_filter})
+    return {"start_date": start_date, "end_date": end_date, "rollup_rows": rows}
+
+
+def _count_if(action: str) -> dict:
+    """$sum of rollup counts for one action type"""
+    return {"$sum": {"$cond": [{"$eq": ["$action", action]}, "$count", 0]}}
+
+
 @audit_router.get("/logs")
 async def get_audit_logs(
     start_date: Optional[str] = None,
@@ -82,6 +217,8 @@ async def get_audit_logs(
     module: Optional[str] = None,
     limit: int = 100,
     skip: int = 0,
+    cursor: Optional[str] = None,
+    include_total: bool = True,
     current_user: dict = Depends(get_erp_user)
 ):
     """Get audit logs with filters"""
@@ -105,14 +242,18 @@ async def get_audit_logs(
     if module:
         query["module"] = module
     
-    logs = await db.audit_logs.find(query, {"_id": 0}).sort("timestamp", -1).skip(skip).limit(limit).to_list(limit)
-    total = await db.audit_logs.count_documents(query)
+    limit = max(1, limit)
+    try:
+        result = await paginate(db.audit_logs, query, limit=limit, cursor=cursor, skip=skip,
+                                sort_field="timestamp", include_total=include_total)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     return {
-        "logs": logs,
-        "total": total,
+        "logs": result.pop("items"),
         "limit": limit,
-        "skip": skip
+        "skip": skip,
+        **result
     }
 
 
@@ -208,80 +349,80 @@ async def get_monthly_mis_report(
     db = get_db()
     target_month = month or datetime.now(timezone.utc).strftime("%Y-%m")
     
-    # Get all logs for the month
-    logs = await db.audit_logs.find(
-        {"month": target_month},
-        {"_id": 0}
-    ).to_list(10000)
+    # Single pass over the month's rollups
+    result = await db.audit_daily_stats.aggregate([
+        {"$match": {"month": target_month}},
+        {"$facet": {
+            "users": [
+                {"$group": {
+                    "_id": "$user_id",
+                    "user_name": {"$last": "$user_name"},
+                    "user_role": {"$last": "$user_role"},
+                    "total_actions": {"$sum": "$count"},
+                    "active_days": {"$addToSet": "$date"},
+                    "create": _count_if("create"),
+                    "update": _count_if("update"),
+                    "delete": _count_if("delete"),
+                    "approve": _count_if("approve"),
+                    "reject": _count_if("reject"),
+                    "modules_used": {"$addToSet": "$module"}
+                }}
+            ],
+            "daily": [
+                {"$group": {
+                    "_id": "$date",
+                    "total": {"$sum": "$count"},
+                    "users": {"$addToSet": "$user_id"}
+                }},
+                {"$sort": {"_id": 1}}
+            ],
+            "modules": [
+                {"$group": {"_id": "$module", "count": {"$sum": "$count"}}}
+            ],
+            "actions": [
+                {"$group": {"_id": "$action", "count": {"$sum": "$count"}}}
+            ]
+        }}
+    ]).to_list(1)
+    facets = result[0] if result else {}
     
     # User performance metrics
-    user_metrics = {}
-    daily_activity = {}
-    
-    for log in logs:
-        uid = log["user_id"]
-        date = log["date"]
-        
-        # User metrics
-        if uid not in user_metrics:
-            user_metrics[uid] = {
-                "user_id": uid,
-                "user_name": log["user_name"],
-                "user_role": log["user_role"],
-                "total_actions": 0,
-                "active_days": set(),
-                "actions": {"create": 0, "update": 0, "delete": 0, "approve": 0, "reject": 0},
-                "modules_used": set()
-            }
-        
-        user_metrics[uid]["total_actions"] += 1
-        user_metrics[uid]["active_days"].add(date)
-        if log["action"] in user_metrics[uid]["actions"]:
-            user_metrics[uid]["actions"][log["action"]] += 1
-        user_metrics[uid]["modules_used"].add(log["module"])
-        
-        # Daily breakdown
-        if date not in daily_activity:
-            daily_activity[date] = {"date": date, "total": 0, "users": set()}
-        daily_activity[date]["total"] += 1
-        daily_activity[date]["users"].add(uid)
-    
-    # Convert sets
-    for uid in user_metrics:
-        user_metrics[uid]["active_days"] = len(user_metrics[uid]["active_days"])
-        user_metrics[uid]["modules_used"] = list(user_metrics[uid]["modules_used"])
-    
-    for date in daily_activity:
-        daily_activity[date]["users"] = len(daily_activity[date]["users"])
+    user_metrics = [
+        {
+            "user_id": u["_id"],
+            "user_name": u["user_name"],
+            "user_role": u["user_role"],
+            "total_actions": u["total_actions"],
+            "active_days": len(u["active_days"]),
+            "actions": {a: u[a] for a in ["create", "update", "delete", "approve", "reject"]},
+            "modules_used": u["modules_used"]
+        }
+        for u in facets.get("users", [])
+    ]
+    daily_activity = [
+        {"date": d["_id"], "total": d["total"], "users": len(d["users"])}
+        for d in facets.get("daily", [])
+    ]
+    module_usage = {m["_id"]: m["count"] for m in facets.get("modules", [])}
+    action_counts = {a["_id"]: a["count"] for a in facets.get("actions", [])}
+    total_actions = sum(action_counts.values())
     
     # Top performers
-    top_performers = sorted(user_metrics.values(), key=lambda x: x["total_actions"], reverse=True)[:10]
-    
-    # Module usage
-    module_usage = {}
-    for log in logs:
-        module = log["module"]
-        if module not in module_usage:
-            module_usage[module] = 0
-        module_usage[module] += 1
+    top_performers = sorted(user_metrics, key=lambda x: x["total_actions"], reverse=True)[:10]
     
     return {
         "month": target_month,
         "summary": {
-            "total_actions": len(logs),
+            "total_actions": total_actions,
             "total_users": len(user_metrics),
-            "avg_actions_per_user": round(len(logs) / max(len(user_metrics), 1), 2),
-            "avg_actions_per_day": round(len(logs) / max(len(daily_activity), 1), 2)
+            "avg_actions_per_user": round(total_actions / max(len(user_metrics), 1), 2),
+            "avg_actions_per_day": round(total_actions / max(len(daily_activity), 1), 2)
         },
         "top_performers": top_performers,
-        "daily_breakdown": sorted(daily_activity.values(), key=lambda x: x["date"]),
+        "daily_breakdown": daily_activity,
         "module_usage": module_usage,
         "action_breakdown": {
-            "create": sum(1 for l in logs if l["action"] == "create"),
-            "update": sum(1 for l in logs if l["action"] == "update"),
-            "delete": sum(1 for l in logs if l["action"] == "delete"),
-            "approve": sum(1 for l in logs if l["action"] == "approve"),
-            "reject": sum(1 for l in logs if l["action"] == "reject")
+            a: action_counts.get(a, 0) for a in ["create", "update", "delete", "approve", "reject"]
         }
     }
 
@@ -298,23 +439,23 @@ async def get_yearly_audit_trail(
     db = get_db()
     target_year = year or datetime.now(timezone.utc).strftime("%Y")
     
-    # Aggregate monthly data
+    # Aggregate monthly data from daily rollups
     pipeline = [
         {"$match": {"year": target_year}},
         {"$group": {
             "_id": "$month",
-            "total_actions": {"$sum": 1},
+            "total_actions": {"$sum": "$count"},
             "unique_users": {"$addToSet": "$user_id"},
-            "creates": {"$sum": {"$cond": [{"$eq": ["$action", "create"]}, 1, 0]}},
-            "updates": {"$sum": {"$cond": [{"$eq": ["$action", "update"]}, 1, 0]}},
-            "deletes": {"$sum": {"$cond": [{"$eq": ["$action", "delete"]}, 1, 0]}},
-            "approvals": {"$sum": {"$cond": [{"$eq": ["$action", "approve"]}, 1, 0]}},
-            "rejections": {"$sum": {"$cond": [{"$eq": ["$action", "reject"]}, 1, 0]}}
+            "creates": _count_if("create"),
+            "updates": _count_if("update"),
+            "deletes": _count_if("delete"),
+            "approvals": _count_if("approve"),
+            "rejections": _count_if("reject")
         }},
         {"$sort": {"_id": 1}}
     ]
     
-    monthly_data = await db.audit_logs.aggregate(pipeline).to_list(12)
+    monthly_data = await db.audit_daily_stats.aggregate(pipeline).to_list(12)
     
     # Process results
     for item in monthly_data:
@@ -322,7 +463,7 @@ async def get_yearly_audit_trail(
         item["unique_users"] = len(item["unique_users"])
     
     # Get total counts
-    total_logs = await db.audit_logs.count_documents({"year": target_year})
+    total_logs = sum(item["total_actions"] for item in monthly_data)
     
     # Get deleted records
     deleted_records = await db.audit_logs.find(
@@ -335,16 +476,16 @@ async def get_yearly_audit_trail(
         {"$match": {"year": target_year}},
         {"$group": {
             "_id": {"user_id": "$user_id", "user_name": "$user_name", "user_role": "$user_role"},
-            "total_actions": {"$sum": 1},
-            "creates": {"$sum": {"$cond": [{"$eq": ["$action", "create"]}, 1, 0]}},
-            "updates": {"$sum": {"$cond": [{"$eq": ["$action", "update"]}, 1, 0]}},
-            "deletes": {"$sum": {"$cond": [{"$eq": ["$action", "delete"]}, 1, 0]}}
+            "total_actions": {"$sum": "$count"},
+            "creates": _count_if("create"),
+            "updates": _count_if("update"),
+            "deletes": _count_if("delete")
         }},
         {"$sort": {"total_actions": -1}},
         {"$limit": 20}
     ]
     
-    user_summary = await db.audit_logs.aggregate(user_pipeline).to_list(20)
+    user_summary = await db.audit_daily_stats.aggregate(user_pipeline).to_list(20)
     for item in user_summary:
         item["user_id"] = item["_id"]["user_id"]
         item["user_name"] = item["_id"]["user_name"]
@@ -527,15 +668,25 @@ async def get_employee_performance_report(
         {"_id": 0, "id": 1, "name": 1, "email": 1, "role": 1}
     ).to_list(100)
     
-    # Get activity for each employee
+    # Activity for all employees in one aggregation over the month's rollups
+    activity_rows = await db.audit_daily_stats.aggregate([
+        {"$match": {"month": target_month, "user_id": {"$in": [emp["id"] for emp in employees]}}},
+        {"$group": {
+            "_id": "$user_id",
+            "total_actions": {"$sum": "$count"},
+            "active_days": {"$addToSet": "$date"},
+            "creates": _count_if("create"),
+            "updates": _count_if("update"),
+            "approvals": _count_if("approve")
+        }}
+    ]).to_list(len(employees))
+    activity_by_user = {row["_id"]: row for row in activity_rows}
+    
     performance = []
     for emp in employees:
-        logs = await db.audit_logs.find(
-            {"user_id": emp["id"], "month": target_month},
-            {"_id": 0}
-        ).to_list(1000)
+        activity = activity_by_user.get(emp["id"])
         
-        if not logs:
+        if not activity or not activity["total_actions"]:
             performance.append({
                 "employee": emp,
                 "total_actions": 0,
@@ -545,11 +696,11 @@ async def get_employee_performance_report(
             })
             continue
         
-        active_days = len(set(l["date"] for l in logs))
-        total_actions = len(logs)
-        creates = sum(1 for l in logs if l["action"] == "create")
-        updates = sum(1 for l in logs if l["action"] == "update")
-        approvals = sum(1 for l in logs if l["action"] == "approve")
+        active_days = len(activity["active_days"])
+        total_actions = activity["total_actions"]
+        creates = activity["creates"]
+        updates = activity["updates"]
+        approvals = activity["approvals"]
         
         # Calculate efficiency score (simple formula)
         efficiency_score = min(100, round((total_actions / max(active_days, 1)) * 5))
@@ -589,6 +740,34 @@ async def get_employee_performance_report(
     }
 
 
+@audit_router.post("/rollups/rebuild")
+async def rebuild_audit_rollups(
+    start_date: str,
+    end_date: Optional[str] = None,
+    current_user: dict = Depends(get_erp_user)
+):
+    """Rebuild daily audit rollups from raw logs (backfill / repair)"""
+    if current_user.get("role") not in ["super_admin", "admin"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    db = get_db()
+    end_date = end_date or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="start_date must be on or before end_date")
+    
+    result = await rebuild_audit_daily_stats(db, start_date, end_date)
+    return {"message": "Audit rollups rebuilt", **result}
+
+
+@audit_router.get("/sink-stats")
+async def get_audit_sink_stats(current_user: dict = Depends(get_erp_user)):
+    """Buffered audit writer counters for this worker"""
+    if current_user.get("role") not in ["super_admin", "admin"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    return {"running": audit_sink.running, **audit_sink.stats}
+
+
 # Helper function to log actions from other routers
 async def audit_log(request: Request, current_user: dict, action: str, module: str, details: dict, record_id: str = None, old_data: dict = None, new_data: dict = None):
     """Helper to log actions from other routers"""
@@ -12,6 +12,8 @@ import os
 import random
 import string
 
+from utils.search_index import USER_SEARCH_FIELDS, build_search_tokens
+
 auth_router = APIRouter(prefix="/auth", tags=["Authentication"])
 
 # Security
@@ -152,6 +154,7 @@ async def register_user(user_data: UserRegister, background_tasks: BackgroundTas
         "referred_by": None,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
+    user["search_tokens"] = build_search_tokens(user, USER_SEARCH_FIELDS)
     
     await db.users.insert_one(user)
     
@@ -574,6 +577,7 @@ async def create_erp_user(user_data: dict, current_user: dict = Depends(get_curr
         "created_at": datetime.now(timezone.utc).isoformat(),
         "created_by": current_user.get("id")
     }
+    user["search_tokens"] = build_search_tokens(user, USER_SEARCH_FIELDS)
     
     await db.users.insert_one(user)
     
@@ -20,6 +20,11 @@ def get_db():
     """Get database instance"""
     return db
 
+def get_report_db():
+    """Database instance for heavy read-only reports (may read from a secondary)"""
+    from utils.database import report_view
+    return report_view(db)
+
 async def get_erp_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     token: Optional[str] = Query(None)  # Support token via query param for PDF downloads
@@ -21,6 +21,14 @@ import calendar
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from twilio.rest import Client as TwilioClient
+from utils.job_coordinator import job_coordinator
+from utils.transactions import run_in_transaction
+from utils.cash_balances import (
+    ALL_SCOPE, apply_cash_transaction, get_opening_balance, get_current_balance,
+    rebuild_cash_daily_balances, repair_recent_cash_balances
+)
+from utils.pnl_engine import get_pnl_figures, cash_pnl_report
+from utils.period_close import cash_totals_by_month
 
 # Scheduler instance
 scheduler = AsyncIOScheduler()
@@ -112,7 +120,11 @@ async def record_cash_transaction(
         "year": now.strftime("%Y")
     }
     
-    await db.cash_transactions.insert_one(transaction)
+    async def write(session):
+        await db.cash_transactions.insert_one(transaction, session=session)
+        await apply_cash_transaction(db, transaction, session=session)
+
+    await run_in_transaction(db, write)
     
     # Log to audit
     await log_action(
@@ -149,25 +161,15 @@ async def get_cash_balance(
     
     db = get_db()
     
-    # Calculate total cash in and out
-    pipeline = [
-        {"$group": {
-            "_id": "$direction",
-            "total": {"$sum": "$amount"}
-        }}
-    ]
-    
-    results = await db.cash_transactions.aggregate(pipeline).to_list(10)
-    
-    cash_in = 0
-    cash_out = 0
-    for r in results:
-        if r["_id"] == "in":
-            cash_in = r["total"]
-        else:
-            cash_out = r["total"]
+    # Totals come from the per-day balance rows (one row per day, not per transaction)
+    totals = await db.cash_daily_balances.aggregate([
+        {"$match": {"scope": ALL_SCOPE}},
+        {"$group": {"_id": None, "cash_in": {"$sum": "$cash_in"}, "cash_out": {"$sum": "$cash_out"}}}
+    ]).to_list(1)
+    cash_in = totals[0]["cash_in"] if totals else 0
+    cash_out = totals[0]["cash_out"] if totals else 0
     
-    balance = cash_in - cash_out
+    balance = await get_current_balance(db)
     
     # Today's transactions
     today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
@@ -194,6 +196,21 @@ async def get_cash_balance(
     }
 
 
+@cash_router.post("/balances/rebuild")
+async def rebuild_cash_balances(
+    from_date: Optional[str] = None,
+    current_user: dict = Depends(get_erp_user)
+):
+    """Rebuild precomputed daily cash balances from transactions (all history, or from_date onwards)"""
+    if current_user.get("role") not in ['admin', 'super_admin', 'owner']:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    db = get_db()
+    result = await rebuild_cash_daily_balances(db, from_date)
+    
+    return {"message": "Cash daily balances rebuilt", **result}
+
+
 # ================== COLLECTION REPORTS ==================
 
 @cash_router.get("/collections")
@@ -372,19 +389,8 @@ async def get_daily_cash_report(
         {"_id": 0}
     ).sort("timestamp", 1).to_list(1000)
     
-    # Calculate opening balance (sum of all transactions before this date)
-    prev_pipeline = [
-        {"$match": {"date": {"$lt": target_date}}},
-        {"$group": {
-            "_id": "$direction",
-            "total": {"$sum": "$amount"}
-        }}
-    ]
-    prev_results = await db.cash_transactions.aggregate(prev_pipeline).to_list(10)
-    
-    prev_in = sum(r["total"] for r in prev_results if r["_id"] == "in")
-    prev_out = sum(r["total"] for r in prev_results if r["_id"] == "out")
-    opening_balance = prev_in - prev_out
+    # Opening balance from the precomputed daily balances
+    opening_balance = await get_opening_balance(db, target_date)
     
     # Today's totals
     today_in = sum(t["amount"] for t in transactions if t["direction"] == "in")
@@ -539,31 +545,13 @@ async def get_yearly_cash_report(
     db = get_db()
     target_year = year or datetime.now(timezone.utc).strftime("%Y")
     
-    # Monthly aggregation
-    pipeline = [
-        {"$match": {"year": target_year}},
-        {"$group": {
-            "_id": {"month": "$month", "direction": "$direction"},
-            "total": {"$sum": "$amount"},
-            "count": {"$sum": 1}
-        }},
-        {"$sort": {"_id.month": 1}}
-    ]
-    
-    results = await db.cash_transactions.aggregate(pipeline).to_list(100)
-    
-    # Process results
-    monthly = {}
-    for r in results:
-        month = r["_id"]["month"]
-        direction = r["_id"]["direction"]
-        if month not in monthly:
-            monthly[month] = {"month": month, "cash_in": 0, "cash_out": 0, "transactions": 0}
-        if direction == "in":
-            monthly[month]["cash_in"] = r["total"]
-        else:
-            monthly[month]["cash_out"] = r["total"]
-        monthly[month]["transactions"] += r["count"]
+    # Monthly totals - frozen months from the period close, the rest live
+    totals = await cash_totals_by_month(db, f"{target_year}-01-01", f"{target_year}-12-31")
+    monthly = {
+        month: {"month": month, "cash_in": t.get("cash_in", 0), "cash_out": t.get("cash_out", 0),
+                "transactions": t.get("count", 0)}
+        for month, t in totals.items() if t.get("count")
+    }
     
     # Calculate net and cumulative
     sorted_months = sorted(monthly.keys())
@@ -701,10 +689,8 @@ async def record_cash_purchase(
         "year": now.strftime("%Y")
     }
     
-    await db.cash_purchases.insert_one(purchase)
-    
     # Also record as cash transaction
-    await db.cash_transactions.insert_one({
+    transaction = {
         "id": str(uuid.uuid4()),
         "amount": amount,
         "transaction_type": "cash_purchase",
@@ -721,7 +707,14 @@ async def record_cash_purchase(
         "date": now.strftime("%Y-%m-%d"),
         "month": now.strftime("%Y-%m"),
         "year": now.strftime("%Y")
-    })
+    }
+    
+    async def write(session):
+        await db.cash_purchases.insert_one(purchase, session=session)
+        await db.cash_transactions.insert_one(transaction, session=session)
+        await apply_cash_transaction(db, transaction, session=session)
+
+    await run_in_transaction(db, write)
     
     # Log to audit
     await log_action(
@@ -812,6 +805,7 @@ async def get_cash_purchases(
 async def get_pnl_report(
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    refresh: bool = False,
     current_user: dict = Depends(get_erp_user)
 ):
     """Get comprehensive P&L Report"""
@@ -827,74 +821,8 @@ async def get_pnl_report(
     if not end_date:
         end_date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
     
-    # Revenue from orders
-    orders = await db.orders.find(
-        {"payment_status": "completed", "created_at": {"$gte": start_date, "$lte": end_date + "T23:59:59"}},
-        {"_id": 0, "total_price": 1, "transport_charge": 1, "advance_amount": 1, 
-         "remaining_amount": 1, "remaining_payment_method": 1}
-    ).to_list(5000)
-    
-    product_revenue = sum(o.get("total_price", 0) for o in orders)
-    transport_revenue = sum(o.get("transport_charge", 0) for o in orders)
-    online_collection = sum(o.get("advance_amount", 0) for o in orders)
-    cash_collection = sum(o.get("remaining_amount", 0) for o in orders if o.get("remaining_payment_method") == "cash")
-    
-    # Expenses from cash transactions
-    expenses_query = {"direction": "out", "date": {"$gte": start_date, "$lte": end_date}}
-    expenses = await db.cash_transactions.find(expenses_query, {"_id": 0}).to_list(5000)
-    
-    # Group expenses by type
-    expense_by_type = {}
-    for e in expenses:
-        t_type = e.get("transaction_type", "other")
-        if t_type not in expense_by_type:
-            expense_by_type[t_type] = 0
-        expense_by_type[t_type] += e["amount"]
-    
-    total_expenses = sum(expense_by_type.values())
-    
-    # Get expenses from expenses collection too
-    db_expenses = await db.expenses.find(
-        {"date": {"$gte": start_date, "$lte": end_date}},
-        {"_id": 0, "amount": 1, "category": 1}
-    ).to_list(1000)
-    
-    for e in db_expenses:
-        cat = e.get("category", "other")
-        expense_by_type[cat] = expense_by_type.get(cat, 0) + e.get("amount", 0)
-        total_expenses += e.get("amount", 0)
-    
-    # Calculate P&L
-    total_revenue = product_revenue + transport_revenue
-    gross_profit = total_revenue - total_expenses
-    profit_margin = round((gross_profit / max(total_revenue, 1)) * 100, 2)
-    
-    return {
-        "period": {
-            "start": start_date,
-            "end": end_date
-        },
-        "revenue": {
-            "product_sales": round(product_revenue, 2),
-            "transport_charges": round(transport_revenue, 2),
-            "total_revenue": round(total_revenue, 2)
-        },
-        "collections": {
-            "online": round(online_collection, 2),
-            "cash": round(cash_collection, 2),
-            "total": round(online_collection + cash_collection, 2)
-        },
-        "expenses": {
-            "by_category": {k: round(v, 2) for k, v in sorted(expense_by_type.items(), key=lambda x: x[1], reverse=True)},
-            "total": round(total_expenses, 2)
-        },
-        "profit_loss": {
-            "gross_profit": round(gross_profit, 2),
-            "profit_margin": profit_margin,
-            "status": "profit" if gross_profit >= 0 else "loss"
-        },
-        "orders_count": len(orders)
-    }
+    figures = await get_pnl_figures(db, start_date, end_date, refresh=refresh)
+    return cash_pnl_report(figures)
 
 
 # ================== AUTO EMAIL/WHATSAPP REPORTS ==================
@@ -1030,41 +958,8 @@ async def trigger_daily_report(
     # Get today's P&L
     today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
     
-    # Get P&L data (reuse the pnl endpoint logic)
-    orders = await db.orders.find(
-        {"payment_status": "completed", "created_at": {"$regex": f"^{today}"}},
-        {"_id": 0}
-    ).to_list(500)
-    
-    product_revenue = sum(o.get("total_price", 0) for o in orders)
-    transport_revenue = sum(o.get("transport_charge", 0) for o in orders)
-    online_collection = sum(o.get("advance_amount", 0) for o in orders)
-    cash_collection = sum(o.get("remaining_amount", 0) for o in orders if o.get("remaining_payment_method") == "cash")
-    
-    expenses = await db.cash_transactions.find(
-        {"direction": "out", "date": today},
-        {"_id": 0}
-    ).to_list(500)
-    total_expenses = sum(e["amount"] for e in expenses)
-    
-    report_data = {
-        "period": {"start": today, "end": today},
-        "revenue": {
-            "product_sales": product_revenue,
-            "transport_charges": transport_revenue,
-            "total_revenue": product_revenue + transport_revenue
-        },
-        "collections": {
-            "online": online_collection,
-            "cash": cash_collection,
-            "total": online_collection + cash_collection
-        },
-        "expenses": {"total": total_expenses},
-        "profit_loss": {
-            "gross_profit": product_revenue + transport_revenue - total_expenses,
-            "profit_margin": round((product_revenue + transport_revenue - total_expenses) / max(product_revenue + transport_revenue, 1) * 100, 2)
-        }
-    }
+    # Get P&L data
+    report_data = cash_pnl_report(await get_pnl_figures(db, today, today))
     
     # Get recipients (admin, super_admin, finance users)
     recipients_users = await db.users.find(
@@ -1155,60 +1050,9 @@ async def scheduled_daily_report():
         logging.info("Daily reports disabled in settings")
         return
     
-    # Fetch yesterday's data
-    orders = await db.orders.find(
-        {"created_at": {"$regex": f"^{yesterday}"}},
-        {"_id": 0}
-    ).to_list(500)
-    
-    completed_orders = [o for o in orders if o.get("payment_status") in ["completed", "partial"]]
-    
-    product_revenue = sum(o.get("total_price", 0) for o in completed_orders)
-    transport_revenue = sum(o.get("transport_charge", 0) for o in completed_orders)
-    online_collection = sum(o.get("advance_amount", 0) for o in completed_orders if o.get("advance_payment_status") == "paid")
-    cash_collection = sum(o.get("remaining_amount", 0) for o in completed_orders if o.get("remaining_payment_status") == "cash_received")
-    
-    # Get expenses
-    expenses = await db.cash_transactions.find(
-        {"direction": "out", "date": yesterday},
-        {"_id": 0}
-    ).to_list(500)
-    total_expenses = sum(e["amount"] for e in expenses)
-    
-    # Get current cash balance
-    cash_in_cursor = await db.cash_transactions.aggregate([
-        {"$match": {"direction": "in"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]).to_list(1)
-    cash_out_cursor = await db.cash_transactions.aggregate([
-        {"$match": {"direction": "out"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]).to_list(1)
-    
-    cash_in = cash_in_cursor[0]["total"] if cash_in_cursor else 0
-    cash_out = cash_out_cursor[0]["total"] if cash_out_cursor else 0
-    cash_balance = cash_in - cash_out
-    
-    report_data = {
-        "period": {"start": yesterday, "end": yesterday},
-        "revenue": {
-            "product_sales": product_revenue,
-            "transport_charges": transport_revenue,
-            "total_revenue": product_revenue + transport_revenue
-        },
-        "collections": {
-            "online": online_collection,
-            "cash": cash_collection,
-            "total": online_collection + cash_collection
-        },
-        "expenses": {"total": total_expenses},
-        "profit_loss": {
-            "gross_profit": product_revenue + transport_revenue - total_expenses,
-            "profit_margin": round((product_revenue + transport_revenue - total_expenses) / max(product_revenue + transport_revenue, 1) * 100, 2)
-        },
-        "cash_balance": cash_balance,
-        "orders_count": len(completed_orders)
-    }
+    # Yesterday is a closed period - the memoised figures are shared with the API
+    figures = await get_pnl_figures(db, yesterday, yesterday)
+    report_data = cash_pnl_report(figures, cash_balance=await get_current_balance(db))
     
     # Get recipients (admin, super_admin, finance users)
     recipients_users = await db.users.find(
@@ -1237,9 +1081,9 @@ async def scheduled_daily_report():
         "email_recipients": emails,
         "whatsapp_recipients": phones,
         "report_summary": {
-            "revenue": product_revenue + transport_revenue,
-            "expenses": total_expenses,
-            "profit": product_revenue + transport_revenue - total_expenses
+            "revenue": report_data["revenue"]["total_revenue"],
+            "expenses": report_data["expenses"]["total"],
+            "profit": report_data["profit_loss"]["gross_profit"]
         }
     })
     
@@ -1251,72 +1095,8 @@ async def scheduled_daily_report():
 async def generate_period_report_data(start_date: str, end_date: str, report_type: str):
     """Generate P&L report data for a date range"""
     db = get_db()
-    
-    # Fetch orders in the period
-    orders = await db.orders.find(
-        {"created_at": {"$gte": start_date, "$lte": end_date + "T23:59:59"}},
-        {"_id": 0}
-    ).to_list(5000)
-    
-    completed_orders = [o for o in orders if o.get("payment_status") in ["completed", "partial"]]
-    
-    product_revenue = sum(o.get("total_price", 0) for o in completed_orders)
-    transport_revenue = sum(o.get("transport_charge", 0) for o in completed_orders)
-    online_collection = sum(o.get("advance_amount", 0) for o in completed_orders if o.get("advance_payment_status") == "paid")
-    cash_collection = sum(o.get("remaining_amount", 0) for o in completed_orders if o.get("remaining_payment_status") == "cash_received")
-    
-    # Get expenses
-    expenses = await db.cash_transactions.find(
-        {"direction": "out", "date": {"$gte": start_date, "$lte": end_date}},
-        {"_id": 0}
-    ).to_list(5000)
-    total_expenses = sum(e["amount"] for e in expenses)
-    
-    # Category-wise expenses
-    expense_by_category = {}
-    for e in expenses:
-        cat = e.get("transaction_type", "other")
-        expense_by_category[cat] = expense_by_category.get(cat, 0) + e["amount"]
-    
-    # Get current cash balance
-    cash_in_cursor = await db.cash_transactions.aggregate([
-        {"$match": {"direction": "in"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]).to_list(1)
-    cash_out_cursor = await db.cash_transactions.aggregate([
-        {"$match": {"direction": "out"}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]).to_list(1)
-    
-    cash_in = cash_in_cursor[0]["total"] if cash_in_cursor else 0
-    cash_out = cash_out_cursor[0]["total"] if cash_out_cursor else 0
-    cash_balance = cash_in - cash_out
-    
-    return {
-        "report_type": report_type,
-        "period": {"start": start_date, "end": end_date},
-        "revenue": {
-            "product_sales": product_revenue,
-            "transport_charges": transport_revenue,
-            "total_revenue": product_revenue + transport_revenue
-        },
-        "collections": {
-            "online": online_collection,
-            "cash": cash_collection,
-            "total": online_collection + cash_collection
-        },
-        "expenses": {
-            "total": total_expenses,
-            "by_category": expense_by_category
-        },
-        "profit_loss": {
-            "gross_profit": product_revenue + transport_revenue - total_expenses,
-            "profit_margin": round((product_revenue + transport_revenue - total_expenses) / max(product_revenue + transport_revenue, 1) * 100, 2)
-        },
-        "cash_balance": cash_balance,
-        "orders_count": len(completed_orders),
-        "total_orders": len(orders)
-    }
+    figures = await get_pnl_figures(db, start_date, end_date)
+    return cash_pnl_report(figures, cash_balance=await get_current_balance(db), report_type=report_type)
 
 
 async def send_period_pnl_email(recipients: List[str], report_data: dict):
@@ -1653,35 +1433,61 @@ async def scheduled_monthly_report():
     logging.info(f"Monthly report completed for {start_date} to {end_date}")
 
 
+async def scheduled_cash_balance_repair():
+    """Nightly re-derive of recent cash_daily_balances rows from cash_transactions"""
+    db = get_db()
+    result = await repair_recent_cash_balances(db)
+    logging.info(f"Cash daily balances repaired from {result['from_date']}: {result['rows']} rows")
+
+
 def start_report_scheduler():
-    """Start the APScheduler for daily/weekly/monthly reports"""
+    """
+    Start the APScheduler for daily/weekly/monthly reports.
+    Every worker schedules them; the job coordinator runs each fire on one worker only.
+    """
     global scheduler_started
     if scheduler_started:
         return
     
     # Daily Report: 5 AM IST = 23:30 UTC previous day (IST is UTC+5:30)
-    scheduler.add_job(
+    job_coordinator.register(
+        scheduler,
         scheduled_daily_report,
         CronTrigger(hour=23, minute=30),
-        id="daily_pnl_report",
-        replace_existing=True
+        job_id="daily_pnl_report",
+        name="Daily P&L Report",
+        log_runs=True
     )
     
     # Weekly Report: Monday 5 AM IST = Sunday 23:30 UTC
-    scheduler.add_job(
+    job_coordinator.register(
+        scheduler,
         scheduled_weekly_report,
         CronTrigger(day_of_week='sun', hour=23, minute=30),
-        id="weekly_pnl_report",
-        replace_existing=True
+        job_id="weekly_pnl_report",
+        name="Weekly P&L Report",
+        log_runs=True
     )
     
     # Monthly Report: 1st of month 5 AM IST = Last day of prev month 23:30 UTC
     # Using day=1 will trigger on the 1st at the specified UTC time
-    scheduler.add_job(
+    job_coordinator.register(
+        scheduler,
         scheduled_monthly_report,
         CronTrigger(day=1, hour=23, minute=30),
-        id="monthly_pnl_report",
-        replace_existing=True
+        job_id="monthly_pnl_report",
+        name="Monthly P&L Report",
+        log_runs=True
+    )
+    
+    # Cash balance repair: 00:15 UTC, rebuilds yesterday and today's daily balance rows
+    job_coordinator.register(
+        scheduler,
+        scheduled_cash_balance_repair,
+        CronTrigger(hour=0, minute=15),
+        job_id="cash_balance_repair",
+        name="Cash Daily Balance Repair",
+        log_runs=True
     )
     
     scheduler.start()
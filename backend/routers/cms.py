@@ -7,6 +7,7 @@ from typing import Optional, List
 from datetime import datetime, timezone
 from pydantic import BaseModel
 from routers.base import get_erp_user, get_db
+from utils.pagination import paginate
 import uuid
 import os
 import re
@@ -583,7 +584,9 @@ async def get_blog_categories(current_user: dict = Depends(get_erp_user)):
 async def get_public_blog_posts(
     category: Optional[str] = None,
     limit: int = 20,
-    page: int = 1
+    page: int = 1,
+    cursor: Optional[str] = None,
+    include_total: bool = True
 ):
     """Get published blog posts (public endpoint)"""
     db = get_db()
@@ -591,19 +594,21 @@ async def get_public_blog_posts(
     if category:
         query["category"] = category
     
-    skip = (page - 1) * limit
-    posts = await db.cms_content.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).to_list(limit)
-    total = await db.cms_content.count_documents(query)
+    limit = max(1, min(limit, 100))
+    try:
+        result = await paginate(db.cms_content, query, limit=limit, cursor=cursor, skip=(max(page, 1) - 1) * limit,
+                                include_total=include_total)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     # Get unique categories for filter
     categories = await db.cms_content.distinct("category", {"type": "blog_post", "status": "published"})
     
     return {
-        "posts": posts,
-        "total": total,
+        "posts": result.pop("items"),
         "page": page,
         "limit": limit,
-        "total_pages": (total + limit - 1) // limit,
+        **result,
         "categories": [c for c in categories if c]
     }
 
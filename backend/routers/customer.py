@@ -7,6 +7,7 @@ from typing import Optional, Dict, Any
 from datetime import datetime, timezone
 import uuid
 from .base import get_erp_user, get_db
+from utils.search_index import USER_SEARCH_FIELDS, with_search_tokens
 
 customer_router = APIRouter(prefix="/customer", tags=["Customer Portal"])
 
@@ -236,6 +237,7 @@ async def update_customer_profile(
     allowed_fields = ["name", "phone", "address", "city", "state", "pincode"]
     update_data = {k: v for k, v in data.items() if k in allowed_fields}
     update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    update_data = await with_search_tokens(db, "users", USER_SEARCH_FIELDS, {"id": current_user["id"]}, update_data)
     
     await db.users.update_one(
         {"id": current_user["id"]},
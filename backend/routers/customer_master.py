@@ -21,6 +21,13 @@ from enum import Enum
 import uuid
 import re
 from .base import get_erp_user, get_db
+from utils.dashboard_metrics import get_customer_stats_metrics, invalidate_dashboard_metrics
+from utils.search_index import (
+    CUSTOMER_SEARCH_FIELDS, HotSearchSet, backfill_search_tokens, build_search_tokens,
+    legacy_search_filter, token_filter
+)
+from utils.gstin_registry import GSTIN_PATTERN
+from utils.pagination import paginate
 
 customer_master_router = APIRouter(prefix="/customer-master", tags=["Customer Master"])
 
@@ -170,8 +177,7 @@ class CustomerProfileCreate(BaseModel):
     def validate_gstin(cls, v):
         if v:
             # GSTIN format: 2 digits state code + 10 char PAN + 1 entity code + Z + 1 checksum
-            pattern = r'^[0-9]{2}[A-Z]{5}[0-9]{4}[A-Z]{1}[1-9A-Z]{1}Z[0-9A-Z]{1}$'
-            if not re.match(pattern, v.upper()):
+            if not GSTIN_PATTERN.match(v.upper()):
                 raise ValueError('Invalid GSTIN format. Expected: 22AAAAA0000A1Z5')
         return v.upper() if v else v
     
@@ -308,6 +314,41 @@ def get_display_name(profile: dict) -> str:
     return profile.get("individual_name") or profile.get("company_name") or "Unknown"
 
 
+# =============== SEARCH INDEX ===============
+
+INVOICE_SEARCH_PROJECTION = {
+    "id": 1,
+    "customer_code": 1,
+    "display_name": 1,
+    "company_name": 1,
+    "individual_name": 1,
+    "mobile": 1,
+    "email": 1,
+    "gstin": 1,
+    "gst_type": 1,
+    "invoice_type": 1,
+    "billing_address": 1,
+    "credit_type": 1,
+    "credit_limit": 1,
+    "credit_days": 1
+}
+LEGACY_SEARCH_FIELDS = ["display_name", "company_name", "individual_name", "mobile", "gstin", "customer_code"]
+
+# Hot working set of active customers for the invoice/order picker
+customer_search = HotSearchSet(
+    "customer_profiles", CUSTOMER_SEARCH_FIELDS, {"status": "active"}, INVOICE_SEARCH_PROJECTION
+)
+
+
+async def index_customer_profile(db, profile: dict):
+    """Refresh search tokens and the in-memory tier after a profile write"""
+    tokens = build_search_tokens(profile, CUSTOMER_SEARCH_FIELDS)
+    if profile.get("search_tokens") != tokens:
+        await db.customer_profiles.update_one({"id": profile["id"]}, {"$set": {"search_tokens": tokens}})
+        profile["search_tokens"] = tokens
+    customer_search.upsert(profile)
+
+
 def generate_customer_code() -> str:
     """Generate unique customer code: CUS-YYYYMMDD-XXXXX"""
     date_str = datetime.now().strftime("%Y%m%d")
@@ -407,6 +448,8 @@ async def create_customer_profile(
         "credit_type": data.credit_type.value,
         "credit_limit": data.credit_limit,
         "credit_days": data.credit_days,
+        "outstanding_balance": 0,  # Maintained by order/payment flows (utils.customer_balance)
+        "credit_exposure": 0,
         
         # Bank Details (Internal)
         "bank_details": data.bank_details.model_dump() if data.bank_details else None,
@@ -440,7 +483,10 @@ async def create_customer_profile(
         "updated_by": None
     }
     
+    profile["search_tokens"] = build_search_tokens(profile, CUSTOMER_SEARCH_FIELDS)
     await db.customer_profiles.insert_one(profile)
+    customer_search.upsert(profile)
+    invalidate_dashboard_metrics("customers")
     
     # Create audit log
     await db.audit_logs.insert_one({
@@ -451,26 +497,32 @@ async def create_customer_profile(
         "user_id": current_user.get("id"),
         "user_name": current_user.get("name"),
         "details": {"customer_code": profile["customer_code"], "display_name": profile["display_name"]},
+        "timestamp": datetime.now(timezone.utc).isoformat(),
         "created_at": datetime.now(timezone.utc).isoformat()
     })
     
     # Return without _id
     profile.pop("_id", None)
+    profile.pop("search_tokens", None)
     return profile
 
 
 @customer_master_router.get("/")
 async def list_customer_profiles(
-    page: int = Query(1, ge=1),
-    limit: int = Query(20, ge=1, le=100),
+    page: int = 1,
+    limit: int = 20,
     search: Optional[str] = None,
     customer_type: Optional[str] = None,
     category: Optional[str] = None,
     status: str = "active",
+    cursor: Optional[str] = None,
+    include_total: bool = True,
     current_user: dict = Depends(get_erp_user)
 ):
     """List all customer profiles with pagination and filters"""
     db = get_db()
+    limit = max(1, min(limit, 100))
+    page = max(1, page)
     
     # Build query
     query = {}
@@ -485,85 +537,30 @@ async def list_customer_profiles(
         query["customer_category"] = category
     
     if search:
-        query["$or"] = [
-            {"display_name": {"$regex": search, "$options": "i"}},
-            {"company_name": {"$regex": search, "$options": "i"}},
-            {"individual_name": {"$regex": search, "$options": "i"}},
-            {"mobile": {"$regex": search, "$options": "i"}},
-            {"gstin": {"$regex": search, "$options": "i"}},
-            {"customer_code": {"$regex": search, "$options": "i"}}
-        ]
-    
-    # Get total count
-    total = await db.customer_profiles.count_documents(query)
-    
-    # Get paginated results
-    skip = (page - 1) * limit
-    profiles = await db.customer_profiles.find(
-        query, {"_id": 0}
-    ).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+        tokens = token_filter(search)
+        if tokens:
+            # Indexed prefix match; regex only for profiles not yet tokenised
+            query["$or"] = [tokens, legacy_search_filter(search, LEGACY_SEARCH_FIELDS)]
+    
+    # Get paginated results (keyset page when a cursor is given)
+    try:
+        result = await paginate(db.customer_profiles, query, {"_id": 0, "search_tokens": 0}, limit=limit,
+                                cursor=cursor, skip=(page - 1) * limit, include_total=include_total)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     return {
-        "profiles": profiles,
-        "total": total,
+        "profiles": result.pop("items"),
         "page": page,
         "limit": limit,
-        "total_pages": (total + limit - 1) // limit
+        **result
     }
 
 
 @customer_master_router.get("/stats")
 async def get_customer_stats(current_user: dict = Depends(get_erp_user)):
     """Get customer statistics for dashboard"""
-    db = get_db()
-    
-    # Total active customers
-    total_active = await db.customer_profiles.count_documents({"status": "active"})
-    
-    # By category
-    retail_count = await db.customer_profiles.count_documents({"status": "active", "customer_category": "retail"})
-    builder_count = await db.customer_profiles.count_documents({"status": "active", "customer_category": "builder"})
-    dealer_count = await db.customer_profiles.count_documents({"status": "active", "customer_category": "dealer"})
-    project_count = await db.customer_profiles.count_documents({"status": "active", "customer_category": "project"})
-    
-    # Credit customers
-    credit_customers = await db.customer_profiles.count_documents({
-        "status": "active", 
-        "credit_type": "credit_allowed"
-    })
-    
-    # B2B vs B2C
-    b2b_count = await db.customer_profiles.count_documents({"status": "active", "invoice_type": "B2B"})
-    b2c_count = await db.customer_profiles.count_documents({"status": "active", "invoice_type": "B2C"})
-    
-    # KYC Status
-    kyc_verified = await db.customer_profiles.count_documents({
-        "status": "active",
-        "compliance.kyc_status": "verified"
-    })
-    kyc_pending = await db.customer_profiles.count_documents({
-        "status": "active",
-        "compliance.kyc_status": "pending"
-    })
-    
-    return {
-        "total_active": total_active,
-        "by_category": {
-            "retail": retail_count,
-            "builder": builder_count,
-            "dealer": dealer_count,
-            "project": project_count
-        },
-        "credit_customers": credit_customers,
-        "invoice_type": {
-            "b2b": b2b_count,
-            "b2c": b2c_count
-        },
-        "kyc": {
-            "verified": kyc_verified,
-            "pending": kyc_pending
-        }
-    }
+    return await get_customer_stats_metrics(get_db())
 
 
 @customer_master_router.get("/{customer_id}")
@@ -577,7 +574,7 @@ async def get_customer_profile(
     # Try to find by id or customer_code
     profile = await db.customer_profiles.find_one(
         {"$or": [{"id": customer_id}, {"customer_code": customer_id}]},
-        {"_id": 0}
+        {"_id": 0, "search_tokens": 0}
     )
     
     if not profile:
@@ -743,6 +740,7 @@ async def update_customer_profile(
         {"id": profile["id"]},
         {"$set": update_data}
     )
+    invalidate_dashboard_metrics("customers")
     
     # Create audit log
     await db.audit_logs.insert_one({
@@ -753,11 +751,14 @@ async def update_customer_profile(
         "user_id": current_user.get("id"),
         "user_name": current_user.get("name"),
         "details": {"fields_updated": list(update_data.keys())},
+        "timestamp": datetime.now(timezone.utc).isoformat(),
         "created_at": datetime.now(timezone.utc).isoformat()
     })
     
     # Return updated profile
     updated = await db.customer_profiles.find_one({"id": profile["id"]}, {"_id": 0})
+    await index_customer_profile(db, updated)
+    updated.pop("search_tokens", None)
     return updated
 
 
@@ -807,6 +808,8 @@ async def deactivate_customer(
             "deactivated_by": current_user.get("id")
         }}
     )
+    customer_search.discard(profile["id"])
+    invalidate_dashboard_metrics("customers")
     
     # Create audit log
     await db.audit_logs.insert_one({
@@ -817,6 +820,7 @@ async def deactivate_customer(
         "user_id": current_user.get("id"),
         "user_name": current_user.get("name"),
         "details": {"customer_code": profile["customer_code"]},
+        "timestamp": datetime.now(timezone.utc).isoformat(),
         "created_at": datetime.now(timezone.utc).isoformat()
     })
     
@@ -852,6 +856,9 @@ async def reactivate_customer(
             "reactivated_by": current_user.get("id")
         }}
     )
+    profile["status"] = "active"
+    await index_customer_profile(db, profile)
+    invalidate_dashboard_metrics("customers")
     
     return {"message": "Customer reactivated successfully"}
 
@@ -994,6 +1001,7 @@ async def update_kyc_status(
         {"id": profile["id"]},
         {"$set": update}
     )
+    invalidate_dashboard_metrics("customers")
     
     return {"message": f"KYC status updated to {status.value}"}
 
@@ -1076,6 +1084,8 @@ async def migrate_existing_customers(
                 "credit_type": CreditType.ADVANCE_ONLY.value,
                 "credit_limit": 0,
                 "credit_days": 0,
+                "outstanding_balance": 0,
+                "credit_exposure": 0,
                 "bank_details": None,
                 "invoice_preferences": InvoicePreferences().model_dump(),
                 "compliance": Compliance().model_dump(),
@@ -1096,12 +1106,17 @@ async def migrate_existing_customers(
                 profile["state_code"] = state_code
                 profile["state_name"] = state_name
             
+            profile["search_tokens"] = build_search_tokens(profile, CUSTOMER_SEARCH_FIELDS)
             await db.customer_profiles.insert_one(profile)
+            customer_search.upsert(profile)
             migrated += 1
             
         except Exception as e:
             errors.append({"user_id": user.get("id"), "error": str(e)})
     
+    if migrated:
+        invalidate_dashboard_metrics("customers")
+    
     return {
         "message": "Migration completed",
         "migrated": migrated,
@@ -1119,39 +1134,25 @@ async def search_customers_for_invoice(
 ):
     """
     Quick search for customers when creating invoices/orders
-    Returns minimal data needed for selection
+    Returns minimal data needed for selection, best matches first
     """
-    db = get_db()
-    
-    profiles = await db.customer_profiles.find(
-        {
-            "status": "active",
-            "$or": [
-                {"display_name": {"$regex": q, "$options": "i"}},
-                {"company_name": {"$regex": q, "$options": "i"}},
-                {"individual_name": {"$regex": q, "$options": "i"}},
-                {"mobile": {"$regex": q, "$options": "i"}},
-                {"gstin": {"$regex": q, "$options": "i"}},
-                {"customer_code": {"$regex": q, "$options": "i"}}
-            ]
-        },
-        {
-            "_id": 0,
-            "id": 1,
-            "customer_code": 1,
-            "display_name": 1,
-            "company_name": 1,
-            "individual_name": 1,
-            "mobile": 1,
-            "email": 1,
-            "gstin": 1,
-            "gst_type": 1,
-            "invoice_type": 1,
-            "billing_address": 1,
-            "credit_type": 1,
-            "credit_limit": 1,
-            "credit_days": 1
-        }
-    ).limit(10).to_list(10)
+    return await customer_search.search(get_db(), q, limit=10)
+
+
+@customer_master_router.post("/search/reindex")
+async def reindex_customer_search(
+    full: bool = False,
+    current_user: dict = Depends(get_erp_user)
+):
+    """Rebuild customer search tokens (missing only, or all with full=true)"""
+    if current_user.get("role") not in ["super_admin", "admin"]:
+        raise HTTPException(status_code=403, detail="Only admin can rebuild the search index")
     
-    return profiles
+    updated = await backfill_search_tokens(get_db(), "customer_profiles", CUSTOMER_SEARCH_FIELDS, only_missing=not full)
+    return {"message": "Search index rebuilt", "updated": updated}
+
+
+@customer_master_router.get("/search/stats")
+async def get_customer_search_stats(current_user: dict = Depends(get_erp_user)):
+    """In-memory search tier size and hit counters"""
+    return customer_search.describe()
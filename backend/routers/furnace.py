@@ -0,0 +1,286 @@
+"""
+Furnace Router - Toughening furnace batch planning, load sheets and utilisation
+- POST /plan packs every piece awaiting toughening into proposed cycles
+- Cycles move planned -> loaded -> completed; loaded pieces leave the waiting pool
+- Completed cycles roll into a daily utilisation history
+"""
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from typing import Optional, Dict, Any
+from datetime import datetime, timezone, timedelta
+import asyncio
+import uuid
+import io
+from .base import get_erp_user, get_db
+from utils.furnace_batching import (
+    DEFAULT_FURNACE_SETTINGS, get_furnace_settings, collect_awaiting_pieces, plan_cycles,
+    record_cycle_utilisation, claim_planning, release_planning, replace_planned_cycles
+)
+
+furnace_router = APIRouter(prefix="/furnace", tags=["Furnace"])
+
+FURNACE_ROLES = ["super_admin", "admin", "owner", "manager", "production_manager", "operator"]
+
+
+@furnace_router.get("/settings")
+async def get_settings(current_user: dict = Depends(get_erp_user)):
+    """Furnace bed size, spacing and cycle timing"""
+    return await get_furnace_settings(get_db())
+
+
+@furnace_router.put("/settings")
+async def update_settings(data: Dict[str, Any], current_user: dict = Depends(get_erp_user)):
+    """Update furnace settings (Admin only)"""
+    if current_user.get("role") not in ["super_admin", "admin", "owner"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    db = get_db()
+    update_data = {}
+    for key, default in DEFAULT_FURNACE_SETTINGS.items():
+        if key not in data:
+            continue
+        if isinstance(default, bool):
+            update_data[key] = bool(data[key])
+        else:
+            try:
+                value = float(data[key])
+            except (TypeError, ValueError):
+                raise HTTPException(status_code=400, detail=f"{key} must be a number")
+            if value < 0 or (key.startswith("bed_") and value == 0):
+                raise HTTPException(status_code=400, detail=f"Invalid value for {key}")
+            update_data[key] = value
+
+    update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    await db.furnace_settings.update_one({"id": "default"}, {"$set": update_data}, upsert=True)
+    return {"message": "Furnace settings updated", "settings": await get_furnace_settings(db)}
+
+
+@furnace_router.get("/awaiting")
+async def get_awaiting_pieces(current_user: dict = Depends(get_erp_user)):
+    """Pieces waiting for toughening, counted per thickness"""
+    pieces = await collect_awaiting_pieces(get_db())
+    by_thickness = {}
+    for piece in pieces:
+        key = str(piece["thickness_mm"])
+        row = by_thickness.setdefault(key, {"pieces": 0, "area_sqft": 0})
+        row["pieces"] += 1
+        row["area_sqft"] = round(row["area_sqft"] + piece["width_mm"] * piece["height_mm"] / 92903.04, 2)
+    return {"total_pieces": len(pieces), "by_thickness": by_thickness}
+
+
+@furnace_router.post("/plan")
+async def plan_furnace_cycles(current_user: dict = Depends(get_erp_user)):
+    """Pack awaiting pieces into a new cycle proposal (replaces the previous unloaded proposal)"""
+    if current_user.get("role") not in FURNACE_ROLES:
+        raise HTTPException(status_code=403, detail="Not authorized to plan furnace loads")
+
+    db = get_db()
+    if not await claim_planning(db, datetime.now(timezone.utc)):
+        raise HTTPException(status_code=409, detail="A furnace plan is already being built - try again shortly")
+    try:
+        settings = await get_furnace_settings(db)
+        pieces = await collect_awaiting_pieces(db)
+        # Packing is CPU-bound (about 0.7 s for 1,500 pieces) - keep it off the event loop
+        plan = await asyncio.to_thread(plan_cycles, pieces, settings)
+
+        now = datetime.now(timezone.utc).isoformat()
+        plan_id = str(uuid.uuid4())
+        cycles = [{
+            "id": str(uuid.uuid4()),
+            "cycle_number": f"FC{datetime.now().strftime('%Y%m%d')}-{cycle['sequence']:02d}-{plan_id[:4].upper()}",
+            "plan_id": plan_id,
+            "status": "planned",
+            **cycle,
+            "bed_length_mm": settings["bed_length_mm"],
+            "bed_width_mm": settings["bed_width_mm"],
+            "planned_by": current_user.get("name", ""),
+            "planned_at": now
+        } for cycle in plan["cycles"]]
+
+        await replace_planned_cycles(db, cycles)
+        for cycle in cycles:
+            cycle.pop("_id", None)
+    finally:
+        await release_planning(db)
+
+    return {"plan_id": plan_id, "summary": plan["summary"], "cycles": cycles, "oversized": plan["oversized"]}
+
+
+@furnace_router.get("/cycles")
+async def get_furnace_cycles(
+    status: Optional[str] = None,
+    limit: int = 50,
+    current_user: dict = Depends(get_erp_user)
+):
+    """Cycles by status - planned cycles in load sequence, others newest first"""
+    db = get_db()
+    query = {"status": status} if status else {}
+    sort = [("sequence", 1)] if status == "planned" else [("planned_at", -1), ("sequence", 1)]
+    return await db.furnace_cycles.find(query, {"_id": 0}).sort(sort).to_list(min(limit, 200))
+
+
+@furnace_router.get("/cycles/{cycle_id}")
+async def get_furnace_cycle(cycle_id: str, current_user: dict = Depends(get_erp_user)):
+    cycle = await get_db().furnace_cycles.find_one({"id": cycle_id}, {"_id": 0})
+    if not cycle:
+        raise HTTPException(status_code=404, detail="Cycle not found")
+    return cycle
+
+
+@furnace_router.post("/cycles/{cycle_id}/load")
+async def load_furnace_cycle(cycle_id: str, current_user: dict = Depends(get_erp_user)):
+    """Mark a planned cycle as loaded into the furnace"""
+    if current_user.get("role") not in FURNACE_ROLES:
+        raise HTTPException(status_code=403, detail="Not authorized to load the furnace")
+
+    db = get_db()
+    result = await db.furnace_cycles.update_one(
+        {"id": cycle_id, "status": "planned"},
+        {"$set": {
+            "status": "loaded",
+            "loaded_at": datetime.now(timezone.utc).isoformat(),
+            "loaded_by": current_user.get("name", "")
+        }}
+    )
+    if result.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Cycle not found or not in planned status")
+    return {"message": "Cycle loaded"}
+
+
+@furnace_router.post("/cycles/{cycle_id}/complete")
+async def complete_furnace_cycle(
+    cycle_id: str,
+    data: Dict[str, Any],
+    current_user: dict = Depends(get_erp_user)
+):
+    """Close a loaded cycle and add it to the utilisation history"""
+    if current_user.get("role") not in FURNACE_ROLES:
+        raise HTTPException(status_code=403, detail="Not authorized to complete furnace cycles")
+
+    db = get_db()
+    now = datetime.now(timezone.utc).isoformat()
+    broken_pieces = int(data.get("broken_pieces", 0))
+    cycle = await db.furnace_cycles.find_one_and_update(
+        {"id": cycle_id, "status": "loaded"},
+        {"$set": {
+            "status": "completed",
+            "completed_at": now,
+            "completed_by": current_user.get("name", ""),
+            "broken_pieces": broken_pieces,
+            "notes": data.get("notes", "")
+        }},
+        projection={"_id": 0}
+    )
+    if not cycle:
+        raise HTTPException(status_code=400, detail="Cycle not found or not loaded")
+
+    await record_cycle_utilisation(db, cycle, broken_pieces, now)
+    return {"message": "Cycle completed", "utilisation": cycle["utilisation"]}
+
+
+@furnace_router.get("/utilisation")
+async def get_furnace_utilisation(days: int = 30, current_user: dict = Depends(get_erp_user)):
+    """Daily bed utilisation of completed cycles"""
+    db = get_db()
+    since = (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d")
+    rows = await db.furnace_utilisation.find({"date": {"$gte": since}}, {"_id": 0}).sort("date", 1).to_list(days + 1)
+
+    for row in rows:
+        row["utilisation"] = round(row["load_area_sqft"] / row["bed_area_sqft"], 4) if row.get("bed_area_sqft") else 0
+        for stats in row.get("by_thickness", {}).values():
+            stats["utilisation"] = round(stats["load_area_sqft"] / stats["bed_area_sqft"], 4) if stats.get("bed_area_sqft") else 0
+
+    load = sum(r.get("load_area_sqft", 0) for r in rows)
+    bed = sum(r.get("bed_area_sqft", 0) for r in rows)
+    return {
+        "days": days,
+        "cycles": sum(r.get("cycles", 0) for r in rows),
+        "pieces": sum(r.get("pieces", 0) for r in rows),
+        "broken_pieces": sum(r.get("broken_pieces", 0) for r in rows),
+        "utilisation": round(load / bed, 4) if bed else 0,
+        "daily": rows
+    }
+
+
+def generate_load_sheet_pdf(cycle: dict) -> bytes:
+    """Load sheet: cycle header, bed layout drawing and piece list"""
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+    from reportlab.graphics.shapes import Drawing, Rect, String
+    from reportlab.lib.units import mm
+
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=landscape(A4), rightMargin=12 * mm, leftMargin=12 * mm,
+                            topMargin=12 * mm, bottomMargin=12 * mm)
+    styles = getSampleStyleSheet()
+    elements = [Paragraph(f"Furnace Load Sheet - {cycle.get('cycle_number', '')}", styles['Heading1'])]
+
+    header = Table([
+        ["Thickness", f"{cycle['thickness_mm']} mm", "Pieces", str(cycle['piece_count']),
+         "Utilisation", f"{cycle['utilisation'] * 100:.1f}%"],
+        ["Sequence", str(cycle.get('sequence', '')), "Load area", f"{cycle['load_area_sqft']} sq.ft",
+         "Cycle time", f"{cycle.get('estimated_minutes', '')} min"],
+    ], colWidths=[28 * mm, 40 * mm, 28 * mm, 40 * mm, 28 * mm, 40 * mm])
+    header.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+        ('FONTNAME', (2, 0), (2, -1), 'Helvetica-Bold'),
+        ('FONTNAME', (4, 0), (4, -1), 'Helvetica-Bold'),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#ddd')),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+    ]))
+    elements += [header, Spacer(1, 4 * mm)]
+
+    # Bed layout, scaled to the page width
+    bed_length, bed_width = cycle["bed_length_mm"], cycle["bed_width_mm"]
+    scale = min(250 * mm / bed_length, 80 * mm / bed_width)
+    drawing = Drawing(bed_length * scale, bed_width * scale)
+    drawing.add(Rect(0, 0, bed_length * scale, bed_width * scale, fillColor=colors.HexColor('#f8fafc'),
+                     strokeColor=colors.HexColor('#334155')))
+    for index, piece in enumerate(cycle["pieces"], start=1):
+        w, h = (piece["height_mm"], piece["width_mm"]) if piece.get("rotated") else (piece["width_mm"], piece["height_mm"])
+        # Bed origin is the loading edge (bottom-left on the sheet)
+        drawing.add(Rect(piece["x_mm"] * scale, piece["y_mm"] * scale, w * scale, h * scale,
+                         fillColor=colors.HexColor('#ddd6fe'), strokeColor=colors.HexColor('#5b21b6')))
+        drawing.add(String((piece["x_mm"] + w / 2) * scale, (piece["y_mm"] + h / 2) * scale - 3, str(index),
+                           fontSize=7, textAnchor='middle'))
+    elements += [drawing, Spacer(1, 4 * mm)]
+
+    rows = [["#", "Reference", "Size (mm)", "Position x, y (mm)", "Rotated", "Due"]]
+    for index, piece in enumerate(cycle["pieces"], start=1):
+        rows.append([
+            index,
+            f"{piece.get('reference', '')} ({piece.get('piece_no', '')})",
+            f"{piece['width_mm']:g} x {piece['height_mm']:g}",
+            f"{piece['x_mm']:g}, {piece['y_mm']:g}",
+            "Yes" if piece.get("rotated") else "",
+            (piece.get("due") or "")[:10]
+        ])
+    pieces_table = Table(rows, colWidths=[10 * mm, 70 * mm, 40 * mm, 45 * mm, 20 * mm, 30 * mm], repeatRows=1)
+    pieces_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f5f3ff')),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#ddd')),
+        ('FONTSIZE', (0, 0), (-1, -1), 8),
+    ]))
+    elements.append(pieces_table)
+
+    doc.build(elements)
+    buffer.seek(0)
+    return buffer.read()
+
+
+@furnace_router.get("/cycles/{cycle_id}/load-sheet")
+async def download_load_sheet(cycle_id: str, current_user: dict = Depends(get_erp_user)):
+    """Download the load sheet PDF for a cycle"""
+    cycle = await get_db().furnace_cycles.find_one({"id": cycle_id}, {"_id": 0})
+    if not cycle:
+        raise HTTPException(status_code=404, detail="Cycle not found")
+
+    pdf_bytes = generate_load_sheet_pdf(cycle)
+    return StreamingResponse(
+        io.BytesIO(pdf_bytes),
+        media_type="application/pdf",
+        headers={"Content-Disposition": f"attachment; filename=load_sheet_{cycle.get('cycle_number', cycle_id)}.pdf"}
+    )
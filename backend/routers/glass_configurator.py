@@ -20,6 +20,7 @@ import io
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from routers.base import get_db, get_erp_user
+from utils.audit_sink import write_audit
 
 # PDF generation
 from reportlab.lib import colors
@@ -234,7 +235,7 @@ async def update_pricing_config(config: PricingConfig, db=Depends(get_db), user=
     await db.glass_pricing_config.insert_one(config_dict)
     
     # Audit log
-    await db.glass_config_audit.insert_one({
+    await write_audit(db, "glass_config_audit", {
         "action": "pricing_updated",
         "user_email": user.get("email"),
         "user_role": user.get("role"),
@@ -394,7 +395,7 @@ async def create_quotation(data: QuotationCreate, db=Depends(get_db), user=Depen
     await db.glass_quotations.insert_one(quotation)
     
     # Audit log
-    await db.glass_config_audit.insert_one({
+    await write_audit(db, "glass_config_audit", {
         "action": "quotation_created",
         "quotation_id": quotation["quotation_id"],
         "quotation_number": quotation_number,
@@ -476,7 +477,7 @@ async def send_quotation(quotation_id: str, db=Depends(get_db), user=Depends(get
         raise HTTPException(status_code=404, detail="Quotation not found")
     
     # Audit log
-    await db.glass_config_audit.insert_one({
+    await write_audit(db, "glass_config_audit", {
         "action": "quotation_sent",
         "quotation_id": quotation_id,
         "user_email": user.get("email"),
@@ -510,7 +511,7 @@ async def approve_quotation(quotation_id: str, db=Depends(get_db), user=Depends(
     )
     
     # Audit log
-    await db.glass_config_audit.insert_one({
+    await write_audit(db, "glass_config_audit", {
         "action": "quotation_approved",
         "quotation_id": quotation_id,
         "user_email": user.get("email"),
@@ -537,7 +538,7 @@ async def reject_quotation(quotation_id: str, reason: Optional[str] = None, db=D
         raise HTTPException(status_code=404, detail="Quotation not found")
     
     # Audit log
-    await db.glass_config_audit.insert_one({
+    await write_audit(db, "glass_config_audit", {
         "action": "quotation_rejected",
         "quotation_id": quotation_id,
         "user_email": user.get("email"),
@@ -602,7 +603,7 @@ async def convert_to_order(quotation_id: str, db=Depends(get_db), user=Depends(g
     )
     
     # Audit log
-    await db.glass_config_audit.insert_one({
+    await write_audit(db, "glass_config_audit", {
         "action": "quotation_converted_to_order",
         "quotation_id": quotation_id,
         "order_number": order_number,
@@ -1150,7 +1151,7 @@ async def send_quotation_email(quotation_id: str, db=Depends(get_db), user=Depen
         )
         
         # Audit log
-        await db.glass_config_audit.insert_one({
+        await write_audit(db, "glass_config_audit", {
             "action": "quotation_email_sent",
             "quotation_id": quotation_id,
             "recipient": customer_email,
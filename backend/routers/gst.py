@@ -4,16 +4,18 @@ GST Management System
 - HSN Code Management
 - CGST/SGST/IGST Calculation
 - GST Verification API
+- GSTR-1 / GSTR-3B returns (JSON or CSV)
 """
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from typing import Optional, List
 from datetime import datetime, timezone
 import uuid
-import httpx
 import re
 
 from routers.base import get_db, get_erp_user
+from utils.gstin_registry import gstin_error, invalidate_api_settings, normalize_gstin, verify_gstin_cached
 
 gst_router = APIRouter(prefix="/gst", tags=["GST Management"])
 
@@ -137,6 +139,7 @@ async def update_gst_settings(
     doc["updated_at"] = datetime.now(timezone.utc).isoformat()
     
     await db.gst_settings.update_one({}, {"$set": doc}, upsert=True)
+    invalidate_api_settings()
     return {"message": "GST settings updated", "settings": {**doc, "gst_api_key": "***" if doc.get("gst_api_key") else None}}
 
 # ============ HSN CODES ============
@@ -264,84 +267,82 @@ async def calculate_gst(request: GSTCalculationRequest):
 @gst_router.post("/verify")
 async def verify_gstin(
     request: GSTVerifyRequest,
+    refresh: bool = False,
     current_user: dict = Depends(get_erp_user)
 ):
-    """Verify GSTIN using GST API"""
+    """Verify GSTIN using GST API (cached in the GSTIN registry)"""
     db = get_db()
     
-    # Validate GSTIN format
-    gstin_pattern = r'^[0-9]{2}[A-Z]{5}[0-9]{4}[A-Z]{1}[1-9A-Z]{1}Z[0-9A-Z]{1}$'
-    if not re.match(gstin_pattern, request.gstin.upper()):
-        raise HTTPException(status_code=400, detail="Invalid GSTIN format")
+    # Validate GSTIN format and checksum locally before any API call
+    gstin = normalize_gstin(request.gstin)
+    error = gstin_error(gstin)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
     
-    gstin = request.gstin.upper()
-    
-    # Get API settings
-    settings = await db.gst_settings.find_one({}, {"_id": 0})
-    
-    # Check if API is enabled
-    if not settings or not settings.get("gst_api_enabled") or not settings.get("gst_api_key"):
-        # Return basic info from GSTIN (without API verification)
-        state_code = gstin[:2]
-        return {
-            "gstin": gstin,
-            "valid": True,
-            "verified_via_api": False,
-            "state_code": state_code,
-            "state_name": INDIAN_STATES.get(state_code, "Unknown"),
-            "message": "GST API not configured. Basic validation passed."
-        }
-    
-    # Call GST API for verification
-    try:
-        api_key = settings.get("gst_api_key")
-        # Using a generic GST API endpoint - can be replaced with actual API
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(
-                f"https://api.gst.gov.in/commonapi/v1.0/search?gstin={gstin}",
-                headers={"Authorization": f"Bearer {api_key}"}
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                return {
-                    "gstin": gstin,
-                    "valid": True,
-                    "verified_via_api": True,
-                    "legal_name": data.get("lgnm", ""),
-                    "trade_name": data.get("tradeNam", ""),
-                    "state_code": data.get("stj", gstin[:2]),
-                    "state_name": INDIAN_STATES.get(gstin[:2], "Unknown"),
-                    "status": data.get("sts", ""),
-                    "registration_date": data.get("rgdt", ""),
-                    "business_type": data.get("ctb", ""),
-                    "address": data.get("pradr", {}).get("adr", "")
-                }
-            else:
-                raise HTTPException(status_code=400, detail="GST verification failed")
-                
-    except httpx.TimeoutException:
-        # Fallback to basic validation
-        state_code = gstin[:2]
-        return {
-            "gstin": gstin,
-            "valid": True,
-            "verified_via_api": False,
-            "state_code": state_code,
-            "state_name": INDIAN_STATES.get(state_code, "Unknown"),
-            "message": "GST API timeout. Basic validation passed."
-        }
-    except Exception as e:
-        # Fallback to basic validation
-        state_code = gstin[:2]
-        return {
-            "gstin": gstin,
-            "valid": True,
-            "verified_via_api": False,
-            "state_code": state_code,
-            "state_name": INDIAN_STATES.get(state_code, "Unknown"),
-            "message": f"API error: {str(e)}. Basic validation passed."
-        }
+    return await verify_gstin_cached(db, gstin, force_refresh=refresh)
+
+# ============ GST RETURNS ============
+
+RETURN_PERIOD_PATTERN = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+
+def _check_return_request(period: str, format: str):
+    if not RETURN_PERIOD_PATTERN.match(period):
+        raise HTTPException(status_code=400, detail="Period must be YYYY-MM")
+    if format not in ["json", "csv"]:
+        raise HTTPException(status_code=400, detail="Format must be json or csv")
+
+@gst_router.get("/returns/{period}/gstr1")
+async def get_gstr1(
+    period: str,
+    format: str = "json",
+    current_user: dict = Depends(get_erp_user)
+):
+    """GSTR-1 (B2B, B2CL, B2CS, HSN summary) for a month"""
+    from utils.gst_returns import build_gstr1, period_status, stream_gstr1_csv
+    _check_return_request(period, format)
+    db = get_db()
+    if format == "csv":
+        status = await period_status(db, period)
+        return StreamingResponse(
+            stream_gstr1_csv(db, period),
+            media_type="text/csv",
+            headers={"Content-Disposition": f"attachment; filename=GSTR1_{period}.csv",
+                     "X-Return-Stale": str(status["stale"]).lower()}
+        )
+    return await build_gstr1(db, period)
+
+@gst_router.get("/returns/{period}/gstr3b")
+async def get_gstr3b(
+    period: str,
+    format: str = "json",
+    current_user: dict = Depends(get_erp_user)
+):
+    """GSTR-3B tables 3.1, 3.2 and 4 for a month"""
+    from utils.gst_returns import build_gstr3b, period_status, stream_gstr3b_csv
+    _check_return_request(period, format)
+    db = get_db()
+    if format == "csv":
+        status = await period_status(db, period)
+        return StreamingResponse(
+            stream_gstr3b_csv(db, period),
+            media_type="text/csv",
+            headers={"Content-Disposition": f"attachment; filename=GSTR3B_{period}.csv",
+                     "X-Return-Stale": str(status["stale"]).lower()}
+        )
+    return await build_gstr3b(db, period)
+
+@gst_router.post("/returns/{period}/rebuild")
+async def rebuild_gst_return(period: str, current_user: dict = Depends(get_erp_user)):
+    """Recompute a month's return aggregates from its invoices"""
+    if current_user.get("role") not in ["super_admin", "admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    from utils.gst_returns import rebuild_gst_returns
+    _check_return_request(period, "json")
+    db = get_db()
+    result = await rebuild_gst_returns(db, period)
+    if result["status"] == "skipped":
+        raise HTTPException(status_code=409, detail=f"A rebuild of {period} is already running")
+    return {"message": f"Rebuilt GST returns for {period}", **result}
 
 # ============ PUBLIC ENDPOINTS ============
 
@@ -8,6 +8,7 @@ from datetime import datetime, timezone, timedelta, date
 import uuid
 import calendar
 from .base import get_erp_user, get_db
+from utils.production_schedule import invalidate_schedule
 
 holiday_router = APIRouter(prefix="/holidays", tags=["Holidays & Calendar"])
 
@@ -76,6 +77,7 @@ async def update_holiday_settings(
         {"$set": update_data},
         upsert=True
     )
+    await invalidate_schedule(db)  # Weekly offs drive the production shift calendar
     
     return {"message": "Settings updated"}
 
@@ -111,6 +113,7 @@ async def create_holiday(
         raise HTTPException(status_code=400, detail="Holiday already exists for this date")
     
     await db.holidays.insert_one(holiday)
+    await invalidate_schedule(db)
     
     return {"message": "Holiday created", "holiday": {k: v for k, v in holiday.items() if k != "_id"}}
 
@@ -231,6 +234,7 @@ async def delete_holiday(holiday_id: str, current_user: dict = Depends(get_erp_u
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Holiday not found")
+    await invalidate_schedule(db)
     
     return {"message": "Holiday deleted"}
 
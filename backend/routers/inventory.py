@@ -4,9 +4,19 @@ Inventory Router - Materials management, stock transactions, low-stock alerts
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
 from typing import Optional, Dict, Any
 from datetime import datetime, timezone
+from pydantic import BaseModel, Field
 import uuid
 from .base import get_erp_user, get_db
 from .notifications import notify_low_stock
+from utils.dashboard_metrics import invalidate_dashboard_metrics
+from utils.inventory_valuation import (
+    VALUATION_METHODS, DEFAULT_VALUATION_METHOD, get_stock_valuation, initialise_material_valuation
+)
+from utils.replenishment import generate_purchase_suggestions, get_replenishment_settings, refresh_replenishment
+from utils.stock_ledger import (
+    InsufficientStockError, MaterialNotFoundError, get_low_stock_materials, is_low_stock,
+    move_stock, set_minimum_stock_flag
+)
 
 inventory_router = APIRouter(prefix="/inventory", tags=["Inventory"])
 
@@ -25,11 +35,16 @@ async def create_material(material_data: Dict[str, Any], current_user: dict = De
         "unit_price": float(material_data.get("unit_price", 0)),
         "location": material_data.get("location", "Main Store"),
         "supplier_id": material_data.get("supplier_id", ""),
+        "valuation_method": material_data.get("valuation_method", DEFAULT_VALUATION_METHOD),  # fifo, weighted_average
         "last_restocked": None,
         "status": "active",
         "created_at": datetime.now(timezone.utc).isoformat()
     }
+    if material["valuation_method"] not in VALUATION_METHODS:
+        raise HTTPException(status_code=400, detail=f"Invalid valuation method. Must be one of: {list(VALUATION_METHODS)}")
+    material["is_low_stock"] = is_low_stock(material)
     await db.raw_materials.insert_one(material)
+    await initialise_material_valuation(db, material["id"])
     return {"message": "Material created", "material_id": material["id"]}
 
 
@@ -45,12 +60,11 @@ async def get_materials(
     if category:
         query["category"] = category
     
-    materials = await db.raw_materials.find(query, {"_id": 0}).to_list(500)
-    
     # Filter low stock if requested
     if low_stock:
-        materials = [m for m in materials if m.get("current_stock", 0) <= m.get("minimum_stock", 10)]
+        query["is_low_stock"] = True
     
+    materials = await db.raw_materials.find(query, {"_id": 0}).to_list(500)
     return materials
 
 
@@ -85,6 +99,9 @@ async def update_material(
     update_fields["updated_at"] = datetime.now(timezone.utc).isoformat()
     
     await db.raw_materials.update_one({"id": material_id}, {"$set": update_fields})
+    if "minimum_stock" in update_fields:
+        await set_minimum_stock_flag(db, material_id)
+        invalidate_dashboard_metrics("inventory")
     return {"message": "Material updated"}
 
 
@@ -96,56 +113,41 @@ async def create_inventory_transaction(
 ):
     """Create stock transaction (IN/OUT)"""
     db = get_db()
-    material = await db.raw_materials.find_one({"id": txn_data.get("material_id")}, {"_id": 0})
-    if not material:
-        raise HTTPException(status_code=404, detail="Material not found")
-    
     txn_type = txn_data.get("type", "IN")  # IN, OUT, ADJUST
     quantity = float(txn_data.get("quantity", 0))
     
-    # Calculate new stock
-    current_stock = material.get("current_stock", 0)
-    if txn_type == "IN":
-        new_stock = current_stock + quantity
-    elif txn_type == "OUT":
-        if quantity > current_stock:
-            raise HTTPException(status_code=400, detail="Insufficient stock")
-        new_stock = current_stock - quantity
-    else:  # ADJUST
-        new_stock = quantity
-    
-    transaction = {
-        "id": str(uuid.uuid4()),
-        "material_id": txn_data.get("material_id"),
-        "material_name": material.get("name"),
-        "type": txn_type,
-        "quantity": quantity,
-        "previous_stock": current_stock,
-        "new_stock": new_stock,
-        "reference": txn_data.get("reference", ""),  # PO number, job card, etc.
-        "notes": txn_data.get("notes", ""),
-        "created_by": current_user.get("id", "system"),
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    
-    await db.inventory_transactions.insert_one(transaction)
-    
-    # Update material stock
-    update_fields = {"current_stock": new_stock, "updated_at": datetime.now(timezone.utc).isoformat()}
-    if txn_type == "IN":
-        update_fields["last_restocked"] = datetime.now(timezone.utc).isoformat()
-    
-    await db.raw_materials.update_one({"id": txn_data.get("material_id")}, {"$set": update_fields})
+    # Conditional atomic update + ledger row in one transaction
+    try:
+        transaction = await move_stock(
+            db,
+            txn_data.get("material_id"),
+            txn_type,
+            quantity,
+            reference=txn_data.get("reference", ""),  # PO number, job card, etc.
+            notes=txn_data.get("notes", ""),
+            created_by=current_user.get("id", "system"),
+            unit_cost=float(txn_data["unit_cost"]) if txn_data.get("unit_cost") is not None else None
+        )
+    except MaterialNotFoundError:
+        raise HTTPException(status_code=404, detail="Material not found")
+    except InsufficientStockError:
+        raise HTTPException(status_code=400, detail="Insufficient stock")
+    invalidate_dashboard_metrics("inventory")
     
     # Check for low stock and send alert if needed
-    if new_stock <= material.get("minimum_stock", 10):
+    if transaction["material"]["is_low_stock"]:
         # Get all low stock items for a comprehensive alert
-        all_materials = await db.raw_materials.find({"status": "active"}, {"_id": 0}).to_list(500)
-        low_stock_items = [m for m in all_materials if m.get("current_stock", 0) <= m.get("minimum_stock", 10)]
+        low_stock_items = await get_low_stock_materials(db)
         if low_stock_items:
             background_tasks.add_task(notify_low_stock, low_stock_items)
     
-    return {"message": "Transaction recorded", "transaction_id": transaction["id"], "new_stock": new_stock}
+    return {
+        "message": "Transaction recorded",
+        "transaction_id": transaction["id"],
+        "new_stock": transaction["new_stock"],
+        "value": transaction["value"],
+        "stock_value": transaction["stock_value"]
+    }
 
 
 @inventory_router.get("/transactions")
@@ -169,7 +171,103 @@ async def get_inventory_transactions(
 @inventory_router.get("/low-stock")
 async def get_low_stock_items(current_user: dict = Depends(get_erp_user)):
     """Get items below minimum stock level"""
+    return await get_low_stock_materials(get_db())
+
+
+# =============== VALUATION ===============
+
+@inventory_router.get("/valuation")
+async def get_inventory_valuation(
+    as_of: Optional[str] = None,
+    category: Optional[str] = None,
+    current_user: dict = Depends(get_erp_user)
+):
+    """Stock value per material (FIFO / weighted average), current or as of a date (YYYY-MM-DD)"""
+    if as_of:
+        try:
+            datetime.strptime(as_of, "%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="as_of must be YYYY-MM-DD")
+    return await get_stock_valuation(get_db(), as_of, category)
+
+
+@inventory_router.get("/materials/{material_id}/cost-layers")
+async def get_material_cost_layers(material_id: str, current_user: dict = Depends(get_erp_user)):
+    """Open FIFO cost layers of a material, oldest first"""
+    db = get_db()
+    material = await db.raw_materials.find_one(
+        {"id": material_id}, {"_id": 0, "id": 1, "name": 1, "current_stock": 1, "stock_value": 1, "valuation_method": 1}
+    )
+    if not material:
+        raise HTTPException(status_code=404, detail="Material not found")
+    
+    layers = await db.stock_cost_layers.find(
+        {"material_id": material_id, "remaining": {"$gt": 0}}, {"_id": 0}
+    ).sort("received_at", 1).to_list(1000)
+    return {"material": material, "layers": layers}
+
+
+# =============== REPLENISHMENT ===============
+
+@inventory_router.get("/replenishment")
+async def get_replenishment(
+    needs_reorder: Optional[bool] = None,
+    current_user: dict = Depends(get_erp_user)
+):
+    """Reorder point, safety stock and cover per material (folds in new activity since the last call)"""
+    items = await refresh_replenishment(get_db())
+    if needs_reorder is not None:
+        items = [i for i in items if i["needs_reorder"] == needs_reorder]
+    items.sort(key=lambda i: (not i["needs_reorder"], i["days_of_cover"] if i["days_of_cover"] is not None else float("inf")))
+    return {"materials": items, "count": len(items), "to_reorder": sum(1 for i in items if i["needs_reorder"])}
+
+
+@inventory_router.get("/replenishment/settings")
+async def get_replenishment_config(current_user: dict = Depends(get_erp_user)):
+    """Service level, consumption window, default lead time and cover days"""
+    return await get_replenishment_settings(get_db())
+
+
+class ReplenishmentSettingsUpdate(BaseModel):
+    window_days: Optional[int] = Field(None, gt=0)
+    service_level: Optional[float] = Field(None, ge=0.5, lt=1)
+    default_lead_time_days: Optional[float] = Field(None, gt=0)
+    cover_days: Optional[float] = Field(None, gt=0)
+    lead_time_samples: Optional[int] = Field(None, gt=0)
+
+
+@inventory_router.put("/replenishment/settings")
+async def update_replenishment_config(settings: ReplenishmentSettingsUpdate, current_user: dict = Depends(get_erp_user)):
+    """Update replenishment settings"""
+    if current_user.get("role") not in ["super_admin", "admin", "owner", "purchase"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    # Coerced values only, so compute_reorder always gets ints for the window and sample count
+    update = settings.model_dump(exclude_none=True)
+    
+    db = get_db()
+    await db.replenishment_settings.update_one(
+        {"id": "default"},
+        {"$set": {**update, "updated_by": current_user.get("name"), "updated_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+    return await get_replenishment_settings(db)
+
+
+@inventory_router.post("/replenishment/suggestions")
+async def run_purchase_suggestions(current_user: dict = Depends(get_erp_user)):
+    """Batch run: one suggested PO per vendor for everything at or below its reorder point"""
+    if current_user.get("role") not in ["super_admin", "admin", "owner", "purchase", "store"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return await generate_purchase_suggestions(get_db(), current_user.get("name", "system"))
+
+
+@inventory_router.get("/replenishment/suggestions")
+async def get_purchase_suggestions(
+    status: str = "suggested",
+    current_user: dict = Depends(get_erp_user)
+):
+    """Purchase suggestions from the latest runs"""
     db = get_db()
-    materials = await db.raw_materials.find({"status": "active"}, {"_id": 0}).to_list(500)
-    low_stock = [m for m in materials if m.get("current_stock", 0) <= m.get("minimum_stock", 10)]
-    return low_stock
+    suggestions = await db.purchase_suggestions.find({"status": status}, {"_id": 0}).sort("created_at", -1).to_list(200)
+    return {"suggestions": suggestions, "count": len(suggestions)}
@@ -22,6 +22,7 @@ import io
 import ssl
 
 from routers.base import get_db, get_erp_user
+from utils.pagination import paginate
 from routers.sms import send_whatsapp
 
 job_work_router = APIRouter(prefix="/job-work", tags=["Job Work"])
@@ -679,6 +680,8 @@ async def get_job_work_orders(
     limit: int = 10,
     status: Optional[str] = None,
     search: Optional[str] = None,
+    cursor: Optional[str] = None,
+    include_total: bool = True,
     current_user: dict = Depends(get_erp_user)
 ):
     """Get all job work orders (Admin) with pagination"""
@@ -697,18 +700,20 @@ async def get_job_work_orders(
         ]
     
     # Pagination
-    limit = min(limit, 200)  # Max 200 per page
+    limit = max(1, min(limit, 200))  # Max 200 per page
     skip = (page - 1) * limit
     
-    total = await db.job_work_orders.count_documents(query)
-    orders = await db.job_work_orders.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    try:
+        result = await paginate(db.job_work_orders, query, limit=limit, cursor=cursor, skip=skip,
+                                include_total=include_total)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     return {
-        "orders": orders,
-        "total": total,
+        "orders": result.pop("items"),
         "page": page,
         "limit": limit,
-        "total_pages": (total + limit - 1) // limit
+        **result
     }
 
 @job_work_router.get("/my-orders")
@@ -15,6 +15,9 @@ import uuid
 import os
 
 from .base import get_db, get_erp_user
+from utils.period_close import (
+    close_period, reopen_period, reopen_periods_containing, gl_totals, party_totals
+)
 
 ledger_router = APIRouter(prefix="/ledger", tags=["Ledger Management"])
 
@@ -254,6 +257,9 @@ async def auto_post_to_ledger(
     
     await db.gl_entries.insert_many(gl_entries)
     
+    # A back-dated posting invalidates any frozen aggregates covering its date
+    await reopen_periods_containing(db, transaction_date, f"{entry_type} {reference_number} posted on {transaction_date}")
+    
     # Log to audit trail
     await db.ledger_audit.insert_one({
         "id": str(uuid.uuid4()),
@@ -430,6 +436,7 @@ async def get_opening_balances(
 @ledger_router.post("/period-lock")
 async def create_period_lock(
     data: PeriodLockCreate,
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(get_erp_user)
 ):
     """Create period lock (quarterly/half-yearly)"""
@@ -464,6 +471,9 @@ async def create_period_lock(
         "created_at": datetime.now(timezone.utc).isoformat()
     })
     
+    # Freeze the period's aggregates (deferred to the nightly close if it has not ended yet)
+    background_tasks.add_task(close_period, db, lock_id, current_user.get("name"))
+    
     return {"message": "Period lock created", "id": lock_id}
 
 
@@ -482,6 +492,7 @@ async def get_period_locks(current_user: dict = Depends(get_erp_user)):
 @ledger_router.put("/period-lock/{lock_id}/toggle")
 async def toggle_period_lock(
     lock_id: str,
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(get_erp_user)
 ):
     """Toggle period lock active/inactive"""
@@ -501,9 +512,51 @@ async def toggle_period_lock(
         {"$set": {"is_active": new_status, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
     
+    # An unlocked period can change again - stop serving its frozen aggregates
+    if new_status:
+        background_tasks.add_task(close_period, db, lock_id, current_user.get("name"))
+    else:
+        await reopen_period(db, lock_id, f"Lock deactivated by {current_user.get('name')}")
+    
     return {"message": f"Lock {'activated' if new_status else 'deactivated'}", "is_active": new_status}
 
 
+@ledger_router.post("/period-lock/{lock_id}/close")
+async def run_period_close(
+    lock_id: str,
+    current_user: dict = Depends(get_erp_user)
+):
+    """Run (or retry) the close job of a locked period now"""
+    if current_user.get("role") not in ["super_admin", "admin"]:
+        raise HTTPException(status_code=403, detail="Only Admin/Super Admin can close periods")
+    
+    db = get_db()
+    
+    lock = await db.period_locks.find_one({"id": lock_id}, {"_id": 0})
+    if not lock:
+        raise HTTPException(status_code=404, detail="Lock not found")
+    if lock.get("close_status") in ["closing", "closed"]:
+        return {"message": f"Period already {lock['close_status']}", "close_id": lock.get("close_id")}
+    
+    result = await close_period(db, lock_id, current_user.get("name"))
+    if result["status"] != "closed":
+        raise HTTPException(status_code=400, detail="Only an active lock on an ended period can be closed")
+    
+    return {"message": "Period closed", **result}
+
+
+@ledger_router.get("/period-closes")
+async def get_period_closes(current_user: dict = Depends(get_erp_user)):
+    """Get period close history (closed and reopened)"""
+    if current_user.get("role") not in ["super_admin", "admin", "finance", "accountant", "ca"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    db = get_db()
+    closes = await db.period_closes.find({}, {"_id": 0}).sort("period_start", -1).to_list(100)
+    
+    return {"closes": closes, "count": len(closes)}
+
+
 @ledger_router.put("/period-lock/{lock_id}/grant-access")
 async def grant_period_access(
     lock_id: str,
@@ -648,39 +701,13 @@ async def get_customer_outstanding(
     
     db = get_db()
     
-    # Aggregate customer balances
-    pipeline = [
-        {"$match": {"party_type": "customer"}},
-        {"$group": {
-            "_id": "$party_id",
-            "party_name": {"$first": "$party_name"},
-            "total_debit": {
-                "$sum": {"$cond": [{"$eq": ["$effect", "debit"]}, "$total_amount", 0]}
-            },
-            "total_credit": {
-                "$sum": {"$cond": [{"$eq": ["$effect", "credit"]}, "$total_amount", 0]}
-            },
-            "last_transaction": {"$max": "$transaction_date"},
-            "entries": {"$push": {
-                "transaction_date": "$transaction_date",
-                "effect": "$effect",
-                "amount": "$total_amount"
-            }}
-        }},
-        {"$project": {
-            "party_id": "$_id",
-            "party_name": 1,
-            "total_debit": 1,
-            "total_credit": 1,
-            "outstanding": {"$subtract": ["$total_debit", "$total_credit"]},
-            "last_transaction": 1,
-            "entries": 1
-        }},
-        {"$match": {"outstanding": {"$ne": 0}}},
-        {"$sort": {"outstanding": -1}}
-    ]
-    
-    results = await db.party_ledger.aggregate(pipeline).to_list(1000)
+    # Customer balances - frozen periods from their close, the rest live
+    results = []
+    for row in await party_totals(db, "customer"):
+        row["outstanding"] = row["total_debit"] - row["total_credit"]
+        if row["outstanding"] != 0:
+            results.append(row)
+    results.sort(key=lambda r: r["outstanding"], reverse=True)
     
     # Add opening balances and calculate ageing
     customers = []
@@ -719,7 +746,6 @@ async def get_customer_outstanding(
                 ageing_summary[bucket] += amount
         
         del result["entries"]
-        del result["_id"]
         
         result["outstanding"] = round(result["outstanding"], 2)
         total_outstanding += result["outstanding"]
@@ -851,39 +877,13 @@ async def get_vendor_outstanding(
     
     db = get_db()
     
-    # Aggregate vendor balances
-    pipeline = [
-        {"$match": {"party_type": "vendor"}},
-        {"$group": {
-            "_id": "$party_id",
-            "party_name": {"$first": "$party_name"},
-            "total_credit": {
-                "$sum": {"$cond": [{"$eq": ["$effect", "credit"]}, "$total_amount", 0]}
-            },
-            "total_debit": {
-                "$sum": {"$cond": [{"$eq": ["$effect", "debit"]}, "$total_amount", 0]}
-            },
-            "last_transaction": {"$max": "$transaction_date"},
-            "entries": {"$push": {
-                "transaction_date": "$transaction_date",
-                "effect": "$effect",
-                "amount": "$total_amount"
-            }}
-        }},
-        {"$project": {
-            "party_id": "$_id",
-            "party_name": 1,
-            "total_debit": 1,
-            "total_credit": 1,
-            "outstanding": {"$subtract": ["$total_credit", "$total_debit"]},
-            "last_transaction": 1,
-            "entries": 1
-        }},
-        {"$match": {"outstanding": {"$ne": 0}}},
-        {"$sort": {"outstanding": -1}}
-    ]
-    
-    results = await db.party_ledger.aggregate(pipeline).to_list(1000)
+    # Vendor balances - frozen periods from their close, the rest live
+    results = []
+    for row in await party_totals(db, "vendor"):
+        row["outstanding"] = row["total_credit"] - row["total_debit"]
+        if row["outstanding"] != 0:
+            results.append(row)
+    results.sort(key=lambda r: r["outstanding"], reverse=True)
     
     vendors = []
     total_outstanding = 0
@@ -919,7 +919,6 @@ async def get_vendor_outstanding(
                 ageing_summary[bucket] += amount
         
         del result["entries"]
-        del result["_id"]
         
         result["outstanding"] = round(result["outstanding"], 2)
         total_outstanding += result["outstanding"]
@@ -1040,33 +1039,16 @@ async def get_trial_balance(
     # Get all accounts
     accounts = await db.gl_accounts.find({"is_active": True}, {"_id": 0}).to_list(100)
     
+    # Debit/credit totals per account - frozen periods from their close, the rest live
+    totals = await gl_totals(db, as_of_date)
+    
     trial_balance = []
     total_debit = 0
     total_credit = 0
     
     for account in accounts:
-        # Get all entries up to as_of_date
-        pipeline = [
-            {"$match": {
-                "account_code": account["code"],
-                "transaction_date": {"$lte": as_of_date}
-            }},
-            {"$group": {
-                "_id": "$entry_type",
-                "total": {"$sum": "$amount"}
-            }}
-        ]
-        
-        results = await db.gl_entries.aggregate(pipeline).to_list(2)
-        
-        debit_total = 0
-        credit_total = 0
-        
-        for r in results:
-            if r["_id"] == "debit":
-                debit_total = r["total"]
-            else:
-                credit_total = r["total"]
+        debit_total = totals.get(account["code"], {}).get("debit", 0)
+        credit_total = totals.get(account["code"], {}).get("credit", 0)
         
         opening = account.get("opening_balance", 0)
         is_debit_account = account.get("balance_type") == "debit"
@@ -17,6 +17,9 @@ import aiosmtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
+from utils.customer_balance import reserve_credit, update_order_and_balance
+from utils.pagination import paginate
+from utils.transactions import run_in_transaction
 
 orders_router = APIRouter(prefix="/orders", tags=["Orders"])
 
@@ -188,7 +191,7 @@ async def create_order(
     if order_data.customer_profile_id:
         customer_profile = await db.customer_profiles.find_one(
             {"id": order_data.customer_profile_id, "status": "active"},
-            {"_id": 0}
+            {"_id": 0, "search_tokens": 0}
         )
         if not customer_profile:
             raise HTTPException(status_code=404, detail="Customer profile not found or inactive")
@@ -269,18 +272,10 @@ async def create_order(
     if not is_valid:
         raise HTTPException(status_code=400, detail=error)
     
-    # Check credit limit for credit customers
+    # Check credit limit for credit customers (fast fail before creating a Razorpay order;
+    # the limit is enforced atomically when the order is saved)
     if is_credit_customer and customer_profile:
-        # Get current outstanding
-        outstanding = 0
-        existing_orders = await db.orders.find({
-            "customer_profile_id": order_data.customer_profile_id,
-            "payment_status": {"$ne": "completed"}
-        }, {"remaining_amount": 1}).to_list(1000)
-        
-        for o in existing_orders:
-            outstanding += o.get("remaining_amount", 0)
-        
+        outstanding = customer_profile.get("credit_exposure", 0) or 0
         if outstanding + total_price > credit_limit:
             raise HTTPException(
                 status_code=400, 
@@ -346,7 +341,28 @@ async def create_order(
         "updated_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.orders.insert_one(order)
+    async def save_order(session):
+        # Reserve credit and insert the order together - concurrent orders cannot overshoot the limit
+        if customer_profile:
+            reserved = await reserve_credit(
+                db, order_data.customer_profile_id, order,
+                limit_check=total_price if is_credit_customer else None,
+                session=session
+            )
+            if not reserved:
+                if not is_credit_customer:
+                    raise HTTPException(status_code=404, detail="Customer profile not found or inactive")
+                current = await db.customer_profiles.find_one(
+                    {"id": order_data.customer_profile_id}, {"_id": 0, "credit_exposure": 1}, session=session
+                )
+                outstanding = (current or {}).get("credit_exposure", 0)
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Order exceeds credit limit. Current outstanding: ₹{outstanding:,.2f}, Limit: ₹{credit_limit:,.2f}"
+                )
+        await db.orders.insert_one(order, session=session)
+    
+    await run_in_transaction(db, save_order)
     
     # AUTO-POST TO PARTY LEDGER & GL
     # Sales Invoice → Debit Accounts Receivable, Credit Sales + GST
@@ -407,18 +423,13 @@ async def verify_payment(
     # Update order
     payment_status = "partial" if order.get("remaining_amount", 0) > 0 else "completed"
     
-    await db.orders.update_one(
-        {"id": order_id},
-        {
-            "$set": {
-                "razorpay_payment_id": razorpay_payment_id,
-                "payment_status": payment_status,
-                "status": "processing" if payment_status in ["partial", "completed"] else "pending",
-                "advance_paid_at": datetime.now(timezone.utc).isoformat(),
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }
-        }
-    )
+    await update_order_and_balance(db, {"id": order_id}, {
+        "razorpay_payment_id": razorpay_payment_id,
+        "payment_status": payment_status,
+        "status": "processing" if payment_status in ["partial", "completed"] else "pending",
+        "advance_paid_at": datetime.now(timezone.utc).isoformat(),
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    })
     
     # AUTO-POST TO PARTY LEDGER & GL
     # Payment Received → Debit Cash/Bank, Credit Accounts Receivable
@@ -517,18 +528,13 @@ async def verify_remaining_payment(
             raise HTTPException(status_code=400, detail="Payment verification failed")
     
     # Update order
-    await db.orders.update_one(
-        {"id": order_id},
-        {
-            "$set": {
-                "remaining_razorpay_payment_id": payment_data.razorpay_payment_id,
-                "remaining_amount": 0,
-                "payment_status": "completed",
-                "remaining_paid_at": datetime.now(timezone.utc).isoformat(),
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }
-        }
-    )
+    await update_order_and_balance(db, {"id": order_id}, {
+        "remaining_razorpay_payment_id": payment_data.razorpay_payment_id,
+        "remaining_amount": 0,
+        "payment_status": "completed",
+        "remaining_paid_at": datetime.now(timezone.utc).isoformat(),
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    })
     
     return {
         "message": "Remaining payment verified successfully",
@@ -571,7 +577,7 @@ async def mark_cash_received(
         update_data["remaining_paid_at"] = datetime.now(timezone.utc).isoformat()
         update_data["remaining_payment_method"] = "cash"
     
-    await db.orders.update_one({"id": order_id}, {"$set": update_data})
+    await update_order_and_balance(db, {"id": order_id}, update_data)
     
     # Record cash payment
     await db.cash_payments.insert_one({
@@ -1083,6 +1089,8 @@ async def admin_get_all_orders(
     skip: int = 0,
     limit: int = 100,
     status: Optional[str] = None,
+    cursor: Optional[str] = None,
+    include_total: bool = True,
     current_user: dict = Depends(get_current_user)
 ):
     """Get all orders (admin only), optionally with 3D glass designs"""
@@ -1097,11 +1105,14 @@ async def admin_get_all_orders(
     if status:
         filter_query["status"] = status
     
-    # Get orders
-    orders = await db.orders.find(
-        filter_query,
-        {"_id": 0}
-    ).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    # Get orders (keyset page when a cursor is given)
+    limit = max(1, limit)
+    try:
+        result = await paginate(db.orders, filter_query, limit=limit, cursor=cursor, skip=skip,
+                                include_total=include_total)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    orders = result.pop("items")
     
     # Populate glass configs if requested
     if include_designs:
@@ -1114,14 +1125,11 @@ async def admin_get_all_orders(
                 if glass_config:
                     order["glass_config"] = glass_config
     
-    # Get total count
-    total = await db.orders.count_documents(filter_query)
-    
     return {
         "orders": orders,
-        "total": total,
         "skip": skip,
-        "limit": limit
+        "limit": limit,
+        **result
     }
 
 
@@ -1165,10 +1173,8 @@ async def update_order_status(
     if notes:
         update_data["status_notes"] = notes
     
-    await db.orders.update_one(
-        {"id": order_id},
-        {"$set": update_data}
-    )
+    # Cancelling releases the order's outstanding amount and credit exposure
+    await update_order_and_balance(db, {"id": order_id}, update_data)
     
     # Get updated order for notification
     updated_order = await db.orders.find_one({"id": order_id}, {"_id": 0})
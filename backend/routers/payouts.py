@@ -9,10 +9,12 @@ from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
 from typing import Optional, Dict, Any, List
 from datetime import datetime, timezone
 import uuid
+import asyncio
 import razorpay
 import requests
 import os
 from .base import get_erp_user, get_db
+from utils.transactions import run_in_transaction
 
 payouts_router = APIRouter(prefix="/payouts", tags=["Payouts"])
 
@@ -26,15 +28,20 @@ razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
 # RazorpayX API base URL for Payouts
 RAZORPAYX_BASE_URL = "https://api.razorpay.com/v1"
 
+# Max RazorpayX payout calls in flight during bulk salary disbursement
+PAYOUT_CONCURRENCY = int(os.environ.get('PAYOUT_CONCURRENCY', '5'))
 
-def razorpayx_request(method: str, endpoint: str, data: dict = None) -> dict:
+
+def razorpayx_request(method: str, endpoint: str, data: dict = None, idempotency_key: str = None) -> dict:
     """Make authenticated request to RazorpayX API"""
     url = f"{RAZORPAYX_BASE_URL}/{endpoint}"
     auth = (RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET)
+    # RazorpayX returns the original payout when a key is re-sent, so retries never pay twice
+    headers = {"X-Payout-Idempotency": idempotency_key} if idempotency_key else None
     
     try:
         if method == "POST":
-            response = requests.post(url, json=data, auth=auth)
+            response = requests.post(url, json=data, auth=auth, headers=headers)
         elif method == "GET":
             response = requests.get(url, params=data, auth=auth)
         else:
@@ -282,13 +289,23 @@ async def bulk_process_salary_payouts(
         "skipped": []
     }
     
+    # Batch-load fund accounts and employees for every salary in two queries
+    employee_ids = list({s.get("employee_id") for s in approved_salaries})
+    fund_accounts = await db.fund_accounts.find(
+        {"employee_id": {"$in": employee_ids}}, {"_id": 0}
+    ).to_list(len(employee_ids) * 2)
+    fund_accounts_by_employee = {}
+    for fa in fund_accounts:
+        fund_accounts_by_employee.setdefault(fa["employee_id"], fa)
+    employees = await db.employees.find(
+        {"id": {"$in": employee_ids}}, {"_id": 0, "id": 1, "name": 1}
+    ).to_list(len(employee_ids))
+    employees_by_id = {e["id"]: e for e in employees}
+    
+    payable = []
     for salary in approved_salaries:
         # Check if employee has fund account
-        fund_account = await db.fund_accounts.find_one(
-            {"employee_id": salary.get("employee_id")},
-            {"_id": 0}
-        )
-        
+        fund_account = fund_accounts_by_employee.get(salary.get("employee_id"))
         if not fund_account:
             results["skipped"].append({
                 "salary_id": salary["id"],
@@ -296,78 +313,138 @@ async def bulk_process_salary_payouts(
                 "reason": "No bank account linked"
             })
             continue
+        payable.append((salary, fund_account, employees_by_id.get(salary.get("employee_id")) or {}))
+    
+    semaphore = asyncio.Semaphore(PAYOUT_CONCURRENCY)
+    ledger_reference = f"BULK_SALARY_{month}_{uuid.uuid4().hex[:8]}"
+    
+    # One ledger entry per bulk run, inserted once here and grown with each recorded payout
+    if payable:
+        await db.ledger.insert_one({
+            "id": str(uuid.uuid4()),
+            "date": datetime.now(timezone.utc).date().isoformat(),
+            "type": "salary_payout",
+            "reference": ledger_reference,
+            "description": f"Bulk Salary Payout for {month}",
+            "debit": 0,
+            "credit": 0,
+            "account": "Salary Expense",
+            "created_at": datetime.now(timezone.utc).isoformat()
+        })
+    
+    async def record_payout(salary: dict, employee: dict, payout: dict):
+        """Salary update, payout record and the run's ledger total commit together"""
+        now_iso = datetime.now(timezone.utc).isoformat()
+        amount = salary.get("net_salary") or 0
         
-        employee = await db.employees.find_one({"id": salary.get("employee_id")}, {"_id": 0})
-        
-        try:
-            # Create payout using RazorpayX API
-            payout = razorpayx_request("POST", "payouts", {
-                "account_number": os.environ.get("RAZORPAY_ACCOUNT_NUMBER", ""),
-                "fund_account_id": fund_account.get("razorpay_fund_account_id"),
-                "amount": int(salary.get("net_salary", 0) * 100),
-                "currency": "INR",
-                "mode": mode,
-                "purpose": "salary",
-                "queue_if_low_balance": True,
-                "reference_id": salary["id"],
-                "narration": f"Salary {month} - {employee.get('name', '')}",
-            })
-            
-            # Update salary record
+        async def _record(session):
             await db.salary_payments.update_one(
                 {"id": salary["id"]},
                 {"$set": {
-                    "payment_status": "processing",
                     "razorpay_payout_id": payout["id"],
                     "payout_status": payout.get("status"),
-                    "payout_mode": mode,
-                    "processed_at": datetime.now(timezone.utc).isoformat()
-                }}
+                    "processed_at": now_iso
+                }},
+                session=session
             )
-            
-            # Create payout record
-            payout_record = {
+            await db.payouts.insert_one({
                 "id": str(uuid.uuid4()),
                 "salary_id": salary["id"],
                 "employee_id": salary.get("employee_id"),
-                "employee_name": employee.get("name") if employee else "",
+                "employee_name": employee.get("name", ""),
                 "razorpay_payout_id": payout["id"],
                 "amount": salary.get("net_salary"),
                 "mode": mode,
                 "status": payout.get("status"),
-                "created_at": datetime.now(timezone.utc).isoformat()
-            }
-            await db.payouts.insert_one(payout_record)
+                "created_at": now_iso
+            }, session=session)
+            if amount > 0:
+                await db.ledger.update_one(
+                    {"reference": ledger_reference},
+                    {"$inc": {"credit": round(amount, 2)}},
+                    session=session
+                )
+        
+        await run_in_transaction(db, _record)
+    
+    async def create_payout(salary: dict, fund_account: dict, employee: dict):
+        """Claim, pay and record one salary, bounded by the semaphore"""
+        async with semaphore:
+            # Claim first: a concurrent or repeated run finds the row no longer approved
+            claimed = await db.salary_payments.update_one(
+                {"id": salary["id"], "payment_status": "approved"},
+                {"$set": {
+                    "payment_status": "processing",
+                    "payout_mode": mode,
+                    "payout_idempotency_key": f"salary-{salary['id']}",
+                    "payout_claimed_at": datetime.now(timezone.utc).isoformat(),
+                    "processed_by": current_user.get("id", "system")
+                }}
+            )
+            if claimed.modified_count == 0:
+                results["skipped"].append({
+                    "salary_id": salary["id"],
+                    "employee_id": salary.get("employee_id"),
+                    "reason": "Already being processed"
+                })
+                return
+            
+            try:
+                payout = await asyncio.to_thread(razorpayx_request, "POST", "payouts", {
+                    "account_number": os.environ.get("RAZORPAY_ACCOUNT_NUMBER", ""),
+                    "fund_account_id": fund_account.get("razorpay_fund_account_id"),
+                    "amount": int(salary.get("net_salary", 0) * 100),
+                    "currency": "INR",
+                    "mode": mode,
+                    "purpose": "salary",
+                    "queue_if_low_balance": True,
+                    "reference_id": salary["id"],
+                    "narration": f"Salary {month} - {employee.get('name', '')}",
+                }, f"salary-{salary['id']}")
+            except Exception as e:
+                # Release the claim; the idempotency key makes a later retry safe even
+                # if this call reached RazorpayX before failing
+                await db.salary_payments.update_one(
+                    {"id": salary["id"], "payment_status": "processing", "razorpay_payout_id": {"$exists": False}},
+                    {"$set": {"payment_status": "approved"}, "$unset": {"payout_claimed_at": ""}}
+                )
+                results["failed"].append({
+                    "salary_id": salary["id"],
+                    "employee_id": salary.get("employee_id"),
+                    "error": str(e)
+                })
+                return
+            
+            try:
+                await record_payout(salary, employee, payout)
+            except Exception as e:
+                # Money has moved: keep the claim (row stays processing) so it is never re-paid
+                results["failed"].append({
+                    "salary_id": salary["id"],
+                    "employee_id": salary.get("employee_id"),
+                    "payout_id": payout["id"],
+                    "error": f"Payout sent but not recorded: {e}"
+                })
+                return
             
             results["success"].append({
                 "salary_id": salary["id"],
-                "employee_name": employee.get("name") if employee else "",
+                "employee_name": employee.get("name", ""),
                 "amount": salary.get("net_salary"),
                 "payout_id": payout["id"]
             })
-            
-        except Exception as e:
-            results["failed"].append({
-                "salary_id": salary["id"],
-                "employee_id": salary.get("employee_id"),
-                "error": str(e)
-            })
     
-    # Create ledger entry for total salaries
+    await asyncio.gather(*(create_payout(*item) for item in payable))
+    
     total_paid = sum(r["amount"] for r in results["success"])
-    if total_paid > 0:
-        ledger_entry = {
-            "id": str(uuid.uuid4()),
-            "date": datetime.now(timezone.utc).date().isoformat(),
-            "type": "salary_payout",
-            "reference": f"BULK_SALARY_{month}",
-            "description": f"Bulk Salary Payout for {month} ({len(results['success'])} employees)",
-            "debit": 0,
-            "credit": round(total_paid, 2),
-            "account": "Salary Expense",
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.ledger.insert_one(ledger_entry)
+    if results["success"]:
+        await db.ledger.update_one(
+            {"reference": ledger_reference},
+            {"$set": {"description": f"Bulk Salary Payout for {month} ({len(results['success'])} employees)"}}
+        )
+    elif payable:
+        # Nothing was recorded against the run's entry
+        await db.ledger.delete_one({"reference": ledger_reference, "credit": 0})
     
     return {
         "message": "Bulk payout processing completed",
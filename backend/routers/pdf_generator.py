@@ -6,6 +6,7 @@ from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import StreamingResponse
 from datetime import datetime, timezone, timedelta
 from .base import get_erp_user, get_db
+from utils.cash_balances import get_opening_balance
 from io import BytesIO
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4, letter
@@ -418,18 +419,8 @@ async def generate_cash_daybook(
         {"_id": 0}
     ).sort("created_at", 1).to_list(500)
     
-    # Calculate opening balance (all transactions before this date)
-    prev_in = await db.cash_transactions.aggregate([
-        {"$match": {"direction": "in", "date": {"$lt": date}}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]).to_list(1)
-    
-    prev_out = await db.cash_transactions.aggregate([
-        {"$match": {"direction": "out", "date": {"$lt": date}}},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]).to_list(1)
-    
-    opening_balance = (prev_in[0]["total"] if prev_in else 0) - (prev_out[0]["total"] if prev_out else 0)
+    # Opening balance from the precomputed daily cash balances
+    opening_balance = await get_opening_balance(db, date)
     
     # Calculate day's totals
     day_in = sum(t["amount"] for t in transactions if t.get("direction") == "in")
@@ -1,5 +1,5 @@
 """
-Production Router - Job cards, stage management, breakage tracking
+Production Router - Job cards, stage management, breakage tracking, capacity schedule
 """
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
 from typing import Optional, Dict, Any
@@ -7,6 +7,10 @@ from datetime import datetime, timezone
 import uuid
 from .base import get_erp_user, get_db
 from .notifications import notify_new_order
+from utils.dashboard_metrics import invalidate_dashboard_metrics
+from utils.production_schedule import (
+    STAGE_FLOW, get_capacity_settings, get_schedule, invalidate_schedule, reschedule_order_safely
+)
 
 production_router = APIRouter(prefix="/production", tags=["Production"])
 
@@ -37,6 +41,8 @@ async def create_production_order(
     }
     
     await db.production_orders.insert_one(order)
+    invalidate_dashboard_metrics("production")
+    background_tasks.add_task(reschedule_order_safely, db, order["id"])
     
     # Notify admin about new order (background task)
     background_tasks.add_task(notify_new_order, order)
@@ -67,6 +73,7 @@ async def get_production_orders(
 async def update_production_stage(
     order_id: str,
     stage_data: Dict[str, Any],
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(get_erp_user)
 ):
     """Update production order stage"""
@@ -88,12 +95,18 @@ async def update_production_stage(
             "updated_at": datetime.now(timezone.utc).isoformat()
         }}
     )
+    invalidate_dashboard_metrics("production")
+    background_tasks.add_task(reschedule_order_safely, db, order_id)
     
     return {"message": "Stage updated successfully"}
 
 
 @production_router.post("/breakage")
-async def create_breakage_entry(breakage_data: Dict[str, Any], current_user: dict = Depends(get_erp_user)):
+async def create_breakage_entry(
+    breakage_data: Dict[str, Any],
+    background_tasks: BackgroundTasks,
+    current_user: dict = Depends(get_erp_user)
+):
     """Record breakage entry"""
     db = get_db()
     breakage = {
@@ -114,6 +127,16 @@ async def create_breakage_entry(breakage_data: Dict[str, Any], current_user: dic
     }
     
     await db.breakage_entries.insert_one(breakage)
+    invalidate_dashboard_metrics("production")
+    
+    # Broken pieces leave the job card - less area left for the remaining stages
+    if breakage["production_order_id"]:
+        result = await db.production_orders.update_one(
+            {"id": breakage["production_order_id"]},
+            {"$inc": {"quantity_broken": breakage["quantity_broken"]}}
+        )
+        if result.modified_count:
+            background_tasks.add_task(reschedule_order_safely, db, breakage["production_order_id"])
     return {"message": "Breakage entry created", "breakage_id": breakage["id"]}
 
 
@@ -160,3 +183,66 @@ async def get_breakage_analytics(
         "by_stage": by_stage,
         "by_operator": by_operator
     }
+
+
+# =============== CAPACITY SCHEDULE ===============
+
+@production_router.get("/schedule")
+async def get_production_schedule(
+    stage: Optional[str] = None,
+    current_user: dict = Depends(get_erp_user)
+):
+    """Gantt view - planned queue per stage with machine slots and the bottleneck stage"""
+    if stage and stage not in STAGE_FLOW:
+        raise HTTPException(status_code=400, detail=f"Invalid stage. Must be one of: {STAGE_FLOW}")
+    planner = await get_schedule(get_db())
+    return planner.gantt(stage)
+
+
+@production_router.get("/schedule/{order_id}")
+async def get_job_card_schedule(order_id: str, current_user: dict = Depends(get_erp_user)):
+    """Planned stage slots and expected completion for one job card"""
+    planner = await get_schedule(get_db())
+    plan = planner.plans.get(order_id)
+    if not plan:
+        raise HTTPException(status_code=404, detail="Order not in the open production schedule")
+    return plan
+
+
+@production_router.get("/capacity")
+async def get_production_capacity(current_user: dict = Depends(get_erp_user)):
+    """Stage throughput, machine counts and shift hours used by the scheduler"""
+    return await get_capacity_settings(get_db())
+
+
+@production_router.put("/capacity")
+async def update_production_capacity(
+    data: Dict[str, Any],
+    current_user: dict = Depends(get_erp_user)
+):
+    """Update stage capacity / shift hours (Admin/Manager only) - re-plans the schedule"""
+    if current_user.get("role") not in ["super_admin", "admin", "owner", "manager"]:
+        raise HTTPException(status_code=403, detail="Admin/Manager access required")
+    
+    db = get_db()
+    update_data = {k: data[k] for k in ["shift_start", "hours_per_shift", "shifts_per_day"] if k in data}
+    for stage, config in (data.get("stages") or {}).items():
+        if stage not in STAGE_FLOW:
+            raise HTTPException(status_code=400, detail=f"Invalid stage: {stage}")
+        for field in ["sqft_per_hour", "machines"]:
+            if field in config:
+                if float(config[field]) <= 0:
+                    raise HTTPException(status_code=400, detail=f"{stage}.{field} must be positive")
+                update_data[f"stages.{stage}.{field}"] = float(config[field]) if field == "sqft_per_hour" else int(config[field])
+    if "shift_start" in update_data:
+        try:
+            datetime.strptime(update_data["shift_start"], "%H:%M")
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="shift_start must be HH:MM")
+    
+    update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    update_data["updated_by"] = current_user.get("id")
+    await db.production_capacity.update_one({"id": "default"}, {"$set": update_data}, upsert=True)
+    await invalidate_schedule(db)
+    
+    return {"message": "Capacity updated", "capacity": await get_capacity_settings(db)}
@@ -6,6 +6,9 @@ from typing import Optional, Dict, Any
 from datetime import datetime, timezone
 import uuid
 from .base import get_erp_user, get_db
+from utils.dashboard_metrics import invalidate_dashboard_metrics
+from utils.stock_ledger import receive_po_items
+from utils.transactions import run_in_transaction
 
 purchase_router = APIRouter(prefix="/purchase", tags=["Purchase"])
 
@@ -67,6 +70,7 @@ async def create_purchase_order(po_data: Dict[str, Any], current_user: dict = De
     }
     
     await db.purchase_orders.insert_one(purchase_order)
+    invalidate_dashboard_metrics("purchase")
     return {"message": "Purchase order created", "po_number": po_number, "po_id": purchase_order["id"]}
 
 
@@ -120,33 +124,24 @@ async def update_po_status(
     
     # If received, update inventory
     if new_status == "received" and po.get("status") != "received":
-        for item in po.get("items", []):
-            material = await db.raw_materials.find_one({"id": item.get("material_id")}, {"_id": 0})
-            if material:
-                new_stock = material.get("current_stock", 0) + item.get("quantity", 0)
-                await db.raw_materials.update_one(
-                    {"id": item.get("material_id")},
-                    {"$set": {"current_stock": new_stock, "last_restocked": datetime.now(timezone.utc).isoformat()}}
-                )
-                
-                # Create inventory transaction
-                txn = {
-                    "id": str(uuid.uuid4()),
-                    "material_id": item.get("material_id"),
-                    "material_name": item.get("material_name", material.get("name")),
-                    "type": "IN",
-                    "quantity": item.get("quantity"),
-                    "previous_stock": material.get("current_stock", 0),
-                    "new_stock": new_stock,
-                    "reference": po.get("po_number"),
-                    "notes": f"Received from PO {po.get('po_number')}",
-                    "created_by": current_user.get("id", "system"),
-                    "created_at": datetime.now(timezone.utc).isoformat()
-                }
-                await db.inventory_transactions.insert_one(txn)
-        
         update_fields["received_at"] = datetime.now(timezone.utc).isoformat()
         update_fields["received_by"] = current_user.get("id", "system")
+        
+        async def receive_po(session):
+            # Claim the PO first so a concurrent receive cannot add the stock twice
+            claimed = await db.purchase_orders.update_one(
+                {"id": po_id, "status": {"$ne": "received"}, "receipt_status": {"$ne": "received"}},
+                {"$set": {**update_fields, "receipt_status": "received"}},
+                session=session
+            )
+            if claimed.modified_count == 0:
+                raise HTTPException(status_code=400, detail="Purchase order already received")
+            
+            await receive_po_items(db, po, current_user.get("id", "system"), session)
+        
+        await run_in_transaction(db, receive_po)
+    else:
+        await db.purchase_orders.update_one({"id": po_id}, {"$set": update_fields})
     
-    await db.purchase_orders.update_one({"id": po_id}, {"$set": update_fields})
+    invalidate_dashboard_metrics("purchase", "inventory")
     return {"message": f"PO status updated to {new_status}"}
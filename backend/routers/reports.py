@@ -6,7 +6,7 @@ from fastapi.responses import StreamingResponse
 from typing import Dict, Any
 from datetime import datetime, timezone
 import io
-from .base import get_erp_user, get_db
+from .base import get_erp_user, get_report_db
 from .accounts import get_profit_loss
 
 reports_router = APIRouter(prefix="/reports", tags=["Reports"])
@@ -20,7 +20,7 @@ async def export_invoices(
     current_user: dict = Depends(get_erp_user)
 ):
     """Export invoices to Excel or PDF"""
-    db = get_db()
+    db = get_report_db()
     invoices = await db.invoices.find({
         "created_at": {"$gte": start_date, "$lte": end_date + "T23:59:59"}
     }, {"_id": 0}).sort("created_at", -1).to_list(5000)
@@ -322,7 +322,7 @@ async def export_ledger(
     current_user: dict = Depends(get_erp_user)
 ):
     """Export ledger entries to Excel"""
-    db = get_db()
+    db = get_report_db()
     entries = await db.ledger.find({
         "date": {"$gte": start_date, "$lte": end_date}
     }, {"_id": 0}).sort("date", 1).to_list(10000)
@@ -378,7 +378,7 @@ async def export_payments(
     current_user: dict = Depends(get_erp_user)
 ):
     """Export payments to Excel"""
-    db = get_db()
+    db = get_report_db()
     payments = await db.payments.find({
         "created_at": {"$gte": start_date, "$lte": end_date + "T23:59:59"}
     }, {"_id": 0}).sort("created_at", -1).to_list(5000)
@@ -437,7 +437,7 @@ async def bulk_export_all_data(
     """Bulk export all business data to Excel with multiple sheets"""
     import xlsxwriter
     
-    db = get_db()
+    db = get_report_db()
     output = io.BytesIO()
     workbook = xlsxwriter.Workbook(output, {'in_memory': True})
     
@@ -2,7 +2,7 @@
 Customer Referral, Rewards & Credit System
 - Referral codes & tracking
 - Reward points on orders
-- Store credit balance
+- Store credit balance (maintained balances, see utils/stored_value.py)
 """
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel, Field
@@ -13,6 +13,8 @@ import random
 import string
 
 from routers.base import get_db, get_erp_user
+from utils.stored_value import InsufficientBalanceError, get_balance, post_entry
+from utils.transactions import run_in_transaction
 
 rewards_router = APIRouter(prefix="/rewards", tags=["Rewards & Referrals"])
 
@@ -56,50 +58,12 @@ def generate_referral_code(name: str) -> str:
     return f"{prefix}{suffix}"
 
 async def get_user_credit_balance(db, user_id: str) -> float:
-    """Calculate user's current credit balance"""
-    pipeline = [
-        {"$match": {"user_id": user_id}},
-        {"$group": {
-            "_id": None,
-            "total_credit": {
-                "$sum": {
-                    "$cond": [{"$in": ["$type", ["credit", "referral_bonus", "order_reward", "admin_credit"]]}, "$amount", 0]
-                }
-            },
-            "total_debit": {
-                "$sum": {
-                    "$cond": [{"$in": ["$type", ["debit", "redemption", "admin_debit"]]}, "$amount", 0]
-                }
-            }
-        }}
-    ]
-    result = await db.credit_transactions.aggregate(pipeline).to_list(1)
-    if result:
-        return round(result[0]["total_credit"] - result[0]["total_debit"], 2)
-    return 0.0
+    """User's current credit balance (maintained on reward_balances)"""
+    return round(await get_balance(db, "credit", user_id), 2)
 
 async def get_user_points_balance(db, user_id: str) -> int:
-    """Calculate user's current reward points"""
-    pipeline = [
-        {"$match": {"user_id": user_id}},
-        {"$group": {
-            "_id": None,
-            "total_earned": {
-                "$sum": {
-                    "$cond": [{"$eq": ["$type", "earned"]}, "$points", 0]
-                }
-            },
-            "total_redeemed": {
-                "$sum": {
-                    "$cond": [{"$eq": ["$type", "redeemed"]}, "$points", 0]
-                }
-            }
-        }}
-    ]
-    result = await db.reward_points.aggregate(pipeline).to_list(1)
-    if result:
-        return int(result[0]["total_earned"] - result[0]["total_redeemed"])
-    return 0
+    """User's current reward points (maintained on reward_balances)"""
+    return int(await get_balance(db, "points", user_id))
 
 # ============ REFERRAL SETTINGS ============
 
@@ -278,28 +242,21 @@ async def redeem_credit(
     db = get_db()
     user_id = current_user.get("user_id") or current_user.get("id")
     
-    # Check balance
-    balance = await get_user_credit_balance(db, user_id)
-    if request.amount > balance:
-        raise HTTPException(status_code=400, detail=f"Insufficient balance. Available: ₹{balance}")
-    
     if request.amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be positive")
     
-    # Create debit transaction
-    transaction = {
-        "id": str(uuid.uuid4()),
-        "user_id": user_id,
-        "amount": request.amount,
-        "type": "redemption",
-        "description": f"Credit redeemed for order {request.order_id}" if request.order_id else "Credit redeemed",
-        "reference_id": request.order_id,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    
-    await db.credit_transactions.insert_one(transaction)
-    
-    new_balance = await get_user_credit_balance(db, user_id)
+    # Debit only if the balance covers it (checked and applied in one update)
+    try:
+        new_balance = await post_entry(db, "credit", {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "amount": request.amount,
+            "type": "redemption",
+            "description": f"Credit redeemed for order {request.order_id}" if request.order_id else "Credit redeemed",
+            "reference_id": request.order_id
+        })
+    except InsufficientBalanceError as e:
+        raise HTTPException(status_code=400, detail=f"Insufficient balance. Available: ₹{round(e.balance, 2)}")
     
     return {
         "message": f"₹{request.amount} redeemed successfully",
@@ -357,19 +314,19 @@ async def admin_adjust_credit(
     
     trans_type = "admin_credit" if adjustment.type == "credit" else "admin_debit"
     
-    transaction = {
-        "id": str(uuid.uuid4()),
-        "user_id": adjustment.user_id,
-        "amount": abs(adjustment.amount),
-        "type": trans_type,
-        "description": f"Admin adjustment: {adjustment.reason}",
-        "created_at": datetime.now(timezone.utc).isoformat(),
-        "created_by": current_user.get("name", "")
-    }
-    
-    await db.credit_transactions.insert_one(transaction)
-    
-    new_balance = await get_user_credit_balance(db, adjustment.user_id)
+    try:
+        new_balance = await post_entry(db, "credit", {
+            "id": str(uuid.uuid4()),
+            "user_id": adjustment.user_id,
+            "amount": abs(adjustment.amount),
+            "type": trans_type,
+            "description": f"Admin adjustment: {adjustment.reason}",
+            "created_by": current_user.get("name", "")
+        })
+    except InsufficientBalanceError as e:
+        raise HTTPException(status_code=400, detail=f"Insufficient balance. Available: ₹{round(e.balance, 2)}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     return {
         "message": f"Credit {'added' if adjustment.type == 'credit' else 'deducted'} successfully",
@@ -466,41 +423,49 @@ async def process_referral_on_order(db, order: dict, settings: dict = None):
     user_id = order.get("user_id")
     order_total = order.get("total_price", 0)
     
-    # Check if user was referred and this is their first order
-    referral = await db.referrals.find_one({
-        "referee_id": user_id,
-        "status": "pending"
-    })
-    
-    if referral and order_total >= settings.get("min_order_for_referral", 1000):
-        # Calculate referrer reward
-        reward_percent = settings.get("referrer_reward_percent", 5)
-        max_reward = settings.get("max_referral_reward", 500)
-        reward_amount = min(order_total * reward_percent / 100, max_reward)
-        
-        # Add credit to referrer
-        credit_transaction = {
-            "id": str(uuid.uuid4()),
-            "user_id": referral.get("referrer_id"),
-            "amount": round(reward_amount, 2),
-            "type": "referral_bonus",
-            "description": f"Referral bonus for {referral.get('referee_name')}'s first order",
-            "reference_id": order.get("id"),
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.credit_transactions.insert_one(credit_transaction)
-        
-        # Update referral status
-        await db.referrals.update_one(
-            {"id": referral.get("id")},
+    if order_total < settings.get("min_order_for_referral", 1000):
+        return {"referrer_rewarded": False}
+    
+    # Calculate referrer reward
+    reward_percent = settings.get("referrer_reward_percent", 5)
+    max_reward = settings.get("max_referral_reward", 500)
+    reward_amount = min(order_total * reward_percent / 100, max_reward)
+    
+    async def _complete(session):
+        # Claim the user's pending referral once, and credit the referrer in the same transaction
+        referral = await db.referrals.find_one_and_update(
+            {"referee_id": user_id, "status": "pending"},
             {"$set": {
                 "status": "completed",
                 "completed_at": datetime.now(timezone.utc).isoformat(),
                 "order_id": order.get("id"),
                 "reward_amount": reward_amount
-            }}
+            }},
+            projection={"_id": 0},
+            session=session
         )
-        
+        if referral and reward_amount > 0:
+            await post_entry(db, "credit", {
+                "id": str(uuid.uuid4()),
+                "user_id": referral.get("referrer_id"),
+                "amount": round(reward_amount, 2),
+                "type": "referral_bonus",
+                "description": f"Referral bonus for {referral.get('referee_name')}'s first order",
+                "reference_id": order.get("id")
+            }, session=session)
+        return referral
+    
+    try:
+        referral = await run_in_transaction(db, _complete)
+    except Exception:
+        # Without transaction support the claim is already written - hand it back so the bonus can be retried
+        await db.referrals.update_one(
+            {"referee_id": user_id, "status": "completed", "order_id": order.get("id")},
+            {"$set": {"status": "pending"}, "$unset": {"completed_at": "", "order_id": "", "reward_amount": ""}}
+        )
+        raise
+    
+    if referral and reward_amount > 0:
         return {"referrer_rewarded": True, "reward_amount": reward_amount}
     
     return {"referrer_rewarded": False}
@@ -516,15 +481,13 @@ async def add_order_reward_points(db, user_id: str, order_total: float, order_id
     points_earned = int(order_total * points_per_rupee)
     
     if points_earned > 0:
-        points_record = {
+        await post_entry(db, "points", {
             "id": str(uuid.uuid4()),
             "user_id": user_id,
             "points": points_earned,
             "type": "earned",
             "description": f"Points for order",
-            "reference_id": order_id,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.reward_points.insert_one(points_record)
+            "reference_id": order_id
+        })
     
     return {"points_earned": points_earned}
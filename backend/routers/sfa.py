@@ -11,6 +11,7 @@ import uuid
 import math
 from .base import get_erp_user, get_db
 from .audit import log_action
+from utils.distance_matrix import path_length_km
 
 sfa_router = APIRouter(prefix="/sfa", tags=["Sales Force Automation"])
 
@@ -189,21 +190,10 @@ async def end_day(
     
     now = datetime.now(timezone.utc)
     
-    # Calculate total distance from route coordinates
+    # Calculate total distance from route coordinates, plus the final leg to the end location
     route = attendance.get("route_coordinates", [])
-    total_distance = 0
-    for i in range(1, len(route)):
-        total_distance += calculate_distance(
-            route[i-1]["lat"], route[i-1]["lng"],
-            route[i]["lat"], route[i]["lng"]
-        )
-    
-    # Add final leg to end location
-    if route:
-        total_distance += calculate_distance(
-            route[-1]["lat"], route[-1]["lng"],
-            data.latitude, data.longitude
-        )
+    trail = [(point["lat"], point["lng"]) for point in route]
+    total_distance = round(path_length_km(trail + [(data.latitude, data.longitude)]), 2) if trail else 0
     
     # Calculate fuel allowance
     fuel_rate = attendance.get("fuel_rate_per_km", 0)
@@ -8,6 +8,8 @@ from datetime import datetime, timezone
 from pydantic import BaseModel
 from .base import get_erp_user, get_db
 from .audit import log_action
+from utils.database import pool_stats
+from utils.search_index import USER_SEARCH_FIELDS, build_search_tokens, legacy_search_filter, rank_results, token_filter
 import uuid
 import hashlib
 
@@ -59,13 +61,16 @@ async def get_all_users(
         query["is_active"] = {"$ne": False}
     elif status == "disabled":
         query["is_active"] = False
-    if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"email": {"$regex": search, "$options": "i"}}
-        ]
+    tokens = token_filter(search) if search else None
+    if tokens:
+        # Indexed prefix match; regex only for users not yet tokenised
+        query["$or"] = [tokens, legacy_search_filter(search, ["name", "email"])]
     
-    users = await db.users.find(query, {"_id": 0, "password_hash": 0}).sort("created_at", -1).to_list(500)
+    users = await db.users.find(
+        query, {"_id": 0, "password_hash": 0, "search_tokens": 0}
+    ).sort("created_at", -1).to_list(500)
+    if tokens:
+        users = rank_results(users, search, USER_SEARCH_FIELDS)
     
     # Get stats
     total = len(users)
@@ -122,6 +127,7 @@ async def create_user(
         "created_at": datetime.now(timezone.utc).isoformat(),
         "created_by": current_user["id"]
     }
+    new_user["search_tokens"] = build_search_tokens(new_user, USER_SEARCH_FIELDS)
     
     await db.users.insert_one(new_user)
     
@@ -176,8 +182,9 @@ async def update_user(
     if updates:
         updates["updated_at"] = datetime.now(timezone.utc).isoformat()
         updates["updated_by"] = current_user["id"]
+        search_tokens = build_search_tokens({**user, **updates}, USER_SEARCH_FIELDS)
         
-        await db.users.update_one({"id": user_id}, {"$set": updates})
+        await db.users.update_one({"id": user_id}, {"$set": {**updates, "search_tokens": search_tokens}})
         
         # Log action
         await log_action(
@@ -526,6 +533,12 @@ async def update_system_setting(
     return {"message": "Setting updated successfully"}
 
 
+@superadmin_router.get("/db-pool-stats")
+async def get_db_pool_stats(current_user: dict = Depends(require_super_admin)):
+    """MongoDB connection pool settings and per-server connection counters"""
+    return pool_stats()
+
+
 # ==================== REPORTS ====================
 
 @superadmin_router.get("/reports/summary")
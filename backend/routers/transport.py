@@ -3,6 +3,7 @@ Transport Management System
 - Vehicle & Driver Management
 - Distance & Cost Calculation
 - Dispatch Assignment & Tracking
+- Multi-drop Route Planning
 - Customer Notifications
 """
 from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks
@@ -10,13 +11,14 @@ from pydantic import BaseModel, Field
 from typing import Optional, List
 from datetime import datetime, timezone
 import uuid
-from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
-from haversine import haversine, Unit
 import asyncio
 import logging
 
 from routers.base import get_db, get_erp_user
+from utils.cache import LRUCache
+from utils.geocoding import geocode_address, geocode_cache_stats
+from utils.route_planner import DEFAULT_ROUTE_SETTINGS, KG_PER_SQFT_MM, plan_routes
+from utils.distance_matrix import distance_service
 
 transport_router = APIRouter(prefix="/transport", tags=["Transport Management"])
 
@@ -28,6 +30,10 @@ FACTORY_LOCATION = {
     "lng": 73.8567
 }
 
+# Repeat quotes for the same pin/load are served from memory
+_settings_cache = LRUCache(maxsize=1, ttl=60)
+_cost_cache = LRUCache(maxsize=4096, ttl=600)
+
 # ============ PYDANTIC MODELS ============
 
 class TransportSettings(BaseModel):
@@ -46,6 +52,7 @@ class Vehicle(BaseModel):
     vehicle_number: str
     vehicle_type: str  # tempo, truck, mini-truck
     capacity_sqft: float = 500
+    capacity_kg: Optional[float] = None  # Payload limit, used by the route planner when set
     driver_id: Optional[str] = None
     status: str = "available"  # available, on_trip, maintenance
     notes: Optional[str] = ""
@@ -80,15 +87,49 @@ class TransportCostRequest(BaseModel):
     total_sqft: float
     include_gst: bool = True
 
+class Coordinates(BaseModel):
+    lat: float
+    lng: float
+
+class DistanceMatrixRequest(BaseModel):
+    origins: List[Coordinates]
+    destinations: Optional[List[Coordinates]] = None  # Default: origins x origins
+    road: bool = True  # Apply the calibrated road factor / measured distances
+
+class DistanceSample(BaseModel):
+    from_location: Coordinates = Field(alias="from")
+    to_location: Coordinates = Field(alias="to")
+    road_km: float
+
+class DistanceCalibrationRequest(BaseModel):
+    samples: List[DistanceSample]
+
+class RoutePlanRequest(BaseModel):
+    order_ids: Optional[List[str]] = None  # Default: every ready_for_dispatch order
+    vehicle_ids: Optional[List[str]] = None  # Default: every available vehicle
+    max_stops: int = Field(DEFAULT_ROUTE_SETTINGS["max_stops"], ge=1, le=50)
+    avg_speed_kmph: float = Field(DEFAULT_ROUTE_SETTINGS["avg_speed_kmph"], gt=0, le=120)
+    service_minutes: float = Field(DEFAULT_ROUTE_SETTINGS["service_minutes"], ge=0, le=240)
+    time_limit_ms: int = Field(DEFAULT_ROUTE_SETTINGS["time_limit_ms"], ge=100, le=10000)  # Solver runs in a worker thread
+    departure_time: str = DEFAULT_ROUTE_SETTINGS["departure_time"]
+
 # ============ TRANSPORT SETTINGS ============
 
+async def load_transport_settings() -> dict:
+    """Transport pricing settings, cached briefly per worker"""
+    settings = _settings_cache.get("settings")
+    if settings is None:
+        db = get_db()
+        settings = await db.transport_settings.find_one({}, {"_id": 0})
+        if not settings:
+            settings = TransportSettings().model_dump()
+        _settings_cache.set("settings", settings)
+    return dict(settings)
+
 @transport_router.get("/settings")
 async def get_transport_settings():
     """Get transport pricing settings"""
-    db = get_db()
-    settings = await db.transport_settings.find_one({}, {"_id": 0})
-    if not settings:
-        settings = TransportSettings().model_dump()
+    settings = await load_transport_settings()
     settings["factory_location"] = FACTORY_LOCATION
     return settings
 
@@ -107,36 +148,40 @@ async def update_transport_settings(
     doc["updated_at"] = datetime.now(timezone.utc).isoformat()
     
     await db.transport_settings.update_one({}, {"$set": doc}, upsert=True)
+    _settings_cache.clear()
+    _cost_cache.clear()
     return {"message": "Transport settings updated", "settings": doc}
 
 # ============ DISTANCE & COST CALCULATION ============
 
+async def distance_from_factory(lat: float, lng: float) -> float:
+    """Distance in km from the factory (road-factor calibrated, memoised per coordinate pair)"""
+    factory_coords = (FACTORY_LOCATION["lat"], FACTORY_LOCATION["lng"])
+    return await distance_service.distance(get_db(), factory_coords, (lat, lng))
+
 @transport_router.post("/calculate-distance")
 async def calculate_distance(location: LocationInput):
     """Calculate distance from factory to delivery location"""
     try:
         # Get delivery coordinates
+        geocode_source = "coordinates"
+        approximate = False
         if location.lat and location.lng:
             delivery_coords = (location.lat, location.lng)
         elif location.address:
-            # Geocode address using Nominatim (OpenStreetMap)
-            geolocator = Nominatim(user_agent="lucumaa_glass_erp")
-            search_query = location.address
-            if location.landmark:
-                search_query += f", near {location.landmark}"
-            
-            geo_location = geolocator.geocode(search_query, timeout=10)
-            if not geo_location:
+            # Geocode via cache -> Nominatim (OpenStreetMap) -> pincode centroid
+            geo = await geocode_address(get_db(), location.address, location.landmark)
+            if not geo:
                 raise HTTPException(status_code=400, detail="Could not find location. Please provide more details or use map pin.")
-            delivery_coords = (geo_location.latitude, geo_location.longitude)
+            delivery_coords = (geo["lat"], geo["lng"])
+            geocode_source = geo["source"]
+            # source is memory/cache on a hit; origin says how the coordinates were found
+            approximate = geo.get("origin") == "pincode"
         else:
             raise HTTPException(status_code=400, detail="Please provide address or coordinates")
         
-        # Factory coordinates
-        factory_coords = (FACTORY_LOCATION["lat"], FACTORY_LOCATION["lng"])
-        
-        # Calculate distance using haversine formula
-        distance_km = haversine(factory_coords, delivery_coords, unit=Unit.KILOMETERS)
+        # Haversine x calibrated road factor (or a measured road distance for this pair)
+        distance_km = await distance_from_factory(*delivery_coords)
         
         return {
             "factory": FACTORY_LOCATION,
@@ -146,7 +191,9 @@ async def calculate_distance(location: LocationInput):
                 "address": location.address or "Pin location"
             },
             "distance_km": round(distance_km, 2),
-            "distance_display": f"{round(distance_km, 1)} km"
+            "distance_display": f"{round(distance_km, 1)} km",
+            "geocode_source": geocode_source,
+            "approximate": approximate
         }
     except HTTPException:
         raise
@@ -154,20 +201,8 @@ async def calculate_distance(location: LocationInput):
         logging.error(f"Distance calculation error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Distance calculation failed: {str(e)}")
 
-@transport_router.post("/calculate-cost")
-async def calculate_transport_cost(request: TransportCostRequest):
-    """Calculate transport cost based on distance and load"""
-    db = get_db()
-    
-    # Get settings
-    settings = await db.transport_settings.find_one({}, {"_id": 0})
-    if not settings:
-        settings = TransportSettings().model_dump()
-    
-    # Calculate distance
-    distance_result = await calculate_distance(request.delivery_location)
-    distance_km = distance_result["distance_km"]
-    
+def compute_transport_cost(settings: dict, distance_km: float, total_sqft: float, include_gst: bool) -> dict:
+    """Pure transport cost breakdown for a distance and load"""
     # Base calculation
     base_charge = settings.get("base_charge", 500)
     base_km = settings.get("base_km", 10)
@@ -185,36 +220,106 @@ async def calculate_transport_cost(request: TransportCostRequest):
     
     # Load charge (for heavy orders)
     load_charge = 0
-    if request.total_sqft > min_sqft_for_load:
-        load_charge = (request.total_sqft - min_sqft_for_load) * per_sqft_rate
+    if total_sqft > min_sqft_for_load:
+        load_charge = (total_sqft - min_sqft_for_load) * per_sqft_rate
     
     # Subtotal
     subtotal = round(distance_charge + load_charge, 2)
     
     # GST
     gst_amount = 0
-    if request.include_gst:
+    if include_gst:
         gst_amount = round(subtotal * gst_percent / 100, 2)
     
     total = round(subtotal + gst_amount, 2)
     
+    return {
+        "base_charge": base_charge,
+        "base_km_included": base_km,
+        "extra_km": max(0, round(distance_km - base_km, 2)),
+        "per_km_rate": per_km_rate,
+        "distance_charge": round(distance_charge, 2),
+        "load_sqft": total_sqft,
+        "load_charge": round(load_charge, 2),
+        "subtotal": subtotal,
+        "gst_percent": gst_percent if include_gst else 0,
+        "gst_amount": gst_amount,
+        "total": total
+    }
+
+@transport_router.post("/calculate-cost")
+async def calculate_transport_cost(request: TransportCostRequest):
+    """Calculate transport cost based on distance and load"""
+    settings = await load_transport_settings()
+    
+    # Calculate distance
+    distance_result = await calculate_distance(request.delivery_location)
+    distance_km = distance_result["distance_km"]
+    delivery = distance_result["delivery"]
+    
+    cost_key = (
+        round(distance_km, 2),
+        round(request.total_sqft, 2),
+        request.include_gst,
+        settings.get("updated_at")
+    )
+    breakdown = _cost_cache.get(cost_key)
+    if breakdown is None:
+        breakdown = compute_transport_cost(settings, distance_km, request.total_sqft, request.include_gst)
+        _cost_cache.set(cost_key, breakdown)
+    
     return {
         "distance_km": distance_km,
-        "breakdown": {
-            "base_charge": base_charge,
-            "base_km_included": base_km,
-            "extra_km": max(0, round(distance_km - base_km, 2)),
-            "per_km_rate": per_km_rate,
-            "distance_charge": round(distance_charge, 2),
-            "load_sqft": request.total_sqft,
-            "load_charge": round(load_charge, 2),
-            "subtotal": subtotal,
-            "gst_percent": gst_percent if request.include_gst else 0,
-            "gst_amount": gst_amount,
-            "total": total
-        },
-        "total_transport_cost": total,
-        "delivery_location": distance_result["delivery"]
+        "breakdown": breakdown,
+        "total_transport_cost": breakdown["total"],
+        "delivery_location": delivery,
+        "approximate": distance_result["approximate"]
+    }
+
+MAX_MATRIX_CELLS = 250_000
+
+@transport_router.post("/distance-matrix")
+async def get_distance_matrix(request: DistanceMatrixRequest, current_user: dict = Depends(get_erp_user)):
+    """Distances in km between many origins and destinations in one call"""
+    origins = [(p.lat, p.lng) for p in request.origins]
+    destinations = [(p.lat, p.lng) for p in request.destinations] if request.destinations else origins
+    if len(origins) * len(destinations) > MAX_MATRIX_CELLS:
+        raise HTTPException(status_code=400, detail=f"Matrix too large (max {MAX_MATRIX_CELLS} cells)")
+    
+    matrix = await distance_service.matrix(get_db(), origins, destinations, road=request.road)
+    return {
+        "origins": len(origins),
+        "destinations": len(destinations),
+        "road_factor": distance_service.road_factor if request.road else 1.0,
+        "distances_km": matrix.round(3).tolist()
+    }
+
+@transport_router.post("/distance-calibration")
+async def calibrate_distances(request: DistanceCalibrationRequest, current_user: dict = Depends(get_erp_user)):
+    """Record measured road distances and refit the road factor (Admin only)"""
+    if current_user.get("role") not in ["super_admin", "admin", "owner"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if any(sample.road_km <= 0 for sample in request.samples):
+        raise HTTPException(status_code=400, detail="road_km must be positive")
+    
+    result = await distance_service.calibrate(get_db(), [{
+        "from": sample.from_location.model_dump(),
+        "to": sample.to_location.model_dump(),
+        "road_km": sample.road_km
+    } for sample in request.samples])
+    _cost_cache.clear()
+    return {"message": "Road factor recalibrated", **result}
+
+@transport_router.get("/cache-stats")
+async def get_transport_cache_stats(current_user: dict = Depends(get_erp_user)):
+    """Hit rates for geocode, distance and cost caches (Admin only)"""
+    if current_user.get("role") not in ["super_admin", "admin", "owner"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {
+        "geocode": geocode_cache_stats(),
+        "distance": distance_service.stats(),
+        "cost": _cost_cache.stats()
     }
 
 # ============ VEHICLE MANAGEMENT ============
@@ -349,6 +454,13 @@ async def delete_driver(driver_id: str, current_user: dict = Depends(get_erp_use
 
 # ============ DISPATCH MANAGEMENT ============
 
+def is_payment_settled(order: dict) -> bool:
+    return (
+        order.get('payment_status') == 'completed' or
+        (order.get('advance_percent') == 100 and order.get('advance_payment_status') == 'paid') or
+        (order.get('advance_payment_status') == 'paid' and order.get('remaining_payment_status') in ['paid', 'cash_received'])
+    )
+
 @transport_router.post("/dispatch")
 async def create_dispatch(
     dispatch: DispatchCreate,
@@ -367,12 +479,7 @@ async def create_dispatch(
         raise HTTPException(status_code=404, detail="Order not found")
     
     # Check payment is fully settled before allowing dispatch
-    payment_settled = (
-        order.get('payment_status') == 'completed' or
-        (order.get('advance_percent') == 100 and order.get('advance_payment_status') == 'paid') or
-        (order.get('advance_payment_status') == 'paid' and order.get('remaining_payment_status') in ['paid', 'cash_received'])
-    )
-    if not payment_settled:
+    if not is_payment_settled(order):
         raise HTTPException(status_code=400, detail="Cannot dispatch. Payment not fully settled. Please complete payment first.")
     
     # Get vehicle details
@@ -495,6 +602,124 @@ async def update_dispatch_status(
     
     return {"message": f"Dispatch status updated to {status}"}
 
+# ============ ROUTE PLANNING ============
+
+def _address_text(address) -> str:
+    if isinstance(address, dict):
+        parts = ["address_line1", "address_line2", "city", "state", "pincode"]
+        return ", ".join(str(address[k]) for k in parts if address.get(k))
+    return address or ""
+
+async def _order_coordinates(db, order: dict) -> Optional[tuple]:
+    """Pinned coordinates if the order has them, else the (cached) geocode of its delivery address"""
+    address = order.get("delivery_address")
+    for location in (order.get("delivery_location"), address):
+        if isinstance(location, dict) and location.get("lat") and location.get("lng"):
+            return (float(location["lat"]), float(location["lng"]))
+    landmark = address.get("landmark") if isinstance(address, dict) else ""
+    text = _address_text(address)
+    if not text:
+        return None
+    geo = await geocode_address(db, text, landmark)
+    return (geo["lat"], geo["lng"]) if geo else None
+
+def _order_load(order: dict) -> tuple:
+    """(sqft, kg, manifest items) for an order - multi-item orders or single-product orders"""
+    items = []
+    kg = 0.0
+    for item in order.get("glass_items") or []:
+        sqft = item.get("width", 0) * item.get("height", 0) * item.get("quantity", 0) / 144
+        kg += sqft * (item.get("thickness") or 0) * KG_PER_SQFT_MM
+        items.append({
+            "product": item.get("product_name", ""),
+            "size": f"{item.get('width')} x {item.get('height')}",
+            "thickness": item.get("thickness"),
+            "quantity": item.get("quantity")
+        })
+    sqft = order.get("total_sqft") or order.get("area_sqft") or 0
+    if not items:
+        kg = sqft * (order.get("thickness") or 0) * KG_PER_SQFT_MM
+        items.append({
+            "product": order.get("product_name", ""),
+            "size": f"{order.get('width')} x {order.get('height')}",
+            "thickness": order.get("thickness"),
+            "quantity": order.get("quantity")
+        })
+    return round(sqft, 2), round(kg, 1), items
+
+@transport_router.post("/route-plan")
+async def create_route_plan(request: RoutePlanRequest, current_user: dict = Depends(get_erp_user)):
+    """Plan multi-drop routes for ready orders across the available fleet"""
+    if current_user.get("role") not in ["super_admin", "admin", "owner", "manager", "supervisor"]:
+        raise HTTPException(status_code=403, detail="Permission denied")
+    try:
+        datetime.strptime(request.departure_time, "%H:%M")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="departure_time must be HH:MM")
+    
+    db = get_db()
+    order_query = {"id": {"$in": request.order_ids}} if request.order_ids else {"status": "ready_for_dispatch"}
+    orders = await db.orders.find(order_query, {"_id": 0}).to_list(500)
+    vehicle_query = {"id": {"$in": request.vehicle_ids}} if request.vehicle_ids else {"status": "available"}
+    vehicles = await db.vehicles.find(vehicle_query, {"_id": 0}).to_list(100)
+    
+    stops, skipped = [], []
+    for order in orders:
+        if not is_payment_settled(order):
+            skipped.append({"order_id": order["id"], "order_number": order.get("order_number"), "reason": "Payment not fully settled"})
+            continue
+        coords = await _order_coordinates(db, order)
+        if not coords:
+            skipped.append({"order_id": order["id"], "order_number": order.get("order_number"), "reason": "Delivery location not found"})
+            continue
+        sqft, kg, items = _order_load(order)
+        stops.append({
+            "order_id": order["id"],
+            "order_number": order.get("order_number", ""),
+            "customer_name": order.get("customer_name", ""),
+            "customer_phone": order.get("customer_phone", ""),
+            "delivery_address": _address_text(order.get("delivery_address")),
+            "lat": coords[0],
+            "lng": coords[1],
+            "sqft": sqft,
+            "kg": kg,
+            "items": items
+        })
+    
+    factory = (FACTORY_LOCATION["lat"], FACTORY_LOCATION["lng"])
+    matrix = (await distance_service.matrix(db, [factory] + [(stop["lat"], stop["lng"]) for stop in stops])).tolist()
+    settings = request.model_dump(exclude={"order_ids", "vehicle_ids"})
+    # CPU-bound local search - keep it off the event loop
+    plan = await asyncio.to_thread(plan_routes, FACTORY_LOCATION, stops, vehicles, matrix, settings)
+    
+    plan_doc = {
+        "id": str(uuid.uuid4()),
+        **plan,
+        "skipped": skipped,
+        "settings": settings,
+        "created_by": current_user.get("name", ""),
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    await db.route_plans.insert_one(plan_doc)
+    plan_doc.pop("_id", None)
+    return plan_doc
+
+@transport_router.get("/route-plans")
+async def get_route_plans(limit: int = 20, current_user: dict = Depends(get_erp_user)):
+    """Recent route plans (summary only)"""
+    db = get_db()
+    return await db.route_plans.find(
+        {}, {"_id": 0, "id": 1, "summary": 1, "created_by": 1, "created_at": 1}
+    ).sort("created_at", -1).to_list(min(limit, 100))
+
+@transport_router.get("/route-plans/{plan_id}")
+async def get_route_plan(plan_id: str, current_user: dict = Depends(get_erp_user)):
+    """Route plan with ordered stops and load manifest per vehicle"""
+    plan = await get_db().route_plans.find_one({"id": plan_id}, {"_id": 0})
+    if not plan:
+        raise HTTPException(status_code=404, detail="Route plan not found")
+    return plan
+
 @transport_router.get("/dashboard")
 async def get_transport_dashboard(current_user: dict = Depends(get_erp_user)):
     """Get transport dashboard stats"""
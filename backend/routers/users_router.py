@@ -7,6 +7,8 @@ from typing import Optional
 from datetime import datetime, timezone
 import uuid
 
+from utils.search_index import USER_SEARCH_FIELDS, with_search_tokens
+
 users_router = APIRouter(tags=["Users"])
 
 # Database reference
@@ -74,6 +76,7 @@ async def update_profile(
     
     update_data = {k: v for k, v in profile_data.dict().items() if v is not None}
     update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    update_data = await with_search_tokens(db, "users", USER_SEARCH_FIELDS, {"id": current_user.get("id")}, update_data)
     
     await db.users.update_one(
         {"id": current_user.get("id")},
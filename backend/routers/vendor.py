@@ -13,9 +13,14 @@ import os
 import razorpay
 import hmac
 import hashlib
+from pymongo import UpdateOne
 
 from .base import get_db, get_erp_user
 from .ledger import auto_post_to_ledger
+from utils.dashboard_metrics import invalidate_dashboard_metrics
+from utils.transactions import run_in_transaction
+from utils.audit_sink import write_audit
+from utils.stock_ledger import receive_po_items
 
 vendor_router = APIRouter(prefix="/vendors", tags=["Vendors"])
 
@@ -320,12 +325,59 @@ async def create_purchase_order(
     
     await db.purchase_orders.insert_one(po)
     del po["_id"]
+    invalidate_dashboard_metrics("purchase")
     
     await log_audit(db, "po_created", po["id"], current_user, f"PO {po_number} created for {vendor.get('name')}")
     
     return {"message": "Purchase Order created", "po": po}
 
 
+@vendor_router.post("/po/from-suggestion/{suggestion_id}")
+async def create_po_from_suggestion(
+    suggestion_id: str,
+    current_user: dict = Depends(get_erp_user)
+):
+    """Turn a replenishment purchase suggestion into a draft PO"""
+    db = get_db()
+    
+    suggestion = await db.purchase_suggestions.find_one({"id": suggestion_id}, {"_id": 0})
+    if not suggestion:
+        raise HTTPException(status_code=404, detail="Suggestion not found")
+    if not suggestion.get("vendor_id"):
+        raise HTTPException(status_code=400, detail="Suggestion has no vendor - set a supplier on the materials first")
+    
+    # Claim first so a double click cannot raise two POs
+    claimed = await db.purchase_suggestions.update_one(
+        {"id": suggestion_id, "status": "suggested"},
+        {"$set": {"status": "converting"}}
+    )
+    if claimed.modified_count == 0:
+        raise HTTPException(status_code=400, detail=f"Suggestion is already {suggestion.get('status')}")
+    
+    try:
+        result = await create_purchase_order(POCreate(
+            vendor_id=suggestion["vendor_id"],
+            items=[{
+                "material_id": item["material_id"],
+                "material_name": item["material_name"],
+                "name": item["name"],
+                "unit": item.get("unit"),
+                "quantity": item["quantity"],
+                "unit_price": item.get("unit_price") or 0
+            } for item in suggestion["items"]],
+            notes=f"Raised from replenishment suggestion {suggestion_id}"
+        ), current_user)
+    except Exception:
+        await db.purchase_suggestions.update_one({"id": suggestion_id}, {"$set": {"status": "suggested"}})
+        raise
+    
+    await db.purchase_suggestions.update_one(
+        {"id": suggestion_id},
+        {"$set": {"status": "converted", "po_id": result["po"]["id"], "po_number": result["po"]["po_number"]}}
+    )
+    return result
+
+
 @vendor_router.get("/po/list")
 async def get_purchase_orders(
     vendor_id: str = None,
@@ -394,6 +446,7 @@ async def submit_po_for_approval(
             }
         }
     )
+    invalidate_dashboard_metrics("purchase")
     
     await log_audit(db, "po_submitted", po_id, current_user, f"PO {po.get('po_number')} submitted for approval")
     
@@ -434,6 +487,7 @@ async def approve_po(
             }
         }
     )
+    invalidate_dashboard_metrics("purchase")
     
     # Update vendor ledger if approved
     if new_status == "approved":
@@ -472,6 +526,56 @@ async def approve_po(
     return {"message": f"PO {new_status}"}
 
 
+@vendor_router.post("/po/{po_id}/receive")
+async def receive_po_goods(
+    po_id: str,
+    current_user: dict = Depends(get_erp_user)
+):
+    """
+    Record goods receipt for an approved PO.
+    Lines carrying a material_id are stocked in at their unit_price (cost layers for valuation).
+    The PO status stays 'approved' so payments continue to work.
+    """
+    if current_user.get("role") not in ["super_admin", "admin", "finance", "purchase", "store"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    db = get_db()
+    
+    po = await db.purchase_orders.find_one({"id": po_id}, {"_id": 0})
+    if not po:
+        raise HTTPException(status_code=404, detail="PO not found")
+    
+    if po.get("status") != "approved":
+        raise HTTPException(status_code=400, detail="Only approved POs can be received")
+    
+    async def receive(session):
+        # Claim the receipt so a double submit cannot stock the goods twice
+        claimed = await db.purchase_orders.update_one(
+            {"id": po_id, "receipt_status": {"$ne": "received"}},
+            {"$set": {
+                "receipt_status": "received",
+                "received_at": datetime.now(timezone.utc).isoformat(),
+                "received_by": current_user.get("name")
+            }},
+            session=session
+        )
+        if claimed.modified_count == 0:
+            raise HTTPException(status_code=400, detail="PO goods already received")
+        return await receive_po_items(db, po, current_user.get("id", "system"), session)
+    
+    received = await run_in_transaction(db, receive)
+    invalidate_dashboard_metrics("purchase", "inventory")
+    
+    await log_audit(db, "po_received", po_id, current_user, f"PO {po.get('po_number')} goods received")
+    
+    return {
+        "message": "Goods received",
+        "stocked_lines": len(received),
+        "unlinked_lines": len(po.get("items", [])) - len(received),
+        "stock_value_added": round(sum(txn["value"] for txn in received), 2)
+    }
+
+
 # ================== VENDOR PAYMENTS (RAZORPAY PAYOUTS) ==================
 
 async def create_mock_payout(db, payment_id: str, amount: float, vendor: dict, po: dict):
@@ -1284,12 +1388,18 @@ async def create_bulk_payment(
     if not vendor:
         raise HTTPException(status_code=404, detail="Vendor not found")
     
-    # Validate all POs belong to this vendor and are approved
+    # Validate all POs belong to this vendor and are approved (single $in fetch)
     valid_pos = []
     total_amount = 0
     
+    pos = await db.purchase_orders.find(
+        {"id": {"$in": data.po_ids}, "vendor_id": data.vendor_id},
+        {"_id": 0}
+    ).to_list(len(data.po_ids))
+    pos_by_id = {po["id"]: po for po in pos}
+    
     for po_id in data.po_ids:
-        po = await db.purchase_orders.find_one({"id": po_id, "vendor_id": data.vendor_id}, {"_id": 0})
+        po = pos_by_id.get(po_id)
         if not po:
             raise HTTPException(status_code=404, detail=f"PO {po_id} not found or doesn't belong to this vendor")
         if po.get("status") not in ["approved", "completed"]:
@@ -1441,22 +1551,33 @@ async def complete_bulk_payment(
     })
     bulk_receipt_number = f"BULK-{today.strftime('%Y%m%d')}-{str(receipt_count + 1).zfill(4)}"
     
-    # Update each payment record and PO
+    # Load all payments and their POs in two round-trips
+    payment_ids = bulk_payment.get("payment_ids", [])
+    payments = await db.vendor_payments.find({"id": {"$in": payment_ids}}, {"_id": 0}).to_list(len(payment_ids))
+    payments_by_id = {p["id"]: p for p in payments}
+    po_ids = [p.get("po_id") for p in payments]
+    pos = await db.purchase_orders.find({"id": {"$in": po_ids}}, {"_id": 0}).to_list(len(po_ids))
+    pos_by_id = {po["id"]: po for po in pos}
+    
+    # Individual receipts are numbered sequentially from the month's current count
+    receipt_count_ind = await db.vendor_payments.count_documents({
+        "status": "completed",
+        "completed_at": {"$regex": today.strftime("%Y-%m")}
+    })
+    
+    now_iso = datetime.now(timezone.utc).isoformat()
+    payment_ops = []
+    po_ops = []
     results = []
-    for payment_id in bulk_payment.get("payment_ids", []):
-        payment = await db.vendor_payments.find_one({"id": payment_id})
+    for payment_id in payment_ids:
+        payment = payments_by_id.get(payment_id)
         if not payment:
             continue
         
-        # Generate individual receipt
-        receipt_count_ind = await db.vendor_payments.count_documents({
-            "status": "completed",
-            "completed_at": {"$regex": today.strftime("%Y-%m")}
-        })
-        receipt_number = f"VPR-{today.strftime('%Y%m%d')}-{str(receipt_count_ind + 1).zfill(4)}"
+        receipt_count_ind += 1
+        receipt_number = f"VPR-{today.strftime('%Y%m%d')}-{str(receipt_count_ind).zfill(4)}"
         
-        # Update payment
-        await db.vendor_payments.update_one(
+        payment_ops.append(UpdateOne(
             {"id": payment_id},
             {
                 "$set": {
@@ -1465,28 +1586,29 @@ async def complete_bulk_payment(
                     "bulk_receipt_number": bulk_receipt_number,
                     "razorpay_payment_id": razorpay_payment_id,
                     "transaction_ref": transaction_ref or razorpay_payment_id,
-                    "completed_at": datetime.now(timezone.utc).isoformat(),
+                    "completed_at": now_iso,
                     "verified_by": current_user.get("name")
                 }
             }
-        )
+        ))
         
-        # Update PO
         po_id = payment.get("po_id")
-        po = await db.purchase_orders.find_one({"id": po_id})
+        po = pos_by_id.get(po_id)
         if po:
             new_amount_paid = po.get("amount_paid", 0) + payment.get("amount")
             new_outstanding = po.get("grand_total") - new_amount_paid
             new_payment_status = "fully_paid" if new_outstanding <= 0 else "partially_paid"
+            # Keep the in-memory copy current in case two payments hit the same PO
+            po["amount_paid"] = new_amount_paid
             
-            await db.purchase_orders.update_one(
+            po_ops.append(UpdateOne(
                 {"id": po_id},
                 {
                     "$set": {
                         "amount_paid": new_amount_paid,
                         "outstanding_balance": max(0, new_outstanding),
                         "payment_status": new_payment_status,
-                        "updated_at": datetime.now(timezone.utc).isoformat()
+                        "updated_at": now_iso
                     },
                     "$push": {"payment_history": {
                         "payment_id": payment_id,
@@ -1495,11 +1617,11 @@ async def complete_bulk_payment(
                         "payment_type": "bulk",
                         "payment_mode": payment.get("payment_mode"),
                         "transaction_ref": transaction_ref or razorpay_payment_id,
-                        "date": datetime.now(timezone.utc).isoformat(),
+                        "date": now_iso,
                         "by": current_user.get("name")
                     }}
                 }
-            )
+            ))
         
         results.append({
             "po_number": payment.get("po_number"),
@@ -1507,33 +1629,46 @@ async def complete_bulk_payment(
             "amount": payment.get("amount")
         })
     
-    # Update vendor balance
     vendor_id = bulk_payment.get("vendor_id")
     total_amount = bulk_payment.get("total_amount", 0)
-    await db.vendors.update_one(
-        {"id": vendor_id},
-        {
-            "$inc": {
-                "total_paid": total_amount,
-                "current_balance": -total_amount
-            }
-        }
-    )
     
-    # Update bulk payment record
-    await db.bulk_payments.update_one(
-        {"id": bulk_payment_id},
-        {
-            "$set": {
-                "status": "completed",
-                "bulk_receipt_number": bulk_receipt_number,
-                "razorpay_payment_id": razorpay_payment_id,
-                "transaction_ref": transaction_ref or razorpay_payment_id,
-                "completed_at": datetime.now(timezone.utc).isoformat(),
-                "verified_by": current_user.get("name")
-            }
-        }
-    )
+    async def apply_bulk_completion(session):
+        # Claim the bulk payment first so a concurrent completion cannot double-pay
+        claimed = await db.bulk_payments.update_one(
+            {"id": bulk_payment_id, "status": {"$ne": "completed"}},
+            {
+                "$set": {
+                    "status": "completed",
+                    "bulk_receipt_number": bulk_receipt_number,
+                    "razorpay_payment_id": razorpay_payment_id,
+                    "transaction_ref": transaction_ref or razorpay_payment_id,
+                    "completed_at": now_iso,
+                    "verified_by": current_user.get("name")
+                }
+            },
+            session=session
+        )
+        if claimed.modified_count == 0:
+            raise HTTPException(status_code=400, detail="Bulk payment already completed")
+        
+        if payment_ops:
+            await db.vendor_payments.bulk_write(payment_ops, ordered=False, session=session)
+        if po_ops:
+            await db.purchase_orders.bulk_write(po_ops, ordered=False, session=session)
+        
+        # Update vendor balance
+        await db.vendors.update_one(
+            {"id": vendor_id},
+            {
+                "$inc": {
+                    "total_paid": total_amount,
+                    "current_balance": -total_amount
+                }
+            },
+            session=session
+        )
+    
+    await run_in_transaction(db, apply_bulk_completion)
     
     await log_audit(db, "bulk_payment_completed", bulk_payment_id, current_user,
                    f"Bulk payment completed: {len(results)} POs, Total: ₹{total_amount}, Receipt: {bulk_receipt_number}")
@@ -1912,7 +2047,7 @@ async def log_audit(db, action: str, entity_id: str, user: dict, description: st
         "user_role": user.get("role"),
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
-    await db.audit_logs.insert_one(entry)
+    await write_audit(db, "audit_logs", entry)
 
 
 @vendor_router.get("/audit/logs")
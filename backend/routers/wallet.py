@@ -8,7 +8,10 @@ from datetime import datetime, timezone
 import uuid
 import random
 import string
+from pymongo import ReturnDocument
 from .base import get_erp_user, get_db
+from utils.stored_value import InsufficientBalanceError, get_balance, post_entry, verify_stored_value_balances
+from utils.transactions import run_in_transaction
 
 wallet_router = APIRouter(prefix="/wallet", tags=["Wallet & Referral"])
 
@@ -19,6 +22,25 @@ def generate_referral_code(length: int = 8) -> str:
     return ''.join(random.choices(chars, k=length))
 
 
+def new_wallet_fields() -> dict:
+    """Fields a wallet is created with; balance and totals start at 0 via $inc"""
+    return {
+        "id": str(uuid.uuid4()),
+        "referral_code": generate_referral_code(),
+        "referred_by": None,
+        "referral_count": 0,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+
+async def get_or_create_wallet(db, user_id: str) -> dict:
+    return await db.wallets.find_one_and_update(
+        {"user_id": user_id},
+        {"$setOnInsert": {**new_wallet_fields(), "balance": 0, "total_earned": 0, "total_spent": 0}},
+        projection={"_id": 0}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+
+
 # =============== ADMIN SETTINGS ===============
 
 @wallet_router.get("/settings")
@@ -100,22 +122,7 @@ async def get_wallet_balance(current_user: dict = Depends(get_erp_user)):
     """Get current user's wallet balance"""
     db = get_db()
     
-    wallet = await db.wallets.find_one({"user_id": current_user["id"]}, {"_id": 0})
-    
-    if not wallet:
-        # Create wallet for user
-        wallet = {
-            "id": str(uuid.uuid4()),
-            "user_id": current_user["id"],
-            "balance": 0,
-            "total_earned": 0,
-            "total_spent": 0,
-            "referral_code": generate_referral_code(),
-            "referred_by": None,
-            "referral_count": 0,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.wallets.insert_one(wallet)
+    wallet = await get_or_create_wallet(db, current_user["id"])
     
     return {
         "balance": wallet.get("balance", 0),
@@ -151,12 +158,6 @@ async def apply_referral_code(
     db = get_db()
     referral_code = data.get("referral_code", "").upper()
     
-    # Get user's wallet
-    wallet = await db.wallets.find_one({"user_id": current_user["id"]}, {"_id": 0})
-    
-    if wallet and wallet.get("referred_by"):
-        raise HTTPException(status_code=400, detail="You have already used a referral code")
-    
     # Find referrer
     referrer_wallet = await db.wallets.find_one({"referral_code": referral_code}, {"_id": 0})
     if not referrer_wallet:
@@ -171,25 +172,14 @@ async def apply_referral_code(
     if not settings.get("referral_enabled"):
         raise HTTPException(status_code=400, detail="Referral program is currently disabled")
     
-    # Update user's wallet with referrer
-    if not wallet:
-        wallet = {
-            "id": str(uuid.uuid4()),
-            "user_id": current_user["id"],
-            "balance": 0,
-            "total_earned": 0,
-            "total_spent": 0,
-            "referral_code": generate_referral_code(),
-            "referred_by": referrer_wallet["user_id"],
-            "referral_count": 0,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.wallets.insert_one(wallet)
-    else:
-        await db.wallets.update_one(
-            {"user_id": current_user["id"]},
-            {"$set": {"referred_by": referrer_wallet["user_id"]}}
-        )
+    # Set the referrer only if none is set yet (a second request cannot claim the bonus again)
+    await get_or_create_wallet(db, current_user["id"])
+    claimed = await db.wallets.update_one(
+        {"user_id": current_user["id"], "referred_by": None},
+        {"$set": {"referred_by": referrer_wallet["user_id"]}}
+    )
+    if not claimed.modified_count:
+        raise HTTPException(status_code=400, detail="You have already used a referral code")
     
     # Give referee bonus if enabled
     if settings.get("referee_bonus_enabled"):
@@ -202,77 +192,34 @@ async def apply_referral_code(
     return {"message": "Referral code applied successfully"}
 
 
-async def credit_wallet(db, user_id: str, amount: float, txn_type: str, description: str):
-    """Credit amount to user's wallet"""
-    # Get or create wallet
-    wallet = await db.wallets.find_one({"user_id": user_id}, {"_id": 0})
-    if not wallet:
-        wallet = {
-            "id": str(uuid.uuid4()),
-            "user_id": user_id,
-            "balance": 0,
-            "total_earned": 0,
-            "total_spent": 0,
-            "referral_code": generate_referral_code(),
-            "referred_by": None,
-            "referral_count": 0,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.wallets.insert_one(wallet)
-    
-    new_balance = wallet.get("balance", 0) + amount
-    new_earned = wallet.get("total_earned", 0) + amount
-    
-    await db.wallets.update_one(
-        {"user_id": user_id},
-        {"$set": {"balance": new_balance, "total_earned": new_earned}}
-    )
-    
-    # Create transaction
-    transaction = {
+async def credit_wallet(db, user_id: str, amount: float, txn_type: str, description: str, session=None):
+    """Credit amount to user's wallet (inside the caller's transaction when session is given)"""
+    if amount <= 0:
+        return await get_balance(db, "wallet", user_id)
+    return await post_entry(db, "wallet", {
         "id": str(uuid.uuid4()),
         "user_id": user_id,
         "type": "credit",
         "category": txn_type,
         "amount": amount,
-        "balance_after": new_balance,
-        "description": description,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.wallet_transactions.insert_one(transaction)
-    
-    return new_balance
+        "description": description
+    }, on_insert={**new_wallet_fields(), "total_spent": 0}, totals={"total_earned": amount}, session=session)
 
 
 async def debit_wallet(db, user_id: str, amount: float, txn_type: str, description: str, reference: str = ""):
-    """Debit amount from user's wallet"""
-    wallet = await db.wallets.find_one({"user_id": user_id}, {"_id": 0})
-    if not wallet or wallet.get("balance", 0) < amount:
+    """Debit amount from user's wallet (never below zero)"""
+    try:
+        return await post_entry(db, "wallet", {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "type": "debit",
+            "category": txn_type,
+            "amount": amount,
+            "description": description,
+            "reference": reference
+        }, totals={"total_spent": amount})
+    except InsufficientBalanceError:
         raise HTTPException(status_code=400, detail="Insufficient wallet balance")
-    
-    new_balance = wallet.get("balance", 0) - amount
-    new_spent = wallet.get("total_spent", 0) + amount
-    
-    await db.wallets.update_one(
-        {"user_id": user_id},
-        {"$set": {"balance": new_balance, "total_spent": new_spent}}
-    )
-    
-    # Create transaction
-    transaction = {
-        "id": str(uuid.uuid4()),
-        "user_id": user_id,
-        "type": "debit",
-        "category": txn_type,
-        "amount": amount,
-        "balance_after": new_balance,
-        "description": description,
-        "reference": reference,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.wallet_transactions.insert_one(transaction)
-    
-    return new_balance
 
 
 @wallet_router.post("/calculate-usage")
@@ -365,14 +312,14 @@ async def process_referral_bonus(
     if not wallet or not wallet.get("referred_by"):
         return {"message": "No referrer found"}
     
-    # Check if bonus already given for this referral
+    # Bonuses paid before the referral_bonus_paid flag existed are only recorded in the ledger
     existing_bonus = await db.wallet_transactions.find_one({
         "user_id": wallet["referred_by"],
         "category": "referral_bonus",
-        "description": {"$regex": user_id}
+        "description": f"Referral bonus for user {user_id[:8]}"
     }, {"_id": 0})
     
-    if existing_bonus:
+    if wallet.get("referral_bonus_paid") or existing_bonus:
         return {"message": "Referral bonus already processed"}
     
     # Get settings
@@ -396,17 +343,39 @@ async def process_referral_bonus(
         else:
             bonus = percentage_bonus
     
-    # Credit referrer
-    await credit_wallet(
-        db, wallet["referred_by"], bonus,
-        "referral_bonus", f"Referral bonus for user {user_id[:8]}"
-    )
+    async def _pay(session):
+        # Claim the referee's bonus once, then credit the referrer and count the referral with it
+        claimed = await db.wallets.find_one_and_update(
+            {"user_id": user_id, "referred_by": wallet["referred_by"], "referral_bonus_paid": {"$ne": True}},
+            {"$set": {"referral_bonus_paid": True, "referral_bonus_order_id": order_id}},
+            projection={"_id": 0},
+            session=session
+        )
+        if not claimed:
+            return False
+        await credit_wallet(
+            db, wallet["referred_by"], bonus,
+            "referral_bonus", f"Referral bonus for user {user_id[:8]}", session=session
+        )
+        await db.wallets.update_one(
+            {"user_id": wallet["referred_by"]},
+            {"$inc": {"referral_count": 1}},
+            session=session
+        )
+        return True
     
-    # Update referrer's referral count
-    await db.wallets.update_one(
-        {"user_id": wallet["referred_by"]},
-        {"$inc": {"referral_count": 1}}
-    )
+    try:
+        paid = await run_in_transaction(db, _pay)
+    except Exception:
+        # Without transaction support the claim is already written - release it so the bonus can be retried
+        await db.wallets.update_one(
+            {"user_id": user_id, "referral_bonus_paid": True, "referral_bonus_order_id": order_id},
+            {"$unset": {"referral_bonus_paid": "", "referral_bonus_order_id": ""}}
+        )
+        raise
+    
+    if not paid:
+        return {"message": "Referral bonus already processed"}
     
     return {"message": "Referral bonus processed", "bonus_amount": bonus}
 
@@ -525,3 +494,25 @@ async def admin_credit_wallet(
     new_balance = await credit_wallet(db, user_id, amount, "admin_credit", reason)
     
     return {"message": "Wallet credited", "new_balance": new_balance}
+
+
+@wallet_router.get("/admin/verify-balances")
+async def verify_balances(current_user: dict = Depends(get_erp_user)):
+    """Recompute wallet, store credit and points balances from their ledgers and report drift (Admin)"""
+    db = get_db()
+    
+    if current_user.get("role") not in ["admin", "owner"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return await verify_stored_value_balances(db)
+
+
+@wallet_router.post("/admin/repair-balances")
+async def repair_balances(current_user: dict = Depends(get_erp_user)):
+    """Reset drifted wallet, store credit and points balances to their ledger totals (Admin)"""
+    db = get_db()
+    
+    if current_user.get("role") not in ["admin", "owner"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return await verify_stored_value_balances(db, repair=True)
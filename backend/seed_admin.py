@@ -7,10 +7,11 @@ import asyncio
 import bcrypt
 import uuid
 from datetime import datetime, timezone
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from dotenv import load_dotenv
 
+from utils.database import get_client
+
 load_dotenv()
 
 async def seed_admin():
@@ -18,7 +19,7 @@ async def seed_admin():
     db_name = os.environ.get('DB_NAME', 'lucumaa')
     
     print(f"Connecting to MongoDB at {mongo_url}...")
-    client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=5000)
+    client = get_client()
     db = client[db_name]
     
     try:
@@ -3,7 +3,6 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import io
 import logging
@@ -26,9 +25,10 @@ from twilio.rest import Client as TwilioClient
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-mongo_url = os.environ.get('MONGO_URL', 'mongodb://127.0.0.1:27017')
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ.get('DB_NAME', 'glass_erp')]
+from utils.database import close_client, get_database
+from utils.search_index import USER_SEARCH_FIELDS, build_search_tokens, with_search_tokens
+
+db = get_database()
 
 app = FastAPI(redirect_slashes=False)
 api_router = APIRouter(prefix="/api")
@@ -523,6 +523,7 @@ async def register_user(user_data: UserRegister, background_tasks: BackgroundTas
     
     doc = user.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    doc['search_tokens'] = build_search_tokens(doc, USER_SEARCH_FIELDS)
     await db.users.insert_one(doc)
     
     token = create_token(user.id, user.email, user.role)
@@ -967,6 +968,7 @@ async def create_erp_user(user_data: dict, current_user: dict = Depends(get_curr
     
     doc = user.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
+    doc['search_tokens'] = build_search_tokens(doc, USER_SEARCH_FIELDS)
     await db.users.insert_one(doc)
     
     return {
@@ -1034,6 +1036,24 @@ async def calculate_price(calc: PriceCalculation):
         "total": round(total, 2)
     }
 
+async def save_order_with_credit(doc: dict, customer_profile: Optional[dict], enforce_limit: bool = False):
+    """Insert an order and add it to the customer's outstanding balance / credit exposure in one transaction"""
+    from utils.customer_balance import reserve_credit
+    from utils.transactions import run_in_transaction
+    
+    async def save(session):
+        if customer_profile:
+            limit_check = doc["total_price"] if enforce_limit and customer_profile.get("credit_type") == "credit_allowed" else None
+            reserved = await reserve_credit(db, customer_profile["id"], doc, limit_check=limit_check, session=session)
+            if not reserved and limit_check is not None:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Order exceeds credit limit. Current outstanding: ₹{customer_profile.get('credit_exposure', 0):,.2f}, Limit: ₹{customer_profile.get('credit_limit', 0):,.2f}"
+                )
+        await db.orders.insert_one(doc, session=session)
+    
+    await run_in_transaction(db, save)
+
 @api_router.post("/orders")
 async def create_order(
     order_data: OrderCreate,
@@ -1053,7 +1073,7 @@ async def create_order(
     if order_data.customer_profile_id:
         customer_profile = await db.customer_profiles.find_one(
             {"id": order_data.customer_profile_id, "status": "active"},
-            {"_id": 0}
+            {"_id": 0, "search_tokens": 0}
         )
         if customer_profile:
             customer_name = customer_profile.get("display_name") or customer_name
@@ -1152,7 +1172,7 @@ async def create_order(
         doc['credit_approved_by'] = current_user.get('name', '')
         doc['credit_approved_at'] = datetime.now(timezone.utc).isoformat()
         doc['customer_profile_id'] = order_data.customer_profile_id  # Link to Customer Master
-        await db.orders.insert_one(doc)
+        await save_order_with_credit(doc, customer_profile, enforce_limit=True)
         
         # Send credit order confirmation email
         async def send_credit_order_email():
@@ -1250,7 +1270,7 @@ async def create_order(
     doc['created_at'] = doc['created_at'].isoformat()
     doc['updated_at'] = doc['updated_at'].isoformat()
     doc['customer_profile_id'] = order_data.customer_profile_id  # Link to Customer Master
-    await db.orders.insert_one(doc)
+    await save_order_with_credit(doc, customer_profile)
     
     # Send order confirmation email
     async def send_order_confirmation():
@@ -1741,7 +1761,8 @@ async def verify_payment(
             "updated_at": datetime.now(timezone.utc).isoformat()
         }
     
-    await db.orders.update_one({"id": order_id}, {"$set": update_data})
+    from utils.customer_balance import update_order_and_balance
+    await update_order_and_balance(db, {"id": order_id}, update_data)
     
     # Send automatic confirmation email in background
     if background_tasks:
@@ -1847,16 +1868,14 @@ async def verify_remaining_payment(
     except:
         raise HTTPException(status_code=400, detail="Payment verification failed")
     
-    await db.orders.update_one(
-        {"id": order_id},
-        {"$set": {
-            "remaining_payment_status": "paid",
-            "remaining_razorpay_payment_id": payment_data.razorpay_payment_id,
-            "payment_status": "completed",
-            "status": "ready_for_dispatch",
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
+    from utils.customer_balance import update_order_and_balance
+    await update_order_and_balance(db, {"id": order_id}, {
+        "remaining_payment_status": "paid",
+        "remaining_razorpay_payment_id": payment_data.razorpay_payment_id,
+        "payment_status": "completed",
+        "status": "ready_for_dispatch",
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    })
     
     # Send notification
     if background_tasks:
@@ -1890,19 +1909,17 @@ async def mark_cash_received(
     if order.get('remaining_payment_status') == 'paid' or order.get('remaining_payment_status') == 'cash_received':
         raise HTTPException(status_code=400, detail="Remaining payment already completed")
     
-    await db.orders.update_one(
-        {"id": order_id},
-        {"$set": {
-            "remaining_payment_status": "cash_received",
-            "remaining_payment_method": "cash",
-            "cash_received_by": current_user['id'],
-            "cash_received_by_name": current_user.get('name', ''),
-            "cash_received_at": datetime.now(timezone.utc).isoformat(),
-            "payment_status": "completed",
-            "status": "ready_for_dispatch",
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
+    from utils.customer_balance import update_order_and_balance
+    await update_order_and_balance(db, {"id": order_id}, {
+        "remaining_payment_status": "cash_received",
+        "remaining_payment_method": "cash",
+        "cash_received_by": current_user['id'],
+        "cash_received_by_name": current_user.get('name', ''),
+        "cash_received_at": datetime.now(timezone.utc).isoformat(),
+        "payment_status": "completed",
+        "status": "ready_for_dispatch",
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    })
     
     return {
         "message": "Cash payment marked as received",
@@ -2208,55 +2225,12 @@ async def get_pnl_with_transport(
     if current_user.get('role') not in allowed_roles:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    target_month = month or datetime.now(timezone.utc).strftime("%Y-%m")
-    
-    # Get completed orders
-    orders = await db.orders.find(
-        {"payment_status": "completed", "created_at": {"$regex": f"^{target_month}"}},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    # Get expenses
-    expenses = await db.expenses.find(
-        {"date": {"$regex": f"^{target_month}"}},
-        {"_id": 0}
-    ).to_list(500)
-    
-    # Calculate revenue
-    product_revenue = sum(o.get('total_price', 0) for o in orders)
-    transport_revenue = sum(o.get('transport_charge', 0) for o in orders)
-    total_revenue = product_revenue + transport_revenue
-    
-    # Calculate expenses by category
-    expense_by_category = {}
-    for exp in expenses:
-        cat = exp.get('category', 'Other')
-        if cat not in expense_by_category:
-            expense_by_category[cat] = 0
-        expense_by_category[cat] += exp.get('amount', 0)
+    from utils.pnl_engine import get_pnl_figures, month_range, transport_pnl_report
     
-    total_expenses = sum(expense_by_category.values())
-    
-    return {
-        "month": target_month,
-        "revenue": {
-            "product_sales": round(product_revenue, 2),
-            "transport_charges": round(transport_revenue, 2),
-            "total_revenue": round(total_revenue, 2)
-        },
-        "expenses": {
-            "by_category": {k: round(v, 2) for k, v in expense_by_category.items()},
-            "total_expenses": round(total_expenses, 2)
-        },
-        "profit_loss": {
-            "gross_profit": round(total_revenue - total_expenses, 2),
-            "profit_margin": round((total_revenue - total_expenses) / max(total_revenue, 1) * 100, 2)
-        },
-        "order_summary": {
-            "total_orders": len(orders),
-            "orders_with_transport": len([o for o in orders if o.get('transport_charge', 0) > 0])
-        }
-    }
+    target_month = month or datetime.now(timezone.utc).strftime("%Y-%m")
+    start_date, end_date = month_range(target_month)
+    figures = await get_pnl_figures(db, start_date, end_date)
+    return transport_pnl_report(figures, target_month)
 
 @api_router.get("/orders/my-orders")
 async def get_my_orders(current_user: dict = Depends(get_current_user)):
@@ -2656,8 +2630,12 @@ async def get_all_orders(
     limit: int = 10,
     status: Optional[str] = None,
     search: Optional[str] = None,
+    cursor: Optional[str] = None,
+    include_total: bool = True,
     current_user: dict = Depends(get_current_user)
 ):
+    from utils.pagination import paginate
+    
     allowed_roles = ['admin', 'super_admin', 'owner', 'manager', 'hr', 'accountant', 'finance', 'operator']
     if current_user['role'] not in allowed_roles:
         raise HTTPException(status_code=403, detail="Access denied")
@@ -2678,10 +2656,12 @@ async def get_all_orders(
             {"customer_email": search_regex},
         ]
     
-    total_count = await db.orders.count_documents(filter_query)
-    skip = (page - 1) * limit
-    
-    orders = await db.orders.find(filter_query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    try:
+        result = await paginate(db.orders, filter_query, limit=limit, cursor=cursor, skip=(page - 1) * limit,
+                                include_total=include_total)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    orders = result.pop("items")
     
     for order in orders:
         if isinstance(order.get('created_at'), str):
@@ -2691,10 +2671,9 @@ async def get_all_orders(
     
     return {
         "orders": orders,
-        "total": total_count,
         "page": page,
         "limit": limit,
-        "total_pages": (total_count + limit - 1) // limit
+        **result
     }
 
 @api_router.patch("/admin/orders/{order_id}/status")
@@ -2814,6 +2793,7 @@ async def update_user_profile(profile: ProfileUpdateRequest, credentials: HTTPAu
         
         update_data = {k: v for k, v in profile.model_dump().items() if v is not None}
         update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+        update_data = await with_search_tokens(db, "users", USER_SEARCH_FIELDS, {"id": payload['user_id']}, update_data)
         
         result = await db.users.update_one(
             {"id": payload['user_id']},
@@ -2948,8 +2928,29 @@ async def shutdown_db_client():
         stop_scheduler()
     except Exception as e:
         logger.warning(f"Scheduler stop warning: {e}")
+
+    # Release the scheduler lease so another worker takes over at once
+    try:
+        from utils.job_coordinator import job_coordinator
+        await job_coordinator.stop()
+    except Exception as e:
+        logger.warning(f"Job coordinator stop warning: {e}")
     
-    client.close()
+    # Close the pooled GST API client
+    try:
+        from utils.gstin_registry import close_http_client
+        await close_http_client()
+    except Exception as e:
+        logger.warning(f"GST API client close warning: {e}")
+    
+    # Flush buffered audit entries before the connection closes
+    try:
+        from utils.audit_sink import audit_sink
+        await audit_sink.stop()
+    except Exception as e:
+        logger.warning(f"Audit sink stop warning: {e}")
+    
+    close_client()
 
 # Include ERP routes
 try:
@@ -2971,7 +2972,152 @@ async def startup_tasks():
         logger.info("Payment alerts scheduler started (runs daily at 9:00 AM IST)")
     except Exception as e:
         logger.error(f"Scheduler initialization warning: {e}")
-    
+
+    # Payment alert cooldown history
+    try:
+        from utils.payment_alerts import ensure_payment_alert_indexes
+        await ensure_payment_alert_indexes(db)
+    except Exception as e:
+        logger.warning(f"Payment alert index warning: {e}")
+
+    # Precomputed daily cash balances - backfilled once, by one worker (utils.job_coordinator.run_once)
+    try:
+        from utils.cash_balances import ensure_cash_balance_indexes, rebuild_cash_daily_balances
+        from utils.job_coordinator import run_once
+        await ensure_cash_balance_indexes(db)
+
+        async def backfill_cash_balances():
+            result = await rebuild_cash_daily_balances(db)
+            logger.info(f"Backfilled {result['rows']} cash daily balance rows")
+
+        await run_once(db, "cash_daily_balances_backfill", backfill_cash_balances)
+    except Exception as e:
+        logger.warning(f"Cash balance index warning: {e}")
+
+    # Frozen aggregates of closed (locked) periods
+    try:
+        from utils.period_close import ensure_period_close_indexes
+        await ensure_period_close_indexes(db)
+    except Exception as e:
+        logger.warning(f"Period close index warning: {e}")
+
+    # Wallet / store credit / reward points balances (initialised once from the ledgers)
+    try:
+        from utils.stored_value import ensure_stored_value_indexes
+        await ensure_stored_value_indexes(db)
+    except Exception as e:
+        logger.warning(f"Stored value index warning: {e}")
+
+    # Keyset pagination indexes for list endpoints
+    try:
+        from utils.pagination import ensure_pagination_indexes
+        await ensure_pagination_indexes(db)
+    except Exception as e:
+        logger.warning(f"Pagination index warning: {e}")
+
+    # Verified GSTIN registry cache
+    try:
+        from utils.gstin_registry import ensure_gstin_registry_indexes
+        await ensure_gstin_registry_indexes(db)
+    except Exception as e:
+        logger.warning(f"GSTIN registry index warning: {e}")
+
+    # GSTR-1 / GSTR-3B return aggregates
+    try:
+        from utils.gst_returns import ensure_gst_return_indexes
+        await ensure_gst_return_indexes(db)
+    except Exception as e:
+        logger.warning(f"GST return index warning: {e}")
+
+    # Memoised P&L figures for closed periods
+    try:
+        from utils.pnl_engine import ensure_pnl_indexes
+        await ensure_pnl_indexes(db)
+    except Exception as e:
+        logger.warning(f"P&L snapshot index warning: {e}")
+
+    # Scheduler leader election - each cron fire runs on one worker only
+    try:
+        from utils.job_coordinator import job_coordinator, ensure_job_coordinator_indexes
+        await ensure_job_coordinator_indexes(db)
+        job_coordinator.start(db)
+    except Exception as e:
+        logger.error(f"Job coordinator start warning: {e}")
+
+    # Indexes for the transport geocode cache
+    try:
+        from utils.geocoding import ensure_geocode_indexes
+        await ensure_geocode_indexes(db)
+    except Exception as e:
+        logger.warning(f"Geocode cache index warning: {e}")
+
+    # Indexes for audit logs and daily rollups
+    try:
+        from routers.audit import ensure_audit_indexes
+        await ensure_audit_indexes(db)
+    except Exception as e:
+        logger.warning(f"Audit index warning: {e}")
+
+    # Customer/user search token indexes (backfill runs in the background)
+    try:
+        from utils.search_index import ensure_search_indexes
+        await ensure_search_indexes(db)
+    except Exception as e:
+        logger.warning(f"Search index warning: {e}")
+
+    # Customer outstanding balances / credit exposure
+    try:
+        from utils.customer_balance import ensure_customer_balance_indexes
+        await ensure_customer_balance_indexes(db)
+    except Exception as e:
+        logger.warning(f"Customer balance index warning: {e}")
+
+    # Low-stock partial index, stock ledger, valuation and replenishment indexes
+    try:
+        from utils.stock_ledger import ensure_stock_indexes
+        from utils.inventory_valuation import ensure_valuation_indexes
+        from utils.replenishment import ensure_replenishment_indexes
+        await ensure_stock_indexes(db)
+        await ensure_valuation_indexes(db)
+        await ensure_replenishment_indexes(db)
+    except Exception as e:
+        logger.warning(f"Stock index warning: {e}")
+
+    # Production schedule indexes
+    try:
+        from utils.production_schedule import ensure_production_schedule_indexes
+        await ensure_production_schedule_indexes(db)
+    except Exception as e:
+        logger.warning(f"Production schedule index warning: {e}")
+
+    # Furnace cycle and utilisation indexes
+    try:
+        from utils.furnace_batching import ensure_furnace_indexes
+        await ensure_furnace_indexes(db)
+    except Exception as e:
+        logger.warning(f"Furnace index warning: {e}")
+
+    # Measured road distance cache
+    try:
+        from utils.distance_matrix import ensure_distance_indexes
+        await ensure_distance_indexes(db)
+    except Exception as e:
+        logger.warning(f"Distance cache index warning: {e}")
+
+    # Cached demand forecast series
+    try:
+        from utils.demand_forecast import ensure_demand_forecast_indexes
+        await ensure_demand_forecast_indexes(db)
+    except Exception as e:
+        logger.warning(f"Demand forecast index warning: {e}")
+
+    # Buffered audit log writer
+    try:
+        from utils.audit_sink import audit_sink
+        audit_sink.start(db)
+    except Exception as e:
+        logger.error(f"Audit sink start warning: {e}")
+
     # Seed initial data
     await seed_initial_data()
 
@@ -3087,5 +3233,6 @@ async def seed_initial_data():
             "is_active": True,
             "created_at": datetime.now(timezone.utc).isoformat()
         }
+        admin_doc["search_tokens"] = build_search_tokens(admin_doc, USER_SEARCH_FIELDS)
         await db.users.insert_one(admin_doc)
         logger.info("Super admin user created: admin@lucumaa.in / adminpass")
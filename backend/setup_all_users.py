@@ -6,15 +6,15 @@ import asyncio
 import bcrypt
 import uuid
 from datetime import datetime, timezone
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 
+from utils.database import get_client
+
 async def setup_users():
-    mongo_url = "mongodb://localhost:27017"
     db_name = "glass_manufacturing"
     
     print(f"Connecting to MongoDB...")
-    client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=5000)
+    client = get_client()
     db = client[db_name]
     
     try:
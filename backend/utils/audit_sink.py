@@ -0,0 +1,290 @@
+"""
+Audit Sink - Buffered, batched audit log writer
+- Request handlers enqueue entries into an in-memory buffer instead of awaiting insert_one
+- A background task flushes with insert_many every AUDIT_FLUSH_INTERVAL_MS or AUDIT_FLUSH_BATCH entries
+- When MongoDB is unavailable, batches spill to a per-worker append-only JSONL file
+  and are replayed once writes succeed again; every entry carries an id (unique
+  index), so replaying a partially written spill skips what is already stored
+- Flush hooks only see entries that were actually inserted, never replays
+- Entries store field-level diffs instead of full before/after document copies
+"""
+from collections import deque
+from pathlib import Path
+from typing import Callable, Dict, Optional
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+AUDIT_FLUSH_INTERVAL_MS = int(os.environ.get("AUDIT_FLUSH_INTERVAL_MS", "500"))
+AUDIT_FLUSH_BATCH = int(os.environ.get("AUDIT_FLUSH_BATCH", "200"))
+AUDIT_BUFFER_SIZE = int(os.environ.get("AUDIT_BUFFER_SIZE", "10000"))
+AUDIT_SPILL_PATH = os.environ.get(
+    "AUDIT_SPILL_PATH",
+    str(Path(__file__).resolve().parent.parent / "audit_spill.jsonl")
+)
+SPILL_REPLAY_INTERVAL = 30  # seconds between replay attempts
+
+_DUPLICATE_KEY = 11000
+
+
+def diff_documents(old: Optional[dict], new: Optional[dict], prefix: str = "") -> dict:
+    """
+    Field-level diff between two documents.
+    Returns {"field.path": {"old": ..., "new": ...}} for changed fields only.
+    """
+    old = old or {}
+    new = new or {}
+    changes = {}
+    for key in set(old) | set(new):
+        if key == "_id":
+            continue
+        path = f"{prefix}{key}"
+        before, after = old.get(key), new.get(key)
+        if isinstance(before, dict) and isinstance(after, dict):
+            changes.update(diff_documents(before, after, f"{path}."))
+        elif before != after:
+            changes[path] = {"old": before, "new": after}
+    return changes
+
+
+class AuditSink:
+    """Per-process audit buffer with periodic insert_many flushes"""
+
+    def __init__(self):
+        self._buffer = deque()
+        self._db = None
+        self._task = None
+        self._wakeup = None
+        self._spill_lock = None
+        self._overflow = []
+        self._overflow_task = None
+        self._stopping = False
+        self._hooks: Dict[str, Callable] = {}
+        self._last_replay = 0.0
+        self._healthy = True  # Last write attempt succeeded
+        self.stats = {"enqueued": 0, "written": 0, "spilled": 0, "replayed": 0, "flushes": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def register_flush_hook(self, collection: str, hook: Callable):
+        """Run `await hook(db, docs)` after each successful batch insert into a collection"""
+        self._hooks[collection] = hook
+
+    def start(self, db):
+        """Start the background flush loop (call from the app startup event)"""
+        if self.running:
+            return
+        self._db = db
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._spill_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Audit sink started (flush every {AUDIT_FLUSH_INTERVAL_MS}ms or {AUDIT_FLUSH_BATCH} entries)")
+
+    async def stop(self):
+        """Flush remaining entries and stop the loop (call from the app shutdown event)"""
+        if not self.running:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        if self._overflow_task is not None:
+            await self._overflow_task
+            self._overflow_task = None
+        logger.info("Audit sink stopped")
+
+    def enqueue(self, collection: str, doc: dict):
+        """Queue an entry; never blocks the request path"""
+        self.stats["enqueued"] += 1
+        # Copy so insert_many's _id never leaks into the caller's dict
+        entry = dict(doc)
+        entry.setdefault("id", str(uuid.uuid4()))
+        if len(self._buffer) >= AUDIT_BUFFER_SIZE:
+            # Buffer full (writes are falling behind) - keep the entry on disk instead
+            self._overflow.append((collection, entry))
+            if self._overflow_task is None or self._overflow_task.done():
+                self._overflow_task = asyncio.create_task(self._drain_overflow())
+            return
+        self._buffer.append((collection, entry))
+        if len(self._buffer) >= AUDIT_FLUSH_BATCH:
+            self._wakeup.set()
+
+    async def _drain_overflow(self):
+        while self._overflow:
+            entries, self._overflow = self._overflow, []
+            await self._spill(entries)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=AUDIT_FLUSH_INTERVAL_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Audit sink flush error: {e}")
+            if self._stopping:
+                break
+
+    async def flush(self):
+        """Write everything currently buffered"""
+        while self._buffer:
+            batch = [self._buffer.popleft() for _ in range(min(AUDIT_FLUSH_BATCH, len(self._buffer)))]
+            await self._write_batch(batch)
+        self.stats["flushes"] += 1
+
+        if self._healthy and time.monotonic() - self._last_replay > SPILL_REPLAY_INTERVAL:
+            self._last_replay = time.monotonic()
+            await self._replay_spill()
+
+    async def _write_batch(self, batch: list):
+        """insert_many per collection; spill on failure"""
+        by_collection: Dict[str, list] = {}
+        for collection, doc in batch:
+            by_collection.setdefault(collection, []).append(doc)
+
+        for collection, docs in by_collection.items():
+            inserted = docs
+            try:
+                await self._db[collection].insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                failed = {err["index"] for err in errors}
+                inserted = [doc for i, doc in enumerate(docs) if i not in failed]
+                # Duplicate ids come from replaying a partially written spill - already stored
+                retry = [docs[err["index"]] for err in errors if err.get("code") != _DUPLICATE_KEY]
+                if retry:
+                    logger.warning(f"Audit batch partially failed for {collection}, spilling {len(retry)} entries")
+                    await self._spill([(collection, d) for d in retry])
+            except Exception as e:
+                logger.warning(f"Audit write to {collection} failed, spilling {len(docs)} entries: {e}")
+                await self._spill([(collection, d) for d in docs])
+                self._healthy = False
+                continue
+
+            self._healthy = True
+            self.stats["written"] += len(inserted)
+            if inserted:
+                await self.run_hook(collection, inserted)
+
+    async def run_hook(self, collection: str, docs: list, db=None):
+        """Run the flush hook registered for a collection, if any"""
+        hook = self._hooks.get(collection)
+        if not hook:
+            return
+        try:
+            await hook(db if db is not None else self._db, docs)
+        except Exception as e:
+            logger.warning(f"Audit flush hook for {collection} failed: {e}")
+
+    async def _spill(self, entries: list):
+        """Append entries to this worker's spill file off the event loop"""
+        async with self._spill_lock:
+            await asyncio.to_thread(_spill_sync, entries)
+        self.stats["spilled"] += len(entries)
+
+    async def _replay_spill(self):
+        """Re-insert spilled entries once MongoDB accepts writes again"""
+        # Held while renaming so no spill write is still appending to a claimed file
+        async with self._spill_lock:
+            claimed = await asyncio.to_thread(_claim_spill_files)
+
+        for replaying in claimed:
+            entries = await asyncio.to_thread(_read_spill, replaying)
+            logger.info(f"Replaying {len(entries)} spilled audit entries from {replaying.name}")
+            for i in range(0, len(entries), AUDIT_FLUSH_BATCH):
+                chunk = entries[i:i + AUDIT_FLUSH_BATCH]
+                await self._write_batch([(e["collection"], e["doc"]) for e in chunk])
+            self.stats["replayed"] += len(entries)
+            replaying.unlink()
+
+
+def _spill_file(pid: int) -> Path:
+    base = Path(AUDIT_SPILL_PATH)
+    return base.with_name(f"{base.stem}.{pid}{base.suffix}")
+
+
+def _spill_owner(path: Path) -> Optional[int]:
+    """Worker pid a spill/replaying file belongs to (None for the legacy shared file)"""
+    token = path.name[len(Path(AUDIT_SPILL_PATH).stem) + 1:].split(".")[0]
+    return int(token) if token.isdigit() else None
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _spill_sync(entries: list):
+    """Append entries to this worker's spill file (one JSON object per line)"""
+    with open(_spill_file(os.getpid()), "a", encoding="utf-8") as f:
+        for collection, doc in entries:
+            doc.pop("_id", None)
+            f.write(json.dumps({"collection": collection, "doc": doc}, default=str) + "\n")
+
+
+def _claim_spill_files() -> list:
+    """
+    Rename this worker's spill file, its interrupted replays and files left by
+    dead workers to <stem>.<pid>.<token>.replaying. rename is atomic, so when two
+    workers race for an orphaned file only one of them gets it.
+    """
+    base = Path(AUDIT_SPILL_PATH)
+    pid = os.getpid()
+    claimed = []
+    for path in sorted(base.parent.glob(f"{base.stem}.*")):
+        owner = _spill_owner(path)
+        if owner == pid and path.suffix == ".replaying":
+            claimed.append(path)
+            continue
+        if owner not in (pid, None) and _pid_alive(owner):
+            continue
+        target = base.with_name(f"{base.stem}.{pid}.{uuid.uuid4().hex[:8]}.replaying")
+        try:
+            if path.stat().st_size == 0:
+                path.unlink()
+                continue
+            path.rename(target)
+        except FileNotFoundError:
+            continue  # Claimed by another worker
+        claimed.append(target)
+    return claimed
+
+
+def _read_spill(path: Path) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+audit_sink = AuditSink()
+
+
+async def write_audit(db, collection: str, doc: dict):
+    """
+    Record an audit entry.
+    Buffered through the sink when it is running (API server); written
+    directly otherwise (scripts, tests, startup before the sink starts).
+    """
+    if audit_sink.running:
+        audit_sink.enqueue(collection, doc)
+        return
+    await db[collection].insert_one(doc)
+    doc.pop("_id", None)
+    await audit_sink.run_hook(collection, [doc], db)
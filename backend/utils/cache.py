@@ -0,0 +1,82 @@
+"""
+In-memory caching helpers - small LRU cache with per-entry TTL
+Used as the fast front tier in front of Mongo-backed caches
+"""
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+import time
+
+
+class LRUCache:
+    """
+    Least-recently-used cache with an optional time-to-live per entry.
+    Not shared between worker processes - each uvicorn worker keeps its own copy.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return cached value or default if missing/expired"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Store a value, evicting the least recently used entry when full"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        """Drop a single key"""
+        self._data.pop(key, None)
+
+    def invalidate_prefix(self, prefix: tuple):
+        """Drop every tuple key that starts with the given prefix"""
+        n = len(prefix)
+        for key in [k for k in self._data if isinstance(k, tuple) and k[:n] == prefix]:
+            del self._data[key]
+
+    def clear(self):
+        """Drop all entries"""
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """Hit/miss counters for monitoring endpoints"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0
+        }
+
+
+_MISSING = object()
@@ -0,0 +1,154 @@
+"""
+Cash Daily Balances - Precomputed cash book balances per day
+- cash_daily_balances holds one row per (scope, date): opening, cash_in, cash_out, count.
+  Scopes: "all", "operator:<user id>" and "branch:<id>" when a transaction carries one
+- Every cash transaction bumps its day rows in the same transaction as the insert;
+  a new day row opens at the previous row's closing balance
+- Opening / current balance is one indexed lookup instead of a $group over all history
+- rebuild_cash_daily_balances recomputes rows from a date onwards (backfill / repair)
+  in one transaction, upserting rows in place and dropping only days without entries;
+  the report scheduler runs it nightly for the last two days
+"""
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from pymongo import ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+from utils.transactions import run_in_transaction
+
+ALL_SCOPE = "all"
+
+
+def transaction_scopes(transaction: dict) -> List[str]:
+    scopes = [ALL_SCOPE]
+    if transaction.get("recorded_by"):
+        scopes.append(f"operator:{transaction['recorded_by']}")
+    if transaction.get("branch_id"):
+        scopes.append(f"branch:{transaction['branch_id']}")
+    return scopes
+
+
+def closing_of(row: Optional[dict]) -> float:
+    if not row:
+        return 0.0
+    return row.get("opening", 0) + row.get("cash_in", 0) - row.get("cash_out", 0)
+
+
+async def _latest_row(db, scope: str, date: str, inclusive: bool, session=None) -> Optional[dict]:
+    return await db.cash_daily_balances.find_one(
+        {"scope": scope, "date": {"$lte" if inclusive else "$lt": date}},
+        {"_id": 0},
+        sort=[("date", -1)],
+        session=session
+    )
+
+
+async def apply_cash_transaction(db, transaction: dict, session=None):
+    """Fold one cash transaction into its day rows (call inside the insert's transaction)"""
+    amount = transaction["amount"]
+    inc = {"cash_in": amount if transaction["direction"] == "in" else 0,
+           "cash_out": amount if transaction["direction"] == "out" else 0,
+           "count": 1}
+    delta = inc["cash_in"] - inc["cash_out"]
+    date = transaction["date"]
+    for scope in transaction_scopes(transaction):
+        previous = await _latest_row(db, scope, date, inclusive=False, session=session)
+        try:
+            await db.cash_daily_balances.update_one(
+                {"scope": scope, "date": date},
+                {"$inc": inc, "$setOnInsert": {"opening": round(closing_of(previous), 2)}},
+                upsert=True,
+                session=session
+            )
+        except DuplicateKeyError:
+            # Lost the race to open the day (no-session fallback) - the row exists now
+            await db.cash_daily_balances.update_one({"scope": scope, "date": date}, {"$inc": inc}, session=session)
+        # A back-dated entry moves the opening of every later day (normally none exist)
+        await db.cash_daily_balances.update_many(
+            {"scope": scope, "date": {"$gt": date}},
+            {"$inc": {"opening": delta}},
+            session=session
+        )
+
+
+async def get_opening_balance(db, date: str, scope: str = ALL_SCOPE) -> float:
+    """Cash in hand at the start of `date` (YYYY-MM-DD)"""
+    row = await _latest_row(db, scope, date, inclusive=True)
+    if row and row["date"] == date:
+        return round(row.get("opening", 0), 2)
+    return round(closing_of(row), 2)
+
+
+async def get_current_balance(db, scope: str = ALL_SCOPE) -> float:
+    row = await db.cash_daily_balances.find_one({"scope": scope}, {"_id": 0}, sort=[("date", -1)])
+    return round(closing_of(row), 2)
+
+
+async def rebuild_cash_daily_balances(db, from_date: Optional[str] = None) -> dict:
+    """
+    Recompute every scope's rows from `from_date` (default: all history) out of cash_transactions.
+    Openings chain on from the last row before from_date, which is trusted.
+    Runs in one transaction, so a concurrent cash entry either lands before the
+    rebuild reads or conflicts and is retried. Rows are replaced in place and only
+    days with no cash entries are deleted, so even overlapping rebuilds without a
+    session never remove each other's rows.
+    """
+    range_filter = {"date": {"$gte": from_date}} if from_date else {}
+
+    async def _rebuild(session):
+        rows = await db.cash_transactions.aggregate([
+            {"$match": range_filter},
+            {"$group": {
+                "_id": {"date": "$date", "recorded_by": "$recorded_by", "branch_id": "$branch_id"},
+                "cash_in": {"$sum": {"$cond": [{"$eq": ["$direction", "in"]}, "$amount", 0]}},
+                "cash_out": {"$sum": {"$cond": [{"$eq": ["$direction", "out"]}, "$amount", 0]}},
+                "count": {"$sum": 1}
+            }}
+        ], allowDiskUse=True, session=session).to_list(None)
+
+        days = {}
+        for row in rows:
+            for scope in transaction_scopes(row["_id"]):
+                day = days.setdefault((scope, row["_id"]["date"]), {"cash_in": 0, "cash_out": 0, "count": 0})
+                for field in ("cash_in", "cash_out", "count"):
+                    day[field] += row[field]
+
+        # Scopes that already have rows in the range keep a row chain even if their entries vanished
+        existing_scopes = await db.cash_daily_balances.distinct("scope", range_filter, session=session)
+        scopes = set(existing_scopes) | {scope for scope, _ in days}
+
+        operations = []
+        for scope in scopes:
+            balance = closing_of(await _latest_row(db, scope, from_date, inclusive=False, session=session)) \
+                if from_date else 0.0
+            for date in sorted(d for s, d in days if s == scope):
+                day = days[(scope, date)]
+                operations.append(ReplaceOne(
+                    {"scope": scope, "date": date},
+                    {"scope": scope, "date": date, "opening": round(balance, 2), **day},
+                    upsert=True
+                ))
+                balance += day["cash_in"] - day["cash_out"]
+
+        if operations:
+            await db.cash_daily_balances.bulk_write(operations, ordered=False, session=session)
+        # Days whose entries are gone
+        for scope in scopes:
+            dates = [d for s, d in days if s == scope]
+            date_filter = {**range_filter.get("date", {}), "$nin": dates}
+            await db.cash_daily_balances.delete_many({"scope": scope, "date": date_filter}, session=session)
+        return {"from_date": from_date, "rows": len(operations), "scopes": len(scopes)}
+
+    return await run_in_transaction(db, _rebuild)
+
+
+async def repair_recent_cash_balances(db, days: int = 2) -> dict:
+    """Nightly: rebuild the last few days (covers writes that raced a day rollover)"""
+    from_date = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    return await rebuild_cash_daily_balances(db, from_date)
+
+
+async def ensure_cash_balance_indexes(db):
+    await db.cash_daily_balances.create_index([("scope", 1), ("date", -1)], unique=True)
+    await db.cash_transactions.create_index("date")
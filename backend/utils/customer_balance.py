@@ -0,0 +1,171 @@
+"""
+Customer Balances - Maintained receivables on customer_profiles
+- outstanding_balance: unpaid amount across the customer's open orders (unpaid advance + remaining)
+- credit_exposure: unpaid remaining amount of open orders - what credit_limit is checked against
+- Moved with $inc on every order money/status transition (same transaction as the order write)
+- Credit is reserved with a conditional update, so concurrent orders cannot overshoot the limit
+- A nightly reconciliation recomputes both fields from orders and repairs drift
+"""
+from typing import Optional, Tuple
+import asyncio
+import logging
+
+from utils.transactions import run_in_transaction
+
+logger = logging.getLogger(__name__)
+
+BALANCE_FIELDS = ("outstanding_balance", "credit_exposure")
+DRIFT_TOLERANCE = 0.01
+
+
+def order_balance(order: dict) -> Tuple[float, float]:
+    """(outstanding, credit exposure) one order contributes to its customer"""
+    if order.get("status") == "cancelled" or order.get("payment_status") == "completed":
+        return 0.0, 0.0
+    remaining = order.get("remaining_amount", 0) or 0
+    advance_paid = order.get("advance_paid_at") or order.get("advance_payment_status") == "paid"
+    unpaid_advance = 0 if advance_paid else (order.get("advance_amount", 0) or 0)
+    return round(remaining + unpaid_advance, 2), round(remaining, 2)
+
+
+async def reserve_credit(db, customer_profile_id: str, order: dict, limit_check: Optional[float] = None,
+                         session=None) -> bool:
+    """
+    Add a new order to the customer's balances.
+    With limit_check, succeeds only if credit_exposure + limit_check stays within credit_limit
+    (checked and incremented in one conditional update). Returns False when rejected.
+    """
+    outstanding, exposure = order_balance(order)
+    query = {"id": customer_profile_id, "status": "active"}
+    if limit_check is not None:
+        query["$expr"] = {"$lte": [
+            {"$add": [{"$ifNull": ["$credit_exposure", 0]}, limit_check]},
+            {"$ifNull": ["$credit_limit", 0]}
+        ]}
+    result = await db.customer_profiles.update_one(
+        query,
+        {"$inc": {"outstanding_balance": outstanding, "credit_exposure": exposure}},
+        session=session
+    )
+    return result.matched_count == 1
+
+
+async def apply_order_transition(db, before: dict, after: dict, session=None):
+    """Move the customer's balances by the difference between two states of an order"""
+    customer_profile_id = before.get("customer_profile_id")
+    if not customer_profile_id:
+        return
+    old_outstanding, old_exposure = order_balance(before)
+    new_outstanding, new_exposure = order_balance(after)
+    delta = {
+        "outstanding_balance": round(new_outstanding - old_outstanding, 2),
+        "credit_exposure": round(new_exposure - old_exposure, 2)
+    }
+    if any(delta.values()):
+        await db.customer_profiles.update_one({"id": customer_profile_id}, {"$inc": delta}, session=session)
+
+
+async def update_order_and_balance(db, order_filter: dict, set_fields: dict) -> Optional[dict]:
+    """
+    $set fields on an order and adjust its customer's balances atomically.
+    Returns the order as it was before the update (None if not found).
+    """
+    async def apply(session):
+        before = await db.orders.find_one_and_update(
+            order_filter, {"$set": set_fields}, projection={"_id": 0}, session=session
+        )
+        if before:
+            await apply_order_transition(db, before, {**before, **set_fields}, session)
+        return before
+
+    return await run_in_transaction(db, apply)
+
+
+def _expected_balances_pipeline(match: dict) -> list:
+    """Aggregation mirroring order_balance(), grouped per customer profile"""
+    return [
+        {"$match": {
+            **match,
+            "status": {"$ne": "cancelled"},
+            "payment_status": {"$ne": "completed"}
+        }},
+        {"$project": {
+            "customer_profile_id": 1,
+            "remaining": {"$ifNull": ["$remaining_amount", 0]},
+            "unpaid_advance": {"$cond": [
+                {"$or": [
+                    {"$ifNull": ["$advance_paid_at", False]},
+                    {"$eq": ["$advance_payment_status", "paid"]}
+                ]},
+                0,
+                {"$ifNull": ["$advance_amount", 0]}
+            ]}
+        }},
+        {"$group": {
+            "_id": "$customer_profile_id",
+            "outstanding_balance": {"$sum": {"$add": ["$remaining", "$unpaid_advance"]}},
+            "credit_exposure": {"$sum": "$remaining"}
+        }}
+    ]
+
+
+def _drifted(profile: dict, expected: dict) -> bool:
+    return any(
+        field not in profile or abs((profile.get(field) or 0) - expected.get(field, 0)) > DRIFT_TOLERANCE
+        for field in BALANCE_FIELDS
+    )
+
+
+async def reconcile_customer_balances(db) -> dict:
+    """
+    Recompute balances from orders and repair profiles that drifted.
+    Each repair re-reads that customer's orders inside a transaction, so it
+    never overwrites an order placed while the scan was running.
+    """
+    rows = await db.orders.aggregate(
+        _expected_balances_pipeline({"customer_profile_id": {"$nin": [None, ""]}})
+    ).to_list(None)
+    expected = {row["_id"]: row for row in rows}
+
+    checked = 0
+    drifted = []
+    async for profile in db.customer_profiles.find({}, {"_id": 0, "id": 1, **{f: 1 for f in BALANCE_FIELDS}}):
+        checked += 1
+        if _drifted(profile, expected.get(profile["id"], {})):
+            drifted.append(profile["id"])
+
+    repaired = 0
+    drift_total = 0.0
+    for customer_profile_id in drifted:
+        async def repair(session, customer_profile_id=customer_profile_id):
+            result = await db.orders.aggregate(
+                _expected_balances_pipeline({"customer_profile_id": customer_profile_id}), session=session
+            ).to_list(1)
+            values = {f: round(result[0][f], 2) if result else 0.0 for f in BALANCE_FIELDS}
+            profile = await db.customer_profiles.find_one_and_update(
+                {"id": customer_profile_id}, {"$set": values},
+                projection={"_id": 0, "outstanding_balance": 1}, session=session
+            )
+            return abs((profile or {}).get("outstanding_balance", 0) - values["outstanding_balance"])
+
+        drift_total += await run_in_transaction(db, repair)
+        repaired += 1
+
+    if repaired:
+        logger.info(f"Customer balances repaired for {repaired} profiles (outstanding drift ₹{drift_total:,.2f})")
+    return {"checked": checked, "repaired": repaired, "outstanding_drift": round(drift_total, 2)}
+
+
+async def ensure_customer_balance_indexes(db):
+    """Index orders by customer profile; initialise balances once if they were never computed"""
+    await db.orders.create_index("customer_profile_id")
+
+    if await db.customer_profiles.find_one({"credit_exposure": {"$exists": False}}, {"_id": 1}):
+        async def initialise():
+            try:
+                result = await reconcile_customer_balances(db)
+                logger.info(f"Customer balances initialised: {result}")
+            except Exception as e:
+                logger.warning(f"Customer balance initialisation failed: {e}")
+
+        asyncio.create_task(initialise())
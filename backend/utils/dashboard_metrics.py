@@ -0,0 +1,197 @@
+"""
+Dashboard Metrics - Counters for the admin and customer master dashboards
+- One $facet aggregation per collection instead of one count per stage/category
+- Independent collections queried concurrently with asyncio.gather
+- Results cached for a short TTL, invalidated by writes to production orders, POs and customers
+"""
+from datetime import datetime, timezone
+import asyncio
+import logging
+
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+DASHBOARD_CACHE_TTL = 30  # seconds - dashboards auto-refresh, a few seconds of lag is fine
+
+PRODUCTION_STAGES = ['pending', 'cutting', 'polishing', 'grinding', 'toughening', 'quality_check', 'packing', 'dispatched']
+JOB_WORK_PENDING_STATUSES = ["pending", "accepted", "material_received", "in_process"]
+CUSTOMER_CATEGORIES = ["retail", "builder", "dealer", "project"]
+
+_cache = LRUCache(maxsize=32, ttl=DASHBOARD_CACHE_TTL)
+
+
+def invalidate_dashboard_metrics(*scopes: str):
+    """
+    Drop cached metrics after a write.
+    Scopes: "production", "purchase", "inventory", "customers" - no scope clears everything.
+    """
+    if not scopes:
+        _cache.clear()
+        return
+    for scope in scopes:
+        # Admin dashboard mixes production, PO and low-stock counts
+        if scope in ("production", "purchase", "inventory"):
+            _cache.invalidate_prefix(("admin",))
+        elif scope == "customers":
+            _cache.invalidate_prefix(("customers",))
+
+
+def _first(result: list, field: str, default=0):
+    """Read a single-value facet ($count / $group) result"""
+    return result[0].get(field, default) if result else default
+
+
+async def _production_metrics(db, today_start: str) -> dict:
+    """Today's orders and per-stage counts in one round-trip"""
+    result = await db.production_orders.aggregate([
+        {"$facet": {
+            "today": [
+                {"$match": {"created_at": {"$gte": today_start}}},
+                {"$count": "count"}
+            ],
+            "by_stage": [
+                {"$match": {"current_stage": {"$in": PRODUCTION_STAGES}}},
+                {"$group": {"_id": "$current_stage", "count": {"$sum": 1}}}
+            ]
+        }}
+    ]).to_list(1)
+    facets = result[0] if result else {}
+    by_stage = {row["_id"]: row["count"] for row in facets.get("by_stage", [])}
+    return {
+        "orders_today": _first(facets.get("today"), "count"),
+        "production_stats": {stage: by_stage.get(stage, 0) for stage in PRODUCTION_STAGES}
+    }
+
+
+async def _job_work_metrics(db, today_start: str) -> dict:
+    """Job work today/pending counts and collected revenue in one round-trip"""
+    result = await db.job_work_orders.aggregate([
+        {"$facet": {
+            "today": [
+                {"$match": {"created_at": {"$gte": today_start}}},
+                {"$count": "count"}
+            ],
+            "pending": [
+                {"$match": {"status": {"$in": JOB_WORK_PENDING_STATUSES}}},
+                {"$count": "count"}
+            ],
+            "revenue": [
+                {"$match": {"payment_status": "completed"}},
+                {"$group": {"_id": None, "total": {"$sum": "$paid_amount"}}}
+            ]
+        }}
+    ]).to_list(1)
+    facets = result[0] if result else {}
+    return {
+        "today": _first(facets.get("today"), "count"),
+        "pending": _first(facets.get("pending"), "count"),
+        "total_revenue": round(_first(facets.get("revenue"), "total"), 2)
+    }
+
+
+async def _breakage_today(db, today_start: str) -> float:
+    result = await db.breakage_entries.aggregate([
+        {"$match": {"created_at": {"$gte": today_start}}},
+        {"$group": {"_id": None, "total_loss": {"$sum": "$total_loss"}}}
+    ]).to_list(1)
+    return _first(result, "total_loss")
+
+
+async def _low_stock_count(db) -> int:
+    # Maintained flag, served by the partial index (see utils.stock_ledger)
+    return await db.raw_materials.count_documents({"status": "active", "is_low_stock": True})
+
+
+async def get_admin_dashboard_metrics(db) -> dict:
+    """Metrics for /admin/dashboard, cached per day for DASHBOARD_CACHE_TTL seconds"""
+    today = datetime.now(timezone.utc).date()
+    cache_key = ("admin", today.isoformat())
+    cached = _cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    today_start = datetime.combine(today, datetime.min.time()).replace(tzinfo=timezone.utc).isoformat()
+
+    production, job_work, breakage_today, low_stock, pending_pos, present_today = await asyncio.gather(
+        _production_metrics(db, today_start),
+        _job_work_metrics(db, today_start),
+        _breakage_today(db, today_start),
+        _low_stock_count(db),
+        db.purchase_orders.count_documents({"status": "pending"}),
+        db.attendance.count_documents({"date": today.isoformat(), "status": "present"})
+    )
+
+    metrics = {
+        "orders_today": production["orders_today"],
+        "production_stats": production["production_stats"],
+        "breakage_today": round(breakage_today, 2),
+        "low_stock_items": low_stock,
+        "pending_pos": pending_pos,
+        "present_employees": present_today,
+        # Job Work Stats
+        "job_work": job_work
+    }
+    _cache.set(cache_key, metrics)
+    return metrics
+
+
+async def get_production_stage_counts(db) -> dict:
+    """Per-stage production order counts (shared by dashboard and charts)"""
+    cached = _cache.get(("admin", "stages"))
+    if cached is not None:
+        return cached
+
+    rows = await db.production_orders.aggregate([
+        {"$match": {"current_stage": {"$in": PRODUCTION_STAGES}}},
+        {"$group": {"_id": "$current_stage", "count": {"$sum": 1}}}
+    ]).to_list(len(PRODUCTION_STAGES))
+    by_stage = {row["_id"]: row["count"] for row in rows}
+    counts = {stage: by_stage.get(stage, 0) for stage in PRODUCTION_STAGES}
+    _cache.set(("admin", "stages"), counts)
+    return counts
+
+
+async def get_customer_stats_metrics(db) -> dict:
+    """Metrics for /customer-master/stats in a single $facet over active profiles"""
+    cached = _cache.get(("customers", "stats"))
+    if cached is not None:
+        return cached
+
+    def group_by(field: str) -> list:
+        return [{"$group": {"_id": f"${field}", "count": {"$sum": 1}}}]
+
+    result = await db.customer_profiles.aggregate([
+        {"$match": {"status": "active"}},
+        {"$facet": {
+            "total": [{"$count": "count"}],
+            "by_category": group_by("customer_category"),
+            "by_credit_type": group_by("credit_type"),
+            "by_invoice_type": group_by("invoice_type"),
+            "by_kyc": group_by("compliance.kyc_status")
+        }}
+    ]).to_list(1)
+    facets = result[0] if result else {}
+
+    def counts(name: str) -> dict:
+        return {row["_id"]: row["count"] for row in facets.get(name, [])}
+
+    by_category = counts("by_category")
+    by_invoice_type = counts("by_invoice_type")
+    by_kyc = counts("by_kyc")
+
+    metrics = {
+        "total_active": _first(facets.get("total"), "count"),
+        "by_category": {category: by_category.get(category, 0) for category in CUSTOMER_CATEGORIES},
+        "credit_customers": counts("by_credit_type").get("credit_allowed", 0),
+        "invoice_type": {
+            "b2b": by_invoice_type.get("B2B", 0),
+            "b2c": by_invoice_type.get("B2C", 0)
+        },
+        "kyc": {
+            "verified": by_kyc.get("verified", 0),
+            "pending": by_kyc.get("pending", 0)
+        }
+    }
+    _cache.set(("customers", "stats"), metrics)
+    return metrics
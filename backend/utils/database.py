@@ -0,0 +1,170 @@
+"""
+Database - One tuned MongoDB client per process
+- get_client() builds the Motor client once from MONGO_URL with pool, timeout and
+  compression settings from the environment; server.py, erp_server.py and the
+  maintenance scripts all share it instead of opening their own
+- get_database() is the app database (DB_NAME); routers keep reaching it through
+  routers.base.get_db
+- report_view(db) is the same database with the report read preference
+  (MONGO_REPORT_READ_PREFERENCE, default secondaryPreferred) so heavy read-only
+  reports can be served by a secondary; on a standalone server it reads the primary
+- A connection pool listener counts connections and checkouts per server;
+  pool_stats() exposes them with the effective settings
+"""
+from typing import Dict, Optional
+import os
+import threading
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient, ReadPreference, monitoring
+
+DEFAULT_MONGO_URL = "mongodb://127.0.0.1:27017"
+DEFAULT_DB_NAME = "glass_erp"
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+_client: Optional[AsyncIOMotorClient] = None
+_report_views: Dict[str, object] = {}
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Per-server connection counters (driver events arrive on background threads)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers: Dict[str, Dict[str, int]] = {}
+
+    def _bump(self, address, **deltas):
+        key = "%s:%s" % address
+        with self._lock:
+            counters = self._servers.setdefault(key, {
+                "open": 0, "in_use": 0, "created": 0, "closed": 0,
+                "checkouts": 0, "checkout_failures": 0, "pool_cleared": 0
+            })
+            for name, delta in deltas.items():
+                counters[name] += delta
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {address: dict(counters) for address, counters in self._servers.items()}
+
+    def pool_created(self, event):
+        self._bump(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._bump(event.address, pool_cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._bump(event.address, open=1, created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._bump(event.address, open=-1, closed=1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._bump(event.address, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._bump(event.address, in_use=1, checkouts=1)
+
+    def connection_checked_in(self, event):
+        self._bump(event.address, in_use=-1)
+
+
+pool_listener = PoolStatsListener()
+
+
+def client_options() -> dict:
+    """Pool/timeout/compression options from the environment"""
+    options = {
+        "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", 100)),
+        "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", 5)),
+        "maxIdleTimeMS": int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 300000)),
+        "waitQueueTimeoutMS": int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000)),
+        "serverSelectionTimeoutMS": int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000)),
+        "connectTimeoutMS": int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 10000)),
+        "retryWrites": True,
+        "retryReads": True,
+    }
+    # zlib ships with Python; zstd/snappy need the zstandard/python-snappy packages
+    compressors = os.environ.get("MONGO_COMPRESSORS", "zlib").strip()
+    if compressors:
+        options["compressors"] = compressors
+    read_preference = os.environ.get("MONGO_READ_PREFERENCE")
+    if read_preference:
+        options["readPreference"] = read_preference
+    return options
+
+
+def get_client() -> AsyncIOMotorClient:
+    """The process-wide Motor client (created on first use)"""
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(
+            os.environ.get("MONGO_URL", DEFAULT_MONGO_URL),
+            event_listeners=[pool_listener],
+            **client_options()
+        )
+    return _client
+
+
+def get_database(name: Optional[str] = None):
+    return get_client()[name or os.environ.get("DB_NAME", DEFAULT_DB_NAME)]
+
+
+def get_sync_client() -> MongoClient:
+    """Blocking pymongo client with the same settings, for synchronous scripts"""
+    return MongoClient(os.environ.get("MONGO_URL", DEFAULT_MONGO_URL), **client_options())
+
+
+def report_view(db):
+    """`db` with the report read preference, for heavy read-only queries"""
+    view = _report_views.get(db.name)
+    if view is None:
+        mode = os.environ.get("MONGO_REPORT_READ_PREFERENCE", "secondaryPreferred")
+        view = db.with_options(read_preference=READ_PREFERENCES.get(mode, ReadPreference.SECONDARY_PREFERRED))
+        _report_views[db.name] = view
+    return view
+
+
+def close_client():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+        _report_views.clear()
+
+
+def pool_stats() -> dict:
+    """Effective pool settings plus per-server connection counters"""
+    options = client_options()
+    return {
+        "settings": {
+            "max_pool_size": options["maxPoolSize"],
+            "min_pool_size": options["minPoolSize"],
+            "max_idle_time_ms": options["maxIdleTimeMS"],
+            "wait_queue_timeout_ms": options["waitQueueTimeoutMS"],
+            "compressors": options.get("compressors", ""),
+            "read_preference": options.get("readPreference", "primary"),
+            "report_read_preference": os.environ.get("MONGO_REPORT_READ_PREFERENCE", "secondaryPreferred"),
+        },
+        "connected": _client is not None,
+        "servers": pool_listener.snapshot()
+    }
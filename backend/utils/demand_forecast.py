@@ -0,0 +1,346 @@
+"""
+Demand Forecast - On-box statistical demand forecasting (no network, no LLM)
+- One aggregation pipeline builds daily demand (sqft) by product, thickness and
+  customer category, plus daily order / revenue totals
+- Per series: moving average, seasonal naive and additive Holt-Winters (parameters
+  grid-searched in one vectorised pass) are backtested on a holdout and the most
+  accurate model (WAPE) is refitted on the full history
+- Outputs are cached per series in demand_forecasts; the scheduler refreshes them
+  nightly so the forecast endpoints are a single indexed read
+- Refreshes are single-flight (lease on the meta doc); a run is published in the
+  meta before older runs are deleted, so readers pinned to either run see a full set
+- Model fitting runs in a worker thread; a read before the first run starts a
+  background refresh and raises ForecastNotReady instead of fitting inline
+"""
+from datetime import datetime, timedelta, timezone
+from itertools import product as grid
+from typing import Dict, List, Optional
+import asyncio
+import logging
+
+import numpy as np
+import pandas as pd
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DAYS = 365
+TOP_SERIES_PER_DIMENSION = 20
+DIMENSIONS = ["product", "thickness", "customer_category"]
+FREQUENCIES = {
+    "daily": {"rule": "D", "season": 7, "horizon": 30},
+    "weekly": {"rule": "W-MON", "season": 52, "horizon": 8}
+}
+EXCLUDED_STATUSES = ["cancelled", "refunded"]
+REFRESH_LEASE = timedelta(minutes=10)  # Longer than a full refit; frees the lease if a worker dies
+
+_refresh_tasks = set()  # Cold-start refreshes started by reads (kept referenced until done)
+
+ALPHAS = (0.1, 0.2, 0.4, 0.6)
+BETAS = (0.0, 0.05, 0.15)
+GAMMAS = (0.05, 0.15, 0.3)
+
+
+class ForecastNotReady(Exception):
+    """No forecast run has been published yet; a refresh is running"""
+
+
+# =============== MODELS ===============
+
+def moving_average(y: np.ndarray, horizon: int, window: int = 28) -> np.ndarray:
+    tail = y[-window:] if len(y) else np.zeros(1)
+    return np.full(horizon, tail.mean())
+
+
+def seasonal_naive(y: np.ndarray, horizon: int, season: int) -> np.ndarray:
+    if len(y) < season:
+        return moving_average(y, horizon)
+    last = y[-season:]
+    return np.resize(last, horizon)
+
+
+def holt_winters(y: np.ndarray, horizon: int, season: Optional[int]) -> np.ndarray:
+    """
+    Additive Holt-Winters. Every (alpha, beta, gamma) in the grid is run side by side
+    as NumPy vectors; the combination with the lowest one-step-ahead SSE forecasts.
+    Falls back to Holt's linear trend when there are fewer than two seasons.
+    """
+    seasonal = bool(season) and len(y) >= 2 * season
+    m = season if seasonal else 1
+    params = np.array(list(grid(ALPHAS, BETAS, GAMMAS if seasonal else (0.0,))))
+    alpha, beta, gamma = params[:, 0], params[:, 1], params[:, 2]
+    count = len(params)
+
+    if seasonal:
+        first = y[:m].mean()
+        level = np.full(count, first)
+        trend = np.full(count, (y[m:2 * m].mean() - first) / m)
+        seasons = np.tile(y[:m] - first, (count, 1))
+        start = m
+    else:
+        level = np.full(count, y[0])
+        trend = np.full(count, y[1] - y[0] if len(y) > 1 else 0.0)
+        seasons = np.zeros((count, 1))
+        start = 1
+
+    sse = np.zeros(count)
+    for t in range(start, len(y)):
+        s = seasons[:, t % m]
+        error = y[t] - (level + trend + s)
+        sse += error ** 2
+        previous_level = level
+        level = alpha * (y[t] - s) + (1 - alpha) * (level + trend)
+        trend = beta * (level - previous_level) + (1 - beta) * trend
+        if seasonal:
+            seasons[:, t % m] = gamma * (y[t] - level) + (1 - gamma) * s
+
+    best = int(np.argmin(sse))
+    steps = np.arange(1, horizon + 1)
+    season_part = seasons[best, (len(y) + steps - 1) % m] if seasonal else 0.0
+    return level[best] + steps * trend[best] + season_part
+
+
+def _forecast(model: str, y: np.ndarray, horizon: int, season: int) -> np.ndarray:
+    if model == "holt_winters":
+        result = holt_winters(y, horizon, season)
+    elif model == "seasonal_naive":
+        result = seasonal_naive(y, horizon, season)
+    else:
+        result = moving_average(y, horizon, window=min(len(y), 4 if season > 7 else 28) or 1)
+    return np.clip(result, 0, None)
+
+
+def wape(actual: np.ndarray, predicted: np.ndarray) -> Optional[float]:
+    total = np.abs(actual).sum()
+    return float(np.abs(actual - predicted).sum() / total) if total else None
+
+
+def fit_series(y: np.ndarray, horizon: int, season: int) -> dict:
+    """Backtest every model on the last `horizon` points, refit the winner on everything"""
+    models = ["moving_average", "seasonal_naive", "holt_winters"]
+    holdout = min(horizon, len(y) // 4)
+    scores = {}
+    if holdout >= 2 and np.count_nonzero(y[:-holdout]) >= 3:
+        train, test = y[:-holdout], y[-holdout:]
+        for model in models:
+            score = wape(test, _forecast(model, train, holdout, season))
+            if score is not None:
+                scores[model] = round(score, 4)
+
+    chosen = min(scores, key=scores.get) if scores else "moving_average"
+    forecast = _forecast(chosen, y, horizon, season)
+    return {
+        "model": chosen,
+        "backtest_wape": scores,
+        "forecast": [round(float(v), 2) for v in forecast]
+    }
+
+
+# =============== SERIES ===============
+
+async def load_demand_frames(db, days: int = HISTORY_DAYS) -> Dict[str, pd.DataFrame]:
+    """Daily demand lines and order totals for the last `days` days in one pipeline"""
+    start = (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d")
+    pipeline = [
+        {"$match": {"created_at": {"$gte": start}, "status": {"$nin": EXCLUDED_STATUSES}}},
+        {"$lookup": {
+            "from": "customer_profiles",
+            "let": {"profile_id": "$customer_profile_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$id", "$$profile_id"]}}},
+                {"$project": {"_id": 0, "customer_category": 1}}
+            ],
+            "as": "profile"
+        }},
+        {"$addFields": {
+            "date": {"$substrBytes": ["$created_at", 0, 10]},
+            "customer_category": {"$ifNull": [{"$arrayElemAt": ["$profile.customer_category", 0]}, "retail"]}
+        }},
+        {"$facet": {
+            "totals": [
+                {"$group": {
+                    "_id": "$date",
+                    "orders": {"$sum": 1},
+                    "revenue": {"$sum": {"$ifNull": ["$total_price", {"$ifNull": ["$total_amount", 0]}]}}
+                }}
+            ],
+            "lines": [
+                # Cart orders carry glass_items; configurator orders are one line on the order itself
+                {"$unwind": {"path": "$glass_items", "preserveNullAndEmptyArrays": True}},
+                {"$project": {
+                    "date": 1,
+                    "customer_category": 1,
+                    "product": {"$ifNull": ["$glass_items.product_name", {"$ifNull": ["$glass_type", "$product_name"]}]},
+                    "thickness": {"$ifNull": ["$glass_items.thickness", "$thickness"]},
+                    "sqft": {"$cond": [
+                        {"$ifNull": ["$glass_items", False]},
+                        {"$divide": [{"$multiply": [
+                            {"$ifNull": ["$glass_items.width", 0]},
+                            {"$ifNull": ["$glass_items.height", 0]},
+                            {"$ifNull": ["$glass_items.quantity", 0]}
+                        ]}, 144]},
+                        {"$multiply": [
+                            {"$ifNull": ["$dimensions.area_sqft", {"$ifNull": ["$total_sqft", 0]}]},
+                            {"$ifNull": ["$quantity", 1]}
+                        ]}
+                    ]}
+                }},
+                {"$group": {
+                    "_id": {
+                        "date": "$date",
+                        "product": "$product",
+                        "thickness": "$thickness",
+                        "customer_category": "$customer_category"
+                    },
+                    "sqft": {"$sum": "$sqft"}
+                }}
+            ]
+        }}
+    ]
+    result = await db.orders.aggregate(pipeline, allowDiskUse=True).to_list(1)
+    facets = result[0] if result else {"totals": [], "lines": []}
+
+    totals = pd.DataFrame(
+        [{"date": r["_id"], "orders": r["orders"], "revenue": r["revenue"]} for r in facets["totals"]],
+        columns=["date", "orders", "revenue"]
+    )
+    lines = pd.DataFrame(
+        [{**r["_id"], "sqft": r["sqft"]} for r in facets["lines"]],
+        columns=["date", "product", "thickness", "customer_category", "sqft"]
+    )
+    lines["product"] = lines["product"].fillna("Unknown")
+    lines["thickness"] = lines["thickness"].map(lambda t: f"{float(t):g}mm" if pd.notna(t) else "Unknown")
+    return {"totals": totals, "lines": lines}
+
+
+def _daily_index(days: int) -> pd.DatetimeIndex:
+    """Complete days only - today is still filling up"""
+    yesterday = pd.Timestamp(datetime.now(timezone.utc).date()) - pd.Timedelta(days=1)
+    return pd.date_range(yesterday - pd.Timedelta(days=days - 1), yesterday, freq="D")
+
+
+def _resample(series: pd.Series, frequency: str) -> pd.Series:
+    if frequency == "daily":
+        return series
+    weekly = series.resample(FREQUENCIES[frequency]["rule"], label="left", closed="left").sum()
+    # Drop partial weeks at either end so they do not read as a demand dip
+    return weekly[(weekly.index >= series.index[0]) & (weekly.index + pd.Timedelta(days=6) <= series.index[-1])]
+
+
+def build_series(frames: Dict[str, pd.DataFrame], frequency: str, days: int = HISTORY_DAYS) -> List[dict]:
+    """Every series to model: totals (orders, revenue, sqft) and sqft per dimension value"""
+    index = _daily_index(days)
+    series = []
+
+    totals = frames["totals"].assign(date=pd.to_datetime(frames["totals"]["date"], errors="coerce"))
+    totals = totals.dropna(subset=["date"]).groupby("date")[["orders", "revenue"]].sum().reindex(index, fill_value=0)
+    lines = frames["lines"].assign(date=pd.to_datetime(frames["lines"]["date"], errors="coerce")).dropna(subset=["date"])
+
+    sqft_total = lines.groupby("date")["sqft"].sum().reindex(index, fill_value=0)
+    for metric, values in (("orders", totals["orders"]), ("revenue", totals["revenue"]), ("sqft", sqft_total)):
+        series.append({"dimension": "total", "key": "all", "metric": metric, "values": _resample(values, frequency)})
+
+    for dimension in DIMENSIONS:
+        table = lines.pivot_table(index="date", columns=dimension, values="sqft", aggfunc="sum", fill_value=0)
+        table = table.reindex(index, fill_value=0)
+        for key in table.sum().sort_values(ascending=False).index[:TOP_SERIES_PER_DIMENSION]:
+            series.append({"dimension": dimension, "key": str(key), "metric": "sqft",
+                           "values": _resample(table[key], frequency)})
+    return series
+
+
+async def _claim_refresh(db, now: datetime) -> bool:
+    """Take the refresh lease; False while another refresh holds it"""
+    try:
+        await db.demand_forecast_meta.update_one(
+            {"id": "default", "$or": [{"refreshing_until": None}, {"refreshing_until": {"$lt": now}}]},
+            {"$set": {"refreshing_until": now + REFRESH_LEASE}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def refresh_demand_forecasts(db, days: int = HISTORY_DAYS) -> dict:
+    """Refit every series for every frequency and replace the cached forecasts"""
+    started = datetime.now(timezone.utc)
+    if not await _claim_refresh(db, started):
+        logger.info("Demand forecast refresh already running - skipped")
+        return {"status": "skipped", "reason": "Refresh already running"}
+    try:
+        return await _refresh(db, days, started)
+    finally:
+        await db.demand_forecast_meta.update_one({"id": "default"}, {"$set": {"refreshing_until": None}})
+
+
+def _fit_documents(frames: Dict[str, pd.DataFrame], days: int, started: datetime) -> List[dict]:
+    """Fit every series for every frequency (CPU-bound - runs in a worker thread)"""
+    docs = []
+    for frequency, config in FREQUENCIES.items():
+        for item in build_series(frames, frequency, days):
+            values = item["values"]
+            fitted = fit_series(values.to_numpy(dtype=float), config["horizon"], config["season"])
+            step = pd.Timedelta(days=1 if frequency == "daily" else 7)
+            future = [values.index[-1] + step * (n + 1) for n in range(config["horizon"])]
+            docs.append({
+                "frequency": frequency,
+                "dimension": item["dimension"],
+                "key": item["key"],
+                "metric": item["metric"],
+                "history": [{"period": p.strftime("%Y-%m-%d"), "value": round(float(v), 2)} for p, v in values.items()],
+                "forecast": [{"period": p.strftime("%Y-%m-%d"), "value": v} for p, v in zip(future, fitted["forecast"])],
+                "model": fitted["model"],
+                "backtest_wape": fitted["backtest_wape"],
+                "fitted_at": started.isoformat()
+            })
+    return docs
+
+
+async def _refresh(db, days: int, started: datetime) -> dict:
+    frames = await load_demand_frames(db, days)
+    docs = await asyncio.to_thread(_fit_documents, frames, days, started)
+
+    # Write the run, publish it, then drop older runs; readers pinned to the previous
+    # fitted_at keep a complete set until the publish
+    if docs:
+        await db.demand_forecasts.insert_many(docs)
+    await db.demand_forecast_meta.update_one(
+        {"id": "default"},
+        {"$set": {"fitted_at": started.isoformat(), "history_days": days, "series": len(docs),
+                  "duration_ms": round((datetime.now(timezone.utc) - started).total_seconds() * 1000)}}
+    )
+    await db.demand_forecasts.delete_many({"fitted_at": {"$lt": started.isoformat()}})
+    logger.info(f"Demand forecasts refreshed: {len(docs)} series")
+    return {"series": len(docs), "fitted_at": started.isoformat()}
+
+
+async def _background_refresh(db):
+    try:
+        await refresh_demand_forecasts(db)
+    except Exception as e:
+        logger.error(f"Demand forecast cold-start refresh failed: {e}")
+
+
+async def get_cached_forecasts(db, frequency: str, dimension: Optional[str] = None,
+                               key: Optional[str] = None) -> List[dict]:
+    """Series of the published run; raises ForecastNotReady (after starting a refresh) before the first run"""
+    meta = await db.demand_forecast_meta.find_one({"id": "default"}, {"_id": 0, "fitted_at": 1})
+    if not (meta or {}).get("fitted_at"):
+        # First use before the nightly job has run - fit in the background (single-flight)
+        task = asyncio.get_event_loop().create_task(_background_refresh(db))
+        _refresh_tasks.add(task)
+        task.add_done_callback(_refresh_tasks.discard)
+        raise ForecastNotReady()
+    # Pin to the published run so a refresh in progress is never mixed in
+    query = {"frequency": frequency, "fitted_at": meta["fitted_at"]}
+    if dimension:
+        query["dimension"] = dimension
+    if key:
+        query["key"] = key
+    return await db.demand_forecasts.find(query, {"_id": 0}).to_list(None)
+
+
+async def ensure_demand_forecast_indexes(db):
+    await db.demand_forecast_meta.create_index("id", unique=True)
+    await db.demand_forecasts.create_index([("fitted_at", 1), ("frequency", 1), ("dimension", 1), ("key", 1)])
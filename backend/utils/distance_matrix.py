@@ -0,0 +1,175 @@
+"""
+Distance Matrix - Batch distances for transport quotes, route planning and SFA analytics
+- Many origins x destinations in one NumPy haversine call (a 100 x 100 matrix is sub-millisecond)
+- Coordinates are quantised (~11 m) so nearby pins share cache entries
+- Road factor: straight-line km x a factor fitted from measured road distances
+  (least squares through the origin), 1.0 until calibrated
+- Measured road km per pair live in Mongo (distance_cache) and override the estimate;
+  the per-worker copy is refreshed periodically
+- Single pair lookups are memoised in an LRU - repeat quotes are O(1)
+"""
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Tuple
+import logging
+import time
+
+import numpy as np
+from pymongo import UpdateOne
+
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+QUANTUM_DEG = 1e-4  # ~11 m
+ROAD_FACTOR_BOUNDS = (1.0, 2.5)
+MIN_CALIBRATION_KM = 0.5  # Very short hops say little about road detours
+REFRESH_SECONDS = 300
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Vectorised great-circle distance; arguments broadcast like NumPy arrays"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def path_length_km(points: List[Tuple[float, float]]) -> float:
+    """Total length of a GPS trail (consecutive legs)"""
+    if len(points) < 2:
+        return 0.0
+    coords = np.asarray(points, dtype=float)
+    return float(haversine_km(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1]).sum())
+
+
+def quantise(lat: float, lng: float) -> Tuple[int, int]:
+    return (int(round(lat / QUANTUM_DEG)), int(round(lng / QUANTUM_DEG)))
+
+
+def pair_key(a: Tuple[float, float], b: Tuple[float, float]) -> str:
+    """Order-independent key for a quantised coordinate pair"""
+    qa, qb = sorted((quantise(*a), quantise(*b)))
+    return f"{qa[0]},{qa[1]}|{qb[0]},{qb[1]}"
+
+
+class DistanceMatrixService:
+    """Road-factor calibrated distances with an LRU front and a Mongo tier of measured pairs"""
+
+    def __init__(self, maxsize: int = 100_000):
+        self._pairs = LRUCache(maxsize=maxsize)
+        self.road_factor = 1.0
+        self._measured = {}  # pair_key -> road km
+        self._measured_points = set()  # quantised points appearing in a measured pair
+        self._loaded_at = 0.0
+
+    async def refresh(self, db, force: bool = False):
+        """Reload road factor and measured pairs from Mongo (every REFRESH_SECONDS)"""
+        if not force and time.monotonic() - self._loaded_at < REFRESH_SECONDS:
+            return
+        self._loaded_at = time.monotonic()
+        try:
+            calibration = await db.distance_calibration.find_one({"id": "default"}, {"_id": 0, "road_factor": 1})
+            measured = await db.distance_cache.find({}, {"_id": 0, "key": 1, "road_km": 1}).to_list(None)
+        except Exception as e:
+            logger.warning(f"Distance cache refresh failed: {e}")
+            return
+        self.road_factor = (calibration or {}).get("road_factor", 1.0)
+        self._measured = {doc["key"]: doc["road_km"] for doc in measured}
+        self._measured_points = {
+            tuple(int(v) for v in point.split(","))
+            for key in self._measured for point in key.split("|")
+        }
+        self._pairs.clear()
+
+    def _pair_km(self, a: Tuple[float, float], b: Tuple[float, float], road: bool) -> float:
+        key = (pair_key(a, b), road)
+        km = self._pairs.get(key)
+        if km is None:
+            measured = self._measured.get(key[0]) if road else None
+            straight = float(haversine_km(a[0], a[1], b[0], b[1]))
+            km = measured if measured is not None else straight * (self.road_factor if road else 1.0)
+            self._pairs.set(key, km)
+        return km
+
+    async def distance(self, db, a: Tuple[float, float], b: Tuple[float, float], road: bool = True) -> float:
+        await self.refresh(db)
+        return self._pair_km(a, b, road)
+
+    async def matrix(self, db, origins: List[Tuple[float, float]],
+                     destinations: Optional[List[Tuple[float, float]]] = None, road: bool = True) -> np.ndarray:
+        """len(origins) x len(destinations) km matrix (destinations default to origins)"""
+        await self.refresh(db)
+        destinations = origins if destinations is None else destinations
+        if not origins or not destinations:
+            return np.zeros((len(origins), len(destinations)))
+        o = np.asarray(origins, dtype=float)
+        d = np.asarray(destinations, dtype=float)
+        km = haversine_km(o[:, None, 0], o[:, None, 1], d[None, :, 0], d[None, :, 1])
+        if not road:
+            return km
+        km *= self.road_factor
+
+        # Overlay measured pairs - only points that appear in one can match
+        if self._measured:
+            origin_keys = [quantise(*p) for p in origins]
+            destination_keys = [quantise(*p) for p in destinations]
+            for i, qa in enumerate(origin_keys):
+                if qa not in self._measured_points:
+                    continue
+                for j, qb in enumerate(destination_keys):
+                    lo, hi = sorted((qa, qb))
+                    measured = self._measured.get(f"{lo[0]},{lo[1]}|{hi[0]},{hi[1]}")
+                    if measured is not None:
+                        km[i, j] = measured
+        return km
+
+    async def calibrate(self, db, samples: Iterable[dict]) -> dict:
+        """
+        Store measured road distances ({"from": {lat, lng}, "to": {lat, lng}, "road_km"})
+        and refit the road factor over every measured pair.
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        operations = []
+        for sample in samples:
+            a = (float(sample["from"]["lat"]), float(sample["from"]["lng"]))
+            b = (float(sample["to"]["lat"]), float(sample["to"]["lng"]))
+            operations.append(UpdateOne({"key": pair_key(a, b)}, {"$set": {
+                "from": {"lat": a[0], "lng": a[1]},
+                "to": {"lat": b[0], "lng": b[1]},
+                "road_km": float(sample["road_km"]),
+                "straight_km": round(float(haversine_km(a[0], a[1], b[0], b[1])), 3),
+                "updated_at": now
+            }}, upsert=True))
+        if operations:
+            await db.distance_cache.bulk_write(operations, ordered=False)
+
+        rows = await db.distance_cache.find(
+            {"straight_km": {"$gte": MIN_CALIBRATION_KM}}, {"_id": 0, "straight_km": 1, "road_km": 1}
+        ).to_list(None)
+        if rows:
+            straight = np.array([r["straight_km"] for r in rows])
+            road = np.array([r["road_km"] for r in rows])
+            factor = float(np.clip((road * straight).sum() / (straight ** 2).sum(), *ROAD_FACTOR_BOUNDS))
+        else:
+            factor = 1.0
+        await db.distance_calibration.update_one(
+            {"id": "default"},
+            {"$set": {"road_factor": round(factor, 4), "samples": len(rows), "fitted_at": now}},
+            upsert=True
+        )
+        await self.refresh(db, force=True)
+        return {"road_factor": self.road_factor, "samples": len(rows)}
+
+    def stats(self) -> dict:
+        return {
+            "road_factor": self.road_factor,
+            "measured_pairs": len(self._measured),
+            "pair_cache": self._pairs.stats()
+        }
+
+
+distance_service = DistanceMatrixService()
+
+
+async def ensure_distance_indexes(db):
+    await db.distance_cache.create_index("key", unique=True)
@@ -0,0 +1,303 @@
+"""
+Furnace Batching - Toughening furnace load planning
+- Collects every piece awaiting toughening (production job cards at the toughening
+  stage, job work orders with material received) minus pieces already loaded
+- Pieces are grouped by thickness (one thickness per cycle) and packed onto the bed
+  with MaxRects (best short side fit, rotation allowed) - spacing between pieces and
+  an edge margin are kept by inflating each piece and shrinking the bed
+- Urgent pieces are packed first, later pieces fill the gaps; cycles are sequenced
+  by earliest due date, then priority, then utilisation
+- A thin last cycle with nothing due soon is put on hold to wait for more glass
+- Planning is single-flight (lease in furnace_plan_meta) and the proposal is replaced
+  in one transaction, so concurrent planners never leave two proposals
+"""
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+from utils.transactions import run_in_transaction
+
+SQMM_PER_SQFT = 92903.04
+MM_PER_INCH = 25.4
+
+DEFAULT_FURNACE_SETTINGS = {
+    "bed_length_mm": 4200,
+    "bed_width_mm": 2440,
+    "spacing_mm": 30,
+    "edge_margin_mm": 50,
+    "allow_rotation": True,
+    "seconds_per_mm": 40,  # Heating time per mm of thickness
+    "cycle_overhead_minutes": 6,  # Loading, quench and unloading
+    "min_utilisation": 0.5,  # Below this a cycle is held if nothing in it is due soon
+    "hold_horizon_hours": 48
+}
+
+AWAITING_JOB_WORK_STATUSES = ["material_received", "in_process"]
+PLAN_LEASE = timedelta(minutes=2)  # Frees the planning lease if a worker dies mid-plan
+
+
+class MaxRectsBed:
+    """Free-rectangle list for one furnace bed (MaxRects, best short side fit)"""
+
+    def __init__(self, length: float, width: float):
+        self.free = [(0.0, 0.0, length, width)] if length > 0 and width > 0 else []
+
+    def insert(self, w: float, h: float, allow_rotation: bool = True) -> Optional[Tuple[float, float, bool]]:
+        best = None
+        orientations = ((w, h, False), (h, w, True)) if allow_rotation and w != h else ((w, h, False),)
+        for fx, fy, fw, fh in self.free:
+            for rw, rh, rotated in orientations:
+                if rw <= fw and rh <= fh:
+                    leftover = (min(fw - rw, fh - rh), max(fw - rw, fh - rh))
+                    if best is None or leftover < best[0]:
+                        best = (leftover, fx, fy, rw, rh, rotated)
+        if best is None:
+            return None
+        _, x, y, rw, rh, rotated = best
+        self._place(x, y, rw, rh)
+        return x, y, rotated
+
+    def _place(self, x: float, y: float, w: float, h: float):
+        split = []
+        for fx, fy, fw, fh in self.free:
+            if x >= fx + fw or x + w <= fx or y >= fy + fh or y + h <= fy:
+                split.append((fx, fy, fw, fh))
+                continue
+            # Keep the parts of the free rectangle around the placed piece
+            if x > fx:
+                split.append((fx, fy, x - fx, fh))
+            if x + w < fx + fw:
+                split.append((x + w, fy, fx + fw - x - w, fh))
+            if y > fy:
+                split.append((fx, fy, fw, y - fy))
+            if y + h < fy + fh:
+                split.append((fx, y + h, fw, fy + fh - y - h))
+        self.free = [
+            rect for i, rect in enumerate(split)
+            if not any(
+                _contains(other, rect) and (other != rect or j < i)
+                for j, other in enumerate(split) if j != i
+            )
+        ]
+
+
+def _contains(outer: tuple, inner: tuple) -> bool:
+    return (inner[0] >= outer[0] and inner[1] >= outer[1]
+            and inner[0] + inner[2] <= outer[0] + outer[2]
+            and inner[1] + inner[3] <= outer[1] + outer[3])
+
+
+def _piece_order(piece: dict) -> tuple:
+    return (piece.get("due") or "9999", -(piece.get("priority") or 0), -piece["width_mm"] * piece["height_mm"])
+
+
+def _fits_bed(piece: dict, length: float, width: float, allow_rotation: bool) -> bool:
+    w, h = piece["width_mm"], piece["height_mm"]
+    return (w <= length and h <= width) or (allow_rotation and h <= length and w <= width)
+
+
+def cycle_minutes(thickness_mm: float, settings: dict) -> float:
+    return round(thickness_mm * settings["seconds_per_mm"] / 60 + settings["cycle_overhead_minutes"], 1)
+
+
+def pack_thickness(pieces: List[dict], settings: dict) -> Tuple[List[dict], List[dict]]:
+    """Pack one thickness group into as many beds as needed; returns (cycles, oversized pieces)"""
+    spacing = settings["spacing_mm"]
+    margin = settings["edge_margin_mm"]
+    rotate = settings["allow_rotation"]
+    # Spacing is kept by inflating every piece by it and giving the bed the same allowance once
+    length = settings["bed_length_mm"] - 2 * margin + spacing
+    width = settings["bed_width_mm"] - 2 * margin + spacing
+    bed_area = settings["bed_length_mm"] * settings["bed_width_mm"]
+
+    queue = sorted(pieces, key=_piece_order)
+    oversized = [p for p in queue if not _fits_bed(p, length - spacing, width - spacing, rotate)]
+    queue = [p for p in queue if _fits_bed(p, length - spacing, width - spacing, rotate)]
+
+    cycles = []
+    while queue:
+        bed = MaxRectsBed(length, width)
+        placed, rest = [], []
+        for piece in queue:
+            position = bed.insert(piece["width_mm"] + spacing, piece["height_mm"] + spacing, rotate)
+            if position is None:
+                rest.append(piece)
+                continue
+            x, y, rotated = position
+            placed.append({**piece, "x_mm": round(margin + x, 1), "y_mm": round(margin + y, 1), "rotated": rotated})
+        load_area = sum(p["width_mm"] * p["height_mm"] for p in placed)
+        cycles.append({
+            "thickness_mm": placed[0]["thickness_mm"],
+            "pieces": placed,
+            "piece_count": len(placed),
+            "load_area_sqft": round(load_area / SQMM_PER_SQFT, 2),
+            "bed_area_sqft": round(bed_area / SQMM_PER_SQFT, 2),
+            "utilisation": round(load_area / bed_area, 4),
+            "earliest_due": min((p["due"] for p in placed if p.get("due")), default=None),
+            "max_priority": max((p.get("priority") or 0 for p in placed), default=0)
+        })
+        queue = rest
+    return cycles, oversized
+
+
+def plan_cycles(pieces: List[dict], settings: dict, now: Optional[datetime] = None) -> dict:
+    """Pack every thickness group and sequence the resulting cycles"""
+    now = now or datetime.now(timezone.utc)
+    hold_before = (now + timedelta(hours=settings["hold_horizon_hours"])).isoformat()
+
+    groups = {}
+    for piece in pieces:
+        groups.setdefault(piece["thickness_mm"], []).append(piece)
+
+    cycles, oversized = [], []
+    for thickness in sorted(groups):
+        packed, too_big = pack_thickness(groups[thickness], settings)
+        cycles.extend(packed)
+        oversized.extend(too_big)
+
+    for cycle in cycles:
+        cycle["hold"] = (
+            cycle["utilisation"] < settings["min_utilisation"]
+            and (cycle["earliest_due"] or "9999") > hold_before
+        )
+    cycles.sort(key=lambda c: (c["hold"], c["earliest_due"] or "9999", -c["max_priority"], -c["utilisation"]))
+
+    start = now
+    for sequence, cycle in enumerate(cycles, start=1):
+        minutes = cycle_minutes(cycle["thickness_mm"], settings)
+        cycle["sequence"] = sequence
+        cycle["estimated_minutes"] = minutes
+        cycle["estimated_start"] = start.isoformat() if not cycle["hold"] else None
+        if not cycle["hold"]:
+            start += timedelta(minutes=minutes)
+
+    active = [c for c in cycles if not c["hold"]]
+    return {
+        "cycles": cycles,
+        "oversized": oversized,
+        "summary": {
+            "pieces": sum(c["piece_count"] for c in cycles),
+            "cycles": len(cycles),
+            "held_cycles": len(cycles) - len(active),
+            "average_utilisation": round(
+                sum(c["utilisation"] for c in active) / len(active), 4
+            ) if active else 0,
+            "furnace_minutes": round(sum(c["estimated_minutes"] for c in active), 1)
+        }
+    }
+
+
+async def get_furnace_settings(db) -> dict:
+    settings = await db.furnace_settings.find_one({"id": "default"}, {"_id": 0}) or {}
+    return {**DEFAULT_FURNACE_SETTINGS, **{k: v for k, v in settings.items() if k in DEFAULT_FURNACE_SETTINGS}}
+
+
+async def _loaded_counts(db) -> dict:
+    """Pieces per source line already on a loaded / completed cycle"""
+    rows = await db.furnace_cycles.aggregate([
+        {"$match": {"status": {"$in": ["loaded", "completed"]}}},
+        {"$unwind": "$pieces"},
+        {"$group": {"_id": {"source_id": "$pieces.source_id", "line": "$pieces.line"}, "count": {"$sum": 1}}}
+    ]).to_list(None)
+    return {(row["_id"]["source_id"], row["_id"]["line"]): row["count"] for row in rows}
+
+
+def _expand(line: dict, count: int) -> List[dict]:
+    return [{**line, "piece_no": n} for n in range(1, count + 1)]
+
+
+async def collect_awaiting_pieces(db) -> List[dict]:
+    """Individual pieces waiting for the furnace from production and job work"""
+    loaded = await _loaded_counts(db)
+    pieces = []
+
+    job_cards = await db.production_orders.find({"current_stage": "toughening"}, {"_id": 0}).to_list(1000)
+    for order in job_cards:
+        count = (order.get("quantity") or 0) - (order.get("quantity_broken") or 0) - loaded.get((order["id"], 0), 0)
+        # Due: explicit due date, else the toughening slot from the capacity schedule
+        slot = next((s for s in order.get("scheduled_stages", []) if s["stage"] == "toughening"), {})
+        pieces += _expand({
+            "source": "production",
+            "source_id": order["id"],
+            "reference": order.get("job_card_number"),
+            "line": 0,
+            "thickness_mm": float(order.get("thickness") or 0),
+            "width_mm": float(order.get("width") or 0),
+            "height_mm": float(order.get("height") or 0),
+            "priority": order.get("priority", 1),
+            "due": order.get("due_date") or slot.get("end")
+        }, count)
+
+    job_work = await db.job_work_orders.find(
+        {"status": {"$in": AWAITING_JOB_WORK_STATUSES}}, {"_id": 0}
+    ).to_list(1000)
+    for order in job_work:
+        for line, item in enumerate(order.get("items", [])):
+            count = (item.get("quantity") or 0) - loaded.get((order["id"], line), 0)
+            pieces += _expand({
+                "source": "job_work",
+                "source_id": order["id"],
+                "reference": order.get("job_work_number"),
+                "line": line,
+                "thickness_mm": float(item.get("thickness_mm") or 0),
+                "width_mm": round(float(item.get("width_inch") or 0) * MM_PER_INCH, 1),
+                "height_mm": round(float(item.get("height_inch") or 0) * MM_PER_INCH, 1),
+                "priority": order.get("priority", 1),
+                "due": order.get("due_date") or order.get("created_at")
+            }, count)
+
+    return [p for p in pieces if p["width_mm"] > 0 and p["height_mm"] > 0 and p["thickness_mm"] > 0]
+
+
+async def claim_planning(db, now: datetime) -> bool:
+    """Take the planning lease; False while another plan is being built"""
+    try:
+        await db.furnace_plan_meta.update_one(
+            {"id": "default", "$or": [{"planning_until": None}, {"planning_until": {"$lt": now}}]},
+            {"$set": {"planning_until": now + PLAN_LEASE}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def release_planning(db):
+    await db.furnace_plan_meta.update_one({"id": "default"}, {"$set": {"planning_until": None}})
+
+
+async def replace_planned_cycles(db, cycles: List[dict]):
+    """Swap the unloaded proposal for `cycles` in one transaction"""
+    async def _replace(session):
+        await db.furnace_cycles.delete_many({"status": "planned"}, session=session)
+        if cycles:
+            await db.furnace_cycles.insert_many(cycles, session=session)
+
+    await run_in_transaction(db, _replace)
+
+
+async def record_cycle_utilisation(db, cycle: dict, broken_pieces: int, completed_at: str):
+    """Roll a completed cycle into the daily utilisation history"""
+    thickness = str(cycle["thickness_mm"]).replace(".", "_")
+    await db.furnace_utilisation.update_one(
+        {"date": completed_at[:10]},
+        {"$inc": {
+            "cycles": 1,
+            "pieces": cycle["piece_count"],
+            "broken_pieces": broken_pieces,
+            "load_area_sqft": cycle["load_area_sqft"],
+            "bed_area_sqft": cycle["bed_area_sqft"],
+            f"by_thickness.{thickness}.cycles": 1,
+            f"by_thickness.{thickness}.load_area_sqft": cycle["load_area_sqft"],
+            f"by_thickness.{thickness}.bed_area_sqft": cycle["bed_area_sqft"]
+        }},
+        upsert=True
+    )
+
+
+async def ensure_furnace_indexes(db):
+    await db.furnace_cycles.create_index([("status", 1), ("sequence", 1)])
+    await db.furnace_cycles.create_index("id", unique=True)
+    await db.furnace_utilisation.create_index("date", unique=True)
+    await db.furnace_plan_meta.create_index("id", unique=True)
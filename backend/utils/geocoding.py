@@ -0,0 +1,230 @@
+"""
+Geocoding - Cached address lookup for transport pricing
+- In-memory LRU front tier (per worker)
+- Persistent Mongo tier (geocode_cache) with TTL expiry
+- Nominatim (OpenStreetMap) lookup, rate limited to 1 request/second
+- Offline pincode-centroid fallback when Nominatim fails or is unreachable
+"""
+from datetime import datetime, timezone, timedelta
+from typing import Optional
+import asyncio
+import logging
+import re
+import time
+
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+GEOCODE_TTL_DAYS = 90  # Nominatim results for an address rarely change
+PINCODE_FALLBACK_TTL_DAYS = 1  # Retry Nominatim soon for approximate hits
+NOMINATIM_MIN_INTERVAL = 1.0  # Nominatim usage policy: max 1 request/second
+
+_memory_cache = LRUCache(maxsize=2048, ttl=6 * 3600)
+_nominatim_lock = asyncio.Lock()
+_last_nominatim_call = 0.0
+
+# Approximate centroids of common delivery pincodes (Pune / PCMC)
+PINCODE_CENTROIDS = {
+    "411001": (18.5196, 73.8757),  # Pune GPO / Camp
+    "411002": (18.5140, 73.8580),  # Budhwar / Shukrawar Peth
+    "411004": (18.5158, 73.8400),  # Deccan Gymkhana / Erandwane
+    "411005": (18.5308, 73.8475),  # Shivajinagar
+    "411006": (18.5529, 73.8797),  # Yerawada
+    "411007": (18.5590, 73.8076),  # Aundh
+    "411008": (18.5400, 73.8050),  # Pashan / NCL
+    "411009": (18.4980, 73.8530),  # Parvati
+    "411011": (18.5220, 73.8590),  # Kasba Peth
+    "411013": (18.5018, 73.9260),  # Hadapsar
+    "411014": (18.5679, 73.9143),  # Viman Nagar / Vadgaon Sheri
+    "411015": (18.5790, 73.8900),  # Vishrantwadi / Dighi
+    "411016": (18.5290, 73.8300),  # Model Colony / Gokhalenagar
+    "411017": (18.6298, 73.7997),  # Pimpri Waghere
+    "411018": (18.6187, 73.8037),  # Pimpri Colony
+    "411019": (18.6440, 73.7900),  # Chinchwad East
+    "411021": (18.5170, 73.7780),  # Bavdhan
+    "411026": (18.6298, 73.8475),  # Bhosari
+    "411027": (18.5800, 73.8100),  # Sangvi
+    "411028": (18.5140, 73.9270),  # Magarpatta
+    "411030": (18.5100, 73.8500),  # Sadashiv Peth
+    "411033": (18.6276, 73.7817),  # Chinchwad
+    "411035": (18.6480, 73.7680),  # Akurdi / Nigdi
+    "411036": (18.5362, 73.8940),  # Koregaon Park / Ghorpadi
+    "411037": (18.4870, 73.8640),  # Market Yard / Bibwewadi
+    "411038": (18.5074, 73.8077),  # Kothrud
+    "411040": (18.4850, 73.8980),  # Wanowrie
+    "411041": (18.4620, 73.8140),  # Dhayari / Vadgaon Bk
+    "411043": (18.4580, 73.8550),  # Dhankawadi
+    "411044": (18.6540, 73.7700),  # Nigdi Pradhikaran
+    "411045": (18.5590, 73.7868),  # Baner
+    "411046": (18.4480, 73.8590),  # Katraj
+    "411047": (18.5920, 73.9190),  # Lohegaon
+    "411048": (18.4640, 73.8900),  # Kondhwa
+    "411051": (18.4810, 73.8180),  # Sinhagad Road
+    "411052": (18.4900, 73.8180),  # Karve Nagar
+    "411057": (18.5980, 73.7600),  # Wakad / Hinjewadi
+    "411058": (18.4830, 73.7960),  # Warje
+    "411060": (18.4800, 73.9200),  # Mohammadwadi
+    "411061": (18.5880, 73.8150),  # Pimple Gurav
+    "411062": (18.6700, 73.8060),  # Chikhali
+}
+
+# Approximate centroids per 3-digit sorting district, used when the
+# exact pincode is not in the table above
+PINCODE_PREFIX_CENTROIDS = {
+    "400": (19.0760, 72.8777),  # Mumbai
+    "401": (19.4500, 72.8500),  # Thane / Palghar
+    "402": (18.5000, 73.1000),  # Raigad
+    "410": (18.7500, 73.4000),  # Lonavala / Maval
+    "411": (18.5204, 73.8567),  # Pune city
+    "412": (18.6000, 73.9500),  # Pune rural
+    "413": (18.2000, 75.0000),  # Solapur / Baramati
+    "414": (19.0952, 74.7496),  # Ahmednagar
+    "415": (17.6800, 74.0000),  # Satara
+    "416": (16.7050, 74.2433),  # Kolhapur / Sangli
+    "422": (19.9975, 73.7898),  # Nashik
+    "423": (20.3000, 74.3000),  # Nashik rural / Malegaon
+    "431": (19.8762, 75.3433),  # Aurangabad
+    "440": (21.1458, 79.0882),  # Nagpur
+}
+
+_PINCODE_RE = re.compile(r"\b(\d{6})\b")
+_NON_WORD_RE = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_address(address: Optional[str], landmark: Optional[str] = "") -> str:
+    """Build the cache key for an address + landmark (case/punctuation insensitive)"""
+    addr = _NON_WORD_RE.sub(" ", (address or "").lower()).strip()
+    mark = _NON_WORD_RE.sub(" ", (landmark or "").lower()).strip()
+    return f"{addr}|{mark}"
+
+
+def extract_pincode(address: Optional[str]) -> Optional[str]:
+    """Return the last 6-digit Indian pincode found in an address"""
+    matches = _PINCODE_RE.findall(address or "")
+    return matches[-1] if matches else None
+
+
+def pincode_centroid(pincode: Optional[str]) -> Optional[tuple]:
+    """Offline fallback - approximate coordinates for a pincode"""
+    if not pincode:
+        return None
+    if pincode in PINCODE_CENTROIDS:
+        return PINCODE_CENTROIDS[pincode]
+    return PINCODE_PREFIX_CENTROIDS.get(pincode[:3])
+
+
+async def ensure_geocode_indexes(db):
+    """Create indexes for the geocode cache (safe to call on every startup)"""
+    await db.geocode_cache.create_index("key", unique=True)
+    await db.geocode_cache.create_index("expires_at", expireAfterSeconds=0)
+    await db.pincode_centroids.create_index("pincode", unique=True)
+
+
+async def _nominatim_geocode(query: str) -> Optional[tuple]:
+    """Call Nominatim in a worker thread, spacing calls to respect its rate limit"""
+    global _last_nominatim_call
+    from geopy.geocoders import Nominatim
+
+    async with _nominatim_lock:
+        wait = NOMINATIM_MIN_INTERVAL - (time.monotonic() - _last_nominatim_call)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            geolocator = Nominatim(user_agent="lucumaa_glass_erp")
+            location = await asyncio.to_thread(geolocator.geocode, query, timeout=10)
+        finally:
+            _last_nominatim_call = time.monotonic()
+
+    if not location:
+        return None
+    return (location.latitude, location.longitude)
+
+
+async def _pincode_lookup(db, pincode: Optional[str]) -> Optional[tuple]:
+    """Pincode centroid from the pincode_centroids collection, then the built-in table"""
+    if not pincode:
+        return None
+    if db is not None:
+        try:
+            doc = await db.pincode_centroids.find_one({"pincode": pincode}, {"_id": 0, "lat": 1, "lng": 1})
+            if doc:
+                return (doc["lat"], doc["lng"])
+        except Exception as e:
+            logger.warning(f"Pincode centroid lookup failed: {e}")
+    return pincode_centroid(pincode)
+
+
+async def geocode_address(db, address: str, landmark: Optional[str] = "") -> Optional[dict]:
+    """
+    Resolve an address to coordinates.
+    Returns {"lat", "lng", "source", "origin"} where source is one of
+    memory, cache, nominatim, pincode (where this answer came from) and origin is
+    nominatim or pincode (how the coordinates were found, kept in both cache tiers)
+    - or None if nothing matched.
+    """
+    key = normalize_address(address, landmark)
+
+    cached = _memory_cache.get(key)
+    if cached:
+        return {**cached, "source": "memory"}
+
+    now = datetime.now(timezone.utc)
+    if db is not None:
+        try:
+            doc = await db.geocode_cache.find_one(
+                {"key": key, "expires_at": {"$gt": now}},
+                {"_id": 0, "lat": 1, "lng": 1, "source": 1}
+            )
+            if doc:
+                result = {"lat": doc["lat"], "lng": doc["lng"], "origin": doc.get("source", "nominatim")}
+                _memory_cache.set(key, result)
+                return {**result, "source": "cache"}
+        except Exception as e:
+            logger.warning(f"Geocode cache read failed: {e}")
+
+    coords = None
+    origin = "nominatim"
+    search_query = address
+    if landmark:
+        search_query += f", near {landmark}"
+    try:
+        coords = await _nominatim_geocode(search_query)
+    except Exception as e:
+        logger.warning(f"Nominatim geocoding failed, using pincode fallback: {e}")
+
+    if not coords:
+        coords = await _pincode_lookup(db, extract_pincode(address))
+        origin = "pincode"
+    if not coords:
+        return None
+
+    result = {"lat": coords[0], "lng": coords[1], "origin": origin}
+    ttl_days = GEOCODE_TTL_DAYS if origin == "nominatim" else PINCODE_FALLBACK_TTL_DAYS
+    _memory_cache.set(key, result, ttl=min(ttl_days * 86400, _memory_cache.ttl))
+
+    if db is not None:
+        try:
+            await db.geocode_cache.update_one(
+                {"key": key},
+                {"$set": {
+                    "key": key,
+                    "address": address,
+                    "landmark": landmark or "",
+                    "lat": coords[0],
+                    "lng": coords[1],
+                    "source": origin,
+                    "created_at": now,
+                    "expires_at": now + timedelta(days=ttl_days)
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"Geocode cache write failed: {e}")
+
+    return {**result, "source": origin}
+
+
+def geocode_cache_stats() -> dict:
+    """Stats for the in-memory geocode tier"""
+    return _memory_cache.stats()
@@ -0,0 +1,442 @@
+"""
+GST Returns - GSTR-1 / GSTR-3B from incrementally maintained aggregates
+- gst_return_rows holds one row per (period YYYY-MM, section, key); creating an
+  invoice adds its share to every row it touches, recording a payment bumps "paid":
+  b2b     - one row per invoice to a registered customer (valid GSTIN), rate-wise items
+  b2cl    - one row per inter-state invoice to an unregistered customer above B2CL_LIMIT
+  b2cs    - other B2C supplies per intra/inter, place of supply and rate
+  hsn     - per HSN code, unit (UQC) and rate
+  summary - period totals (GSTR-3B table 3.1), B2B/B2C split and amount received
+- Items are classified with the HSN codes from GST settings (routers/gst.py);
+  items without an HSN code fall back to DEFAULT_HSN_CODE
+- A return is produced in one pass over the period's rows sorted by (section, key),
+  as portal-style JSON or a streamed CSV
+- rebuild_gst_returns recomputes a period from its invoices (backfill / repair) in one
+  transaction, single-flight per period (lease in gst_return_meta)
+- Reads never rebuild inline: a period with uncounted invoices is reported as stale
+  and its rebuild is started in the background
+"""
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, Tuple
+import asyncio
+import csv
+import io
+import logging
+
+from pymongo.errors import DuplicateKeyError
+
+from routers.gst import DEFAULT_HSN_CODES
+from utils.period_close import gst_totals
+from utils.pnl_engine import month_range
+from utils.gstin_registry import GSTIN_PATTERN
+from utils.transactions import run_in_transaction
+
+logger = logging.getLogger(__name__)
+
+B2CL_LIMIT = 100000  # Invoice value above which inter-state B2C is reported invoice-wise (Rs 2.5 lakh before Aug 2024)
+DEFAULT_HSN_CODE = "7007"  # Safety glass - same default as /gst/calculate
+UQC_BY_UNIT = {"sqft": "SQF", "sq ft": "SQF", "sqm": "SQM", "sq m": "SQM", "nos": "NOS",
+               "pcs": "PCS", "piece": "PCS", "pieces": "PCS", "kg": "KGS", "kgs": "KGS"}
+AMOUNTS = ("txval", "iamt", "camt", "samt")
+INVOICE_SECTIONS = ("b2b", "b2cl")
+GSTR1_SECTIONS = ["b2b", "b2cl", "b2cs", "hsn"]
+GSTR3B_SECTIONS = ["b2cl", "b2cs", "summary"]
+REBUILD_LEASE = timedelta(minutes=10)  # Frees a period's lease if the worker rebuilding it dies
+STALE_WARNING = "Some invoices are not in the return yet - a rebuild is running, retry shortly"
+
+_rebuild_tasks = set()  # Background rebuilds started by reads (kept referenced until done)
+
+GSTR1_CSV_HEADER = ["section", "recipient_gstin", "invoice_number", "invoice_date", "invoice_value",
+                    "place_of_supply", "supply_type", "hsn", "description", "uqc", "quantity", "rate",
+                    "taxable_value", "igst", "cgst", "sgst", "amount_paid"]
+GSTR3B_CSV_HEADER = ["table", "description", "place_of_supply", "taxable_value", "igst", "cgst", "sgst", "total"]
+
+
+def period_match(period: str) -> dict:
+    """created_at filter for every timestamp in a YYYY-MM period"""
+    return {"$gte": period, "$lt": f"{period}-32"}
+
+
+def filing_period(period: str) -> str:
+    """YYYY-MM -> MMYYYY as used in the return JSON"""
+    return period[5:7] + period[:4]
+
+
+def _rate_key(rate: float) -> str:
+    return f"{rate:g}".replace(".", "_")
+
+
+def valid_gstin(value) -> str:
+    gstin = str(value or "").strip().upper()
+    return gstin if GSTIN_PATTERN.match(gstin) else ""
+
+
+async def load_gst_context(db) -> dict:
+    settings = await db.gst_settings.find_one(
+        {}, {"_id": 0, "company_gstin": 1, "company_state_code": 1, "hsn_codes": 1}
+    ) or {}
+    return {
+        "gstin": settings.get("company_gstin", ""),
+        "state_code": settings.get("company_state_code") or "27",
+        "hsn": {h["code"]: h for h in settings.get("hsn_codes") or DEFAULT_HSN_CODES},
+    }
+
+
+def place_of_supply(invoice: dict, context: dict) -> str:
+    """Two-digit state code; empty when an inter-state B2C invoice carries none"""
+    pos = str(invoice.get("place_of_supply") or "")[:2]
+    if pos.isdigit():
+        return pos
+    gstin = valid_gstin(invoice.get("customer_gst"))
+    if gstin:
+        return gstin[:2]
+    return "" if invoice.get("igst") else context["state_code"]
+
+
+def invoice_lines(invoice: dict, context: dict) -> List[dict]:
+    """Split an invoice's tax over its items in proportion to their taxable value"""
+    subtotal = invoice.get("subtotal") or 0
+    items = [i for i in invoice.get("items", []) if i.get("quantity", 0) * i.get("unit_price", 0)]
+    if not subtotal or not items:
+        return []
+    rate = round((invoice.get("total_tax") or 0) * 100 / subtotal, 2)
+    taxes = {"iamt": invoice.get("igst", 0), "camt": invoice.get("cgst", 0), "samt": invoice.get("sgst", 0)}
+    allocated = dict.fromkeys(taxes, 0.0)
+
+    lines = []
+    for index, item in enumerate(items):
+        txval = round(item.get("quantity", 0) * item.get("unit_price", 0), 2)
+        line = {"txval": txval, "rt": rate, "qty": item.get("quantity", 0)}
+        for field, total in taxes.items():
+            # Last item takes the rounding remainder so lines add up to the invoice
+            share = total - allocated[field] if index == len(items) - 1 else round(total * txval / subtotal, 2)
+            allocated[field] += share
+            line[field] = round(share, 2)
+        hsn = str(item.get("hsn_code") or item.get("hsn") or DEFAULT_HSN_CODE)
+        line["hsn_sc"] = hsn
+        line["desc"] = context["hsn"].get(hsn, {}).get("description", item.get("description", ""))
+        line["uqc"] = UQC_BY_UNIT.get(str(item.get("unit", "")).strip().lower(), "OTH")
+        lines.append(line)
+    return lines
+
+
+def invoice_contributions(invoice: dict, context: dict) -> List[Tuple[str, str, dict, dict]]:
+    """(section, key, fields set on insert, amounts to $inc) for every row an invoice touches"""
+    lines = invoice_lines(invoice, context)
+    if not lines:
+        return []
+    gstin = valid_gstin(invoice.get("customer_gst"))
+    pos = place_of_supply(invoice, context)
+    inter = bool(invoice.get("igst"))
+    value = invoice.get("total", 0)
+    paid = invoice.get("amount_paid", 0)
+    contributions = []
+
+    by_rate: Dict[str, dict] = {}
+    for line in lines:
+        bucket = by_rate.setdefault(_rate_key(line["rt"]), {"rt": line["rt"], **dict.fromkeys(AMOUNTS, 0)})
+        for field in AMOUNTS:
+            bucket[field] = round(bucket[field] + line[field], 2)
+
+    if gstin or (inter and value > B2CL_LIMIT):
+        section = "b2b" if gstin else "b2cl"
+        contributions.append((section, f"{gstin or pos}|{invoice['invoice_number']}", {
+            "invoice_id": invoice["id"],
+            "ctin": gstin,
+            "inum": invoice["invoice_number"],
+            "idt": datetime.strptime(invoice["created_at"][:10], "%Y-%m-%d").strftime("%d-%m-%Y"),
+            "val": value,
+            "pos": pos,
+            "items": list(by_rate.values()),
+        }, {"paid": paid}))
+    else:
+        supply = "INTER" if inter else "INTRA"
+        for rate_key, bucket in by_rate.items():
+            contributions.append(("b2cs", f"{supply}|{pos}|{rate_key}",
+                                  {"sply_ty": supply, "pos": pos, "rt": bucket["rt"]},
+                                  {field: bucket[field] for field in AMOUNTS}))
+
+    for line in lines:
+        contributions.append(("hsn", f"{line['hsn_sc']}|{line['uqc']}|{_rate_key(line['rt'])}",
+                              {"hsn_sc": line["hsn_sc"], "desc": line["desc"], "uqc": line["uqc"], "rt": line["rt"]},
+                              {"qty": line["qty"], "val": round(line["txval"] + line["iamt"] + line["camt"] + line["samt"], 2),
+                               **{field: line[field] for field in AMOUNTS}}))
+
+    taxable = sum(line["txval"] for line in lines)
+    contributions.append(("summary", "summary", {}, {
+        **{field: sum(line[field] for line in lines) for field in AMOUNTS},
+        "val": value,
+        "invoice_count": 1,
+        "b2b_txval" if gstin else "b2c_txval": taxable,
+        "amount_received": paid,
+    }))
+    return contributions
+
+
+# ================== INCREMENTAL UPDATES ==================
+
+async def record_invoice(db, invoice: dict, context: dict = None) -> bool:
+    """Add a new invoice to its period's return rows; False when it was already counted"""
+    context = context or await load_gst_context(db)
+    period = invoice["created_at"][:7]
+    contributions = invoice_contributions(invoice, context)
+    now = datetime.now(timezone.utc).isoformat()
+
+    async def _apply(session):
+        claimed = await db.invoices.update_one(
+            {"id": invoice["id"], "gst_return_period": {"$exists": False}},
+            {"$set": {"gst_return_period": period}},
+            session=session
+        )
+        if not claimed.modified_count:
+            return False
+        for section, key, fields, amounts in contributions:
+            update = {"$set": {"updated_at": now}}
+            if fields:
+                update["$setOnInsert"] = fields
+            if amounts:
+                update["$inc"] = amounts
+            await db.gst_return_rows.update_one(
+                {"period": period, "section": section, "key": key}, update, upsert=True, session=session
+            )
+        return True
+
+    return await run_in_transaction(db, _apply)
+
+
+async def record_invoice_payment(db, invoice: dict, amount: float):
+    """Bump the amount received on an invoice's return rows"""
+    period = invoice.get("gst_return_period")
+    if not period or not amount:
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    await db.gst_return_rows.update_many(
+        {"period": period, "section": {"$in": list(INVOICE_SECTIONS)}, "invoice_id": invoice["id"]},
+        {"$inc": {"paid": amount}, "$set": {"updated_at": now}}
+    )
+    await db.gst_return_rows.update_one(
+        {"period": period, "section": "summary", "key": "summary"},
+        {"$inc": {"amount_received": amount}, "$set": {"updated_at": now}}
+    )
+
+
+async def _claim_rebuild(db, period: str, now: datetime) -> bool:
+    """Take the period's rebuild lease; False while another rebuild holds it"""
+    try:
+        await db.gst_return_meta.update_one(
+            {"period": period, "$or": [{"rebuilding_until": None}, {"rebuilding_until": {"$lt": now}}]},
+            {"$set": {"rebuilding_until": now + REBUILD_LEASE}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def rebuild_gst_returns(db, period: str) -> dict:
+    """
+    Recompute a period's return rows from its invoices (backfill / repair).
+    The invoices are read inside the transaction that replaces the rows, so an
+    invoice recorded meanwhile conflicts with the rebuild (which is retried) instead
+    of being wiped from the rows.
+    """
+    started = datetime.now(timezone.utc)
+    if not await _claim_rebuild(db, period, started):
+        return {"period": period, "status": "skipped", "reason": "Rebuild already running"}
+    try:
+        context = await load_gst_context(db)
+        now = started.isoformat()
+
+        async def _apply(session):
+            rows: Dict[Tuple[str, str], dict] = {}
+            invoice_ids = []
+            async for invoice in db.invoices.find({"created_at": period_match(period)}, {"_id": 0}, session=session):
+                invoice_ids.append(invoice["id"])
+                for section, key, fields, amounts in invoice_contributions(invoice, context):
+                    row = rows.setdefault((section, key), {"period": period, "section": section, "key": key,
+                                                           **fields, "updated_at": now})
+                    for field, amount in amounts.items():
+                        row[field] = row.get(field, 0) + amount
+
+            await db.gst_return_rows.delete_many({"period": period}, session=session)
+            if rows:
+                await db.gst_return_rows.insert_many(list(rows.values()), session=session)
+            if invoice_ids:
+                await db.invoices.update_many({"id": {"$in": invoice_ids}},
+                                              {"$set": {"gst_return_period": period}}, session=session)
+            return {"period": period, "status": "rebuilt", "invoices": len(invoice_ids), "rows": len(rows)}
+
+        return await run_in_transaction(db, _apply)
+    finally:
+        await db.gst_return_meta.update_one(
+            {"period": period},
+            {"$set": {"rebuilding_until": None, "rebuilt_at": datetime.now(timezone.utc).isoformat()}}
+        )
+
+
+async def _background_rebuild(db, period: str):
+    try:
+        result = await rebuild_gst_returns(db, period)
+        logger.info(f"GST return rows for {period}: {result['status']}")
+    except Exception as e:
+        logger.error(f"GST return rebuild for {period} failed: {e}")
+
+
+async def period_status(db, period: str) -> dict:
+    """
+    Whether a period has invoices its rows do not count yet (older data, or a failed hook).
+    A stale period gets a background rebuild; the caller serves the rows as they are.
+    """
+    missed = await db.invoices.find_one(
+        {"created_at": period_match(period), "gst_return_period": {"$exists": False}}, {"_id": 0, "id": 1}
+    )
+    if not missed:
+        return {"stale": False}
+    task = asyncio.get_event_loop().create_task(_background_rebuild(db, period))
+    _rebuild_tasks.add(task)
+    task.add_done_callback(_rebuild_tasks.discard)
+    return {"stale": True}
+
+
+async def return_summary(db, period: str) -> dict:
+    row = await db.gst_return_rows.find_one({"period": period, "section": "summary"}, {"_id": 0}) or {}
+    return {"b2b_taxable": round(row.get("b2b_txval", 0), 2), "b2c_taxable": round(row.get("b2c_txval", 0), 2),
+            "amount_received": round(row.get("amount_received", 0), 2)}
+
+
+# ================== BUILDERS ==================
+
+def _rounded(row: dict, fields=AMOUNTS) -> dict:
+    return {field: round(row.get(field, 0), 2) for field in fields}
+
+
+async def _rows(db, period: str, sections: List[str]) -> AsyncIterator[dict]:
+    cursor = db.gst_return_rows.find({"period": period, "section": {"$in": sections}}, {"_id": 0})
+    async for row in cursor.sort([("section", 1), ("key", 1)]):
+        yield row
+
+
+def _portal_invoice(row: dict, intra_tax: bool) -> dict:
+    items = []
+    for number, item in enumerate(row.get("items", []), start=1):
+        detail = {"rt": item["rt"], "txval": round(item["txval"], 2), "iamt": round(item["iamt"], 2), "csamt": 0}
+        if intra_tax:
+            detail.update(camt=round(item["camt"], 2), samt=round(item["samt"], 2))
+        items.append({"num": number, "itm_det": detail})
+    invoice = {"inum": row["inum"], "idt": row["idt"], "val": round(row["val"], 2), "pos": row["pos"], "itms": items}
+    if intra_tax:
+        invoice.update(rchrg="N", inv_typ="R")
+    return invoice
+
+
+async def build_gstr1(db, period: str) -> dict:
+    """GSTR-1 sections B2B, B2CL, B2CS and HSN summary in one pass"""
+    context = await load_gst_context(db)
+    status = await period_status(db, period)
+    gstr1 = {"gstin": context["gstin"], "fp": filing_period(period),
+             "b2b": [], "b2cl": [], "b2cs": [], "hsn": {"data": []}, "warnings": [], **status}
+    if status["stale"]:
+        gstr1["warnings"].append(STALE_WARNING)
+
+    async for row in _rows(db, period, GSTR1_SECTIONS):
+        section = row["section"]
+        if section in INVOICE_SECTIONS and not row.get("pos"):
+            gstr1["warnings"].append(f"{row['inum']}: place of supply missing")
+        if section == "b2b":
+            if not gstr1["b2b"] or gstr1["b2b"][-1]["ctin"] != row["ctin"]:
+                gstr1["b2b"].append({"ctin": row["ctin"], "inv": []})
+            gstr1["b2b"][-1]["inv"].append(_portal_invoice(row, intra_tax=True))
+        elif section == "b2cl":
+            if not gstr1["b2cl"] or gstr1["b2cl"][-1]["pos"] != row["pos"]:
+                gstr1["b2cl"].append({"pos": row["pos"], "inv": []})
+            gstr1["b2cl"][-1]["inv"].append(_portal_invoice(row, intra_tax=False))
+        elif section == "b2cs":
+            if not row.get("pos"):
+                gstr1["warnings"].append(f"B2CS {row['sply_ty']} supplies without place of supply")
+            gstr1["b2cs"].append({"sply_ty": row["sply_ty"], "pos": row["pos"], "typ": "OE", "rt": row["rt"],
+                                  **_rounded(row), "csamt": 0})
+        elif section == "hsn":
+            gstr1["hsn"]["data"].append({"num": len(gstr1["hsn"]["data"]) + 1, "hsn_sc": row["hsn_sc"],
+                                         "desc": row["desc"], "uqc": row["uqc"], "qty": round(row.get("qty", 0), 3),
+                                         "rt": row["rt"], **_rounded(row, ("val",) + AMOUNTS), "csamt": 0})
+    return gstr1
+
+
+async def build_gstr3b(db, period: str, check_stale: bool = True) -> dict:
+    """GSTR-3B table 3.1(a) outward supplies, 3.2 inter-state B2C by state, 4 ITC"""
+    context = await load_gst_context(db)
+    status = await period_status(db, period) if check_stale else {}
+    outward = dict.fromkeys(AMOUNTS, 0)
+    unregistered: Dict[str, dict] = {}
+
+    async for row in _rows(db, period, GSTR3B_SECTIONS):
+        if row["section"] == "summary":
+            outward = _rounded(row)
+        elif row["section"] == "b2cl" or row.get("sply_ty") == "INTER":
+            state = unregistered.setdefault(row["pos"], {"pos": row["pos"], "txval": 0, "iamt": 0})
+            for part in row.get("items") or [row]:
+                state["txval"] = round(state["txval"] + part["txval"], 2)
+                state["iamt"] = round(state["iamt"] + part["iamt"], 2)
+
+    start, end = month_range(period)
+    input_gst = round((await gst_totals(db, start, end))["input_gst"], 2)
+    output_tax = round(outward["iamt"] + outward["camt"] + outward["samt"], 2)
+    return {
+        "gstin": context["gstin"],
+        "ret_period": filing_period(period),
+        "sup_details": {"osup_det": {**outward, "csamt": 0}},
+        "inter_sup": {"unreg_details": sorted(unregistered.values(), key=lambda s: s["pos"])},
+        # Purchase orders carry a single GST amount, so ITC is not split by tax head
+        "itc_elg": {"itc_avl": [{"ty": "OTH", "total": input_gst}], "itc_net": input_gst},
+        "tax_payable": {"output_tax": output_tax, "itc": input_gst, "net": round(output_tax - input_gst, 2)},
+        **status,
+    }
+
+
+def _csv_line(values: list) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
+
+
+async def stream_gstr1_csv(db, period: str) -> AsyncIterator[str]:
+    """
+    GSTR-1 as CSV, one line per invoice rate / B2CS bucket / HSN row, written as rows are read.
+    The caller checks period_status first (reported in a header).
+    """
+    yield _csv_line(GSTR1_CSV_HEADER)
+    async for row in _rows(db, period, GSTR1_SECTIONS):
+        section = row["section"]
+        if section in INVOICE_SECTIONS:
+            for item in row.get("items", []):
+                yield _csv_line([section, row["ctin"], row["inum"], row["idt"], round(row["val"], 2), row["pos"],
+                                 "", "", "", "", "", item["rt"], *_rounded(item).values(), round(row.get("paid", 0), 2)])
+        elif section == "b2cs":
+            yield _csv_line([section, "", "", "", "", row["pos"], row["sply_ty"], "", "", "", "", row["rt"],
+                             *_rounded(row).values(), ""])
+        else:
+            yield _csv_line([section, "", "", "", round(row.get("val", 0), 2), "", "", row["hsn_sc"], row["desc"],
+                             row["uqc"], round(row.get("qty", 0), 3), row["rt"], *_rounded(row).values(), ""])
+
+
+async def stream_gstr3b_csv(db, period: str) -> AsyncIterator[str]:
+    gstr3b = await build_gstr3b(db, period, check_stale=False)
+    outward = gstr3b["sup_details"]["osup_det"]
+    yield _csv_line(GSTR3B_CSV_HEADER)
+    yield _csv_line(["3.1(a)", "Outward taxable supplies", "", outward["txval"], outward["iamt"],
+                     outward["camt"], outward["samt"], round(outward["iamt"] + outward["camt"] + outward["samt"], 2)])
+    for state in gstr3b["inter_sup"]["unreg_details"]:
+        yield _csv_line(["3.2", "Inter-state supplies to unregistered persons", state["pos"], state["txval"],
+                         state["iamt"], 0, 0, state["iamt"]])
+    itc = gstr3b["itc_elg"]["itc_net"]
+    yield _csv_line(["4", "Net ITC available", "", "", "", "", "", itc])
+    yield _csv_line(["", "Net tax payable", "", "", "", "", "", gstr3b["tax_payable"]["net"]])
+
+
+async def ensure_gst_return_indexes(db):
+    await db.gst_return_rows.create_index(
+        [("period", 1), ("section", 1), ("key", 1)], unique=True, name="gst_return_row_unique"
+    )
+    await db.gst_return_rows.create_index([("period", 1), ("invoice_id", 1)], name="gst_return_invoice")
+    await db.invoices.create_index([("created_at", 1), ("gst_return_period", 1)], name="invoice_gst_return_period")
+    await db.gst_return_meta.create_index("period", unique=True)
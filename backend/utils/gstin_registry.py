@@ -0,0 +1,198 @@
+"""
+GSTIN Registry - Cached GSTIN verification
+- Format and checksum are validated locally (precompiled) before any remote call
+- In-memory LRU front tier (per worker), persistent Mongo tier (gstin_registry)
+  holding the verified legal name, state, status and verification time
+- Entries older than REFRESH_AFTER are still returned at once and refreshed in the
+  background (one refresh per GSTIN at a time)
+- One pooled httpx client is shared by all lookups; closed on shutdown
+"""
+from datetime import datetime, timezone, timedelta
+from typing import Optional
+import asyncio
+import logging
+import re
+
+import httpx
+
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+GST_SEARCH_URL = "https://api.gst.gov.in/commonapi/v1.0/search"
+REFRESH_AFTER = timedelta(days=7)  # Registration status rarely changes
+SETTINGS_TTL = 60  # Seconds the GST API settings are reused
+
+GSTIN_PATTERN = re.compile(r"^[0-9]{2}[A-Z]{5}[0-9]{4}[A-Z][1-9A-Z]Z[0-9A-Z]$")
+_CHECKSUM_CHARS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_CHECKSUM_INDEX = {c: i for i, c in enumerate(_CHECKSUM_CHARS)}
+
+_memory_cache = LRUCache(maxsize=4096, ttl=3600)
+_settings_cache = LRUCache(maxsize=1, ttl=SETTINGS_TTL)
+_refreshing = set()
+_client: Optional[httpx.AsyncClient] = None
+
+
+def normalize_gstin(gstin: Optional[str]) -> str:
+    return (gstin or "").strip().upper()
+
+
+def gstin_checksum(gstin: str) -> str:
+    """Check character for the first 14 characters (GSTN mod-36 scheme)"""
+    total = 0
+    for position, char in enumerate(gstin[:14]):
+        product = _CHECKSUM_INDEX[char] * (2 if position % 2 else 1)
+        total += product // 36 + product % 36
+    return _CHECKSUM_CHARS[(36 - total % 36) % 36]
+
+
+def gstin_error(gstin: str) -> Optional[str]:
+    """None when the (normalized) GSTIN is well formed, else the reason"""
+    if not GSTIN_PATTERN.match(gstin):
+        return "Invalid GSTIN format"
+    if gstin_checksum(gstin) != gstin[14]:
+        return "Invalid GSTIN checksum"
+    return None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=10.0,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+        )
+    return _client
+
+
+async def close_http_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _api_settings(db) -> dict:
+    settings = _settings_cache.get("settings")
+    if settings is None:
+        settings = await db.gst_settings.find_one(
+            {}, {"_id": 0, "gst_api_enabled": 1, "gst_api_key": 1}
+        ) or {}
+        _settings_cache.set("settings", settings)
+    return settings
+
+
+def invalidate_api_settings():
+    """Call after GST settings change"""
+    _settings_cache.clear()
+
+
+def basic_result(gstin: str, message: str) -> dict:
+    from routers.gst import INDIAN_STATES
+
+    state_code = gstin[:2]
+    return {
+        "gstin": gstin,
+        "valid": True,
+        "verified_via_api": False,
+        "state_code": state_code,
+        "state_name": INDIAN_STATES.get(state_code, "Unknown"),
+        "message": message
+    }
+
+
+async def _fetch(gstin: str, api_key: str) -> dict:
+    from routers.gst import INDIAN_STATES
+
+    response = await get_http_client().get(
+        GST_SEARCH_URL,
+        params={"gstin": gstin},
+        headers={"Authorization": f"Bearer {api_key}"}
+    )
+    if response.status_code != 200:
+        raise ValueError(f"GST verification failed (HTTP {response.status_code})")
+    data = response.json()
+    return {
+        "gstin": gstin,
+        "valid": True,
+        "verified_via_api": True,
+        "legal_name": data.get("lgnm", ""),
+        "trade_name": data.get("tradeNam", ""),
+        "state_code": data.get("stj", gstin[:2]),
+        "state_name": INDIAN_STATES.get(gstin[:2], "Unknown"),
+        "status": data.get("sts", ""),
+        "registration_date": data.get("rgdt", ""),
+        "business_type": data.get("ctb", ""),
+        "address": data.get("pradr", {}).get("adr", "")
+    }
+
+
+async def _verify_remote(db, gstin: str, api_key: str) -> dict:
+    """Call the GST API and store the result in both tiers"""
+    result = await _fetch(gstin, api_key)
+    verified_at = datetime.now(timezone.utc)
+    _memory_cache.set(gstin, {**result, "verified_at": verified_at.isoformat()})
+    await db.gstin_registry.update_one(
+        {"gstin": gstin},
+        {"$set": {**result, "verified_at": verified_at, "refresh_after": verified_at + REFRESH_AFTER}},
+        upsert=True
+    )
+    return {**result, "verified_at": verified_at.isoformat()}
+
+
+async def _refresh_in_background(db, gstin: str, api_key: str):
+    try:
+        await _verify_remote(db, gstin, api_key)
+    except Exception as e:
+        logger.warning(f"GSTIN background refresh failed for {gstin}: {e}")
+    finally:
+        _refreshing.discard(gstin)
+
+
+def _schedule_refresh(db, gstin: str, api_key: str):
+    if gstin in _refreshing:
+        return
+    _refreshing.add(gstin)
+    asyncio.create_task(_refresh_in_background(db, gstin, api_key))
+
+
+async def verify_gstin_cached(db, gstin: str, force_refresh: bool = False) -> dict:
+    """
+    Verify a normalized, locally validated GSTIN.
+    Returns the verification result with "source": memory, cache or api;
+    falls back to state-code-only info when the API is off or unreachable.
+    """
+    settings = await _api_settings(db)
+    api_key = settings.get("gst_api_key")
+    if not settings.get("gst_api_enabled") or not api_key:
+        return basic_result(gstin, "GST API not configured. Basic validation passed.")
+
+    if not force_refresh:
+        cached = _memory_cache.get(gstin)
+        if cached:
+            return {**cached, "source": "memory"}
+
+        doc = await db.gstin_registry.find_one({"gstin": gstin}, {"_id": 0})
+        if doc:
+            refresh_after = doc.pop("refresh_after")
+            verified_at = doc.pop("verified_at")
+            if refresh_after.tzinfo is None:
+                refresh_after = refresh_after.replace(tzinfo=timezone.utc)
+                verified_at = verified_at.replace(tzinfo=timezone.utc)
+            result = {**doc, "verified_at": verified_at.isoformat()}
+            if refresh_after <= datetime.now(timezone.utc):
+                _schedule_refresh(db, gstin, api_key)
+            else:
+                _memory_cache.set(gstin, result)
+            return {**result, "source": "cache"}
+
+    try:
+        return {**await _verify_remote(db, gstin, api_key), "source": "api"}
+    except httpx.TimeoutException:
+        return basic_result(gstin, "GST API timeout. Basic validation passed.")
+    except Exception as e:
+        return basic_result(gstin, f"API error: {str(e)}. Basic validation passed.")
+
+
+async def ensure_gstin_registry_indexes(db):
+    await db.gstin_registry.create_index("gstin", unique=True)
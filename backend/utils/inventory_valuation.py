@@ -0,0 +1,249 @@
+"""
+Inventory Valuation - Cost basis for raw material stock
+- Every stock movement is valued inside the stock-ledger transaction:
+  IN / PO receipts add a cost layer; OUT consumes layers FIFO, or at the running
+  average cost for materials valued by weighted average
+- Materials carry stock_value / avg_cost; the ledger row carries unit_cost / value
+- stock_valuation_daily keeps one closing snapshot per material per day it moved,
+  so the value as of any date is the latest snapshot on or before it (no replay)
+"""
+from datetime import datetime, timezone
+from typing import Optional
+import os
+import uuid
+
+from utils.transactions import run_in_transaction
+
+VALUATION_METHODS = ("fifo", "weighted_average")
+DEFAULT_VALUATION_METHOD = os.environ.get("INVENTORY_VALUATION_METHOD", "fifo")
+
+
+def valuation_method(material: dict) -> str:
+    method = material.get("valuation_method") or DEFAULT_VALUATION_METHOD
+    return method if method in VALUATION_METHODS else "fifo"
+
+
+def _average_cost(quantity: float, value: float, fallback: float) -> float:
+    return value / quantity if quantity > 0 else fallback
+
+
+async def _add_layer(db, material_id: str, quantity: float, unit_cost: float, txn_id: Optional[str],
+                     received_at: str, session=None):
+    await db.stock_cost_layers.insert_one({
+        "id": str(uuid.uuid4()),
+        "material_id": material_id,
+        "txn_id": txn_id,
+        "received_at": received_at,
+        "quantity": quantity,
+        "remaining": quantity,
+        "unit_cost": unit_cost
+    }, session=session)
+
+
+async def _consume_fifo(db, material_id: str, quantity: float, fallback_cost: float, session=None) -> float:
+    """Take quantity from the oldest layers; returns the cost consumed"""
+    cost = 0.0
+    needed = quantity
+    while needed > 1e-9:
+        layer = await db.stock_cost_layers.find_one(
+            {"material_id": material_id, "remaining": {"$gt": 0}},
+            {"_id": 0, "id": 1, "remaining": 1, "unit_cost": 1},
+            sort=[("received_at", 1)],
+            session=session
+        )
+        if not layer:
+            # Layers short of recorded stock (pre-valuation history) - cost the rest at the fallback
+            cost += needed * fallback_cost
+            break
+        take = min(layer["remaining"], needed)
+        # Conditional decrement keeps layers consistent even without a transaction
+        result = await db.stock_cost_layers.update_one(
+            {"id": layer["id"], "remaining": {"$gte": take}},
+            {"$inc": {"remaining": -take}},
+            session=session
+        )
+        if result.modified_count == 0:
+            continue  # Taken concurrently - re-read
+        cost += take * layer["unit_cost"]
+        needed -= take
+    return cost
+
+
+async def _record_snapshot(db, material: dict, date: str, closing_qty: float, closing_value: float,
+                           qty_change: float, value_change: float, session=None):
+    moved_in = qty_change > 0
+    await db.stock_valuation_daily.update_one(
+        {"material_id": material["id"], "date": date},
+        {
+            "$set": {
+                "material_name": material.get("name"),
+                "category": material.get("category"),
+                "closing_qty": closing_qty,
+                "closing_value": closing_value,
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            },
+            "$inc": {
+                "in_qty" if moved_in else "out_qty": abs(qty_change),
+                "in_value" if moved_in else "out_value": round(abs(value_change), 2)
+            }
+        },
+        upsert=True,
+        session=session
+    )
+
+
+async def value_movement(db, before: dict, new_stock: float, unit_cost: Optional[float], txn_id: str,
+                         moved_at: str, session=None) -> dict:
+    """
+    Value a movement from the material's state before it to new_stock.
+    Updates stock_value / avg_cost, cost layers and the daily snapshot.
+    Returns {"unit_cost", "value", "stock_value"} for the ledger row.
+    """
+    material_id = before["id"]
+    method = valuation_method(before)
+    prev_qty = before.get("current_stock", 0) or 0
+    fallback_cost = before.get("unit_price", 0) or 0
+    prev_value = before.get("stock_value")
+    if prev_value is None:
+        prev_value = prev_qty * fallback_cost
+    avg_cost = _average_cost(prev_qty, prev_value, fallback_cost)
+
+    delta = new_stock - prev_qty
+    if delta > 0:
+        cost = unit_cost if unit_cost is not None else (avg_cost if prev_qty > 0 else fallback_cost)
+        value_change = delta * cost
+        if method == "fifo":
+            await _add_layer(db, material_id, delta, cost, txn_id, moved_at, session)
+    elif delta < 0:
+        if method == "fifo":
+            value_change = -await _consume_fifo(db, material_id, -delta, avg_cost, session)
+        else:
+            value_change = delta * avg_cost
+    else:
+        value_change = 0.0
+
+    stock_value = round(prev_value + value_change, 2) if new_stock > 0 else 0.0
+    await db.raw_materials.update_one(
+        {"id": material_id},
+        {"$set": {
+            "stock_value": stock_value,
+            "avg_cost": round(_average_cost(new_stock, stock_value, fallback_cost), 4),
+            "valuation_method": method
+        }},
+        session=session
+    )
+    await _record_snapshot(db, before, moved_at[:10], new_stock, stock_value, delta, value_change, session)
+
+    return {
+        "unit_cost": round(abs(value_change) / abs(delta), 4) if delta else 0,
+        "value": round(value_change, 2),
+        "stock_value": stock_value
+    }
+
+
+async def initialise_material_valuation(db, material_id: str) -> bool:
+    """
+    Opening layer, value and snapshot for a material's existing stock.
+    The material is claimed by a conditional update on the missing stock_value, so
+    when several workers backfill at once only one of them adds the layer and snapshot.
+    Returns whether this call initialised it.
+    """
+    async def _initialise(session):
+        material = await db.raw_materials.find_one(
+            {"id": material_id, "stock_value": {"$exists": False}}, {"_id": 0}, session=session
+        )
+        if not material:
+            return False
+        quantity = material.get("current_stock", 0) or 0
+        unit_cost = material.get("unit_price", 0) or 0
+        method = valuation_method(material)
+        opened_at = material.get("created_at") or datetime.now(timezone.utc).isoformat()
+        stock_value = round(quantity * unit_cost, 2)
+
+        claimed = await db.raw_materials.update_one(
+            {"id": material_id, "stock_value": {"$exists": False}},
+            {"$set": {"stock_value": stock_value, "avg_cost": unit_cost, "valuation_method": method}},
+            session=session
+        )
+        if claimed.modified_count != 1:
+            return False
+        if quantity > 0 and method == "fifo":
+            await _add_layer(db, material_id, quantity, unit_cost, None, opened_at, session=session)
+        await _record_snapshot(db, material, opened_at[:10], quantity, stock_value, quantity, stock_value, session)
+        return True
+
+    return await run_in_transaction(db, _initialise)
+
+
+async def get_stock_valuation(db, as_of: Optional[str] = None, category: Optional[str] = None) -> dict:
+    """
+    Per-material quantity and value, current or as of a date (YYYY-MM-DD).
+    Both paths cover the same materials (active ones), so their totals agree for today.
+    """
+    query = {"status": "active"}
+    if category:
+        query["category"] = category
+    if not as_of:
+        materials = await db.raw_materials.find(query, {
+            "_id": 0, "id": 1, "name": 1, "category": 1, "unit": 1,
+            "current_stock": 1, "stock_value": 1, "avg_cost": 1, "valuation_method": 1
+        }).sort("name", 1).to_list(5000)
+        items = [{
+            "material_id": m["id"],
+            "material_name": m.get("name"),
+            "category": m.get("category"),
+            "unit": m.get("unit"),
+            "quantity": m.get("current_stock", 0),
+            "value": m.get("stock_value", 0),
+            "avg_cost": m.get("avg_cost", 0),
+            "valuation_method": valuation_method(m)
+        } for m in materials]
+    else:
+        active_ids = await db.raw_materials.distinct("id", query)
+        match = {"material_id": {"$in": active_ids}, "date": {"$lte": as_of}}
+        # Latest snapshot per material on or before the date ({material_id, date} index)
+        rows = await db.stock_valuation_daily.aggregate([
+            {"$match": match},
+            {"$sort": {"material_id": 1, "date": -1}},
+            {"$group": {
+                "_id": "$material_id",
+                "material_name": {"$first": "$material_name"},
+                "category": {"$first": "$category"},
+                "quantity": {"$first": "$closing_qty"},
+                "value": {"$first": "$closing_value"},
+                "last_movement": {"$first": "$date"}
+            }},
+            {"$match": {"quantity": {"$gt": 0}}},
+            {"$sort": {"material_name": 1}}
+        ]).to_list(None)
+        items = [{
+            "material_id": r["_id"],
+            "material_name": r.get("material_name"),
+            "category": r.get("category"),
+            "quantity": r["quantity"],
+            "value": r["value"],
+            "avg_cost": round(_average_cost(r["quantity"], r["value"], 0), 4),
+            "last_movement": r["last_movement"]
+        } for r in rows]
+
+    by_category = {}
+    for item in items:
+        key = item.get("category") or "uncategorised"
+        by_category[key] = round(by_category.get(key, 0) + (item["value"] or 0), 2)
+
+    return {
+        "as_of": as_of or datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+        "total_value": round(sum(item["value"] or 0 for item in items), 2),
+        "by_category": by_category,
+        "items": items
+    }
+
+
+async def ensure_valuation_indexes(db):
+    """Indexes for layers and snapshots; opening valuation for materials that predate it"""
+    await db.stock_cost_layers.create_index([("material_id", 1), ("received_at", 1)])
+    await db.stock_valuation_daily.create_index([("material_id", 1), ("date", -1)], unique=True)
+    await db.stock_valuation_daily.create_index("date")
+
+    async for material in db.raw_materials.find({"stock_value": {"$exists": False}}, {"_id": 0, "id": 1}):
+        await initialise_material_valuation(db, material["id"])
@@ -0,0 +1,253 @@
+"""
+Job Coordinator - Run each cron job once across all uvicorn workers
+- Every worker keeps its APScheduler, but registered jobs are wrapped: only the
+  holder of the Mongo lease (scheduler_leases) runs them
+- Lease: owner + expires_at, renewed by a heartbeat every TTL/3; a worker that dies
+  stops renewing and another one takes over once the lease expires
+- Every run also claims (job_id, scheduled_for) in scheduler_runs (unique index), so
+  a fire that lands during a leader hand-over still runs exactly once
+- Missed runs: the leader compares each job's last claimed fire time with its trigger
+  and runs the latest missed occurrence once (coalesced) after downtime
+- run_once(): one-time startup migrations (backfills) run on a single worker, with a
+  persistent marker in `migrations`; a failed or abandoned run is retried on a later start
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+import asyncio
+import logging
+import os
+import socket
+import uuid
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = "scheduler"
+LEASE_TTL_SECONDS = 60
+MIGRATION_LEASE = timedelta(minutes=30)  # A worker that dies mid-migration is retried after this
+CATCH_UP_WINDOW = timedelta(days=35)  # Longest regular interval is monthly
+ON_TIME_GRACE = timedelta(minutes=2)  # Leave fresh fires to the worker's own scheduler
+
+
+def last_fire_time(trigger, now: datetime, since: datetime) -> Optional[datetime]:
+    """Latest fire time of `trigger` in (since, now], or None"""
+    last = None
+    fire = trigger.get_next_fire_time(None, since)
+    while fire and fire <= now:
+        last = fire
+        fire = trigger.get_next_fire_time(fire, fire)
+    return last
+
+
+class JobCoordinator:
+    """Mongo lease leader election plus per-fire run claims for APScheduler jobs"""
+
+    def __init__(self, ttl: int = LEASE_TTL_SECONDS):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.ttl = ttl
+        self._db = None
+        self._jobs = {}
+        self._running = set()
+        self._lease_expires = None
+        self._task = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._lease_expires is not None and datetime.now(timezone.utc) < self._lease_expires
+
+    def register(self, scheduler, func: Callable, trigger, job_id: str, name: str, log_runs: bool = False):
+        """
+        Add a coordinated job to `scheduler`. log_runs writes scheduler_logs entries
+        for jobs that do not record their own history.
+        """
+        self._jobs[job_id] = {"scheduler": scheduler, "func": func, "name": name, "log_runs": log_runs}
+        scheduler.add_job(self.run, trigger, args=[job_id], id=job_id, name=name, replace_existing=True)
+
+    def start(self, db):
+        self._db = db
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._heartbeat())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._db is not None and self.is_leader:
+            # Hand over straight away instead of waiting for expiry
+            await self._db.scheduler_leases.update_one(
+                {"id": LEASE_NAME, "owner": self.owner},
+                {"$set": {"expires_at": datetime.now(timezone.utc)}}
+            )
+        self._lease_expires = None
+
+    def status(self) -> dict:
+        return {
+            "owner": self.owner,
+            "is_leader": self.is_leader,
+            "lease_expires": self._lease_expires.isoformat() if self._lease_expires else None
+        }
+
+    async def _acquire(self) -> bool:
+        now = datetime.now(timezone.utc)
+        expires = now + timedelta(seconds=self.ttl)
+        try:
+            lease = await self._db.scheduler_leases.find_one_and_update(
+                {"id": LEASE_NAME, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": expires, "heartbeat_at": now}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            lease = None  # Another worker holds a live lease
+        if lease is None:
+            self._lease_expires = None
+            return False
+        if not self.is_leader:
+            logger.info(f"Scheduler leadership acquired by {self.owner}")
+        self._lease_expires = expires
+        return True
+
+    async def _heartbeat(self):
+        while True:
+            try:
+                if await self._acquire():
+                    await self.catch_up()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Scheduler lease heartbeat failed: {e}")
+                self._lease_expires = None
+            await asyncio.sleep(self.ttl / 3)
+
+    def _trigger(self, job_id: str):
+        job = self._jobs[job_id]["scheduler"].get_job(job_id)
+        return job.trigger if job else None
+
+    async def run(self, job_id: str):
+        """Scheduler entry point - runs the fire only on the leader, once"""
+        if not self.is_leader:
+            return
+        trigger = self._trigger(job_id)
+        now = datetime.now(timezone.utc)
+        scheduled_for = last_fire_time(trigger, now, now - CATCH_UP_WINDOW) if trigger else now
+        await self._execute(job_id, scheduled_for or now, catch_up=False)
+
+    async def catch_up(self):
+        """Run the latest missed fire of every job (once), e.g. after all workers were down"""
+        now = datetime.now(timezone.utc)
+        for job_id in list(self._jobs):
+            trigger = self._trigger(job_id)
+            if trigger is None or job_id in self._running:
+                continue
+            due = last_fire_time(trigger, now, now - CATCH_UP_WINDOW)
+            if due is None or now - due < ON_TIME_GRACE:
+                continue
+            due_key = due.astimezone(timezone.utc).isoformat()
+            last = await self._db.scheduler_runs.find_one(
+                {"job_id": job_id}, {"_id": 0, "scheduled_for": 1}, sort=[("scheduled_for", -1)]
+            )
+            if last is None:
+                # First start under coordination - record the baseline rather than replaying history
+                await self._claim(job_id, due_key, status="baseline")
+                continue
+            if due_key > last["scheduled_for"]:
+                logger.info(f"Catching up missed run of {job_id} scheduled for {due_key}")
+                asyncio.get_event_loop().create_task(self._execute(job_id, due, catch_up=True))
+
+    async def _claim(self, job_id: str, scheduled_for: str, status: str = "running") -> bool:
+        try:
+            await self._db.scheduler_runs.insert_one({
+                "job_id": job_id,
+                "scheduled_for": scheduled_for,
+                "owner": self.owner,
+                "status": status,
+                "started_at": datetime.now(timezone.utc).isoformat()
+            })
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def _execute(self, job_id: str, scheduled_for: datetime, catch_up: bool):
+        job = self._jobs[job_id]
+        key = scheduled_for.astimezone(timezone.utc).isoformat()
+        if job_id in self._running or not await self._claim(job_id, key):
+            return
+        self._running.add(job_id)
+        result = {"status": "success"}
+        try:
+            await job["func"]()
+        except Exception as e:
+            logger.error(f"Scheduled job {job_id} failed: {e}")
+            result = {"status": "failed", "error": str(e)}
+        finally:
+            self._running.discard(job_id)
+
+        finished = datetime.now(timezone.utc).isoformat()
+        await self._db.scheduler_runs.update_one(
+            {"job_id": job_id, "scheduled_for": key},
+            {"$set": {**result, "catch_up": catch_up, "finished_at": finished}}
+        )
+        if job["log_runs"]:
+            await self._db.scheduler_logs.insert_one({
+                "job_id": job_id,
+                "job_name": job["name"],
+                **result,
+                "scheduled_for": key,
+                "catch_up": catch_up,
+                "run_at": finished
+            })
+
+
+job_coordinator = JobCoordinator()
+
+
+async def run_once(db, migration_id: str, func: Callable) -> bool:
+    """
+    Run `await func()` once across all workers and restarts.
+    Returns True when this worker ran it; False when it is already done or running
+    elsewhere. Errors propagate after the marker is released for the next start.
+    """
+    await db.migrations.create_index("id", unique=True)
+    now = datetime.now(timezone.utc)
+    try:
+        claimed = await db.migrations.find_one_and_update(
+            {
+                "id": migration_id,
+                "status": {"$ne": "done"},
+                "$or": [{"lease_until": {"$exists": False}}, {"lease_until": {"$lt": now}}]
+            },
+            {"$set": {
+                "status": "running",
+                "owner": job_coordinator.owner,
+                "lease_until": now + MIGRATION_LEASE,
+                "started_at": now.isoformat()
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        claimed = None  # Done, or running on a live lease
+    if claimed is None:
+        return False
+
+    try:
+        await func()
+    except Exception as e:
+        await db.migrations.update_one(
+            {"id": migration_id, "owner": job_coordinator.owner},
+            {"$set": {"status": "failed", "error": str(e)}, "$unset": {"lease_until": ""}}
+        )
+        raise
+    await db.migrations.update_one(
+        {"id": migration_id, "owner": job_coordinator.owner},
+        {"$set": {"status": "done", "finished_at": datetime.now(timezone.utc).isoformat()},
+         "$unset": {"lease_until": "", "error": ""}}
+    )
+    return True
+
+
+async def ensure_job_coordinator_indexes(db):
+    await db.scheduler_leases.create_index("id", unique=True)
+    await db.scheduler_runs.create_index([("job_id", 1), ("scheduled_for", -1)], unique=True)
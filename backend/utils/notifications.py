@@ -2,6 +2,8 @@
 Notification utilities - Email, SMS, WhatsApp with fallback support
 """
 import os
+import asyncio
+import contextlib
 import aiosmtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -73,7 +75,9 @@ async def send_sms_notification(phone: str, message: str) -> bool:
         if not phone.startswith('+'):
             phone = '+91' + phone.lstrip('0')
         
-        twilio_client.messages.create(
+        # The Twilio SDK is blocking - keep it off the event loop so sends can overlap
+        await asyncio.to_thread(
+            twilio_client.messages.create,
             body=message,
             from_=TWILIO_PHONE,
             to=phone
@@ -96,7 +100,8 @@ async def send_whatsapp_notification(phone: str, message: str) -> bool:
         if not phone.startswith('+'):
             phone = '+91' + phone.lstrip('0')
         
-        twilio_client.messages.create(
+        await asyncio.to_thread(
+            twilio_client.messages.create,
             body=message,
             from_=TWILIO_WHATSAPP,
             to=f'whatsapp:{phone}'
@@ -108,17 +113,23 @@ async def send_whatsapp_notification(phone: str, message: str) -> bool:
         return False
 
 
+def _slot(limiter, channel: str):
+    return limiter.slot(channel) if limiter else contextlib.nullcontext()
+
+
 async def send_notification_with_fallback(
     phone: str, 
     message: str, 
     email: str = None,
     email_subject: str = None,
     email_html: str = None,
-    prefer_whatsapp: bool = True
+    prefer_whatsapp: bool = True,
+    limiter=None
 ) -> dict:
     """
     Send notification with fallback support.
     Priority: WhatsApp -> SMS -> Email
+    limiter (optional) paces each channel: `async with limiter.slot(channel)` per send.
     
     Returns dict with status for each channel attempted.
     """
@@ -132,7 +143,8 @@ async def send_notification_with_fallback(
     # Try WhatsApp first if preferred
     if prefer_whatsapp:
         result["whatsapp"]["attempted"] = True
-        result["whatsapp"]["success"] = await send_whatsapp_notification(phone, message)
+        async with _slot(limiter, "whatsapp"):
+            result["whatsapp"]["success"] = await send_whatsapp_notification(phone, message)
         
         if result["whatsapp"]["success"]:
             result["any_success"] = True
@@ -140,7 +152,8 @@ async def send_notification_with_fallback(
     
     # Fallback to SMS
     result["sms"]["attempted"] = True
-    result["sms"]["success"] = await send_sms_notification(phone, message)
+    async with _slot(limiter, "sms"):
+        result["sms"]["success"] = await send_sms_notification(phone, message)
     
     if result["sms"]["success"]:
         result["any_success"] = True
@@ -149,7 +162,8 @@ async def send_notification_with_fallback(
     # If WhatsApp wasn't preferred, try it now
     if not prefer_whatsapp:
         result["whatsapp"]["attempted"] = True
-        result["whatsapp"]["success"] = await send_whatsapp_notification(phone, message)
+        async with _slot(limiter, "whatsapp"):
+            result["whatsapp"]["success"] = await send_whatsapp_notification(phone, message)
         
         if result["whatsapp"]["success"]:
             result["any_success"] = True
@@ -158,7 +172,8 @@ async def send_notification_with_fallback(
     # Final fallback: Email
     if email and email_subject and email_html:
         result["email"]["attempted"] = True
-        result["email"]["success"] = await send_email_notification(email, email_subject, email_html)
+        async with _slot(limiter, "email"):
+            result["email"]["success"] = await send_email_notification(email, email_subject, email_html)
         
         if result["email"]["success"]:
             result["any_success"] = True
@@ -286,3 +301,122 @@ Please process this payment."""
         result["any_success"] = result["email"]["success"]
     
     return result
+
+
+def _due_line(due: dict) -> str:
+    if due["days_until_due"] < 0:
+        return f"overdue by {abs(due['days_until_due'])} days"
+    return f"due {due['due_date']}"
+
+
+async def send_payment_due_digest(
+    phone: str,
+    customer_name: str,
+    dues: list,
+    email: str = None,
+    limiter=None
+) -> dict:
+    """
+    One payment reminder covering every due order of a customer.
+    dues: [{order_number, amount_due, due_date, days_until_due}]
+    """
+    total = sum(d["amount_due"] for d in dues)
+    overdue = any(d["days_until_due"] < 0 for d in dues)
+    lines = "\n".join(f"• {d['order_number']}: ₹{d['amount_due']:,.2f} ({_due_line(d)})" for d in dues)
+    
+    message = f"""{'🔴 *Payment Overdue Alert*' if overdue else '⏰ *Payment Reminder*'}
+
+Dear {customer_name},
+
+You have ₹{total:,.2f} pending across {len(dues)} order{'s' if len(dues) > 1 else ''}:
+{lines}
+
+Please make the payment at your earliest convenience{' to avoid any service interruptions' if overdue else ''}.
+
+Thank you,
+Lucumaa Glass"""
+    
+    rows = "".join(
+        f"<tr><td style='padding: 6px;'>{d['order_number']}</td>"
+        f"<td style='padding: 6px; text-align: right;'>₹{d['amount_due']:,.2f}</td>"
+        f"<td style='padding: 6px;'>{_due_line(d)}</td></tr>"
+        for d in dues
+    )
+    email_subject = f"Payment {'Overdue' if overdue else 'Reminder'} - ₹{total:,.2f} pending"
+    email_html = f"""
+    <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+        <div style="background: {'#dc2626' if overdue else '#f59e0b'}; color: white; padding: 20px; text-align: center;">
+            <h2>{'Payment Overdue' if overdue else 'Payment Reminder'}</h2>
+        </div>
+        <div style="padding: 20px;">
+            <p>Dear {customer_name},</p>
+            <p>The following payments are {'overdue or ' if overdue else ''}due soon:</p>
+            <table style="width: 100%; background: #f3f4f6; border-radius: 8px; margin: 20px 0;">
+                {rows}
+                <tr><td style='padding: 6px;'><strong>Total</strong></td>
+                <td style='padding: 6px; text-align: right;'><strong>₹{total:,.2f}</strong></td><td></td></tr>
+            </table>
+            <p>Please make the payment at your earliest convenience.</p>
+            <p>Thank you for your business!</p>
+            <p>Best regards,<br>Lucumaa Glass</p>
+        </div>
+    </div>
+    """
+    
+    return await send_notification_with_fallback(
+        phone=phone,
+        message=message,
+        email=email,
+        email_subject=email_subject,
+        email_html=email_html,
+        prefer_whatsapp=True,
+        limiter=limiter
+    )
+
+
+async def send_vendor_payment_due_digest(
+    vendor_name: str,
+    dues: list,
+    admin_email: str = None,
+    limiter=None
+) -> dict:
+    """
+    One finance-team alert covering every due PO of a vendor.
+    dues: [{po_number, amount_due, due_date, days_until_due}]
+    """
+    total = sum(d["amount_due"] for d in dues)
+    soonest = min(d["days_until_due"] for d in dues)
+    urgency = "OVERDUE" if soonest <= 0 else "DUE SOON" if soonest <= 3 else "UPCOMING"
+    rows = "".join(
+        f"<tr><td style='padding: 6px;'>{d['po_number']}</td>"
+        f"<td style='padding: 6px; text-align: right;'>₹{d['amount_due']:,.2f}</td>"
+        f"<td style='padding: 6px;'>{_due_line(d)}</td></tr>"
+        for d in dues
+    )
+    email_subject = f"Vendor Payment {urgency} - {vendor_name} (₹{total:,.2f})"
+    email_html = f"""
+    <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+        <div style="background: {'#dc2626' if soonest <= 0 else '#f59e0b' if soonest <= 3 else '#10b981'}; color: white; padding: 20px; text-align: center;">
+            <h2>Vendor Payment {urgency}</h2>
+        </div>
+        <div style="padding: 20px;">
+            <p><strong>Vendor:</strong> {vendor_name}</p>
+            <table style="width: 100%; background: #f3f4f6; border-radius: 8px;">
+                {rows}
+                <tr><td style='padding: 6px;'><strong>Total</strong></td>
+                <td style='padding: 6px; text-align: right;'><strong>₹{total:,.2f}</strong></td><td></td></tr>
+            </table>
+            <p style="margin-top: 20px;">Please process these vendor payments to maintain good supplier relationships.</p>
+        </div>
+    </div>
+    """
+    
+    result = {"email": {"attempted": False, "success": False}, "any_success": False}
+    
+    if admin_email:
+        result["email"]["attempted"] = True
+        async with _slot(limiter, "email"):
+            result["email"]["success"] = await send_email_notification(admin_email, email_subject, email_html)
+        result["any_success"] = result["email"]["success"]
+    
+    return result
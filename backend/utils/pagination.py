@@ -0,0 +1,107 @@
+"""
+Pagination - Keyset (cursor) pagination for list endpoints
+- Lists are ordered by (sort field desc, id desc) and continued with an opaque
+  cursor token encoding the last row's sort value and id, so every page is an
+  indexed range scan instead of skip() over all earlier rows
+- page=/skip= are still accepted for numbered pagers (skip fallback); the response always
+  carries next_cursor so clients can switch without losing their place
+- Totals are optional and estimated: metadata count for an unfiltered collection,
+  otherwise a count capped at TOTAL_COUNT_CAP (total_is_estimate when capped)
+- Every row needs the sort field: a range on a missing field never matches, so such
+  rows would silently fall off cursor pages
+"""
+from datetime import datetime
+from typing import Any, Optional, Tuple
+import base64
+import json
+
+TOTAL_COUNT_CAP = 10000
+
+
+def encode_cursor(value: Any, row_id: str) -> str:
+    if isinstance(value, datetime):
+        payload = ["d", value.isoformat(), row_id]
+    else:
+        payload = ["v", value, row_id]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> Tuple[Any, str]:
+    """(sort value, id) from a cursor token; ValueError when malformed"""
+    try:
+        kind, value, row_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return (datetime.fromisoformat(value) if kind == "d" else value), row_id
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def keyset_filter(query: dict, sort_field: str, cursor: str) -> dict:
+    """query narrowed to rows after the cursor in (sort_field desc, id desc) order"""
+    value, row_id = decode_cursor(cursor)
+    after = {"$or": [
+        {sort_field: {"$lt": value}},
+        {sort_field: value, "id": {"$lt": row_id}}
+    ]}
+    return {"$and": [query, after]} if query else after
+
+
+async def estimated_total(collection, query: dict) -> Tuple[int, bool]:
+    """(total, is_estimate)"""
+    if not query:
+        return await collection.estimated_document_count(), True
+    total = await collection.count_documents(query, limit=TOTAL_COUNT_CAP)
+    return total, total >= TOTAL_COUNT_CAP
+
+
+async def paginate(
+    collection,
+    query: dict,
+    projection: Optional[dict] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    skip: int = 0,
+    sort_field: str = "created_at",
+    include_total: bool = False
+) -> dict:
+    """
+    One page of `collection` matching `query`.
+    Returns {"items", "next_cursor", "has_more"} plus "total"/"total_pages"/
+    "total_is_estimate" when include_total. A cursor takes precedence over skip.
+    """
+    # Callers clamp too; a zero limit or negative skip here would divide by zero / error
+    limit = max(1, limit)
+    skip = max(0, skip)
+    find_query = keyset_filter(query, sort_field, cursor) if cursor else query
+    find = collection.find(find_query, projection or {"_id": 0}).sort([(sort_field, -1), ("id", -1)])
+    if not cursor and skip > 0:
+        find = find.skip(skip)
+    rows = await find.limit(limit + 1).to_list(limit + 1)
+
+    has_more = len(rows) > limit
+    items = rows[:limit]
+    last = items[-1] if items else None
+    result = {
+        "items": items,
+        "has_more": has_more,
+        "next_cursor": encode_cursor(last.get(sort_field), last.get("id")) if has_more and last else None
+    }
+    if include_total:
+        total, is_estimate = await estimated_total(collection, query)
+        result.update(total=total, total_pages=(total + limit - 1) // limit, total_is_estimate=is_estimate)
+    return result
+
+
+async def ensure_pagination_indexes(db):
+    """(filter, sort, id) indexes behind the paginated lists"""
+    await db.orders.create_index([("created_at", -1), ("id", -1)])
+    await db.orders.create_index([("status", 1), ("created_at", -1), ("id", -1)])
+    await db.job_work_orders.create_index([("created_at", -1), ("id", -1)])
+    await db.job_work_orders.create_index([("status", 1), ("created_at", -1), ("id", -1)])
+    await db.customer_profiles.create_index([("status", 1), ("created_at", -1), ("id", -1)])
+    await db.audit_logs.create_index([("timestamp", -1), ("id", -1)])
+    # Customer master audit rows used to be written with created_at only
+    await db.audit_logs.update_many(
+        {"timestamp": {"$exists": False}, "created_at": {"$exists": True}},
+        [{"$set": {"timestamp": "$created_at"}}]
+    )
+    await db.cms_content.create_index([("type", 1), ("status", 1), ("created_at", -1), ("id", -1)])
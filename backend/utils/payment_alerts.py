@@ -1,183 +1,314 @@
 """
 Payment Due Alerts - Background task for sending payment reminders
+- Dues are streamed (no cap) and grouped into one digest per customer / vendor
+- payment_alert_history holds one row per party; a digest is claimed there atomically
+  and suppressed while the party is inside the cooldown, unless its urgency escalated
+- Digests are dispatched concurrently; each channel has its own concurrency cap and
+  send rate (ChannelLimiter)
+- Every run records throughput metrics in payment_alert_logs
 """
 from datetime import datetime, timezone, timedelta
-from motor.motor_asyncio import AsyncIOMotorClient
-import os
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import asyncio
+import contextlib
 import logging
-from .notifications import send_payment_due_alert, send_vendor_payment_due_alert
+import time
+import uuid
+from .notifications import send_payment_due_digest, send_vendor_payment_due_digest
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_NOTIFY_DAYS = [3, 1]  # Days before due; overdue is always included
+DEFAULT_COOLDOWN_HOURS = 20  # Daily run, with slack for a run that starts early
+MAX_IN_FLIGHT = 20
+DEFAULT_CHANNEL_LIMITS = {
+    "whatsapp": {"concurrency": 5, "per_second": 10},
+    "sms": {"concurrency": 2, "per_second": 1},
+    "email": {"concurrency": 3, "per_second": 5}
+}
+URGENCY_RANK = {"due_soon": 1, "due_tomorrow": 2, "due_today": 2, "overdue": 3}
 
-async def check_customer_payment_dues(db):
+
+class ChannelLimiter:
+    """Per-channel concurrency cap and minimum spacing between send starts"""
+
+    def __init__(self, limits: dict = None):
+        limits = limits or DEFAULT_CHANNEL_LIMITS
+        self._semaphores = {c: asyncio.Semaphore(l["concurrency"]) for c, l in limits.items()}
+        self._interval = {c: 1 / l["per_second"] for c, l in limits.items()}
+        self._locks = {c: asyncio.Lock() for c in limits}
+        self._next_start = {c: 0.0 for c in limits}
+        self.sent = {c: 0 for c in limits}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, channel: str):
+        async with self._semaphores[channel]:
+            async with self._locks[channel]:
+                now = time.monotonic()
+                wait = self._next_start[channel] - now
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self._next_start[channel] = max(now, self._next_start[channel]) + self._interval[channel]
+            self.sent[channel] += 1
+            yield
+
+
+def _parse(value) -> datetime:
+    if isinstance(value, str):
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return value
+
+
+def _bucket(days_until_due: int, notify_days: list):
+    if days_until_due < 0:
+        return "overdue"
+    if days_until_due not in notify_days:
+        return None
+    return {0: "due_today", 1: "due_tomorrow"}.get(days_until_due, "due_soon")
+
+
+async def _get_alert_settings(db) -> dict:
+    return await db.alert_settings.find_one({"type": "payment_alerts"}, {"_id": 0}) or {}
+
+
+async def _claim_alert(db, party_type: str, party_key: str, rank: int, now: datetime, cooldown: timedelta):
+    """
+    Take the alert slot for a party. Returns the previous history row ({} if none),
+    or None when the party is inside its cooldown at the same or higher urgency.
+    """
+    try:
+        previous = await db.payment_alert_history.find_one_and_update(
+            {
+                "party_type": party_type,
+                "party_key": party_key,
+                "$or": [
+                    {"last_alerted_at": {"$lt": (now - cooldown).isoformat()}},
+                    {"urgency_rank": {"$lt": rank}}
+                ]
+            },
+            {"$set": {"last_alerted_at": now.isoformat(), "urgency_rank": rank}},
+            upsert=True,
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        return None  # Row exists and did not match - still cooling down
+    return previous or {}
+
+
+async def _release_alert(db, party_type: str, party_key: str, previous: dict):
+    """Put the history row back after a failed send so the next run retries"""
+    await db.payment_alert_history.update_one(
+        {"party_type": party_type, "party_key": party_key},
+        {"$set": {
+            "last_alerted_at": previous.get("last_alerted_at", ""),
+            "urgency_rank": previous.get("urgency_rank", 0)
+        }}
+    )
+
+
+async def _dispatch(db, party_type: str, digests: dict, send, now: datetime, cooldown: timedelta,
+                    mark_sent, stats: dict):
+    """Claim and send every digest concurrently; `send(digest)` returns the channel result"""
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+    async def one(party_key: str, digest: dict):
+        rank = max(URGENCY_RANK[d["bucket"]] for d in digest["dues"])
+        async with in_flight:
+            try:
+                previous = await _claim_alert(db, party_type, party_key, rank, now, cooldown)
+                if previous is None:
+                    stats["suppressed"] += 1
+                    return
+                try:
+                    result = await send(digest)
+                except Exception:
+                    await _release_alert(db, party_type, party_key, previous)
+                    raise
+                if result.get("any_success"):
+                    stats["digests_sent"] += 1
+                    await db.payment_alert_history.update_one(
+                        {"party_type": party_type, "party_key": party_key},
+                        {"$set": {
+                            "party_name": digest["name"],
+                            "references": [d["reference"] for d in digest["dues"]],
+                            "amount_due": round(sum(d["amount_due"] for d in digest["dues"]), 2)
+                        }, "$inc": {"alert_count": 1}}
+                    )
+                    await mark_sent(digest)
+                else:
+                    stats["failed"] += 1
+                    await _release_alert(db, party_type, party_key, previous)
+            except Exception as e:
+                logger.error(f"Error sending {party_type} payment digest to {digest['name']}: {e}")
+                stats["failed"] += 1
+
+    await asyncio.gather(*(one(key, digest) for key, digest in digests.items()))
+
+
+async def check_customer_payment_dues(db, limiter: ChannelLimiter = None):
     """
-    Check for customer orders with pending payments and send alerts.
-    Runs daily to identify:
-    - Payments due in 3 days
-    - Payments due tomorrow
-    - Overdue payments
+    Check for customer orders with pending payments and send one digest per customer.
+    Due date: 30 days from order for credit customers, 7 days for others.
+    Alerts on the configured days before due (default 3 and 1) and when overdue.
     """
     today = datetime.now(timezone.utc)
-    
-    # Find orders with remaining balance
-    orders = await db.orders.find({
+    settings = await _get_alert_settings(db)
+    customer_settings = settings.get("customer_alerts", {})
+    stats = {"dues": 0, "parties": 0, "digests_sent": 0, "suppressed": 0, "failed": 0,
+             "due_soon": 0, "due_tomorrow": 0, "due_today": 0, "overdue": 0}
+    if not settings.get("enabled", True) or not customer_settings.get("enabled", True):
+        return stats
+    notify_days = customer_settings.get("days_before_due", DEFAULT_NOTIFY_DAYS)
+    cooldown = timedelta(hours=settings.get("cooldown_hours", DEFAULT_COOLDOWN_HOURS))
+
+    digests = {}
+    cursor = db.orders.find({
         "remaining_amount": {"$gt": 0},
         "status": {"$nin": ["cancelled", "returned"]}
-    }, {"_id": 0}).to_list(1000)
-    
-    alerts_sent = {"due_soon": 0, "due_tomorrow": 0, "overdue": 0, "failed": 0}
-    
-    for order in orders:
+    }, {
+        "_id": 0, "id": 1, "order_number": 1, "remaining_amount": 1, "created_at": 1, "is_credit_customer": 1,
+        "customer_profile_id": 1, "customer_id": 1, "customer_name": 1, "customer_phone": 1, "customer_email": 1
+    }).batch_size(500)
+    async for order in cursor:
         try:
-            # Calculate due date (30 days from order for credit customers, 7 days for others)
-            created_at = order.get("created_at", "")
-            if isinstance(created_at, str):
-                created_date = datetime.fromisoformat(created_at.replace("Z", "+00:00"))
-            else:
-                created_date = created_at
-            
-            # Check if customer is credit customer
-            is_credit = order.get("is_credit_customer", False)
-            payment_days = 30 if is_credit else 7
-            
-            due_date = created_date + timedelta(days=payment_days)
-            days_until_due = (due_date.date() - today.date()).days
-            
-            # Skip if already notified today
-            last_reminder = order.get("last_payment_reminder")
-            if last_reminder:
-                last_reminder_date = datetime.fromisoformat(last_reminder.replace("Z", "+00:00")).date()
-                if last_reminder_date == today.date():
-                    continue
-            
-            should_notify = False
-            
-            # Overdue
-            if days_until_due < 0:
-                should_notify = True
-                alerts_sent["overdue"] += 1
-            # Due tomorrow
-            elif days_until_due == 1:
-                should_notify = True
-                alerts_sent["due_tomorrow"] += 1
-            # Due in 3 days
-            elif days_until_due == 3:
-                should_notify = True
-                alerts_sent["due_soon"] += 1
-            
-            if should_notify:
-                result = await send_payment_due_alert(
-                    phone=order.get("customer_phone", ""),
-                    customer_name=order.get("customer_name", "Customer"),
-                    order_number=order.get("order_number", ""),
-                    amount_due=order.get("remaining_amount", 0),
-                    due_date=due_date.strftime("%d-%m-%Y"),
-                    days_overdue=abs(days_until_due) if days_until_due < 0 else 0,
-                    email=order.get("customer_email")
-                )
-                
-                if result.get("any_success"):
-                    # Update last reminder date
-                    await db.orders.update_one(
-                        {"id": order.get("id")},
-                        {"$set": {"last_payment_reminder": today.isoformat()}}
-                    )
-                else:
-                    alerts_sent["failed"] += 1
-                    
-        except Exception as e:
-            logger.error(f"Error processing payment due for order {order.get('order_number')}: {e}")
-            alerts_sent["failed"] += 1
-    
-    return alerts_sent
+            payment_days = 30 if order.get("is_credit_customer", False) else 7
+            due_date = _parse(order.get("created_at", "")) + timedelta(days=payment_days)
+        except (TypeError, ValueError):
+            continue
+        days_until_due = (due_date.date() - today.date()).days
+        bucket = _bucket(days_until_due, notify_days)
+        if bucket is None or (bucket == "overdue" and not customer_settings.get("overdue_reminders", True)):
+            continue
+
+        key = (order.get("customer_profile_id") or order.get("customer_id")
+               or order.get("customer_phone") or order.get("customer_email"))
+        if not key:
+            continue
+        digest = digests.setdefault(key, {"dues": [], "order_ids": []})
+        # Contact details from the most recent order
+        digest.update(
+            name=order.get("customer_name") or digest.get("name") or "Customer",
+            phone=order.get("customer_phone") or digest.get("phone", ""),
+            email=order.get("customer_email") or digest.get("email")
+        )
+        digest["order_ids"].append(order.get("id"))
+        digest["dues"].append({
+            "reference": order.get("order_number", ""),
+            "order_number": order.get("order_number", ""),
+            "amount_due": order.get("remaining_amount", 0),
+            "due_date": due_date.strftime("%d-%m-%Y"),
+            "days_until_due": days_until_due,
+            "bucket": bucket
+        })
+        stats["dues"] += 1
+        stats[bucket] += 1
+    stats["parties"] = len(digests)
+
+    async def send(digest):
+        return await send_payment_due_digest(
+            phone=digest["phone"],
+            customer_name=digest["name"],
+            dues=sorted(digest["dues"], key=lambda d: d["days_until_due"]),
+            email=digest["email"],
+            limiter=limiter
+        )
+
+    async def mark_sent(digest):
+        await db.orders.update_many(
+            {"id": {"$in": digest["order_ids"]}},
+            {"$set": {"last_payment_reminder": today.isoformat()}}
+        )
+
+    await _dispatch(db, "customer", digests, send, today, cooldown, mark_sent, stats)
+    return stats
 
 
-async def check_vendor_payment_dues(db):
+async def check_vendor_payment_dues(db, limiter: ChannelLimiter = None):
     """
-    Check for vendor POs with pending payments and send alerts to finance team.
-    Alerts for:
-    - Payments due in 3 days
-    - Payments due tomorrow
-    - Overdue payments
+    Check for vendor POs with pending payments and send one digest per vendor to the finance team.
+    Due date: approval + the vendor's credit days (default 30).
     """
     today = datetime.now(timezone.utc)
-    
-    # Find POs with outstanding balance
-    pos = await db.purchase_orders.find({
-        "outstanding_balance": {"$gt": 0},
-        "status": "approved"
-    }, {"_id": 0}).to_list(1000)
-    
-    alerts_sent = {"due_soon": 0, "due_tomorrow": 0, "overdue": 0, "failed": 0}
-    
-    # Get admin email for notifications
-    admin = await db.users.find_one({"role": {"$in": ["super_admin", "admin", "finance"]}}, {"_id": 0})
-    admin_email = admin.get("email") if admin else None
-    
-    for po in pos:
+    settings = await _get_alert_settings(db)
+    vendor_settings = settings.get("vendor_alerts", {})
+    stats = {"dues": 0, "parties": 0, "digests_sent": 0, "suppressed": 0, "failed": 0,
+             "due_soon": 0, "due_tomorrow": 0, "due_today": 0, "overdue": 0}
+    if not settings.get("enabled", True) or not vendor_settings.get("enabled", True):
+        return stats
+    notify_days = vendor_settings.get("days_before_due", DEFAULT_NOTIFY_DAYS)
+    cooldown = timedelta(hours=settings.get("cooldown_hours", DEFAULT_COOLDOWN_HOURS))
+
+    admin_email = vendor_settings.get("admin_email")
+    if not admin_email:
+        admin = await db.users.find_one({"role": {"$in": ["super_admin", "admin", "finance"]}}, {"_id": 0, "email": 1})
+        admin_email = admin.get("email") if admin else None
+    if not admin_email:
+        return stats
+
+    # Vendor credit days joined in the same query instead of one lookup per PO
+    cursor = db.purchase_orders.aggregate([
+        {"$match": {"outstanding_balance": {"$gt": 0}, "status": "approved"}},
+        {"$lookup": {
+            "from": "vendors",
+            "let": {"vendor_id": "$vendor_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$id", "$$vendor_id"]}}},
+                {"$project": {"_id": 0, "credit_days": 1}}
+            ],
+            "as": "vendor"
+        }},
+        {"$project": {
+            "_id": 0, "id": 1, "po_number": 1, "vendor_id": 1, "vendor_name": 1, "outstanding_balance": 1,
+            "approved_at": 1, "created_at": 1,
+            "credit_days": {"$ifNull": [{"$arrayElemAt": ["$vendor.credit_days", 0]}, 30]}
+        }}
+    ])
+
+    digests = {}
+    async for po in cursor:
         try:
-            # Get vendor credit days
-            vendor = await db.vendors.find_one({"id": po.get("vendor_id")}, {"_id": 0})
-            credit_days = vendor.get("credit_days", 30) if vendor else 30
-            
-            # Calculate due date
-            approved_at = po.get("approved_at") or po.get("created_at", "")
-            if isinstance(approved_at, str):
-                approved_date = datetime.fromisoformat(approved_at.replace("Z", "+00:00"))
-            else:
-                approved_date = approved_at
-            
-            due_date = approved_date + timedelta(days=credit_days)
-            days_until_due = (due_date.date() - today.date()).days
-            
-            # Skip if already notified today
-            last_reminder = po.get("last_payment_reminder")
-            if last_reminder:
-                last_reminder_date = datetime.fromisoformat(last_reminder.replace("Z", "+00:00")).date()
-                if last_reminder_date == today.date():
-                    continue
-            
-            should_notify = False
-            
-            # Overdue
-            if days_until_due < 0:
-                should_notify = True
-                alerts_sent["overdue"] += 1
-            # Due tomorrow
-            elif days_until_due == 1:
-                should_notify = True
-                alerts_sent["due_tomorrow"] += 1
-            # Due in 3 days
-            elif days_until_due == 3:
-                should_notify = True
-                alerts_sent["due_soon"] += 1
-            
-            if should_notify and admin_email:
-                result = await send_vendor_payment_due_alert(
-                    vendor_name=po.get("vendor_name", "Unknown"),
-                    po_number=po.get("po_number", ""),
-                    amount_due=po.get("outstanding_balance", 0),
-                    due_date=due_date.strftime("%d-%m-%Y"),
-                    days_until_due=days_until_due,
-                    admin_email=admin_email
-                )
-                
-                if result.get("any_success"):
-                    # Update last reminder date
-                    await db.purchase_orders.update_one(
-                        {"id": po.get("id")},
-                        {"$set": {"last_payment_reminder": today.isoformat()}}
-                    )
-                else:
-                    alerts_sent["failed"] += 1
-                    
-        except Exception as e:
-            logger.error(f"Error processing vendor payment due for PO {po.get('po_number')}: {e}")
-            alerts_sent["failed"] += 1
-    
-    return alerts_sent
+            due_date = _parse(po.get("approved_at") or po.get("created_at", "")) + timedelta(days=po["credit_days"])
+        except (TypeError, ValueError):
+            continue
+        days_until_due = (due_date.date() - today.date()).days
+        bucket = _bucket(days_until_due, notify_days)
+        if bucket is None:
+            continue
+
+        digest = digests.setdefault(po.get("vendor_id") or po.get("vendor_name"), {
+            "name": po.get("vendor_name", "Unknown"), "dues": [], "po_ids": []
+        })
+        digest["po_ids"].append(po.get("id"))
+        digest["dues"].append({
+            "reference": po.get("po_number", ""),
+            "po_number": po.get("po_number", ""),
+            "amount_due": po.get("outstanding_balance", 0),
+            "due_date": due_date.strftime("%d-%m-%Y"),
+            "days_until_due": days_until_due,
+            "bucket": bucket
+        })
+        stats["dues"] += 1
+        stats[bucket] += 1
+    stats["parties"] = len(digests)
+
+    async def send(digest):
+        return await send_vendor_payment_due_digest(
+            vendor_name=digest["name"],
+            dues=sorted(digest["dues"], key=lambda d: d["days_until_due"]),
+            admin_email=admin_email,
+            limiter=limiter
+        )
+
+    async def mark_sent(digest):
+        await db.purchase_orders.update_many(
+            {"id": {"$in": digest["po_ids"]}},
+            {"$set": {"last_payment_reminder": today.isoformat()}}
+        )
+
+    await _dispatch(db, "vendor", digests, send, today, cooldown, mark_sent, stats)
+    return stats
 
 
 async def run_payment_due_alerts(db):
@@ -185,21 +316,36 @@ async def run_payment_due_alerts(db):
     Main function to run all payment due alert checks
     """
     logger.info("Running payment due alerts...")
-    
-    customer_alerts = await check_customer_payment_dues(db)
-    vendor_alerts = await check_vendor_payment_dues(db)
-    
+    started = time.monotonic()
+    limiter = ChannelLimiter()
+
+    customer_alerts, vendor_alerts = await asyncio.gather(
+        check_customer_payment_dues(db, limiter),
+        check_vendor_payment_dues(db, limiter)
+    )
+
+    duration = time.monotonic() - started
+    digests = customer_alerts["digests_sent"] + vendor_alerts["digests_sent"]
     summary = {
+        "run_id": str(uuid.uuid4()),
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "customer_alerts": customer_alerts,
-        "vendor_alerts": vendor_alerts
+        "vendor_alerts": vendor_alerts,
+        "metrics": {
+            "duration_ms": round(duration * 1000),
+            "dues_scanned": customer_alerts["dues"] + vendor_alerts["dues"],
+            "digests_sent": digests,
+            "digests_per_second": round(digests / duration, 2) if duration else 0,
+            "channel_sends": dict(limiter.sent)
+        }
     }
-    
+
     # Log summary
     await db.payment_alert_logs.insert_one(summary)
-    
-    logger.info(f"Payment alerts sent - Customers: {customer_alerts}, Vendors: {vendor_alerts}")
-    
+    summary.pop("_id", None)
+
+    logger.info(f"Payment alerts sent - Customers: {customer_alerts}, Vendors: {vendor_alerts}, Metrics: {summary['metrics']}")
+
     return summary
 
 
@@ -213,6 +359,11 @@ async def schedule_payment_alerts(db, interval_hours: int = 24):
             await run_payment_due_alerts(db)
         except Exception as e:
             logger.error(f"Payment alert scheduler error: {e}")
-        
+
         # Wait for next run
         await asyncio.sleep(interval_hours * 3600)
+
+
+async def ensure_payment_alert_indexes(db):
+    await db.payment_alert_history.create_index([("party_type", 1), ("party_key", 1)], unique=True)
+    await db.payment_alert_logs.create_index("timestamp")
@@ -0,0 +1,391 @@
+"""
+Period Close - Frozen per-period aggregates behind ledger period locks
+- Locking a period (ledger period_locks) runs a close job once the period has ended:
+  every calendar month in it is frozen into period_aggregates (GL debit/credit per
+  account, GST totals, cash totals, P&L figures) and period_party_balances
+  (customer/vendor debit and credit per party, by transaction date for ageing)
+- Frozen rows are written as "closing" and flipped to "closed" in one step; a
+  deactivated lock or a posting dated inside the period marks them "reopened"
+  (kept for audit, ignored by readers) and a later close re-freezes the period
+- Readers split any date range into frozen segments plus open gaps: frozen figures
+  come from the aggregates, only the gaps are aggregated live from raw entries
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+import logging
+import uuid
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+MIN_DATE = ""  # Sorts before every YYYY-MM-DD
+MAX_DATE = "9999-12-31"
+STALE_CLOSE_AFTER = timedelta(hours=1)
+
+
+def _day(date_str: str) -> datetime:
+    return datetime.strptime(date_str[:10], "%Y-%m-%d")
+
+
+def _shift(date_str: str, days: int) -> str:
+    return (_day(date_str) + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def month_segments(start: str, end: str) -> List[Tuple[str, str]]:
+    """Split [start, end] at calendar month boundaries"""
+    segments = []
+    current = _day(start)
+    last = _day(end)
+    while current <= last:
+        month_end = (current.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        segment_end = min(month_end, last)
+        segments.append((current.strftime("%Y-%m-%d"), segment_end.strftime("%Y-%m-%d")))
+        current = segment_end + timedelta(days=1)
+    return segments
+
+
+# ================== READING ==================
+
+async def plan_range(db, start: Optional[str], end: Optional[str], projection: Optional[dict] = None) -> tuple:
+    """
+    Frozen segments fully inside [start, end] (non-overlapping, in date order) and the
+    open gaps between them as (gap_start, gap_end) pairs to aggregate live
+    """
+    start, end = start or MIN_DATE, end or MAX_DATE
+    docs = await db.period_aggregates.find(
+        {"status": "closed", "start": {"$gte": start}, "end": {"$lte": end}},
+        {"_id": 0, "id": 1, "start": 1, "end": 1, **(projection or {})}
+    ).sort([("start", 1), ("end", -1)]).to_list(None)
+
+    segments, gaps = [], []
+    cursor = start
+    for doc in docs:
+        if doc["start"] < cursor:
+            continue  # Overlapped by an earlier close of the same dates
+        if doc["start"] > cursor:
+            gaps.append((cursor, _shift(doc["start"], -1)))
+        segments.append(doc)
+        cursor = _shift(doc["end"], 1)
+    if cursor <= end:
+        gaps.append((cursor, end))
+    return segments, gaps
+
+
+def gap_match(field: str, gaps: List[Tuple[str, str]], timestamps: bool = False) -> dict:
+    """Match only documents dated inside the open gaps"""
+    suffix = "T23:59:59" if timestamps else ""
+    ranges = [{field: {"$gte": s, "$lte": e + suffix if e != MAX_DATE else e}} for s, e in gaps]
+    return ranges[0] if len(ranges) == 1 else {"$or": ranges}
+
+
+def merge_figures(parts: List[dict]) -> dict:
+    """Sum numeric leaves of several figure dicts (nested dicts merged key by key)"""
+    merged = {}
+    for part in parts:
+        for key, value in part.items():
+            if isinstance(value, dict):
+                merged[key] = merge_figures([merged.get(key, {}), value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+async def gl_totals(db, as_of_date: Optional[str] = None) -> Dict[str, dict]:
+    """Debit/credit totals per GL account up to a date"""
+    segments, gaps = await plan_range(db, None, as_of_date, {"gl": 1})
+    totals = merge_figures([s.get("gl", {}) for s in segments])
+    if gaps:
+        rows = await db.gl_entries.aggregate([
+            {"$match": gap_match("transaction_date", gaps)},
+            {"$group": {"_id": {"code": "$account_code", "type": "$entry_type"}, "total": {"$sum": "$amount"}}}
+        ]).to_list(None)
+        live = {}
+        for row in rows:
+            side = "debit" if row["_id"]["type"] == "debit" else "credit"
+            live.setdefault(row["_id"]["code"], {})[side] = row["total"]
+        totals = merge_figures([totals, live])
+    return totals
+
+
+async def party_totals(db, party_type: str) -> List[dict]:
+    """
+    Per-party debit/credit totals over all time, with dated entries for ageing.
+    Frozen segments contribute one entry per transaction date and side.
+    """
+    segments, gaps = await plan_range(db, None, None)
+    parties = {}
+
+    def party(party_id, name):
+        row = parties.setdefault(party_id, {"party_id": party_id, "party_name": name, "total_debit": 0,
+                                            "total_credit": 0, "last_transaction": None, "entries": []})
+        row["party_name"] = row["party_name"] or name
+        return row
+
+    if segments:
+        frozen = await db.period_party_balances.aggregate([
+            {"$match": {"segment_id": {"$in": [s["id"] for s in segments]}, "party_type": party_type}},
+            {"$group": {
+                "_id": "$party_id",
+                "party_name": {"$first": "$party_name"},
+                "debit": {"$sum": "$debit"},
+                "credit": {"$sum": "$credit"},
+                "last_transaction": {"$max": "$last_transaction"},
+                "debit_by_date": {"$mergeObjects": "$debit_by_date"},
+                "credit_by_date": {"$mergeObjects": "$credit_by_date"}
+            }}
+        ], allowDiskUse=True).to_list(None)
+        for row in frozen:
+            target = party(row["_id"], row["party_name"])
+            target["total_debit"] += row["debit"]
+            target["total_credit"] += row["credit"]
+            target["last_transaction"] = row["last_transaction"]
+            for effect in ("debit", "credit"):
+                target["entries"] += [{"transaction_date": date, "effect": effect, "amount": amount}
+                                      for date, amount in (row.get(f"{effect}_by_date") or {}).items()]
+
+    if gaps:
+        live = await db.party_ledger.aggregate([
+            {"$match": {"party_type": party_type, **gap_match("transaction_date", gaps)}},
+            {"$group": {
+                "_id": "$party_id",
+                "party_name": {"$first": "$party_name"},
+                "total_debit": {"$sum": {"$cond": [{"$eq": ["$effect", "debit"]}, "$total_amount", 0]}},
+                "total_credit": {"$sum": {"$cond": [{"$eq": ["$effect", "credit"]}, "$total_amount", 0]}},
+                "last_transaction": {"$max": "$transaction_date"},
+                "entries": {"$push": {"transaction_date": "$transaction_date", "effect": "$effect", "amount": "$total_amount"}}
+            }}
+        ], allowDiskUse=True).to_list(None)
+        for row in live:
+            target = party(row["_id"], row["party_name"])
+            target["total_debit"] += row["total_debit"]
+            target["total_credit"] += row["total_credit"]
+            target["last_transaction"] = max(filter(None, [target["last_transaction"], row["last_transaction"]]), default=None)
+            target["entries"] += row["entries"]
+
+    return list(parties.values())
+
+
+async def _live_gst(db, start: str, end: str) -> dict:
+    invoice_rows = await db.invoices.aggregate([
+        {"$match": {"created_at": {"$gte": start, "$lte": end + "T23:59:59"}}},
+        {"$group": {"_id": None, "taxable": {"$sum": "$subtotal"}, "cgst": {"$sum": "$cgst"},
+                    "sgst": {"$sum": "$sgst"}, "igst": {"$sum": "$igst"}, "invoice_count": {"$sum": 1}}}
+    ]).to_list(1)
+    purchase_rows = await db.purchase_orders.aggregate([
+        {"$match": {"created_at": {"$gte": start, "$lte": end + "T23:59:59"}, "status": "received"}},
+        {"$group": {"_id": None, "input_gst": {"$sum": "$gst"}, "purchase_count": {"$sum": 1}}}
+    ]).to_list(1)
+    totals = {**(invoice_rows[0] if invoice_rows else {}), **(purchase_rows[0] if purchase_rows else {})}
+    totals.pop("_id", None)
+    return totals
+
+
+async def gst_totals(db, start: str, end: str) -> dict:
+    """Output GST (sales invoices) and input GST (received POs) for a date range"""
+    segments, gaps = await plan_range(db, start, end, {"gst": 1})
+    parts = [s.get("gst", {}) for s in segments]
+    for gap_start, gap_end in gaps:
+        parts.append(await _live_gst(db, gap_start, gap_end))
+    totals = merge_figures(parts)
+    return {key: totals.get(key, 0) for key in
+            ("taxable", "cgst", "sgst", "igst", "input_gst", "invoice_count", "purchase_count")}
+
+
+async def cash_totals_by_month(db, start: str, end: str) -> Dict[str, dict]:
+    """Cash in/out and transaction count per YYYY-MM"""
+    segments, gaps = await plan_range(db, start, end, {"cash": 1})
+    months = {}
+    for segment in segments:
+        months[segment["start"][:7]] = merge_figures([months.get(segment["start"][:7], {}), segment.get("cash", {})])
+    if gaps:
+        rows = await db.cash_transactions.aggregate([
+            {"$match": gap_match("date", gaps)},
+            {"$group": {"_id": {"month": {"$substrBytes": ["$date", 0, 7]}, "direction": "$direction"},
+                        "total": {"$sum": "$amount"}, "count": {"$sum": 1}}}
+        ]).to_list(None)
+        for row in rows:
+            side = "cash_in" if row["_id"]["direction"] == "in" else "cash_out"
+            months[row["_id"]["month"]] = merge_figures([months.get(row["_id"]["month"], {}),
+                                                         {side: row["total"], "count": row["count"]}])
+    return months
+
+
+# ================== CLOSING ==================
+
+async def _freeze_segment(db, close_id: str, start: str, end: str) -> int:
+    """Compute and store one month's aggregates as 'closing'; returns party rows written"""
+    from utils.pnl_engine import compute_pnl_figures
+
+    segment_id = str(uuid.uuid4())
+    gl_rows = await db.gl_entries.aggregate([
+        {"$match": {"transaction_date": {"$gte": start, "$lte": end}}},
+        {"$group": {"_id": {"code": "$account_code", "type": "$entry_type"}, "total": {"$sum": "$amount"}}}
+    ]).to_list(None)
+    gl = {}
+    for row in gl_rows:
+        gl.setdefault(row["_id"]["code"], {})["debit" if row["_id"]["type"] == "debit" else "credit"] = row["total"]
+
+    cash_rows = await db.cash_transactions.aggregate([
+        {"$match": {"date": {"$gte": start, "$lte": end}}},
+        {"$group": {"_id": "$direction", "total": {"$sum": "$amount"}, "count": {"$sum": 1}}}
+    ]).to_list(None)
+    cash = {"cash_in": 0, "cash_out": 0, "count": 0}
+    for row in cash_rows:
+        cash["cash_in" if row["_id"] == "in" else "cash_out"] += row["total"]
+        cash["count"] += row["count"]
+
+    pnl = await compute_pnl_figures(db, start, end)
+    pnl.pop("period", None)
+    pnl.pop("computed_at", None)
+
+    await db.period_aggregates.insert_one({
+        "id": segment_id,
+        "close_id": close_id,
+        "status": "closing",
+        "start": start,
+        "end": end,
+        "gl": gl,
+        "gst": await _live_gst(db, start, end),
+        "cash": cash,
+        "pnl": pnl
+    })
+
+    party_rows = await db.party_ledger.aggregate([
+        {"$match": {"transaction_date": {"$gte": start, "$lte": end}}},
+        {"$group": {
+            "_id": {"party_type": "$party_type", "party_id": "$party_id",
+                    "date": {"$substrBytes": ["$transaction_date", 0, 10]}, "effect": "$effect"},
+            "party_name": {"$first": "$party_name"},
+            "total": {"$sum": "$total_amount"}
+        }}
+    ], allowDiskUse=True).to_list(None)
+    parties = {}
+    for row in party_rows:
+        key = (row["_id"]["party_type"], row["_id"]["party_id"])
+        doc = parties.setdefault(key, {
+            "close_id": close_id, "segment_id": segment_id, "status": "closing", "start": start, "end": end,
+            "party_type": key[0], "party_id": key[1], "party_name": row["party_name"],
+            "debit": 0, "credit": 0, "debit_by_date": {}, "credit_by_date": {}, "last_transaction": None
+        })
+        effect = "debit" if row["_id"]["effect"] == "debit" else "credit"
+        doc[effect] += row["total"]
+        doc[f"{effect}_by_date"][row["_id"]["date"]] = row["total"]
+        doc["last_transaction"] = max(filter(None, [doc["last_transaction"], row["_id"]["date"]]))
+    if parties:
+        await db.period_party_balances.insert_many(list(parties.values()))
+    return len(parties)
+
+
+async def close_period(db, lock_id: str, closed_by: str = "system") -> dict:
+    """Freeze an active, ended period lock. Safe to call repeatedly - only one close runs."""
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    close_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
+    lock = await db.period_locks.find_one_and_update(
+        {"id": lock_id, "is_active": True, "period_end": {"$lt": today},
+         "close_status": {"$nin": ["closing", "closed"]}},
+        {"$set": {"close_status": "closing", "close_id": close_id, "close_started_at": now}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not lock:
+        return {"lock_id": lock_id, "status": "skipped"}
+
+    try:
+        segments = month_segments(lock["period_start"], lock["period_end"])
+        party_rows = 0
+        for start, end in segments:
+            party_rows += await _freeze_segment(db, close_id, start, end)
+
+        await db.period_closes.insert_one({
+            "id": close_id,
+            "lock_id": lock_id,
+            "period_start": lock["period_start"],
+            "period_end": lock["period_end"],
+            "status": "closed",
+            "segments": len(segments),
+            "party_rows": party_rows,
+            "closed_by": closed_by,
+            "closed_at": datetime.now(timezone.utc).isoformat()
+        })
+        # Publish: readers only see "closed" rows
+        for collection in (db.period_aggregates, db.period_party_balances):
+            await collection.update_many({"close_id": close_id, "status": "closing"}, {"$set": {"status": "closed"}})
+        await db.period_locks.update_one(
+            {"id": lock_id, "close_id": close_id},
+            {"$set": {"close_status": "closed", "closed_at": datetime.now(timezone.utc).isoformat()}}
+        )
+    except Exception:
+        await _discard(db, close_id)
+        await db.period_locks.update_one({"id": lock_id, "close_id": close_id},
+                                         {"$set": {"close_status": "failed"}})
+        raise
+
+    logger.info(f"Period {lock['period_start']}..{lock['period_end']} closed ({len(segments)} months)")
+    return {"lock_id": lock_id, "close_id": close_id, "status": "closed",
+            "segments": len(segments), "party_rows": party_rows}
+
+
+async def _discard(db, close_id: str):
+    for collection in (db.period_aggregates, db.period_party_balances):
+        await collection.delete_many({"close_id": close_id, "status": "closing"})
+
+
+async def reopen_period(db, lock_id: str, reason: str) -> bool:
+    """Stop serving a lock's frozen aggregates (kept as 'reopened' for audit)"""
+    lock = await db.period_locks.find_one_and_update(
+        {"id": lock_id, "close_status": "closed"},
+        {"$set": {"close_status": "reopened", "reopened_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    if not lock:
+        return False
+    close_id = lock.get("close_id")
+    for collection in (db.period_aggregates, db.period_party_balances):
+        await collection.update_many({"close_id": close_id}, {"$set": {"status": "reopened"}})
+    await db.period_closes.update_one(
+        {"id": close_id},
+        {"$set": {"status": "reopened", "reopen_reason": reason,
+                  "reopened_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    return True
+
+
+async def reopen_periods_containing(db, date_str: str, reason: str) -> List[str]:
+    """Called when an entry is posted into a date that may already be frozen"""
+    locks = await db.period_locks.find(
+        {"close_status": "closed", "period_start": {"$lte": date_str[:10]}, "period_end": {"$gte": date_str[:10]}},
+        {"_id": 0, "id": 1}
+    ).to_list(None)
+    reopened = [lock["id"] for lock in locks if await reopen_period(db, lock["id"], reason)]
+    if reopened:
+        logger.warning(f"Reopened frozen periods {reopened}: {reason}")
+    return reopened
+
+
+async def close_pending_periods(db) -> dict:
+    """Nightly: close active locks whose period has ended and retry failed / stuck closes"""
+    stuck_before = (datetime.now(timezone.utc) - STALE_CLOSE_AFTER).isoformat()
+    stuck = await db.period_locks.find(
+        {"close_status": "closing", "close_started_at": {"$lt": stuck_before}}, {"_id": 0, "id": 1, "close_id": 1}
+    ).to_list(None)
+    for lock in stuck:
+        await _discard(db, lock["close_id"])
+        await db.period_locks.update_one({"id": lock["id"], "close_id": lock["close_id"]},
+                                         {"$set": {"close_status": "failed"}})
+
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    pending = await db.period_locks.find(
+        {"is_active": True, "period_end": {"$lt": today}, "close_status": {"$nin": ["closing", "closed"]}},
+        {"_id": 0, "id": 1}
+    ).to_list(None)
+    results = [await close_period(db, lock["id"]) for lock in pending]
+    return {"closed": sum(1 for r in results if r["status"] == "closed"), "reset_stuck": len(stuck)}
+
+
+async def ensure_period_close_indexes(db):
+    await db.period_aggregates.create_index([("status", 1), ("start", 1), ("end", 1)])
+    await db.period_aggregates.create_index("close_id")
+    await db.period_party_balances.create_index([("segment_id", 1), ("party_type", 1)])
+    await db.period_party_balances.create_index("close_id")
+    await db.period_closes.create_index("id", unique=True)
+    await db.period_locks.create_index([("close_status", 1), ("period_start", 1), ("period_end", 1)])
@@ -0,0 +1,293 @@
+"""
+P&L Engine - One profit & loss computation shared by every P&L report
+- Per period: revenue, collections, transport, GST, purchases, salaries, breakage and
+  expenses, each collection summed by one aggregation ($facet where a collection
+  feeds several figures), all collections queried concurrently
+- Views shape the same figures for the cash P&L / emailed reports, the accounts
+  statement (and its Excel/PDF export) and the monthly transport P&L
+- Months frozen by a period close (utils.period_close) are read from their stored
+  figures; only the rest of the range is aggregated live
+- Closed periods (ending before today) are memoised: in-process LRU in front of
+  pnl_snapshots in Mongo; snapshots expire after a day so late edits settle in
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+import asyncio
+
+from utils.cache import LRUCache
+from utils.period_close import plan_range, merge_figures
+
+ENGINE_VERSION = 1  # Bump when a figure's definition changes - old snapshots stop matching
+SNAPSHOT_TTL = timedelta(days=1)
+REVENUE_STATUSES = ["completed", "partial"]
+SALARY_STATUSES = ["approved", "paid"]
+
+_memory_cache = LRUCache(maxsize=256, ttl=3600)
+
+
+def _first(result: list) -> dict:
+    return result[0] if result else {}
+
+
+def _range(start_date: str, end_date: str) -> dict:
+    """Timestamp range for ISO datetime fields, inclusive of the whole end day"""
+    return {"$gte": start_date, "$lte": end_date + "T23:59:59"}
+
+
+async def _order_figures(db, start_date: str, end_date: str) -> dict:
+    """Sales, transport and collections of the period's orders in one round-trip"""
+    result = await db.orders.aggregate([
+        {"$match": {"created_at": _range(start_date, end_date)}},
+        {"$facet": {
+            "revenue": [
+                {"$match": {"payment_status": {"$in": REVENUE_STATUSES}}},
+                {"$group": {
+                    "_id": None,
+                    "product_sales": {"$sum": {"$ifNull": ["$total_price", 0]}},
+                    "transport": {"$sum": {"$ifNull": ["$transport_charge", 0]}},
+                    "online_collection": {"$sum": {"$cond": [
+                        {"$eq": ["$advance_payment_status", "paid"]}, {"$ifNull": ["$advance_amount", 0]}, 0]}},
+                    "cash_collection": {"$sum": {"$cond": [
+                        {"$eq": ["$remaining_payment_status", "cash_received"]}, {"$ifNull": ["$remaining_amount", 0]}, 0]}},
+                    "count": {"$sum": 1},
+                    "with_transport": {"$sum": {"$cond": [{"$gt": ["$transport_charge", 0]}, 1, 0]}}
+                }}
+            ],
+            "all": [{"$count": "count"}]
+        }}
+    ]).to_list(1)
+    facets = _first(result)
+    revenue = _first(facets.get("revenue"))
+    revenue.pop("_id", None)
+    return {
+        "product_sales": revenue.get("product_sales", 0),
+        "transport": revenue.get("transport", 0),
+        "online_collection": revenue.get("online_collection", 0),
+        "cash_collection": revenue.get("cash_collection", 0),
+        "count": revenue.get("count", 0),
+        "with_transport": revenue.get("with_transport", 0),
+        "total_count": _first(facets.get("all")).get("count", 0)
+    }
+
+
+async def _sum(collection, match: dict, fields: dict) -> dict:
+    """Single $group of several summed fields plus a document count"""
+    result = await collection.aggregate([
+        {"$match": match},
+        {"$group": {"_id": None, "count": {"$sum": 1},
+                    **{name: {"$sum": {"$ifNull": [expr, 0]}} for name, expr in fields.items()}}}
+    ]).to_list(1)
+    row = _first(result)
+    return {"count": row.get("count", 0), **{name: row.get(name, 0) for name in fields}}
+
+
+async def _by_key(collection, match: dict, key: str, default: str) -> dict:
+    rows = await collection.aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"$ifNull": [f"${key}", default]}, "total": {"$sum": {"$ifNull": ["$amount", 0]}}}}
+    ]).to_list(None)
+    return {row["_id"]: row["total"] for row in rows}
+
+
+async def compute_pnl_figures(db, start_date: str, end_date: str) -> dict:
+    """Raw P&L figures for [start_date, end_date] (YYYY-MM-DD), uncached"""
+    (orders, invoices, job_work, purchases, breakage, salaries, cash_expenses, other_expenses) = await asyncio.gather(
+        _order_figures(db, start_date, end_date),
+        _sum(db.invoices, {"created_at": _range(start_date, end_date)},
+             {"subtotal": "$subtotal", "gst": "$total_tax"}),
+        _sum(db.job_work_orders, {"payment_status": "completed", "paid_at": _range(start_date, end_date)},
+             {"labour": "$summary.labour_charges", "gst": "$summary.gst_amount", "collected": "$paid_amount"}),
+        _sum(db.purchase_orders, {"status": "received", "received_at": _range(start_date, end_date)},
+             {"subtotal": "$subtotal", "gst": "$gst"}),
+        _sum(db.breakage_entries, {"created_at": _range(start_date, end_date)},
+             {"total": "$total_cost"}),
+        _sum(db.salary_payments, {"created_at": _range(start_date, end_date), "status": {"$in": SALARY_STATUSES}},
+             {"total": {"$ifNull": ["$net_salary", "$amount"]}}),
+        _by_key(db.cash_transactions, {"direction": "out", "date": {"$gte": start_date, "$lte": end_date}},
+                "transaction_type", "other"),
+        _by_key(db.expenses, {"date": {"$gte": start_date, "$lte": end_date}}, "category", "other")
+    )
+    expenses_by_category = dict(cash_expenses)
+    for category, amount in other_expenses.items():
+        expenses_by_category[category] = expenses_by_category.get(category, 0) + amount
+    return {
+        "period": {"start": start_date, "end": end_date},
+        "orders": orders,
+        "invoices": invoices,
+        "job_work": job_work,
+        "purchases": purchases,
+        "breakage": breakage,
+        "salaries": salaries,
+        "expenses": {
+            "by_category": expenses_by_category,
+            "total": sum(expenses_by_category.values())
+        },
+        "computed_at": datetime.now(timezone.utc).isoformat()
+    }
+
+
+async def assemble_pnl_figures(db, start_date: str, end_date: str) -> dict:
+    """Frozen month figures plus live figures for the open gaps of the range"""
+    segments, gaps = await plan_range(db, start_date, end_date, {"pnl": 1})
+    if not segments:
+        return await compute_pnl_figures(db, start_date, end_date)
+    live = await asyncio.gather(*(compute_pnl_figures(db, s, e) for s, e in gaps))
+    figures = merge_figures([segment["pnl"] for segment in segments] + list(live))
+    figures["period"] = {"start": start_date, "end": end_date}
+    figures["computed_at"] = datetime.now(timezone.utc).isoformat()
+    return figures
+
+
+def is_closed_period(end_date: str) -> bool:
+    return end_date < datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+async def get_pnl_figures(db, start_date: str, end_date: str, refresh: bool = False) -> dict:
+    """P&L figures for a period - memoised once the period has closed"""
+    if not is_closed_period(end_date):
+        return await assemble_pnl_figures(db, start_date, end_date)
+
+    key = f"v{ENGINE_VERSION}:{start_date}:{end_date}"
+    if not refresh:
+        figures = _memory_cache.get(key)
+        if figures is not None:
+            return figures
+        snapshot = await db.pnl_snapshots.find_one({"key": key}, {"_id": 0, "figures": 1})
+        if snapshot:
+            _memory_cache.set(key, snapshot["figures"])
+            return snapshot["figures"]
+
+    figures = await assemble_pnl_figures(db, start_date, end_date)
+    await db.pnl_snapshots.update_one(
+        {"key": key},
+        {"$set": {"figures": figures, "expires_at": datetime.now(timezone.utc) + SNAPSHOT_TTL}},
+        upsert=True
+    )
+    _memory_cache.set(key, figures)
+    return figures
+
+
+def _margin(profit: float, revenue: float) -> float:
+    return round(profit / max(revenue, 1) * 100, 2)
+
+
+def cash_pnl_report(figures: dict, cash_balance: Optional[float] = None, report_type: Optional[str] = None) -> dict:
+    """Shape used by /cash/pnl and the daily / weekly / monthly email and WhatsApp reports"""
+    orders, expenses = figures["orders"], figures["expenses"]
+    total_revenue = orders["product_sales"] + orders["transport"]
+    gross_profit = total_revenue - expenses["total"]
+    report = {
+        "period": dict(figures["period"]),
+        "revenue": {
+            "product_sales": round(orders["product_sales"], 2),
+            "transport_charges": round(orders["transport"], 2),
+            "total_revenue": round(total_revenue, 2)
+        },
+        "collections": {
+            "online": round(orders["online_collection"], 2),
+            "cash": round(orders["cash_collection"], 2),
+            "total": round(orders["online_collection"] + orders["cash_collection"], 2)
+        },
+        "expenses": {
+            "by_category": {k: round(v, 2) for k, v in sorted(expenses["by_category"].items(), key=lambda x: x[1], reverse=True)},
+            "total": round(expenses["total"], 2)
+        },
+        "profit_loss": {
+            "gross_profit": round(gross_profit, 2),
+            "profit_margin": _margin(gross_profit, total_revenue),
+            "status": "profit" if gross_profit >= 0 else "loss"
+        },
+        "orders_count": orders["count"],
+        "total_orders": orders["total_count"]
+    }
+    if cash_balance is not None:
+        report["cash_balance"] = cash_balance
+    if report_type:
+        report["report_type"] = report_type
+    return report
+
+
+def transport_pnl_report(figures: dict, month: str) -> dict:
+    """Shape used by /reports/pnl-with-transport"""
+    report = cash_pnl_report(figures)
+    return {
+        "month": month,
+        "revenue": report["revenue"],
+        "expenses": {
+            "by_category": report["expenses"]["by_category"],
+            "total_expenses": report["expenses"]["total"]
+        },
+        "profit_loss": {k: report["profit_loss"][k] for k in ("gross_profit", "profit_margin")},
+        "order_summary": {
+            "total_orders": figures["orders"]["count"],
+            "orders_with_transport": figures["orders"]["with_transport"]
+        }
+    }
+
+
+def profit_loss_statement(figures: dict, opening_stock: float, closing_stock: float) -> dict:
+    """Accrual statement used by /accounts/profit-loss and its Excel / PDF export"""
+    invoices, job_work, purchases = figures["invoices"], figures["job_work"], figures["purchases"]
+    breakage, salaries = figures["breakage"]["total"], figures["salaries"]["total"]
+
+    combined_revenue = invoices["subtotal"] + job_work["labour"]
+    gst_collected = invoices["gst"] + job_work["gst"]
+    gross_profit = combined_revenue - purchases["subtotal"]
+    operating_expenses = breakage + salaries
+    net_profit = gross_profit - operating_expenses
+    return {
+        "period": {"start_date": figures["period"]["start"], "end_date": figures["period"]["end"]},
+        "revenue": {
+            "sales": round(invoices["subtotal"], 2),
+            "job_work": round(job_work["labour"], 2),
+            "total_sales": round(combined_revenue, 2),
+            "invoice_count": invoices["count"],
+            "job_work_count": job_work["count"],
+            "gst_collected": round(gst_collected, 2)
+        },
+        "job_work_details": {
+            "orders": job_work["count"],
+            "labour_revenue": round(job_work["labour"], 2),
+            "gst_collected": round(job_work["gst"], 2),
+            "total_collected": round(job_work["collected"], 2)
+        },
+        "cost_of_goods": {
+            "total_purchases": round(purchases["subtotal"], 2),
+            "po_count": purchases["count"],
+            "gst_paid": round(purchases["gst"], 2)
+        },
+        "inventory": {
+            "opening_stock": round(opening_stock, 2),
+            "closing_stock": round(closing_stock, 2),
+            "material_consumed": round(opening_stock + purchases["subtotal"] - closing_stock, 2)
+        },
+        "gross_profit": round(gross_profit, 2),
+        "operating_expenses": {
+            "breakage_loss": round(breakage, 2),
+            "salaries": round(salaries, 2),
+            "total": round(operating_expenses, 2)
+        },
+        "transport": {
+            "charges": round(figures["orders"]["transport"], 2),
+            "orders_with_transport": figures["orders"]["with_transport"]
+        },
+        "net_profit": round(net_profit, 2),
+        "profit_margin": round((net_profit / combined_revenue * 100) if combined_revenue > 0 else 0, 2),
+        "gst_summary": {
+            "collected": round(gst_collected, 2),
+            "paid": round(purchases["gst"], 2),
+            "net_liability": round(gst_collected - purchases["gst"], 2)
+        }
+    }
+
+
+def month_range(month: str) -> tuple:
+    """'YYYY-MM' -> (first day, last day)"""
+    first = datetime.strptime(month + "-01", "%Y-%m-%d")
+    last = (first.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    return first.strftime("%Y-%m-%d"), last.strftime("%Y-%m-%d")
+
+
+async def ensure_pnl_indexes(db):
+    await db.pnl_snapshots.create_index("key", unique=True)
+    await db.pnl_snapshots.create_index("expires_at", expireAfterSeconds=0)
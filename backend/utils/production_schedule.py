@@ -0,0 +1,384 @@
+"""
+Production Schedule - Finite-capacity plan for job cards across the shop-floor stages
+- Each stage has a throughput (sqft/hour) and a machine count; work only runs inside
+  shift hours, skipping weekly offs and holidays from the holiday calendar
+- Job cards are planned in order (work in progress first, then priority, then oldest):
+  each remaining stage starts once the previous stage is done and a machine is free
+- Machine state is checkpointed before every job, so a stage update or breakage entry
+  re-plans only that job and the ones queued behind it
+- expected_completion is written back to production_orders for jobs whose estimate moved
+"""
+from bisect import bisect_left
+from datetime import datetime, date, time, timedelta, timezone
+from typing import Dict, List, Optional
+import asyncio
+import logging
+import os
+
+from pymongo import ReturnDocument, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+IST = timezone(timedelta(hours=5, minutes=30))
+
+STAGE_FLOW = ["cutting", "polishing", "grinding", "toughening", "quality_check", "packing"]
+CLOSED_STAGES = ("dispatched", "completed", "cancelled")
+
+DEFAULT_CAPACITY = {
+    "shift_start": "09:00",
+    "hours_per_shift": 8,
+    "shifts_per_day": 1,
+    "stages": {
+        "cutting": {"sqft_per_hour": 400, "machines": 2},
+        "polishing": {"sqft_per_hour": 200, "machines": 2},
+        "grinding": {"sqft_per_hour": 250, "machines": 1},
+        "toughening": {"sqft_per_hour": 300, "machines": 1},
+        "quality_check": {"sqft_per_hour": 600, "machines": 1},
+        "packing": {"sqft_per_hour": 500, "machines": 1}
+    }
+}
+
+SQFT_PER_SQMM = 1 / 92903.04
+CALENDAR_LOOKAHEAD_DAYS = 730
+SCHEDULE_MAX_AGE = int(os.environ.get("PRODUCTION_SCHEDULE_MAX_AGE", "900"))  # seconds before a full re-plan
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+def _parse_time(value: str) -> time:
+    hour, minute = (value or "09:00").split(":")[:2]
+    return time(int(hour), int(minute))
+
+
+class WorkCalendar:
+    """Shift windows per day (IST) with weekly offs, half-day offs and holidays removed"""
+
+    def __init__(self, shift_start: str = "09:00", hours_per_day: float = 8, weekly_offs=None,
+                 half_day_offs=None, holidays=None):
+        self.shift_start = _parse_time(shift_start)
+        self.hours_per_day = min(max(float(hours_per_day), 0.5), 24)
+        offs = {d.lower() for d in (weekly_offs or [])}
+        self.weekly_offs = offs if len(offs) < 7 else set()  # A calendar with no working day is a misconfiguration
+        self.half_day_offs = {d.lower() for d in (half_day_offs or [])}
+        self.holidays = set(holidays or [])
+
+    def window(self, day: date):
+        """(open, close) for a day, or None when the plant is closed"""
+        weekday = WEEKDAYS[day.weekday()]
+        if weekday in self.weekly_offs or day.isoformat() in self.holidays:
+            return None
+        hours = self.hours_per_day / 2 if weekday in self.half_day_offs else self.hours_per_day
+        opens = datetime.combine(day, self.shift_start, IST)
+        return opens, opens + timedelta(hours=hours)
+
+    def _windows_from(self, moment: datetime):
+        # Start a day early - a night shift can run past midnight into `moment`'s date
+        day = moment.astimezone(IST).date() - timedelta(days=1)
+        for offset in range(CALENDAR_LOOKAHEAD_DAYS):
+            window = self.window(day + timedelta(days=offset))
+            if window and window[1] > moment:
+                yield window
+
+    def add_working_hours(self, start: datetime, hours: float) -> datetime:
+        """Moment when `hours` of shift time starting at `start` have elapsed"""
+        remaining = max(hours, 0)
+        for opens, closes in self._windows_from(start):
+            begin = max(start, opens)
+            available = (closes - begin).total_seconds() / 3600
+            if remaining <= available:
+                return begin + timedelta(hours=remaining)
+            remaining -= available
+        return start + timedelta(days=CALENDAR_LOOKAHEAD_DAYS)
+
+    def working_hours_between(self, start: datetime, end: datetime) -> float:
+        total = 0.0
+        for opens, closes in self._windows_from(start):
+            if opens >= end:
+                break
+            total += (min(closes, end) - max(opens, start)).total_seconds() / 3600
+        return total
+
+
+def job_sqft(order: dict) -> float:
+    """Area still to be processed: pieces minus breakage, width x height in mm"""
+    pieces = max((order.get("quantity") or 0) - (order.get("quantity_broken") or 0), 0)
+    return (order.get("width") or 0) * (order.get("height") or 0) * SQFT_PER_SQMM * pieces
+
+
+def remaining_stages(order: dict) -> List[str]:
+    stage = order.get("current_stage")
+    if stage in CLOSED_STAGES:
+        return []
+    if stage in STAGE_FLOW:
+        return STAGE_FLOW[STAGE_FLOW.index(stage):]
+    return list(STAGE_FLOW)
+
+
+def _is_open(order: dict) -> bool:
+    return bool(remaining_stages(order)) and job_sqft(order) > 0
+
+
+def _sort_key(order: dict) -> tuple:
+    in_progress = order.get("current_stage") in STAGE_FLOW
+    return (not in_progress, -(order.get("priority") or 0), order.get("created_at") or "", order["id"])
+
+
+def _parse_moment(value: str) -> datetime:
+    moment = datetime.fromisoformat(value)
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def _iso(moment: datetime) -> str:
+    return moment.astimezone(timezone.utc).replace(second=0, microsecond=0).isoformat()
+
+
+class ProductionPlanner:
+    """List scheduler over open job cards with per-job machine-state checkpoints"""
+
+    def __init__(self, capacity: dict, calendar: WorkCalendar, now: Optional[datetime] = None):
+        self.capacity = capacity
+        self.calendar = calendar
+        self.now = now or datetime.now(timezone.utc)
+        self.jobs: List[dict] = []
+        self.keys: List[tuple] = []
+        self.plans: Dict[str, dict] = {}
+        self._checkpoints: List[dict] = []
+
+    def stage_capacity(self, stage: str) -> dict:
+        config = self.capacity.get("stages", {}).get(stage) or DEFAULT_CAPACITY["stages"][stage]
+        return {
+            "sqft_per_hour": max(float(config.get("sqft_per_hour") or 1), 1.0),
+            "machines": max(int(config.get("machines") or 1), 1)
+        }
+
+    def _empty_machines(self) -> dict:
+        return {stage: [self.now] * self.stage_capacity(stage)["machines"] for stage in STAGE_FLOW}
+
+    def _plan_job(self, order: dict, machines: dict) -> dict:
+        sqft = job_sqft(order)
+        stages = remaining_stages(order)
+        ready = self.now
+        slots = []
+        for stage in stages:
+            hours = sqft / self.stage_capacity(stage)["sqft_per_hour"]
+            if stage == order.get("current_stage"):
+                started = (order.get("stage_timestamps") or {}).get(stage)
+                if started:
+                    # Already on the machine - only the unfinished part is left
+                    elapsed = self.calendar.working_hours_between(_parse_moment(started), self.now)
+                    hours = max(hours - elapsed, 0)
+            free = machines[stage]
+            machine = min(range(len(free)), key=free.__getitem__)
+            start = self.calendar.add_working_hours(max(ready, free[machine]), 0)
+            end = self.calendar.add_working_hours(start, hours)
+            free[machine] = end
+            ready = end
+            slots.append({
+                "stage": stage,
+                "machine": machine + 1,
+                "start": _iso(start),
+                "end": _iso(end),
+                "hours": round(hours, 2)
+            })
+        return {
+            "order_id": order["id"],
+            "job_card_number": order.get("job_card_number"),
+            "priority": order.get("priority"),
+            "current_stage": order.get("current_stage"),
+            "sqft": round(sqft, 2),
+            "stages": slots,
+            "expected_completion": slots[-1]["end"] if slots else None
+        }
+
+    def plan_from(self, index: int) -> List[str]:
+        """Re-plan jobs[index:] from the checkpoint before index; returns ids whose estimate moved"""
+        if index == 0 or not self._checkpoints:
+            machines = self._empty_machines()
+        else:
+            machines = {stage: list(free) for stage, free in self._checkpoints[index].items()}
+        del self._checkpoints[index:]
+
+        changed = []
+        for order in self.jobs[index:]:
+            self._checkpoints.append({stage: list(free) for stage, free in machines.items()})
+            plan = self._plan_job(order, machines)
+            self.plans[order["id"]] = plan
+            if plan["expected_completion"] != order.get("expected_completion"):
+                order["expected_completion"] = plan["expected_completion"]
+                changed.append(order["id"])
+        # Final state, so a job appended at the end re-plans from here
+        self._checkpoints.append(machines)
+        return changed
+
+    def load(self, orders: List[dict]) -> List[str]:
+        self.jobs = sorted((o for o in orders if _is_open(o)), key=_sort_key)
+        self.keys = [_sort_key(o) for o in self.jobs]
+        self.plans = {}
+        return self.plan_from(0)
+
+    def _position(self, order_id: str) -> Optional[int]:
+        for index, job in enumerate(self.jobs):
+            if job["id"] == order_id:
+                return index
+        return None
+
+    def update(self, order_id: str, order: Optional[dict]) -> List[str]:
+        """Apply one job card's new state (None = deleted) and re-plan the affected suffix"""
+        start = len(self.jobs)
+        old = self._position(order_id)
+        if old is not None:
+            del self.jobs[old]
+            del self.keys[old]
+            self.plans.pop(order_id, None)
+            start = old
+        if order is not None and _is_open(order):
+            key = _sort_key(order)
+            new = bisect_left(self.keys, key)
+            self.jobs.insert(new, order)
+            self.keys.insert(new, key)
+            start = min(start, new)
+        return self.plan_from(start)
+
+    def gantt(self, stage: Optional[str] = None) -> dict:
+        stages = []
+        for name in ([stage] if stage else STAGE_FLOW):
+            queue = []
+            for job in self.jobs:
+                for slot in self.plans[job["id"]]["stages"]:
+                    if slot["stage"] == name:
+                        queue.append({
+                            "order_id": job["id"],
+                            "job_card_number": job.get("job_card_number"),
+                            "priority": job.get("priority"),
+                            "glass_type": job.get("glass_type"),
+                            "machine": slot["machine"],
+                            "start": slot["start"],
+                            "end": slot["end"],
+                            "hours": slot["hours"]
+                        })
+            queue.sort(key=lambda row: (row["start"], row["machine"]))
+            capacity = self.stage_capacity(name)
+            stages.append({
+                "stage": name,
+                "machines": capacity["machines"],
+                "sqft_per_hour": capacity["sqft_per_hour"],
+                "queued_jobs": len(queue),
+                "load_hours": round(sum(row["hours"] for row in queue), 2),
+                "busy_until": max((row["end"] for row in queue), default=None),
+                "queue": queue
+            })
+
+        # Bottleneck = stage with the most queued work per machine
+        bottleneck = max(stages, key=lambda s: s["load_hours"] / s["machines"], default=None)
+        return {
+            "generated_at": _iso(self.now),
+            "open_jobs": len(self.jobs),
+            "bottleneck": bottleneck["stage"] if bottleneck and bottleneck["load_hours"] else None,
+            "stages": stages
+        }
+
+
+# Process-local planner; a version counter in Mongo tells workers when another one changed the floor
+_planner: Optional[ProductionPlanner] = None
+_planner_version: Optional[int] = None
+_lock = asyncio.Lock()
+
+
+async def get_capacity_settings(db) -> dict:
+    settings = await db.production_capacity.find_one({"id": "default"}, {"_id": 0})
+    if not settings:
+        return {"id": "default", **DEFAULT_CAPACITY}
+    stages = {**DEFAULT_CAPACITY["stages"], **settings.get("stages", {})}
+    return {**DEFAULT_CAPACITY, **settings, "stages": stages}
+
+
+async def load_work_calendar(db, capacity: dict) -> WorkCalendar:
+    """Shift hours from capacity settings; weekly offs and holidays from the holiday calendar"""
+    holiday_settings = await db.holiday_settings.find_one({"id": "default"}, {"_id": 0}) or {}
+    today = datetime.now(IST).date()
+    holidays = await db.holidays.find({
+        "date": {"$gte": today.isoformat(), "$lte": (today + timedelta(days=CALENDAR_LOOKAHEAD_DAYS)).isoformat()},
+        "type": {"$ne": "optional"}
+    }, {"_id": 0, "date": 1, "departments": 1}).to_list(1000)
+    return WorkCalendar(
+        shift_start=capacity.get("shift_start", "09:00"),
+        hours_per_day=float(capacity.get("hours_per_shift", 8)) * int(capacity.get("shifts_per_day", 1)),
+        weekly_offs=holiday_settings.get("weekly_offs", ["sunday"]),
+        half_day_offs=holiday_settings.get("half_day_weekly_off", []),
+        # Department-specific holidays only close the floor if they include production
+        holidays={h["date"] for h in holidays if not h.get("departments") or "production" in h["departments"]}
+    )
+
+
+async def _persist(db, planner: ProductionPlanner, order_ids: List[str]):
+    if not order_ids:
+        return
+    await db.production_orders.bulk_write([
+        UpdateOne({"id": order_id}, {"$set": {
+            "expected_completion": planner.plans[order_id]["expected_completion"],
+            "scheduled_stages": planner.plans[order_id]["stages"]
+        }})
+        for order_id in order_ids if order_id in planner.plans
+    ], ordered=False)
+
+
+async def _schedule_version(db) -> int:
+    meta = await db.production_schedule_meta.find_one({"id": "version"}, {"_id": 0, "version": 1})
+    return (meta or {}).get("version", 0)
+
+
+async def _rebuild(db, version: int) -> ProductionPlanner:
+    global _planner, _planner_version
+    capacity = await get_capacity_settings(db)
+    planner = ProductionPlanner(capacity, await load_work_calendar(db, capacity))
+    orders = await db.production_orders.find(
+        {"current_stage": {"$nin": list(CLOSED_STAGES)}}, {"_id": 0}
+    ).to_list(None)
+    changed = planner.load(orders)
+    _planner, _planner_version = planner, version
+    await _persist(db, planner, changed)
+    return planner
+
+
+async def get_schedule(db) -> ProductionPlanner:
+    """Current plan; rebuilt if stale or another worker changed the floor since"""
+    async with _lock:
+        version = await _schedule_version(db)
+        age = (datetime.now(timezone.utc) - _planner.now).total_seconds() if _planner else None
+        if _planner is None or version != _planner_version or age > SCHEDULE_MAX_AGE:
+            return await _rebuild(db, version)
+        return _planner
+
+
+async def reschedule_order(db, order_id: str):
+    """Re-plan after a job card was created, moved a stage or recorded breakage"""
+    global _planner_version
+    meta = await db.production_schedule_meta.find_one_and_update(
+        {"id": "version"}, {"$inc": {"version": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    async with _lock:
+        if _planner is None or _planner_version != meta["version"] - 1:
+            # Missed another worker's change - re-plan everything
+            await _rebuild(db, meta["version"])
+            return
+        order = await db.production_orders.find_one({"id": order_id}, {"_id": 0})
+        changed = _planner.update(order_id, order)
+        _planner_version = meta["version"]
+        await _persist(db, _planner, changed)
+
+
+async def invalidate_schedule(db):
+    """Force a full re-plan on next read (capacity or calendar changed)"""
+    await db.production_schedule_meta.update_one({"id": "version"}, {"$inc": {"version": 1}}, upsert=True)
+
+
+async def reschedule_order_safely(db, order_id: str):
+    """Background-task wrapper - a planning failure must not surface on the write path"""
+    try:
+        await reschedule_order(db, order_id)
+    except Exception as e:
+        logger.warning(f"Production re-plan failed for {order_id}: {e}")
+
+
+async def ensure_production_schedule_indexes(db):
+    await db.production_orders.create_index([("current_stage", 1), ("priority", -1)])
+    await db.production_schedule_meta.create_index("id", unique=True)
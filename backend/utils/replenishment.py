@@ -0,0 +1,284 @@
+"""
+Replenishment - Reorder points and purchase suggestions for raw materials
+- Consumption velocity: daily OUT quantities from inventory_transactions over a
+  rolling window (days without issues count as zero)
+- Lead time: approve -> receive days of the material's past POs
+- Safety stock = z x sqrt(L x sd_daily² + d² x sd_lead²); reorder point = d x L + safety stock
+- State is cached per material in replenishment_stats behind watermarks, so a refresh
+  only folds in ledger rows and PO receipts that arrived since the last one
+- A batch run groups every material at or below its reorder point into one
+  suggested purchase order per vendor
+"""
+from datetime import datetime, timedelta, timezone
+from math import ceil, sqrt
+from statistics import NormalDist
+from typing import Dict, List, Optional
+import uuid
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from utils.transactions import run_in_transaction
+
+DEFAULT_REPLENISHMENT_SETTINGS = {
+    "window_days": 90,
+    "service_level": 0.95,
+    "default_lead_time_days": 7,
+    "cover_days": 30,  # Order enough to last this long past the reorder point
+    "lead_time_samples": 20
+}
+
+OPEN_PO_STATUSES = ["draft", "pending_approval", "approved", "pending", "ordered"]
+EPOCH = "1970-01-01"
+
+
+def _days_between(start: Optional[str], end: Optional[str]) -> Optional[float]:
+    try:
+        delta = datetime.fromisoformat(end) - datetime.fromisoformat(start)
+    except (TypeError, ValueError):
+        return None
+    return max(delta.total_seconds() / 86400, 0)
+
+
+def _mean_std(values: List[float]) -> tuple:
+    if not values:
+        return 0.0, 0.0
+    mean = sum(values) / len(values)
+    return mean, sqrt(sum((v - mean) ** 2 for v in values) / len(values))
+
+
+def compute_reorder(stats: dict, material: dict, on_order: float, settings: dict, today: datetime) -> dict:
+    """Velocity, lead time, safety stock, reorder point and suggested quantity for one material"""
+    window = settings["window_days"]
+    start = (today - timedelta(days=window)).strftime("%Y-%m-%d")
+    daily = [qty for date, qty in (stats.get("daily_out") or {}).items() if date >= start]
+    daily += [0.0] * (window - len(daily))
+    demand, demand_sd = _mean_std(daily)
+
+    samples = stats.get("lead_times") or []
+    if material.get("lead_time_days"):
+        lead, lead_sd = float(material["lead_time_days"]), 0.0
+    elif samples:
+        lead, lead_sd = _mean_std(samples)
+    else:
+        lead, lead_sd = float(settings["default_lead_time_days"]), 0.0
+
+    z = NormalDist().inv_cdf(settings["service_level"])
+    safety_stock = z * sqrt(lead * demand_sd ** 2 + demand ** 2 * lead_sd ** 2)
+    reorder_point = demand * lead + safety_stock
+    # Materials with no recent issues fall back to the static minimum
+    if demand == 0:
+        reorder_point = float(material.get("minimum_stock") or 0)
+
+    position = float(material.get("current_stock") or 0) + on_order
+    order_up_to = reorder_point + demand * settings["cover_days"]
+    needs_reorder = position <= reorder_point
+    return {
+        "avg_daily_consumption": round(demand, 3),
+        "consumption_sd": round(demand_sd, 3),
+        "lead_time_days": round(lead, 1),
+        "lead_time_sd": round(lead_sd, 1),
+        "lead_time_samples": len(samples),
+        "safety_stock": round(safety_stock, 2),
+        "reorder_point": round(reorder_point, 2),
+        "on_order": round(on_order, 2),
+        "stock_position": round(position, 2),
+        "days_of_cover": round(position / demand, 1) if demand else None,
+        "needs_reorder": needs_reorder,
+        "suggested_quantity": ceil(max(order_up_to - position, 0)) if needs_reorder else 0
+    }
+
+
+async def get_replenishment_settings(db) -> dict:
+    settings = await db.replenishment_settings.find_one({"id": "default"}, {"_id": 0}) or {}
+    return {**DEFAULT_REPLENISHMENT_SETTINGS,
+            **{k: v for k, v in settings.items() if k in DEFAULT_REPLENISHMENT_SETTINGS}}
+
+
+async def _fold_new_activity(db, settings: dict):
+    """Fold ledger OUT rows and PO receipts newer than the watermarks into the per-material cache"""
+    meta = await db.replenishment_meta.find_one({"id": "default"}, {"_id": 0}) or {}
+    window_start = (datetime.now(timezone.utc) - timedelta(days=settings["window_days"])).isoformat()
+    out_mark = meta.get("consumption_watermark") or window_start
+    po_mark = meta.get("receipt_watermark") or EPOCH
+
+    consumption = await db.inventory_transactions.aggregate([
+        {"$match": {"type": "OUT", "created_at": {"$gt": out_mark}}},
+        {"$group": {
+            "_id": {"material_id": "$material_id", "date": {"$substrBytes": ["$created_at", 0, 10]}},
+            "quantity": {"$sum": "$quantity"},
+            "last": {"$max": "$created_at"}
+        }}
+    ]).to_list(None)
+
+    receipts = await db.purchase_orders.find(
+        {"received_at": {"$gt": po_mark}, "items.material_id": {"$exists": True}},
+        {"_id": 0, "items": 1, "approved_at": 1, "created_at": 1, "received_at": 1,
+         "vendor_id": 1, "vendor_name": 1, "supplier_id": 1, "supplier_name": 1}
+    ).to_list(None)
+
+    if not consumption and not receipts:
+        return
+
+    operations = []
+    for row in consumption:
+        operations.append(UpdateOne(
+            {"material_id": row["_id"]["material_id"]},
+            {"$inc": {f"daily_out.{row['_id']['date']}": row["quantity"]}},
+            upsert=True
+        ))
+    for po in receipts:
+        lead = _days_between(po.get("approved_at") or po.get("created_at"), po["received_at"])
+        for item in po.get("items", []):
+            if not item.get("material_id"):
+                continue
+            update = {"$set": {
+                "vendor_id": po.get("vendor_id") or po.get("supplier_id"),
+                "vendor_name": po.get("vendor_name") or po.get("supplier_name"),
+                "last_unit_price": item.get("unit_price")
+            }}
+            if lead is not None:
+                update["$push"] = {"lead_times": {"$each": [round(lead, 2)], "$slice": -settings["lead_time_samples"]}}
+            operations.append(UpdateOne({"material_id": item["material_id"]}, update, upsert=True))
+
+    new_meta = {
+        "consumption_watermark": max([out_mark] + [row["last"] for row in consumption]),
+        "receipt_watermark": max([po_mark] + [po["received_at"] for po in receipts])
+    }
+
+    async def apply(session):
+        # Compare-and-set on the watermarks: a concurrent refresh that got there first wins,
+        # so the same rows are never counted twice
+        claimed = await db.replenishment_meta.update_one(
+            {"id": "default", "consumption_watermark": meta.get("consumption_watermark"),
+             "receipt_watermark": meta.get("receipt_watermark")},
+            {"$set": new_meta},
+            upsert=not meta,
+            session=session
+        )
+        if claimed.matched_count == 0 and claimed.upserted_id is None:
+            return
+        await db.replenishment_stats.bulk_write(operations, ordered=False, session=session)
+
+    try:
+        await run_in_transaction(db, apply)
+    except DuplicateKeyError:
+        pass  # Concurrent first run created the watermarks - its fold covers these rows
+
+
+async def _open_po_quantities(db) -> Dict[str, float]:
+    rows = await db.purchase_orders.aggregate([
+        {"$match": {"status": {"$in": OPEN_PO_STATUSES}, "receipt_status": {"$ne": "received"}}},
+        {"$unwind": "$items"},
+        {"$match": {"items.material_id": {"$exists": True, "$ne": None}}},
+        {"$group": {"_id": "$items.material_id", "quantity": {"$sum": "$items.quantity"}}}
+    ]).to_list(None)
+    return {row["_id"]: float(row["quantity"] or 0) for row in rows}
+
+
+async def refresh_replenishment(db, material_ids: Optional[List[str]] = None) -> List[dict]:
+    """Fold in new activity, then recompute reorder figures from the cache (no full-history scan)"""
+    settings = await get_replenishment_settings(db)
+    await _fold_new_activity(db, settings)
+
+    query = {"status": "active"}
+    if material_ids:
+        query["id"] = {"$in": material_ids}
+    materials = await db.raw_materials.find(query, {"_id": 0}).to_list(None)
+    stats = {
+        doc["material_id"]: doc
+        for doc in await db.replenishment_stats.find(
+            {"material_id": {"$in": [m["id"] for m in materials]}}, {"_id": 0}
+        ).to_list(None)
+    }
+    on_order = await _open_po_quantities(db)
+
+    today = datetime.now(timezone.utc)
+    cutoff = (today - timedelta(days=settings["window_days"])).strftime("%Y-%m-%d")
+    now = today.isoformat()
+    results, operations = [], []
+    for material in materials:
+        cached = stats.get(material["id"], {})
+        figures = compute_reorder(cached, material, on_order.get(material["id"], 0.0), settings, today)
+        update = {"$set": {**figures, "computed_at": now}}
+        stale = {f"daily_out.{date}": "" for date in (cached.get("daily_out") or {}) if date < cutoff}
+        if stale:
+            update["$unset"] = stale
+        operations.append(UpdateOne({"material_id": material["id"]}, update, upsert=True))
+        results.append({
+            "material_id": material["id"],
+            "material_name": material.get("name"),
+            "unit": material.get("unit"),
+            "current_stock": material.get("current_stock", 0),
+            "minimum_stock": material.get("minimum_stock"),
+            "vendor_id": cached.get("vendor_id") or material.get("supplier_id") or None,
+            "vendor_name": cached.get("vendor_name"),
+            "unit_price": cached.get("last_unit_price") or material.get("unit_price", 0),
+            **figures
+        })
+    if operations:
+        await db.replenishment_stats.bulk_write(operations, ordered=False)
+    return results
+
+
+async def generate_purchase_suggestions(db, created_by: str = "system") -> dict:
+    """Batch run: one suggested PO per vendor covering every material at or below its reorder point"""
+    materials = await refresh_replenishment(db)
+    by_vendor = {}
+    for item in materials:
+        if item["needs_reorder"] and item["suggested_quantity"] > 0:
+            by_vendor.setdefault(item["vendor_id"], []).append(item)
+
+    vendors = {
+        v["id"]: v for v in await db.vendors.find(
+            {"id": {"$in": [v for v in by_vendor if v]}}, {"_id": 0, "id": 1, "name": 1}
+        ).to_list(None)
+    }
+    run_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
+    suggestions = []
+    for vendor_id, items in by_vendor.items():
+        lines = [{
+            "material_id": i["material_id"],
+            "material_name": i["material_name"],
+            "name": i["material_name"],
+            "unit": i["unit"],
+            "quantity": i["suggested_quantity"],
+            "unit_price": i["unit_price"],
+            "reorder_point": i["reorder_point"],
+            "stock_position": i["stock_position"],
+            "days_of_cover": i["days_of_cover"]
+        } for i in items]
+        suggestions.append({
+            "id": str(uuid.uuid4()),
+            "run_id": run_id,
+            "vendor_id": vendor_id if vendor_id in vendors else None,
+            "vendor_name": vendors[vendor_id]["name"] if vendor_id in vendors else items[0]["vendor_name"],
+            "items": lines,
+            "estimated_value": round(sum(l["quantity"] * (l["unit_price"] or 0) for l in lines), 2),
+            "status": "suggested",  # suggested, converted, dismissed
+            "created_by": created_by,
+            "created_at": now
+        })
+
+    # A new run supersedes suggestions nobody acted on
+    await db.purchase_suggestions.update_many(
+        {"status": "suggested"}, {"$set": {"status": "superseded", "superseded_by": run_id}}
+    )
+    if suggestions:
+        await db.purchase_suggestions.insert_many(suggestions)
+        for suggestion in suggestions:
+            suggestion.pop("_id", None)
+    return {
+        "run_id": run_id,
+        "suggestions": suggestions,
+        "materials_to_reorder": sum(len(s["items"]) for s in suggestions),
+        "unassigned_vendor": sum(1 for s in suggestions if not s["vendor_id"])
+    }
+
+
+async def ensure_replenishment_indexes(db):
+    await db.replenishment_stats.create_index("material_id", unique=True)
+    await db.replenishment_meta.create_index("id", unique=True)
+    await db.purchase_suggestions.create_index([("status", 1), ("created_at", -1)])
+    await db.inventory_transactions.create_index([("type", 1), ("created_at", 1)])
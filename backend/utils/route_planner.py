@@ -0,0 +1,212 @@
+"""
+Route Planner - Multi-drop delivery routes for a dispatch day
+- Clarke-Wright savings builds routes from the factory under a vehicle's load limit
+  (sqft, and kg when the vehicle has a weight limit) and a max stops per route
+- Mixed fleet: largest vehicle first, it takes the fullest savings route over the
+  stops still open, then the next vehicle re-runs savings on what is left
+- 2-opt then shortens every route until no improving swap is left or the time limit is hit
+- Works on any distance matrix (km) - see utils.distance_matrix
+"""
+from datetime import datetime, timedelta
+from typing import List, Optional
+import time
+
+KG_PER_SQFT_MM = 0.2323  # Float glass: 2.5 kg per m² per mm thickness
+
+DEFAULT_ROUTE_SETTINGS = {
+    "max_stops": 15,
+    "avg_speed_kmph": 30,
+    "service_minutes": 20,  # Unloading + customer sign-off per drop
+    "time_limit_ms": 2000,
+    "departure_time": "09:30"
+}
+
+
+def route_length(route: List[int], matrix: List[List[float]]) -> float:
+    """Depot -> stops -> depot"""
+    if not route:
+        return 0.0
+    total = matrix[0][route[0]] + matrix[route[-1]][0]
+    for a, b in zip(route, route[1:]):
+        total += matrix[a][b]
+    return total
+
+
+def clarke_wright(matrix: List[List[float]], loads: List[dict], capacity: dict, max_stops: int) -> List[List[int]]:
+    """
+    Savings heuristic. Node 0 is the depot; loads[i] = {"sqft", "kg"} for node i.
+    capacity = {"sqft", "kg"} (kg None = unlimited). Returns routes as node lists.
+    """
+    size = len(matrix)
+    routes = {i: [i] for i in range(1, size)}
+    route_of = {i: i for i in range(1, size)}
+    load = {i: dict(loads[i]) for i in range(1, size)}
+
+    savings = sorted(
+        ((matrix[0][i] + matrix[0][j] - matrix[i][j], i, j) for i in range(1, size) for j in range(i + 1, size)),
+        reverse=True
+    )
+    for saving, i, j in savings:
+        if saving <= 0:
+            break
+        a, b = route_of[i], route_of[j]
+        if a == b:
+            continue
+        ra, rb = routes[a], routes[b]
+        if len(ra) + len(rb) > max_stops:
+            continue
+        sqft = load[a]["sqft"] + load[b]["sqft"]
+        kg = load[a]["kg"] + load[b]["kg"]
+        if sqft > capacity["sqft"] or (capacity.get("kg") is not None and kg > capacity["kg"]):
+            continue
+
+        # Join only at route ends; distances are symmetric so a route may be reversed
+        if ra[-1] == i and rb[0] == j:
+            merged = ra + rb
+        elif ra[0] == i and rb[-1] == j:
+            merged = rb + ra
+        elif ra[-1] == i and rb[-1] == j:
+            merged = ra + rb[::-1]
+        elif ra[0] == i and rb[0] == j:
+            merged = ra[::-1] + rb
+        else:
+            continue
+
+        routes[a] = merged
+        load[a] = {"sqft": sqft, "kg": kg}
+        del routes[b], load[b]
+        for node in rb:
+            route_of[node] = a
+
+    return list(routes.values())
+
+
+def two_opt(route: List[int], matrix: List[List[float]], deadline: float) -> List[int]:
+    """Reverse segments while that shortens the tour (depot fixed at both ends)"""
+    tour = [0] + route + [0]
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(1, len(tour) - 2):
+            for j in range(i + 1, len(tour) - 1):
+                delta = (matrix[tour[i - 1]][tour[j]] + matrix[tour[i]][tour[j + 1]]
+                         - matrix[tour[i - 1]][tour[i]] - matrix[tour[j]][tour[j + 1]])
+                if delta < -1e-9:
+                    tour[i:j + 1] = reversed(tour[i:j + 1])
+                    improved = True
+            if time.monotonic() >= deadline:
+                break
+    return tour[1:-1]
+
+
+def _fits(load: dict, vehicle: dict) -> bool:
+    if load["sqft"] > (vehicle.get("capacity_sqft") or 0):
+        return False
+    return not vehicle.get("capacity_kg") or load["kg"] <= vehicle["capacity_kg"]
+
+
+def plan_routes(depot: dict, stops: List[dict], vehicles: List[dict], matrix: List[List[float]],
+                settings: Optional[dict] = None) -> dict:
+    """
+    depot = {"lat", "lng", "name"}; stops carry "sqft", "kg" and display fields;
+    matrix is (len(stops) + 1)² with the depot at index 0.
+    """
+    settings = {**DEFAULT_ROUTE_SETTINGS, **(settings or {})}
+    deadline = time.monotonic() + settings["time_limit_ms"] / 1000
+    loads = [{"sqft": 0, "kg": 0}] + [{"sqft": s["sqft"], "kg": s["kg"]} for s in stops]
+
+    fleet = sorted(vehicles, key=lambda v: (v.get("capacity_sqft") or 0, v.get("capacity_kg") or 0), reverse=True)
+    if not fleet:
+        return {"depot": depot, "routes": [], "unassigned": [dict(s, reason="No vehicles available") for s in stops],
+                "summary": {"stops": len(stops), "routed_stops": 0, "vehicles_used": 0, "total_km": 0}}
+
+    unassigned = []
+    remaining = []
+    for index, stop in enumerate(stops, start=1):
+        if any(_fits(loads[index], v) for v in fleet):
+            remaining.append(index)
+        else:
+            unassigned.append(dict(stop, reason="Load exceeds the largest vehicle"))
+
+    def route_load(route):
+        return {"sqft": sum(loads[n]["sqft"] for n in route), "kg": sum(loads[n]["kg"] for n in route)}
+
+    # Largest vehicle first: savings routes under its limits, keep the fullest one, repeat
+    assigned = []
+    for vehicle in fleet:
+        if not remaining:
+            break
+        capacity = {"sqft": vehicle.get("capacity_sqft") or 0, "kg": vehicle.get("capacity_kg") or None}
+        nodes = [0] + [n for n in remaining if _fits(loads[n], vehicle)]
+        if len(nodes) == 1:
+            continue
+        sub_matrix = [[matrix[a][b] for b in nodes] for a in nodes]
+        candidates = [[nodes[n] for n in route]
+                      for route in clarke_wright(sub_matrix, [loads[n] for n in nodes], capacity, settings["max_stops"])]
+        route = max(candidates, key=lambda r: (route_load(r)["sqft"], -route_length(r, matrix)))
+        assigned.append((vehicle, two_opt(route, matrix, deadline), route_load(route)))
+        remaining = [n for n in remaining if n not in route]
+
+    unassigned += [dict(stops[n - 1], reason="No free vehicle left - plan a second trip") for n in remaining]
+
+    departure = datetime.combine(datetime.now().date(), datetime.strptime(settings["departure_time"], "%H:%M").time())
+    speed = settings["avg_speed_kmph"]
+    result = []
+    for vehicle, route, load in assigned:
+        clock = departure
+        previous = 0
+        distance = 0.0
+        ordered = []
+        for sequence, node in enumerate(route, start=1):
+            leg = matrix[previous][node]
+            distance += leg
+            clock += timedelta(hours=leg / speed)
+            ordered.append({
+                **stops[node - 1],
+                "sequence": sequence,
+                "leg_km": round(leg, 2),
+                "cumulative_km": round(distance, 2),
+                "eta": clock.strftime("%H:%M")
+            })
+            clock += timedelta(minutes=settings["service_minutes"])
+            previous = node
+        back = matrix[previous][0]
+        clock += timedelta(hours=back / speed)
+        result.append({
+            "vehicle_id": vehicle.get("id"),
+            "vehicle_number": vehicle.get("vehicle_number"),
+            "vehicle_type": vehicle.get("vehicle_type"),
+            "driver_id": vehicle.get("driver_id"),
+            "stops": ordered,
+            "stop_count": len(ordered),
+            "distance_km": round(distance + back, 2),
+            "load_sqft": round(load["sqft"], 2),
+            "load_kg": round(load["kg"], 1),
+            "capacity_sqft": vehicle.get("capacity_sqft"),
+            "utilisation": round(load["sqft"] / vehicle["capacity_sqft"], 4) if vehicle.get("capacity_sqft") else None,
+            "departure": departure.strftime("%H:%M"),
+            "return_eta": clock.strftime("%H:%M"),
+            # Last drop is loaded first so every drop is at the tailgate when the truck arrives
+            "manifest": [{
+                "loading_order": position,
+                "sequence": stop["sequence"],
+                "order_number": stop.get("order_number"),
+                "customer_name": stop.get("customer_name"),
+                "sqft": stop["sqft"],
+                "kg": stop["kg"],
+                "items": stop.get("items", [])
+            } for position, stop in enumerate(reversed(ordered), start=1)]
+        })
+
+    return {
+        "depot": depot,
+        "routes": result,
+        "unassigned": unassigned,
+        "summary": {
+            "stops": len(stops),
+            "routed_stops": sum(r["stop_count"] for r in result),
+            "vehicles_used": len(result),
+            "total_km": round(sum(r["distance_km"] for r in result), 2),
+            "optimised_within_time_limit": time.monotonic() < deadline
+        }
+    }
@@ -1,6 +1,7 @@
 """
 Scheduler - Background task scheduler for automated jobs
-Uses APScheduler for cron-like scheduling
+Uses APScheduler for cron-like scheduling; jobs go through the job coordinator so
+each fire runs once across all workers (see utils.job_coordinator)
 """
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
@@ -8,6 +9,8 @@ from datetime import datetime, timezone
 import logging
 import asyncio
 
+from utils.job_coordinator import job_coordinator
+
 logger = logging.getLogger(__name__)
 
 # Scheduler instance
@@ -23,24 +26,69 @@ def init_scheduler(database):
     scheduler = AsyncIOScheduler(timezone="Asia/Kolkata")
     
     # Add payment alerts job - runs daily at 9:00 AM IST
-    scheduler.add_job(
+    job_coordinator.register(
+        scheduler,
         run_payment_alerts_job,
         CronTrigger(hour=9, minute=0),
-        id="payment_alerts_daily",
-        name="Daily Payment Alerts",
-        replace_existing=True
+        job_id="payment_alerts_daily",
+        name="Daily Payment Alerts"
     )
     
     # Add weekly vendor payment summary - runs every Monday at 10:00 AM IST
-    scheduler.add_job(
+    job_coordinator.register(
+        scheduler,
         run_weekly_vendor_summary,
         CronTrigger(day_of_week="mon", hour=10, minute=0),
-        id="vendor_summary_weekly",
-        name="Weekly Vendor Payment Summary",
-        replace_existing=True
+        job_id="vendor_summary_weekly",
+        name="Weekly Vendor Payment Summary"
+    )
+    
+    # Add audit rollup compaction - runs daily at 12:30 AM IST for the previous day
+    job_coordinator.register(
+        scheduler,
+        run_audit_rollup_job,
+        CronTrigger(hour=0, minute=30),
+        job_id="audit_rollup_nightly",
+        name="Nightly Audit Rollup Compaction"
+    )
+    
+    # Add customer balance reconciliation - runs daily at 1:00 AM IST
+    job_coordinator.register(
+        scheduler,
+        run_customer_balance_reconcile_job,
+        CronTrigger(hour=1, minute=0),
+        job_id="customer_balance_reconcile",
+        name="Nightly Customer Balance Reconciliation"
+    )
+    
+    # Add demand forecast refit - runs daily at 2:00 AM IST
+    job_coordinator.register(
+        scheduler,
+        run_demand_forecast_job,
+        CronTrigger(hour=2, minute=0),
+        job_id="demand_forecast_nightly",
+        name="Nightly Demand Forecast Refresh"
+    )
+    
+    # Add period close - runs daily at 3:00 AM IST, freezes locked periods that have ended
+    job_coordinator.register(
+        scheduler,
+        run_period_close_job,
+        CronTrigger(hour=3, minute=0),
+        job_id="period_close_nightly",
+        name="Nightly Period Close"
     )
     
-    logger.info("Scheduler initialized with jobs: payment_alerts_daily, vendor_summary_weekly")
+    # Add stored value verification - runs daily at 3:30 AM IST, reports wallet/credit/points drift
+    job_coordinator.register(
+        scheduler,
+        run_stored_value_verify_job,
+        CronTrigger(hour=3, minute=30),
+        job_id="stored_value_verify",
+        name="Nightly Wallet & Rewards Balance Check"
+    )
+    
+    logger.info("Scheduler initialized with jobs: payment_alerts_daily, vendor_summary_weekly, audit_rollup_nightly, customer_balance_reconcile, demand_forecast_nightly, period_close_nightly, stored_value_verify")
     
     return scheduler
 
@@ -183,6 +231,153 @@ async def run_weekly_vendor_summary():
         })
 
 
+async def run_audit_rollup_job():
+    """Job function to rebuild yesterday's audit_daily_stats from raw audit_logs"""
+    logger.info("Running nightly audit rollup compaction...")
+    
+    try:
+        from datetime import timedelta
+        from zoneinfo import ZoneInfo
+        from routers.audit import rebuild_audit_daily_stats
+        
+        # Fires at 00:30 IST (19:00 UTC the day before): "yesterday" is the IST day that
+        # just closed; the day before it is included since audit dates are UTC
+        yesterday = datetime.now(ZoneInfo("Asia/Kolkata")).date() - timedelta(days=1)
+        result = await rebuild_audit_daily_stats(
+            _db, (yesterday - timedelta(days=1)).isoformat(), yesterday.isoformat()
+        )
+        
+        await _db.scheduler_logs.insert_one({
+            "job_id": "audit_rollup_nightly",
+            "job_name": "Nightly Audit Rollup Compaction",
+            "status": "success",
+            "result": result,
+            "run_at": datetime.now(timezone.utc).isoformat()
+        })
+        logger.info(f"Audit rollup compaction completed: {result}")
+    except Exception as e:
+        logger.error(f"Audit rollup compaction failed: {e}")
+        await _db.scheduler_logs.insert_one({
+            "job_id": "audit_rollup_nightly",
+            "job_name": "Nightly Audit Rollup Compaction",
+            "status": "failed",
+            "error": str(e),
+            "run_at": datetime.now(timezone.utc).isoformat()
+        })
+
+
+async def run_customer_balance_reconcile_job():
+    """Job function to repair drift in customer outstanding_balance / credit_exposure"""
+    logger.info("Running nightly customer balance reconciliation...")
+    
+    try:
+        from utils.customer_balance import reconcile_customer_balances
+        
+        result = await reconcile_customer_balances(_db)
+        
+        await _db.scheduler_logs.insert_one({
+            "job_id": "customer_balance_reconcile",
+            "job_name": "Nightly Customer Balance Reconciliation",
+            "status": "success",
+            "result": result,
+            "run_at": datetime.now(timezone.utc).isoformat()
+        })
+        logger.info(f"Customer balance reconciliation completed: {result}")
+    except Exception as e:
+        logger.error(f"Customer balance reconciliation failed: {e}")
+        await _db.scheduler_logs.insert_one({
+            "job_id": "customer_balance_reconcile",
+            "job_name": "Nightly Customer Balance Reconciliation",
+            "status": "failed",
+            "error": str(e),
+            "run_at": datetime.now(timezone.utc).isoformat()
+        })
+
+
+async def run_demand_forecast_job():
+    """Job function to refit every demand series and refresh the cached forecasts"""
+    logger.info("Running nightly demand forecast refresh...")
+    
+    try:
+        from utils.demand_forecast import refresh_demand_forecasts
+        
+        result = await refresh_demand_forecasts(_db)
+        
+        await _db.scheduler_logs.insert_one({
+            "job_id": "demand_forecast_nightly",
+            "job_name": "Nightly Demand Forecast Refresh",
+            "status": "success",
+            "result": result,
+            "run_at": datetime.now(timezone.utc).isoformat()
+        })
+        logger.info(f"Demand forecast refresh completed: {result}")
+    except Exception as e:
+        logger.error(f"Demand forecast refresh failed: {e}")
+        await _db.scheduler_logs.insert_one({
+            "job_id": "demand_forecast_nightly",
+            "job_name": "Nightly Demand Forecast Refresh",
+            "status": "failed",
+            "error": str(e),
+            "run_at": datetime.now(timezone.utc).isoformat()
+        })
+
+
+async def run_period_close_job():
+    """Job function to close active period locks whose period has ended"""
+    logger.info("Running nightly period close...")
+    
+    try:
+        from utils.period_close import close_pending_periods
+        
+        result = await close_pending_periods(_db)
+        
+        await _db.scheduler_logs.insert_one({
+            "job_id": "period_close_nightly",
+            "job_name": "Nightly Period Close",
+            "status": "success",
+            "result": result,
+            "run_at": datetime.now(timezone.utc).isoformat()
+        })
+        logger.info(f"Period close completed: {result}")
+    except Exception as e:
+        logger.error(f"Period close failed: {e}")
+        await _db.scheduler_logs.insert_one({
+            "job_id": "period_close_nightly",
+            "job_name": "Nightly Period Close",
+            "status": "failed",
+            "error": str(e),
+            "run_at": datetime.now(timezone.utc).isoformat()
+        })
+
+
+async def run_stored_value_verify_job():
+    """Job function to recompute wallet, credit and points balances from their ledgers"""
+    logger.info("Running stored value balance check...")
+    
+    try:
+        from utils.stored_value import verify_stored_value_balances
+        
+        result = await verify_stored_value_balances(_db)
+        
+        await _db.scheduler_logs.insert_one({
+            "job_id": "stored_value_verify",
+            "job_name": "Nightly Wallet & Rewards Balance Check",
+            "status": "success",
+            "result": result,
+            "run_at": datetime.now(timezone.utc).isoformat()
+        })
+        logger.info(f"Stored value balance check completed: {result}")
+    except Exception as e:
+        logger.error(f"Stored value balance check failed: {e}")
+        await _db.scheduler_logs.insert_one({
+            "job_id": "stored_value_verify",
+            "job_name": "Nightly Wallet & Rewards Balance Check",
+            "status": "failed",
+            "error": str(e),
+            "run_at": datetime.now(timezone.utc).isoformat()
+        })
+
+
 def get_scheduled_jobs():
     """Get list of all scheduled jobs"""
     global scheduler
@@ -195,7 +390,8 @@ def get_scheduled_jobs():
             "id": job.id,
             "name": job.name,
             "next_run": job.next_run_time.isoformat() if job.next_run_time else None,
-            "trigger": str(job.trigger)
+            "trigger": str(job.trigger),
+            "runs_on_this_worker": job_coordinator.is_leader
         })
     
     return jobs
@@ -216,6 +412,16 @@ async def run_job_manually(job_id: str):
         await run_payment_alerts_job()
     elif job_id == "vendor_summary_weekly":
         await run_weekly_vendor_summary()
+    elif job_id == "audit_rollup_nightly":
+        await run_audit_rollup_job()
+    elif job_id == "customer_balance_reconcile":
+        await run_customer_balance_reconcile_job()
+    elif job_id == "demand_forecast_nightly":
+        await run_demand_forecast_job()
+    elif job_id == "period_close_nightly":
+        await run_period_close_job()
+    elif job_id == "stored_value_verify":
+        await run_stored_value_verify_job()
     else:
         raise ValueError(f"Unknown job: {job_id}")
     
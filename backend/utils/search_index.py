@@ -0,0 +1,405 @@
+"""
+Search Index - Token/prefix index for customer and user typeahead
+- Each searchable document stores `search_tokens`: edge n-grams of name words,
+  digit-only mobile numbers and uppercase GSTINs (multikey index, no regex scans)
+- Queries become anchored token lookups that can use the index
+- Results are ranked (exact identifier > name prefix > word prefix > other fields)
+- A per-process prefix trie holds the hot working set of active customers so
+  most picker keystrokes never reach MongoDB
+"""
+from typing import Dict, Iterable, List, Optional
+import asyncio
+import logging
+import os
+import re
+import time
+
+from pymongo import UpdateOne
+from pymongo.errors import ExecutionTimeout
+
+logger = logging.getLogger(__name__)
+
+SEARCH_MAX_PREFIX = 20  # longer terms are indexed/queried on their first 20 chars
+SEARCH_MAX_QUERY_WORDS = 5
+SEARCH_BUDGET_MS = int(os.environ.get("SEARCH_BUDGET_MS", "150"))
+SEARCH_HOT_SET_SIZE = int(os.environ.get("SEARCH_HOT_SET_SIZE", "5000"))
+SEARCH_HOT_SET_TTL = 60  # seconds - reload picks up writes made by other workers
+BACKFILL_BATCH = 500
+
+# Which fields feed the index, by normalisation rule
+CUSTOMER_SEARCH_FIELDS = {
+    "names": ["display_name", "company_name", "individual_name", "contact_person"],
+    "phones": ["mobile"],
+    "gstins": ["gstin"],
+    "codes": ["customer_code"]
+}
+USER_SEARCH_FIELDS = {
+    "names": ["name", "email"],
+    "phones": ["phone"],
+    "gstins": ["gst_number"],
+    "codes": []
+}
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_PHONE_QUERY_RE = re.compile(r"[\d\s+\-()]+")
+
+
+# =============== NORMALISATION ===============
+
+def _words(text) -> List[str]:
+    return _WORD_RE.findall(str(text).lower()) if text else []
+
+
+def normalize_phone(value) -> str:
+    """Digits only, country code / trunk prefix dropped (last 10 digits)"""
+    digits = re.sub(r"\D", "", str(value or ""))
+    return digits[-10:] if len(digits) > 10 else digits
+
+
+def _phone_query(q: str) -> str:
+    """Partial typed number: drop a +91 / 0 prefix so it lines up with the stored 10 digits"""
+    digits = re.sub(r"\D", "", q)
+    if q.startswith("+91") or (len(digits) > 10 and digits.startswith("91")):
+        digits = digits[2:]
+    elif digits.startswith("0"):
+        digits = digits[1:]
+    return digits[-10:] if len(digits) > 10 else digits
+
+
+def normalize_gstin(value) -> str:
+    return re.sub(r"[^A-Z0-9]", "", str(value or "").upper())
+
+
+def edge_ngrams(term: str) -> List[str]:
+    """'sharma' -> ['s', 'sh', 'sha', 'shar', 'sharm', 'sharma']"""
+    term = term[:SEARCH_MAX_PREFIX]
+    return [term[:i] for i in range(1, len(term) + 1)]
+
+
+def search_terms(doc: dict, fields: dict) -> set:
+    """Whole normalised terms of a document (before n-gram expansion)"""
+    terms = set()
+    for field in fields["names"] + fields["codes"]:
+        terms.update(_words(doc.get(field)))
+    for field in fields["phones"]:
+        phone = normalize_phone(doc.get(field))
+        if phone:
+            terms.add(phone)
+    for field in fields["gstins"]:
+        gstin = normalize_gstin(doc.get(field))
+        if gstin:
+            terms.add(gstin)
+    return terms
+
+
+def build_search_tokens(doc: dict, fields: dict) -> List[str]:
+    """Value for the `search_tokens` field of a document"""
+    tokens = set()
+    for term in search_terms(doc, fields):
+        tokens.update(edge_ngrams(term))
+    return sorted(tokens)
+
+
+def search_projection(fields: dict) -> dict:
+    """Projection of every field that feeds the index"""
+    return {field: 1 for names in fields.values() for field in names}
+
+
+async def with_search_tokens(db, collection: str, fields: dict, query: dict, update: dict) -> dict:
+    """
+    `update` (a $set payload) plus recomputed search_tokens when it touches an
+    indexed field; every write to those fields must go through this (or set the
+    tokens itself), since legacy_search_filter only covers documents without tokens.
+    """
+    indexed = search_projection(fields)
+    if not any(field in indexed for field in update):
+        return update
+    current = await db[collection].find_one(query, {"_id": 0, **indexed}) or {}
+    return {**update, "search_tokens": build_search_tokens({**current, **update}, fields)}
+
+
+def query_token_groups(q: str) -> List[List[str]]:
+    """
+    One group per query word; a document matches when every group has a hit.
+    Each word is tried as a name/code token (lowercase) and as a GSTIN token (uppercase).
+    Phone-like queries ("+91 98765 43") collapse into a single digit token.
+    """
+    q = (q or "").strip()
+    if not q:
+        return []
+    if q.isdigit() and len(q) > 10 or not q.isdigit() and _PHONE_QUERY_RE.fullmatch(q):
+        phone = _phone_query(q)
+        if phone:
+            return [[phone]]
+
+    groups = []
+    for word in _words(q)[:SEARCH_MAX_QUERY_WORDS]:
+        word = word[:SEARCH_MAX_PREFIX]
+        groups.append(sorted({word, word.upper()}))
+    return groups
+
+
+def token_filter(q: str) -> Optional[dict]:
+    """MongoDB filter on `search_tokens` for a query, None when the query has no tokens"""
+    groups = query_token_groups(q)
+    if not groups:
+        return None
+    clauses = [{"search_tokens": {"$in": group}} for group in groups]
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def legacy_search_filter(q: str, fields: Iterable[str]) -> dict:
+    """Regex filter for documents written before tokens existed (not yet backfilled)"""
+    pattern = re.escape(q.strip())
+    return {
+        "search_tokens": {"$exists": False},
+        "$or": [{field: {"$regex": pattern, "$options": "i"}} for field in fields]
+    }
+
+
+# =============== RANKING ===============
+
+def _joined(text) -> str:
+    return " ".join(_words(text))
+
+
+def rank_score(doc: dict, q: str, fields: dict) -> int:
+    """Higher is better: exact identifier > primary name prefix > word prefix > other fields"""
+    query = _joined(q)
+    compact = query.replace(" ", "")
+    phone = _phone_query(q)
+
+    for field in fields["phones"]:
+        if phone and normalize_phone(doc.get(field)) == phone:
+            return 100
+    for field in fields["gstins"]:
+        if compact and normalize_gstin(doc.get(field)).lower() == compact:
+            return 100
+    for field in fields["codes"]:
+        if compact and _joined(doc.get(field)).replace(" ", "") == compact:
+            return 100
+
+    names = [_joined(doc.get(field)) for field in fields["names"]]
+    if names and names[0] == query:
+        return 90
+    if names and names[0].startswith(query):
+        return 80
+    if any(name.startswith(query) for name in names[1:]):
+        return 60
+
+    query_words = query.split()
+    name_words = set(" ".join(names).split())
+    if query_words and all(any(w.startswith(qw) for w in name_words) for qw in query_words):
+        return 40
+    return 20
+
+
+def rank_results(docs: List[dict], q: str, fields: dict, limit: Optional[int] = None) -> List[dict]:
+    primary = fields["names"][0]
+    ranked = sorted(
+        docs,
+        key=lambda d: (-rank_score(d, q, fields), len(str(d.get(primary) or "")), str(d.get(primary) or "").lower())
+    )
+    return ranked[:limit] if limit else ranked
+
+
+# =============== HOT TIER ===============
+
+_IDS = ""  # node key holding document ids (real children are single characters)
+
+
+class PrefixTrie:
+    """Character trie where every node keeps the ids of documents having a term with that prefix"""
+
+    def __init__(self):
+        self._root: dict = {}
+        self._terms: Dict[str, set] = {}
+
+    def __len__(self):
+        return len(self._terms)
+
+    def insert(self, doc_id: str, terms: Iterable[str]):
+        self.remove(doc_id)
+        terms = {t[:SEARCH_MAX_PREFIX] for t in terms if t}
+        for term in terms:
+            node = self._root
+            for ch in term:
+                node = node.setdefault(ch, {})
+                node.setdefault(_IDS, set()).add(doc_id)
+        self._terms[doc_id] = terms
+
+    def remove(self, doc_id: str):
+        for term in self._terms.pop(doc_id, ()):
+            node = self._root
+            for ch in term:
+                node = node.get(ch)
+                if node is None:
+                    break
+                node.get(_IDS, set()).discard(doc_id)
+
+    def lookup(self, prefix: str) -> set:
+        node = self._root
+        for ch in prefix:
+            node = node.get(ch)
+            if node is None:
+                return set()
+        return node.get(_IDS, set())
+
+    def match(self, groups: List[List[str]]) -> set:
+        """Ids matching every group (any variant within a group)"""
+        result = None
+        for group in groups:
+            hits = set()
+            for token in group:
+                hits |= self.lookup(token)
+            result = hits if result is None else result & hits
+            if not result:
+                return set()
+        return result or set()
+
+
+class HotSearchSet:
+    """
+    In-memory tier for one collection: the most recently touched documents
+    matching `base_filter`, held in a PrefixTrie with their projected fields.
+    When the whole filtered collection fits, searches are answered from memory alone.
+    """
+
+    def __init__(self, collection: str, fields: dict, base_filter: dict, projection: dict,
+                 size: int = SEARCH_HOT_SET_SIZE, ttl: int = SEARCH_HOT_SET_TTL):
+        self.collection = collection
+        self.fields = fields
+        self.base_filter = base_filter
+        self.result_fields = [k for k, v in projection.items() if v and k != "_id"]
+        # Loaded documents also carry every indexed field so the trie sees the same terms as the DB
+        self.projection = {"_id": 0, **{k: 1 for k in self.result_fields}}
+        for names in fields.values():
+            self.projection.update({field: 1 for field in names})
+        self.size = size
+        self.ttl = ttl
+        self._trie = PrefixTrie()
+        self._docs: Dict[str, dict] = {}
+        self._loaded_at = 0.0
+        self._complete = False
+        self._lock = asyncio.Lock()
+        self.stats = {"memory_hits": 0, "db_queries": 0, "budget_timeouts": 0, "reloads": 0}
+
+    def _matches_base(self, doc: dict) -> bool:
+        return all(doc.get(k) == v for k, v in self.base_filter.items())
+
+    def upsert(self, doc: dict):
+        """Keep the tier in step with a write made by this process"""
+        doc_id = doc.get("id")
+        if not doc_id or not self._loaded_at:
+            return
+        if not self._matches_base(doc):
+            self.discard(doc_id)
+            return
+        if doc_id not in self._docs and len(self._docs) >= self.size:
+            self._complete = False  # no room - the DB tier covers it
+            return
+        self._docs[doc_id] = {k: doc[k] for k in self.projection if k in doc and k != "_id"}
+        self._trie.insert(doc_id, search_terms(doc, self.fields))
+
+    def discard(self, doc_id: str):
+        self._docs.pop(doc_id, None)
+        self._trie.remove(doc_id)
+
+    async def ensure_loaded(self, db):
+        if time.monotonic() - self._loaded_at < self.ttl:
+            return
+        async with self._lock:
+            if time.monotonic() - self._loaded_at < self.ttl:
+                return
+            docs = await db[self.collection].find(self.base_filter, self.projection).sort(
+                [("updated_at", -1), ("created_at", -1)]
+            ).limit(self.size + 1).to_list(self.size + 1)
+
+            trie = PrefixTrie()
+            by_id = {}
+            for doc in docs[:self.size]:
+                if doc.get("id"):
+                    by_id[doc["id"]] = doc
+                    trie.insert(doc["id"], search_terms(doc, self.fields))
+            self._trie, self._docs = trie, by_id
+            self._complete = len(docs) <= self.size
+            self._loaded_at = time.monotonic()
+            self.stats["reloads"] += 1
+
+    async def search(self, db, q: str, limit: int = 10) -> List[dict]:
+        """Ranked typeahead: memory tier first, MongoDB token query within SEARCH_BUDGET_MS"""
+        groups = query_token_groups(q)
+        if not groups:
+            return []
+        await self.ensure_loaded(db)
+
+        found = {doc_id: self._docs[doc_id] for doc_id in self._trie.match(groups) if doc_id in self._docs}
+        if self._complete or len(found) >= limit * 3:
+            self.stats["memory_hits"] += 1
+            return self._results(found, q, limit)
+
+        self.stats["db_queries"] += 1
+        query = {**self.base_filter, **token_filter(q)}
+        try:
+            docs = await db[self.collection].find(query, self.projection).limit(limit * 3).max_time_ms(
+                SEARCH_BUDGET_MS
+            ).to_list(limit * 3)
+            for doc in docs:
+                found.setdefault(doc.get("id"), doc)
+        except ExecutionTimeout:
+            # Over budget - answer with what the memory tier found
+            self.stats["budget_timeouts"] += 1
+            logger.warning(f"Search on {self.collection} exceeded {SEARCH_BUDGET_MS}ms budget for {q!r}")
+        return self._results(found, q, limit)
+
+    def _results(self, found: dict, q: str, limit: int) -> List[dict]:
+        ranked = rank_results(list(found.values()), q, self.fields, limit)
+        return [{k: d[k] for k in self.result_fields if k in d} for d in ranked]
+
+    def describe(self) -> dict:
+        return {
+            "collection": self.collection,
+            "documents": len(self._docs),
+            "complete": self._complete,
+            "age_seconds": round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None,
+            **self.stats
+        }
+
+
+# =============== MAINTENANCE ===============
+
+async def backfill_search_tokens(db, collection: str, fields: dict, only_missing: bool = True) -> int:
+    """(Re)compute `search_tokens` in bulk; returns documents updated"""
+    projection = {"_id": 1, "id": 1, **search_projection(fields)}
+
+    query = {"search_tokens": {"$exists": False}} if only_missing else {}
+    cursor = db[collection].find(query, projection)
+    updated = 0
+    ops = []
+    async for doc in cursor:
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"search_tokens": build_search_tokens(doc, fields)}}))
+        if len(ops) >= BACKFILL_BATCH:
+            await db[collection].bulk_write(ops, ordered=False)
+            updated += len(ops)
+            ops = []
+    if ops:
+        await db[collection].bulk_write(ops, ordered=False)
+        updated += len(ops)
+    return updated
+
+
+async def ensure_search_indexes(db):
+    """Multikey token indexes, plus a background backfill of documents without tokens"""
+    await db.customer_profiles.create_index("search_tokens")
+    await db.users.create_index("search_tokens")
+
+    async def backfill():
+        try:
+            customers = await backfill_search_tokens(db, "customer_profiles", CUSTOMER_SEARCH_FIELDS)
+            users = await backfill_search_tokens(db, "users", USER_SEARCH_FIELDS)
+            if customers or users:
+                logger.info(f"Search tokens backfilled: {customers} customers, {users} users")
+        except Exception as e:
+            logger.warning(f"Search token backfill failed: {e}")
+
+    asyncio.create_task(backfill())
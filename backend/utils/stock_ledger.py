@@ -0,0 +1,166 @@
+"""
+Stock Ledger - Race-free raw material stock movements
+- IN/OUT are conditional $inc updates (OUT only matches while current_stock >= qty),
+  so concurrent issues can never take stock negative
+- The inventory_transactions ledger row is written in the same transaction
+- `is_low_stock` is recomputed in the same update; a partial index on it
+  serves /inventory/low-stock and the dashboard count without scanning materials
+- Each movement is valued (cost layers / weighted average) in the same transaction
+"""
+from datetime import datetime, timezone
+from typing import Optional
+import uuid
+
+from pymongo import ReturnDocument
+
+from utils.inventory_valuation import value_movement
+from utils.transactions import run_in_transaction
+
+DEFAULT_MINIMUM_STOCK = 10
+
+# Pipeline stage that keeps the flag in step with current_stock / minimum_stock
+LOW_STOCK_STAGE = {"$set": {
+    "is_low_stock": {"$lte": ["$current_stock", {"$ifNull": ["$minimum_stock", DEFAULT_MINIMUM_STOCK]}]}
+}}
+
+
+class StockError(Exception):
+    """Base class for rejected stock movements"""
+
+
+class MaterialNotFoundError(StockError):
+    pass
+
+
+class InsufficientStockError(StockError):
+    def __init__(self, material: dict, requested: float):
+        self.material = material
+        self.requested = requested
+        super().__init__(
+            f"Insufficient stock for {material.get('name')}: "
+            f"available {material.get('current_stock', 0)}, requested {requested}"
+        )
+
+
+def is_low_stock(material: dict) -> bool:
+    return material.get("current_stock", 0) <= material.get("minimum_stock", DEFAULT_MINIMUM_STOCK)
+
+
+async def move_stock(db, material_id: str, txn_type: str, quantity: float, *, reference: str = "",
+                     notes: str = "", created_by: str = "system", material_name: Optional[str] = None,
+                     unit_cost: Optional[float] = None, session=None) -> dict:
+    """
+    Apply an IN / OUT / ADJUST movement and record its ledger row.
+    unit_cost prices incoming stock (defaults to the material's unit_price).
+    Runs in its own transaction unless a session is passed (caller's transaction).
+    Returns the ledger row plus the material after the movement under "material".
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    txn_id = str(uuid.uuid4())
+    query = {"id": material_id}
+    stock = {"$ifNull": ["$current_stock", 0]}
+    if txn_type == "IN":
+        fields = {"current_stock": {"$add": [stock, quantity]}, "last_restocked": now}
+    elif txn_type == "OUT":
+        query["current_stock"] = {"$gte": quantity}
+        fields = {"current_stock": {"$subtract": [stock, quantity]}}
+    else:  # ADJUST - set the counted stock
+        fields = {"current_stock": {"$literal": quantity}}
+    fields["updated_at"] = now
+
+    async def apply(session):
+        before = await db.raw_materials.find_one_and_update(
+            query,
+            [{"$set": fields}, LOW_STOCK_STAGE],
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE,
+            session=session
+        )
+        if before is None:
+            material = await db.raw_materials.find_one({"id": material_id}, {"_id": 0}, session=session)
+            if not material:
+                raise MaterialNotFoundError(material_id)
+            raise InsufficientStockError(material, quantity)
+
+        previous_stock = before.get("current_stock", 0)
+        if txn_type == "IN":
+            new_stock = previous_stock + quantity
+        elif txn_type == "OUT":
+            new_stock = previous_stock - quantity
+        else:
+            new_stock = quantity
+        valuation = await value_movement(db, before, new_stock, unit_cost, txn_id, now, session)
+
+        transaction = {
+            "id": txn_id,
+            "material_id": material_id,
+            "material_name": material_name or before.get("name"),
+            "type": txn_type,
+            "quantity": quantity,
+            "previous_stock": previous_stock,
+            "new_stock": new_stock,
+            "unit_cost": valuation["unit_cost"],
+            "value": valuation["value"],
+            "stock_value": valuation["stock_value"],
+            "reference": reference,  # PO number, job card, etc.
+            "notes": notes,
+            "created_by": created_by,
+            "created_at": now
+        }
+        await db.inventory_transactions.insert_one(transaction, session=session)
+        transaction.pop("_id", None)
+        material = {**before, "current_stock": new_stock, "stock_value": valuation["stock_value"]}
+        material["is_low_stock"] = is_low_stock(material)
+        return {**transaction, "material": material}
+
+    if session is not None:
+        return await apply(session)
+    return await run_in_transaction(db, apply)
+
+
+async def receive_po_items(db, po: dict, created_by: str, session=None) -> list:
+    """Stock IN every PO line linked to a material, costed at the line's unit_price"""
+    received = []
+    for item in po.get("items", []):
+        if not item.get("material_id"):
+            continue
+        try:
+            received.append(await move_stock(
+                db,
+                item["material_id"],
+                "IN",
+                float(item.get("quantity", 0)),
+                reference=po.get("po_number"),
+                notes=f"Received from PO {po.get('po_number')}",
+                created_by=created_by,
+                material_name=item.get("material_name"),
+                unit_cost=item.get("unit_price"),
+                session=session
+            ))
+        except MaterialNotFoundError:
+            continue  # Line points at a deleted material - nothing to stock
+    return received
+
+
+async def set_minimum_stock_flag(db, material_id: str):
+    """Recompute is_low_stock after minimum_stock changes"""
+    await db.raw_materials.update_one({"id": material_id}, [LOW_STOCK_STAGE])
+
+
+async def get_low_stock_materials(db, limit: int = 500) -> list:
+    """Active materials at or below minimum stock (partial index on is_low_stock)"""
+    return await db.raw_materials.find(
+        {"status": "active", "is_low_stock": True}, {"_id": 0}
+    ).to_list(limit)
+
+
+async def ensure_stock_indexes(db):
+    """Partial low-stock index, ledger index, and a one-time flag backfill"""
+    await db.raw_materials.create_index(
+        [("status", 1), ("name", 1)],
+        name="low_stock_partial",
+        partialFilterExpression={"is_low_stock": True}
+    )
+    await db.raw_materials.create_index("id")
+    await db.inventory_transactions.create_index([("material_id", 1), ("created_at", -1)])
+    await db.raw_materials.update_many({"is_low_stock": {"$exists": False}}, [LOW_STOCK_STAGE])
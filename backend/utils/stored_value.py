@@ -0,0 +1,185 @@
+"""
+Stored Value - Append-only ledgers with maintained balances
+- One engine for the three stored-value accounts a user can hold:
+  wallet (wallets.balance / wallet_transactions), store credit and reward points
+  (reward_balances.credit_balance / credit_transactions, .points_balance / reward_points)
+- post_entry moves the balance with $inc and appends the ledger entry (with balance_after)
+  in one transaction; a debit is a conditional $inc that only matches when the balance
+  covers it, so concurrent debits can never take a balance below zero
+- Balance reads are a single find_one on the maintained field
+- verify_stored_value_balances recomputes every balance from its ledger in bulk, reports
+  drift and (with repair) resets drifted balances from the ledger inside a transaction
+"""
+from datetime import datetime, timezone
+from typing import Dict, Optional
+import logging
+
+from pymongo import ReturnDocument
+
+from utils.job_coordinator import run_once
+from utils.transactions import run_in_transaction
+
+logger = logging.getLogger(__name__)
+
+DRIFT_TOLERANCE = 0.01
+
+ACCOUNTS = {
+    "wallet": {
+        "balances": "wallets", "field": "balance",
+        "ledger": "wallet_transactions", "value": "amount",
+        "credit_types": ["credit"], "debit_types": ["debit"],
+    },
+    "credit": {
+        "balances": "reward_balances", "field": "credit_balance",
+        "ledger": "credit_transactions", "value": "amount",
+        "credit_types": ["credit", "referral_bonus", "order_reward", "admin_credit"],
+        "debit_types": ["debit", "redemption", "admin_debit"],
+    },
+    "points": {
+        "balances": "reward_balances", "field": "points_balance",
+        "ledger": "reward_points", "value": "points",
+        "credit_types": ["earned"], "debit_types": ["redeemed"],
+    },
+}
+
+
+class InsufficientBalanceError(Exception):
+    def __init__(self, kind: str, balance: float):
+        self.kind = kind
+        self.balance = balance
+        super().__init__(f"Insufficient {kind} balance")
+
+
+async def get_balance(db, kind: str, user_id: str, session=None) -> float:
+    account = ACCOUNTS[kind]
+    doc = await db[account["balances"]].find_one(
+        {"user_id": user_id}, {"_id": 0, account["field"]: 1}, session=session
+    )
+    return (doc or {}).get(account["field"], 0) or 0
+
+
+async def post_entry(db, kind: str, entry: dict, on_insert: Optional[dict] = None,
+                     totals: Optional[Dict[str, float]] = None, session=None) -> float:
+    """
+    Append a ledger entry and move the balance by it in one transaction.
+    entry needs user_id, type (one of the account's credit/debit types) and the
+    positive value field. Credits create the balance doc (with on_insert fields)
+    if needed; debits raise InsufficientBalanceError instead of going negative.
+    totals: extra counters to $inc alongside the balance (e.g. total_earned).
+    session: join the caller's run_in_transaction instead of starting one, so a
+    claim and the entry it pays for commit together.
+    Returns the balance after the entry.
+    """
+    account = ACCOUNTS[kind]
+    field = account["field"]
+    value = entry[account["value"]]
+    if value <= 0:
+        raise ValueError("Amount must be positive")
+    if entry["type"] in account["debit_types"]:
+        delta, query = -value, {"user_id": entry["user_id"], field: {"$gte": value}}
+    elif entry["type"] in account["credit_types"]:
+        delta, query = value, {"user_id": entry["user_id"]}
+    else:
+        raise ValueError(f"Unknown {kind} entry type: {entry['type']}")
+
+    now = datetime.now(timezone.utc).isoformat()
+    update = {"$inc": {field: delta, **(totals or {})}, "$set": {"updated_at": now}}
+    if on_insert:
+        update["$setOnInsert"] = on_insert
+
+    async def _apply(session):
+        balance_doc = await db[account["balances"]].find_one_and_update(
+            query, update, projection={"_id": 0, field: 1},
+            upsert=delta > 0, return_document=ReturnDocument.AFTER, session=session
+        )
+        if balance_doc is None:
+            raise InsufficientBalanceError(kind, await get_balance(db, kind, entry["user_id"], session))
+        balance_after = round(balance_doc[field], 2)
+        await db[account["ledger"]].insert_one(
+            {"created_at": now, **entry, "balance_after": balance_after}, session=session
+        )
+        return balance_after
+
+    if session is not None:
+        return await _apply(session)
+    return await run_in_transaction(db, _apply)
+
+
+def _ledger_pipeline(kind: str, match: dict) -> list:
+    account = ACCOUNTS[kind]
+    value = f"${account['value']}"
+    return [
+        {"$match": {**match, "type": {"$in": account["credit_types"] + account["debit_types"]}}},
+        {"$group": {"_id": "$user_id", "balance": {"$sum": {
+            "$cond": [{"$in": ["$type", account["credit_types"]]}, value, {"$multiply": [value, -1]}]
+        }}}}
+    ]
+
+
+async def verify_stored_value_balances(db, repair: bool = False) -> dict:
+    """
+    Recompute balances from the ledgers and report (optionally repair) drift.
+    Each repair re-aggregates that user's ledger inside a transaction, so an
+    entry posted while the scan was running is never lost.
+    """
+    report = {}
+    for kind, account in ACCOUNTS.items():
+        field = account["field"]
+        rows = await db[account["ledger"]].aggregate(_ledger_pipeline(kind, {})).to_list(None)
+        expected = {row["_id"]: row["balance"] for row in rows if row["_id"]}
+
+        drifted = []
+        seen = set()
+        async for doc in db[account["balances"]].find({}, {"_id": 0, "user_id": 1, field: 1}):
+            seen.add(doc["user_id"])
+            if abs((doc.get(field) or 0) - expected.get(doc["user_id"], 0)) > DRIFT_TOLERANCE:
+                drifted.append(doc["user_id"])
+        drifted += [user_id for user_id, balance in expected.items()
+                    if user_id not in seen and abs(balance) > DRIFT_TOLERANCE]
+
+        repaired = 0
+        drift_total = 0.0
+        if repair:
+            for user_id in drifted:
+                async def _repair(session, user_id=user_id, kind=kind, account=account, field=field):
+                    result = await db[account["ledger"]].aggregate(
+                        _ledger_pipeline(kind, {"user_id": user_id}), session=session
+                    ).to_list(1)
+                    balance = round(result[0]["balance"], 2) if result else 0
+                    before = await db[account["balances"]].find_one_and_update(
+                        {"user_id": user_id}, {"$set": {field: balance}},
+                        projection={"_id": 0, field: 1}, upsert=True, session=session
+                    )
+                    return abs(((before or {}).get(field) or 0) - balance)
+
+                drift_total += await run_in_transaction(db, _repair)
+                repaired += 1
+
+        report[kind] = {"checked": len(seen), "drifted": len(drifted), "repaired": repaired,
+                        "drift": round(drift_total, 2), "sample": drifted[:20]}
+        if drifted:
+            logger.warning(f"Stored value drift in {kind}: {len(drifted)} balances"
+                           + (f" repaired (₹{drift_total:,.2f})" if repair else ""))
+    return report
+
+
+async def ensure_stored_value_indexes(db):
+    """Index balances and ledgers by user; initialise reward balances once from the ledgers"""
+    await db.reward_balances.create_index("user_id", unique=True)
+    await db.credit_transactions.create_index([("user_id", 1), ("created_at", -1)])
+    await db.reward_points.create_index([("user_id", 1), ("created_at", -1)])
+    await db.wallet_transactions.create_index([("user_id", 1), ("created_at", -1)])
+
+    async def initialise():
+        result = await verify_stored_value_balances(db, repair=True)
+        logger.info(f"Stored value balances initialised: {result}")
+
+    # Gated on a persistent marker, not on reward_balances being empty, so a failed or
+    # interrupted run is retried on the next start even after new credits were posted
+    try:
+        await run_once(db, "reward_balances_init", initialise)
+    except Exception as e:
+        logger.warning(f"Stored value balance initialisation failed (retried on next start): {e}")
+
+    # Wallet credits upsert by user_id; fails (and is logged) while legacy duplicate wallets exist
+    await db.wallets.create_index("user_id", unique=True)
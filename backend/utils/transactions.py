@@ -0,0 +1,40 @@
+"""
+Multi-document transactions - helper for flows where money or stock moves
+Transactions need a replica set; on a standalone MongoDB (local dev) the
+callback runs without a session so the same code path works everywhere.
+"""
+from pymongo.errors import OperationFailure
+import logging
+
+logger = logging.getLogger(__name__)
+
+# None = not probed yet, False = server does not support transactions
+_transactions_supported = None
+
+
+def _is_unsupported(error: OperationFailure) -> bool:
+    """Standalone servers reject transactions with IllegalOperation (code 20)"""
+    return error.code == 20 or "replica set" in str(error).lower()
+
+
+async def run_in_transaction(db, callback):
+    """
+    Run `await callback(session)` inside a transaction and return its result.
+    Retries on transient transaction errors (handled by the driver).
+    Falls back to `await callback(None)` when transactions are unavailable.
+    """
+    global _transactions_supported
+
+    if _transactions_supported is not False:
+        try:
+            async with await db.client.start_session() as session:
+                result = await session.with_transaction(callback)
+                _transactions_supported = True
+                return result
+        except OperationFailure as e:
+            if not _is_unsupported(e):
+                raise
+            _transactions_supported = False
+            logger.warning("MongoDB transactions unavailable (standalone server) - running without a session")
+
+    return await callback(None)
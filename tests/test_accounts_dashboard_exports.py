@@ -105,6 +105,18 @@ class TestProfitLossReport:
         assert data["period"]["end_date"] == "2026-01-31"
         print(f"✓ P&L date range filter works")
 
+    def test_profit_loss_closed_period_memoised(self):
+        """Test a closed period returns the same figures from the snapshot and on refresh"""
+        params = {"start_date": "2026-01-01", "end_date": "2026-01-31"}
+        first = requests.get(f"{BASE_URL}/api/erp/accounts/profit-loss", params=params)
+        cached = requests.get(f"{BASE_URL}/api/erp/accounts/profit-loss", params=params)
+        refreshed = requests.get(f"{BASE_URL}/api/erp/accounts/profit-loss", params={**params, "refresh": "true"})
+        assert first.status_code == cached.status_code == refreshed.status_code == 200
+
+        assert cached.json() == first.json()
+        assert refreshed.json()["net_profit"] == first.json()["net_profit"]
+        print(f"✓ Closed-period P&L memoised: net profit ₹{first.json()['net_profit']}")
+
 
 class TestGSTReport:
     """GST Report Tests"""
@@ -96,7 +96,32 @@ class TestAIForecast(TestAuthSetup):
         assert "generated_at" in data, "Response should have generated_at"
         
         print(f"✅ GET /api/erp/forecast/demand - Trend: {data['trend']}, Summary: {data['summary'][:100]}...")
-    
+
+    def test_forecast_series_cached(self, admin_headers):
+        """GET /api/erp/forecast/series - Cached per-series forecasts from the local models"""
+        # A cold start fits in the background and answers "refresh_started" until the first run is published
+        deadline = time.time() + 120
+        while True:
+            response = requests.get(
+                f"{BASE_URL}/api/erp/forecast/series",
+                headers=admin_headers,
+                params={"frequency": "weekly", "dimension": "total"}
+            )
+            assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+            data = response.json()
+            if data.get("status") != "refresh_started" or time.time() > deadline:
+                break
+            time.sleep(2)
+
+        assert data.get("status") != "refresh_started", "First forecast run was not published within 120s"
+        assert {s["metric"] for s in data["series"]} == {"orders", "revenue", "sqft"}
+        for series in data["series"]:
+            assert series["model"] in ["moving_average", "seasonal_naive", "holt_winters"]
+            assert len(series["forecast"]) == 8
+            assert all(p["value"] >= 0 for p in series["forecast"])
+
+        print(f"✅ GET /api/erp/forecast/series - {data['count']} weekly total series")
+
     def test_forecast_unauthorized(self):
         """GET /api/erp/forecast/stats - Should require auth"""
         response = requests.get(f"{BASE_URL}/api/erp/forecast/stats")
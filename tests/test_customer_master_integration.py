@@ -88,7 +88,22 @@ class TestCustomerMasterIntegration:
         assert response.status_code == 200, f"Search failed: {response.text}"
         results = response.json()
         print(f"✓ Customer search by GSTIN returned {len(results)} results")
-    
+
+    def test_customer_search_formatted_mobile_ranks_exact_first(self):
+        """Test that '+91 98765 43210' matches the stored 10-digit mobile and ranks it first"""
+        response = self.session.get(
+            f"{BASE_URL}/api/erp/customer-master/search/for-invoice",
+            params={"q": "+91 98765 43210"},
+            headers=self.admin_headers
+        )
+        assert response.status_code == 200, f"Search failed: {response.text}"
+        results = response.json()
+
+        if len(results) > 0:
+            assert results[0]["mobile"].replace(" ", "")[-10:] == "9876543210", "Exact mobile match should rank first"
+            assert "search_tokens" not in results[0], "Index tokens should not be returned"
+        print(f"✓ Formatted mobile search returned {len(results)} results")
+
     def test_customer_search_returns_credit_info(self):
         """Test that search returns credit limit and credit days"""
         response = self.session.get(
@@ -313,7 +328,60 @@ class TestCustomerMasterIntegration:
         
         print(f"✓ Credit order created: {order_result.get('order_number')}")
         print(f"✓ Credit terms applied: advance={order_result.get('advance_percent')}%")
-    
+
+    def test_credit_order_increases_credit_exposure(self):
+        """Test that a credit order is added to the profile's maintained credit exposure"""
+        search_response = self.session.get(
+            f"{BASE_URL}/api/erp/customer-master/search/for-invoice",
+            params={"q": "ABC"},
+            headers=self.admin_headers
+        )
+        assert search_response.status_code == 200
+        credit_customer = next(
+            (c for c in search_response.json() if c.get("credit_type") == "credit_allowed"), None
+        )
+        if not credit_customer:
+            pytest.skip("No credit-allowed customer found for testing")
+
+        def get_exposure():
+            response = self.session.get(
+                f"{BASE_URL}/api/erp/customer-master/{credit_customer['id']}",
+                headers=self.admin_headers
+            )
+            assert response.status_code == 200
+            profile = response.json()
+            assert "credit_exposure" in profile, "Profile should carry maintained credit_exposure"
+            return profile.get("credit_exposure", 0)
+
+        exposure_before = get_exposure()
+
+        products = self.session.get(f"{BASE_URL}/api/products", headers=self.admin_headers).json()
+        product = products[0]
+        order_response = self.session.post(
+            f"{BASE_URL}/api/orders",
+            json={
+                "product_id": product["id"],
+                "thickness": product["thickness_options"][0] if product.get("thickness_options") else 6.0,
+                "width": 12,
+                "height": 12,
+                "quantity": 1,
+                "delivery_address": "Test Credit Exposure Address",
+                "notes": "TEST_CreditExposure",
+                "advance_percent": 0,
+                "is_credit_order": True,
+                "customer_profile_id": credit_customer["id"]
+            },
+            headers=self.admin_headers
+        )
+        if order_response.status_code == 400 and "credit limit" in order_response.text:
+            print("✓ Order rejected at credit limit")
+            return
+        assert order_response.status_code == 200, f"Credit order creation failed: {order_response.text}"
+
+        total = order_response.json().get("total_amount", 0)
+        assert abs(get_exposure() - (exposure_before + total)) < 0.01, "Credit exposure should grow by the order total"
+        print(f"✓ Credit exposure {exposure_before} -> {exposure_before + total}")
+
     # ============ ERP Order Creation Tests ============
     
     def test_erp_order_creation_with_customer_profile(self):
@@ -386,6 +454,16 @@ class TestCustomerMasterIntegration:
         
         print(f"✓ Customer Master list: {data.get('total')} total customers")
     
+    def test_customer_master_list_clamps_paging(self):
+        """Test a zero limit and non-positive page are clamped instead of failing"""
+        response = self.session.get(
+            f"{BASE_URL}/api/erp/customer-master/",
+            params={"limit": 0, "page": 0},
+            headers=self.admin_headers
+        )
+        assert response.status_code == 200, f"List failed: {response.text}"
+        assert response.json()["page"] == 1
+    
     def test_customer_master_stats(self):
         """Test customer master stats endpoint"""
         response = self.session.get(
@@ -258,6 +258,35 @@ class TestDailyReportsAPI:
         assert response.status_code in [200, 401, 403], f"Unexpected status: {response.status_code}"
         print(f"✓ Request returned {response.status_code} (Note: Backend uses system admin fallback)")
 
+    # ==================== Daily Cash Balances ====================
+    
+    def test_daily_opening_matches_balance_after_cash_in(self):
+        """Test cash in moves /cash/balance and keeps today's opening + net equal to it"""
+        before = self.session.get(f"{BASE_URL}/api/erp/cash/balance").json()
+        
+        response = self.session.post(f"{BASE_URL}/api/erp/cash/transaction", json={
+            "amount": 125.5,
+            "transaction_type": "cash_in",
+            "description": "TEST daily balance"
+        })
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+        
+        after = self.session.get(f"{BASE_URL}/api/erp/cash/balance").json()
+        assert round(after["current_balance"] - before["current_balance"], 2) == 125.5
+        
+        daily = self.session.get(f"{BASE_URL}/api/erp/cash/report/daily").json()
+        balances = daily["balances"]
+        assert round(balances["opening"] + balances["cash_in"] - balances["cash_out"], 2) == balances["closing"]
+        assert balances["closing"] == after["current_balance"]
+        print(f"✓ Opening {balances['opening']} + today's net = balance {after['current_balance']}")
+        
+        # Cleanup: offset the test entry
+        self.session.post(f"{BASE_URL}/api/erp/cash/transaction", json={
+            "amount": 125.5,
+            "transaction_type": "cash_out",
+            "description": "TEST daily balance reversal"
+        })
+
 
 class TestDailyReportsRoleAccess:
     """Test role-based access for daily reports APIs"""
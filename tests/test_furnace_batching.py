@@ -0,0 +1,86 @@
+"""
+Furnace Batching Tests
+Tests toughening cycle planning, load/complete workflow and utilisation history
+"""
+import pytest
+import requests
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'https://glassmesh.preview.emergentagent.com').rstrip('/')
+
+
+class TestFurnacePlanning:
+    """Furnace cycle planning tests"""
+
+    def _job_card_at_toughening(self, thickness, width, height, quantity):
+        order_id = requests.post(f"{BASE_URL}/api/erp/production/orders", json={
+            "glass_type": "Toughened Glass",
+            "thickness": thickness,
+            "width": width,
+            "height": height,
+            "quantity": quantity,
+            "priority": 2
+        }).json()["order_id"]
+        requests.patch(f"{BASE_URL}/api/erp/production/orders/{order_id}/stage", json={"stage": "toughening"})
+        return order_id
+
+    def test_plan_keeps_one_thickness_per_cycle(self):
+        """Test every planned cycle holds a single thickness and fits the bed"""
+        self._job_card_at_toughening(8, 1200, 900, 6)
+        self._job_card_at_toughening(12, 1500, 1000, 4)
+
+        response = requests.post(f"{BASE_URL}/api/erp/furnace/plan")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["summary"]["cycles"] >= 2
+        for cycle in data["cycles"]:
+            assert len({p["thickness_mm"] for p in cycle["pieces"]}) == 1
+            assert 0 < cycle["utilisation"] <= 1
+        print(f"✓ POST /api/erp/furnace/plan - {data['summary']}")
+
+    def test_loaded_pieces_leave_the_waiting_pool(self):
+        """Test a loaded cycle's pieces are not planned again, and completion records utilisation"""
+        self._job_card_at_toughening(10, 1000, 800, 3)
+        cycles = requests.post(f"{BASE_URL}/api/erp/furnace/plan").json()["cycles"]
+        cycle = cycles[0]
+
+        assert requests.post(f"{BASE_URL}/api/erp/furnace/cycles/{cycle['id']}/load").status_code == 200
+        replanned = requests.post(f"{BASE_URL}/api/erp/furnace/plan").json()
+        assert replanned["summary"]["pieces"] == sum(c["piece_count"] for c in cycles) - cycle["piece_count"]
+
+        response = requests.post(f"{BASE_URL}/api/erp/furnace/cycles/{cycle['id']}/complete", json={"broken_pieces": 0})
+        assert response.status_code == 200
+        history = requests.get(f"{BASE_URL}/api/erp/furnace/utilisation", params={"days": 1}).json()
+        assert history["cycles"] >= 1
+        print("✓ Loaded cycle excluded from re-plan; utilisation history updated")
+
+    def test_load_sheet_pdf(self):
+        """Test load sheet downloads as PDF"""
+        self._job_card_at_toughening(8, 600, 600, 2)
+        cycle = requests.post(f"{BASE_URL}/api/erp/furnace/plan").json()["cycles"][0]
+        response = requests.get(f"{BASE_URL}/api/erp/furnace/cycles/{cycle['id']}/load-sheet")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/pdf"
+        print("✓ GET /api/erp/furnace/cycles/{id}/load-sheet - PDF generated")
+
+    def test_concurrent_plans_leave_one_proposal(self):
+        """Test planners racing each other never leave two proposals"""
+        self._job_card_at_toughening(6, 900, 700, 4)
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            responses = list(pool.map(lambda _: requests.post(f"{BASE_URL}/api/erp/furnace/plan"), range(3)))
+        assert all(r.status_code in [200, 409] for r in responses)
+        assert any(r.status_code == 200 for r in responses)
+
+        planned = requests.get(f"{BASE_URL}/api/erp/furnace/cycles", params={"status": "planned", "limit": 200}).json()
+        assert len({c["plan_id"] for c in planned}) <= 1
+        print("✓ Concurrent POST /api/erp/furnace/plan - one proposal kept")
+
+    def test_non_numeric_setting_rejected(self):
+        """Test a non-numeric furnace setting returns 400"""
+        response = requests.put(f"{BASE_URL}/api/erp/furnace/settings", json={"bed_length_mm": "wide"})
+        assert response.status_code in [400, 403]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])
@@ -206,7 +206,118 @@ class TestInventoryTransactions:
         assert response.status_code == 400
         assert "Insufficient stock" in response.json()["detail"]
         print(f"✓ Stock out correctly rejected for insufficient stock")
-    
+
+    def test_concurrent_stock_out_never_goes_negative(self):
+        """Test simultaneous OUT movements cannot both pass the stock check"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        material_data = {
+            "name": f"TEST_Concurrent_{uuid.uuid4().hex[:6]}",
+            "category": "spare",
+            "unit": "pcs",
+            "current_stock": 10,
+            "minimum_stock": 2,
+            "unit_price": 100
+        }
+        material_id = requests.post(f"{BASE_URL}/api/erp/inventory/materials", json=material_data).json()["material_id"]
+
+        def stock_out(_):
+            return requests.post(f"{BASE_URL}/api/erp/inventory/transactions", json={
+                "material_id": material_id, "type": "OUT", "quantity": 6, "notes": "Concurrent issue"
+            }).status_code
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            codes = list(pool.map(stock_out, range(4)))
+
+        assert codes.count(200) == 1, f"Exactly one OUT of 6 should fit in stock 10, got {codes}"
+        material = requests.get(f"{BASE_URL}/api/erp/inventory/materials/{material_id}").json()
+        assert material["current_stock"] == 4
+        print(f"✓ Concurrent stock out: {codes} → stock {material['current_stock']}")
+
+    def test_low_stock_flag_follows_movements(self):
+        """Test is_low_stock flips with stock movements and drives /low-stock"""
+        material_data = {
+            "name": f"TEST_LowFlag_{uuid.uuid4().hex[:6]}",
+            "category": "spare",
+            "unit": "pcs",
+            "current_stock": 20,
+            "minimum_stock": 10,
+            "unit_price": 100
+        }
+        material_id = requests.post(f"{BASE_URL}/api/erp/inventory/materials", json=material_data).json()["material_id"]
+
+        def low_stock_ids():
+            return {m["id"] for m in requests.get(f"{BASE_URL}/api/erp/inventory/low-stock").json()}
+
+        assert material_id not in low_stock_ids()
+        requests.post(f"{BASE_URL}/api/erp/inventory/transactions", json={
+            "material_id": material_id, "type": "OUT", "quantity": 15
+        })
+        assert material_id in low_stock_ids()
+        requests.post(f"{BASE_URL}/api/erp/inventory/transactions", json={
+            "material_id": material_id, "type": "IN", "quantity": 50
+        })
+        assert material_id not in low_stock_ids()
+        print("✓ Low-stock flag follows IN/OUT movements")
+
+    def test_fifo_valuation_consumes_oldest_layer(self):
+        """Test OUT is costed from the oldest cost layer under FIFO"""
+        material_data = {
+            "name": f"TEST_FIFO_{uuid.uuid4().hex[:6]}",
+            "category": "glass",
+            "unit": "sqft",
+            "current_stock": 10,
+            "minimum_stock": 0,
+            "unit_price": 50,
+            "valuation_method": "fifo"
+        }
+        material_id = requests.post(f"{BASE_URL}/api/erp/inventory/materials", json=material_data).json()["material_id"]
+
+        requests.post(f"{BASE_URL}/api/erp/inventory/transactions", json={
+            "material_id": material_id, "type": "IN", "quantity": 10, "unit_cost": 80
+        })
+        response = requests.post(f"{BASE_URL}/api/erp/inventory/transactions", json={
+            "material_id": material_id, "type": "OUT", "quantity": 15
+        })
+        assert response.status_code == 200
+        data = response.json()
+        # 10 @ 50 (opening layer) + 5 @ 80
+        assert data["value"] == -900
+        assert data["stock_value"] == 400
+
+        valuation = requests.get(f"{BASE_URL}/api/erp/inventory/valuation").json()
+        item = next(i for i in valuation["items"] if i["material_id"] == material_id)
+        assert item["value"] == 400
+        print("✓ FIFO valuation consumed the oldest layer first")
+
+    def test_replenishment_reorder_point_from_consumption(self):
+        """Test consumption velocity drives the reorder point and a purchase suggestion"""
+        material_data = {
+            "name": f"TEST_Reorder_{uuid.uuid4().hex[:6]}",
+            "category": "chemical",
+            "unit": "kg",
+            "current_stock": 1000,
+            "minimum_stock": 0,
+            "unit_price": 20
+        }
+        material_id = requests.post(f"{BASE_URL}/api/erp/inventory/materials", json=material_data).json()["material_id"]
+        requests.post(f"{BASE_URL}/api/erp/inventory/transactions", json={
+            "material_id": material_id, "type": "OUT", "quantity": 900
+        })
+
+        response = requests.get(f"{BASE_URL}/api/erp/inventory/replenishment", params={"needs_reorder": True})
+        assert response.status_code == 200
+        item = next(i for i in response.json()["materials"] if i["material_id"] == material_id)
+        # 900 over a 90-day window = 10/day; 7-day default lead time puts the reorder point above 100
+        assert item["avg_daily_consumption"] == 10
+        assert item["reorder_point"] > 100
+        assert item["suggested_quantity"] > 0
+
+        run = requests.post(f"{BASE_URL}/api/erp/inventory/replenishment/suggestions").json()
+        lines = [line for s in run["suggestions"] for line in s["items"]]
+        assert any(line["material_id"] == material_id for line in lines)
+        print(f"✓ Reorder point {item['reorder_point']} - suggested {item['suggested_quantity']} {item['unit']}")
+
     def test_get_transactions(self):
         """Test fetching all transactions"""
         response = requests.get(f"{BASE_URL}/api/erp/inventory/transactions")
@@ -45,6 +45,29 @@ class TestPublicBlogEndpoints:
         assert data["limit"] == 5
         print(f"✓ Pagination working - Page {data['page']}, Total pages: {data['total_pages']}")
     
+    def test_get_public_blog_cursor_pagination(self):
+        """Test cursor (keyset) continuation and invalid cursor rejection"""
+        response = requests.get(f"{BASE_URL}/api/erp/cms/public/blog", params={"limit": 1})
+        assert response.status_code == 200
+
+        data = response.json()
+        assert "has_more" in data
+        assert "next_cursor" in data
+        if data["has_more"]:
+            assert data["next_cursor"]
+            next_page = requests.get(
+                f"{BASE_URL}/api/erp/cms/public/blog",
+                params={"limit": 1, "cursor": data["next_cursor"]}
+            )
+            assert next_page.status_code == 200
+            next_posts = next_page.json()["posts"]
+            assert len(next_posts) == 1
+            assert next_posts[0]["id"] != data["posts"][0]["id"]
+
+        bad = requests.get(f"{BASE_URL}/api/erp/cms/public/blog", params={"cursor": "not-a-cursor"})
+        assert bad.status_code == 400
+        print(f"✓ Cursor pagination working - has_more: {data['has_more']}")
+    
     def test_get_public_blog_with_category_filter(self):
         """Test category filter"""
         response = requests.get(f"{BASE_URL}/api/erp/cms/public/blog", params={"category": "Glass Guide"})
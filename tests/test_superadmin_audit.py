@@ -133,6 +133,22 @@ class TestSuperAdminDashboard:
         
         print(f"✓ System stats: {system}")
 
+    def test_db_pool_stats(self, authenticated_client):
+        """Test connection pool settings and counters are exposed"""
+        response = authenticated_client.get(f"{BASE_URL}/api/erp/superadmin/db-pool-stats")
+        assert response.status_code == 200
+        data = response.json()
+
+        assert data["connected"] is True
+        assert data["settings"]["max_pool_size"] >= data["settings"]["min_pool_size"]
+        assert len(data["servers"]) >= 1
+        # Secondaries get a pool (minPoolSize) but no checkouts until a report reads from them
+        assert sum(counters["checkouts"] for counters in data["servers"].values()) >= 1
+        for counters in data["servers"].values():
+            assert counters["open"] >= counters["in_use"] >= 0
+
+        print(f"✓ Pool stats: {data['servers']}")
+
 
 class TestUserManagement:
     """Test User Management APIs"""
@@ -444,6 +460,35 @@ class TestYearlyAudit:
         print(f"  - Months active: {data['summary']['months_active']}")
 
 
+class TestAuditRollups:
+    """Test daily audit rollup rebuild"""
+
+    def test_rebuild_rollups_matches_mis(self, authenticated_client):
+        """Test /api/erp/audit/rollups/rebuild recomputes the month and MIS reads it"""
+        month_start = datetime.now().strftime("%Y-%m-01")
+        response = authenticated_client.post(
+            f"{BASE_URL}/api/erp/audit/rollups/rebuild",
+            params={"start_date": month_start}
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert "rollup_rows" in data
+
+        mis = authenticated_client.get(f"{BASE_URL}/api/erp/audit/monthly-mis").json()
+        breakdown_total = sum(d["total"] for d in mis["daily_breakdown"])
+        assert breakdown_total == mis["summary"]["total_actions"]
+
+        print(f"✓ Rebuilt {data['rollup_rows']} rollup rows from {month_start}")
+
+    def test_rebuild_rollups_invalid_range(self, authenticated_client):
+        """Test start_date after end_date is rejected"""
+        response = authenticated_client.post(
+            f"{BASE_URL}/api/erp/audit/rollups/rebuild",
+            params={"start_date": "2026-02-01", "end_date": "2026-01-01"}
+        )
+        assert response.status_code == 400
+
+
 class TestApprovalHistory:
     """Test Approval History API"""
     
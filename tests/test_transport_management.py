@@ -5,6 +5,7 @@ Transport Management System Tests
 - Vehicles CRUD
 - Drivers CRUD
 - Transport Dashboard
+- Route Planning
 """
 import pytest
 import requests
@@ -240,6 +241,60 @@ class TestDistanceAndCostCalculation:
         
         print(f"✓ Invalid address correctly returns error")
 
+    def test_repeat_quote_served_from_geocode_cache(self):
+        """POST /api/erp/transport/calculate-distance - Same address twice hits the geocode cache"""
+        location = {
+            "address": "Kothrud, Pune, Maharashtra 411038",
+            "landmark": ""
+        }
+
+        first = self.session.post(f"{BASE_URL}/api/erp/transport/calculate-distance", json=location)
+        assert first.status_code == 200, f"Expected 200, got {first.status_code}: {first.text}"
+
+        # Different casing/punctuation normalises to the same cache key
+        location["address"] = "kothrud,  PUNE, maharashtra 411038"
+        second = self.session.post(f"{BASE_URL}/api/erp/transport/calculate-distance", json=location)
+        assert second.status_code == 200
+
+        data = second.json()
+        assert data["geocode_source"] in ["memory", "cache"], f"Expected cache hit, got {data['geocode_source']}"
+        assert data["distance_km"] == first.json()["distance_km"]
+
+        print(f"✓ Repeat quote served from {data['geocode_source']} cache")
+
+    def test_distance_matrix_batch(self):
+        """POST /api/erp/transport/distance-matrix - Many origins x destinations in one call"""
+        origins = [{"lat": 18.5204 + i * 0.01, "lng": 73.8567} for i in range(20)]
+        destinations = [{"lat": 18.5204, "lng": 73.8567 + j * 0.01} for j in range(30)]
+        response = self.session.post(f"{BASE_URL}/api/erp/transport/distance-matrix", json={
+            "origins": origins, "destinations": destinations, "road": False
+        })
+        
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+        
+        data = response.json()
+        assert len(data["distances_km"]) == 20
+        assert len(data["distances_km"][0]) == 30
+        assert data["distances_km"][0][0] == 0
+        # 0.01° of latitude is ~1.11 km
+        assert abs(data["distances_km"][1][0] - 1.11) < 0.02
+        print("✓ 20 x 30 distance matrix returned")
+    
+    def test_calculate_distance_pincode_fallback(self):
+        """POST /api/erp/transport/calculate-distance - Unknown street with a known pincode uses the centroid"""
+        location = {
+            "address": "Plot 9999 Unmapped Lane Qwzx, 411045",
+            "landmark": ""
+        }
+
+        response = self.session.post(f"{BASE_URL}/api/erp/transport/calculate-distance", json=location)
+
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+        data = response.json()
+        assert data["distance_km"] < 50, "Pune pincode should resolve near the factory"
+
+        print(f"✓ Pincode fallback distance: {data['distance_km']}km (source: {data['geocode_source']})")
+
 
 class TestVehicleManagement:
     """Vehicle CRUD API Tests"""
@@ -472,6 +527,29 @@ class TestDispatchManagement:
         
         print(f"✓ Retrieved {data['count']} dispatches")
 
+    def test_route_plan_respects_vehicle_capacity(self):
+        """POST /api/erp/transport/route-plan - No route loads more than its vehicle holds"""
+        response = self.session.post(f"{BASE_URL}/api/erp/transport/route-plan", json={"time_limit_ms": 500})
+        
+        assert response.status_code == 200, f"Expected 200, got {response.status_code}: {response.text}"
+        
+        data = response.json()
+        for route in data["routes"]:
+            assert route["load_sqft"] <= route["capacity_sqft"]
+            assert [stop["sequence"] for stop in route["stops"]] == list(range(1, route["stop_count"] + 1))
+            # Manifest loads the last drop first
+            assert route["manifest"][0]["sequence"] == route["stop_count"]
+        
+        saved = self.session.get(f"{BASE_URL}/api/erp/transport/route-plans/{data['id']}")
+        assert saved.status_code == 200
+        print(f"✓ Route plan: {data['summary']}")
+
+    def test_route_plan_rejects_invalid_settings(self):
+        """POST /api/erp/transport/route-plan - Zero speed and unbounded limits are rejected"""
+        for settings in [{"avg_speed_kmph": 0}, {"max_stops": 0}, {"time_limit_ms": 600000}]:
+            response = self.session.post(f"{BASE_URL}/api/erp/transport/route-plan", json=settings)
+            assert response.status_code == 422, f"Expected 422 for {settings}, got {response.status_code}"
+
 
 # Cleanup test data
 class TestCleanup: